@@ -36,8 +36,9 @@ def send_notification(scope: str, event: str, recipient: str, context: Optional[
                             wire convention (``key@host`` for inline images,
                             otherwise the filename); values are either a
                             :class:`pathlib.Path` (local file, read by the
-                            client) or an ``http(s)://`` URL string (fetched
-                            by the server).
+                            client, and uploaded once to the server's attachment
+                            store if it has one) or an ``http(s)://`` URL string
+                            (fetched by the server).
 
     :return:                Whether delivery succeeded for at least one vector, and delivery details for all.
     """
@@ -49,7 +50,7 @@ def send_notification(scope: str, event: str, recipient: str, context: Optional[
         if '_attachments' in context:
             raise ValueError(
                 "Pass attachments via attachments= or context['_attachments'], not both")
-        context['_attachments'] = translate_attachments(attachments)
+        context['_attachments'] = translate_attachments(attachments, nsrv.ensure_attachment)
     corrid = correlationId or mk_correlation_id()
     log.info("Booking delivery %s@%s to #%s (m=%s,v=%s,p=%s,s=%s:%s,cid=%s)", event, scope, recipient, mode, vectors, priority, srv_addr, srv_port, correlationId)
     try:
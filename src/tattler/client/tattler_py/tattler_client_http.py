@@ -1,7 +1,7 @@
 """Implementation of tattler client using HTTP interface to connect to tattler server"""
 
 import json
-from urllib import request, parse
+from urllib import error, request, parse
 from typing import Mapping, Iterable, Optional
 
 from tattler.client.tattler_py.tattler_client import TattlerClient, log
@@ -55,6 +55,35 @@ class TattlerClientHTTP(TattlerClient):
             raise ValueError(f"All requested delivery targets failed: {failed}")
         log.info("Notif #%s successfully sent: %s", correlationId, res)
 
+    def ensure_attachment(self, digest: str, content: bytes) -> bool:
+        """Make the server hold an attachment in its store, uploading it only if missing there.
+
+        :param digest:      Lowercase hex SHA-256 digest of the content.
+        :param content:     Content of the attachment.
+
+        :return:            Whether the server holds the attachment, so that notifications can reference it by digest;
+                            False if the server has no attachment store or the upload failed.
+        """
+        url = f'http://{self.endpoint}/attachments/{digest}'
+        try:
+            with request.urlopen(request.Request(url, method='HEAD')):
+                return True
+        except error.HTTPError as err:
+            if err.code != 404:
+                log.debug("Server %s does not store attachments (HTTP %s). Embedding them in requests.", self.endpoint, err.code)
+                return False
+        except OSError as err:
+            log.warning("Error checking attachment %s on server %s: %s", digest, self.endpoint, err)
+            return False
+        req = request.Request(url, data=content, headers={'Content-Type': 'application/octet-stream'}, method='PUT')
+        try:
+            with request.urlopen(req):
+                log.debug("Uploaded attachment %s of %d bytes to server %s", digest, len(content), self.endpoint)
+                return True
+        except OSError as err:
+            log.warning("Error uploading attachment %s to server %s: %s. Embedding it in requests.", digest, self.endpoint, err)
+            return False
+
     def scopes(self):
         """Return list of vectors available events within this scope."""
         url = f'http://{self.endpoint}/notification/'
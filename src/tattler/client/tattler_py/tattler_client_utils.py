@@ -1,10 +1,11 @@
 """Utilities for tattler client"""
 
 import base64
+import hashlib
 import os
 import uuid
 from pathlib import Path
-from typing import Mapping, Optional, Tuple, Union
+from typing import Callable, Mapping, Optional, Tuple, Union
 
 DEFAULT_ADDRESS = '127.0.0.1'
 DEFAULT_PORT = 11503
@@ -23,19 +24,29 @@ def mk_correlation_id(prefix: Optional[str]='tattler') -> str:
         return f'{prefix}:{uuid.uuid4()}'
     return str(uuid.uuid4())
 
-def translate_attachments(spec: Mapping[str, Union[Path, str]]) -> Mapping[str, Mapping[str, str]]:
+def translate_attachments(spec: Mapping[str, Union[Path, str]], upload: Optional[Callable[[str, bytes], bool]]=None) -> Mapping[str, Mapping[str, str]]:
     """Translate user-supplied attachment values to the wire format.
 
     Each value must be one of:
 
-    * :class:`pathlib.Path` -- local file; read and base64-encoded by the client.
+    * :class:`pathlib.Path` -- local file; read and base64-encoded by the client,
+      or referenced by its SHA-256 digest if ``upload`` makes the server hold it.
     * :class:`str` starting with ``http://`` or ``https://`` -- forwarded to the
       server as a URL to fetch.
+
+    :param spec:    Attachments to translate.
+    :param upload:  Optional function taking the hex SHA-256 digest and content of a file, and returning
+                    whether the server holds it, e.g. :meth:`TattlerClientHTTP.ensure_attachment`.
     """
     out = {}
     for key, val in spec.items():
         if isinstance(val, Path):
-            out[key] = {'content_b64': base64.b64encode(val.read_bytes()).decode()}
+            content = val.read_bytes()
+            digest = hashlib.sha256(content).hexdigest()
+            if upload is not None and upload(digest, content):
+                out[key] = {'ref': digest}
+            else:
+                out[key] = {'content_b64': base64.b64encode(content).decode()}
         elif isinstance(val, str):
             if not val.startswith(('http://', 'https://')):
                 raise ValueError(
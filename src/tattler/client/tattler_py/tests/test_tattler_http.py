@@ -236,6 +236,31 @@ class TestTattlerClientHTTP(unittest.TestCase):
             with self.assertRaises(urllib.error.HTTPError):
                 n.vectors('test_event')
 
+    def test_ensure_attachment_uploads_on_miss(self):
+        """ensure_attachment() uploads attachments only if the server reports them missing"""
+        n = TattlerClientHTTP('test_scope', '127.0.0.1', self.port)
+        digest = 'ab' * 32
+        want_url = f'http://127.0.0.1:11503/attachments/{digest}'
+        with mock.patch('tattler.client.tattler_py.tattler_client_http.request.urlopen') as murlopen:
+            self.assertTrue(n.ensure_attachment(digest, b'data'))
+            self.assertEqual([('HEAD', want_url)], [(c.args[0].get_method(), c.args[0].full_url) for c in murlopen.call_args_list])
+            murlopen.reset_mock()
+            murlopen.side_effect = [urllib.error.HTTPError(want_url, 404, "Attachment not found", {}, None), mock.MagicMock()]
+            self.assertTrue(n.ensure_attachment(digest, b'data'))
+            self.assertEqual(['HEAD', 'PUT'], [c.args[0].get_method() for c in murlopen.call_args_list])
+            self.assertEqual(b'data', murlopen.call_args.args[0].data)
+
+    def test_ensure_attachment_unsupported(self):
+        """ensure_attachment() reports attachments not held if the server has no store or the upload fails"""
+        n = TattlerClientHTTP('test_scope', '127.0.0.1', self.port)
+        digest = 'ab' * 32
+        with mock.patch('tattler.client.tattler_py.tattler_client_http.request.urlopen') as murlopen:
+            murlopen.side_effect = urllib.error.HTTPError('url', 501, "Unsupported method", {}, None)
+            self.assertFalse(n.ensure_attachment(digest, b'data'))
+            self.assertEqual(1, murlopen.call_count)
+            murlopen.side_effect = [urllib.error.HTTPError('url', 404, "Attachment not found", {}, None), urllib.error.HTTPError('url', 413, "Too large", {}, None)]
+            self.assertFalse(n.ensure_attachment(digest, b'data'))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -103,6 +103,24 @@ class TattlerModuleTest(unittest.TestCase):
         finally:
             tmp.unlink()
 
+    def testtranslate_attachments_path_referenced_if_uploaded(self):
+        """A Path value is referenced by its digest if upload() makes the server hold it, embedded otherwise"""
+        import hashlib
+        import tempfile
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(b'hello bytes')
+            tmp = Path(f.name)
+        digest = hashlib.sha256(b'hello bytes').hexdigest()
+        try:
+            upload = mock.Mock(return_value=True)
+            self.assertEqual(translate_attachments({'a.bin': tmp}, upload), {'a.bin': {'ref': digest}})
+            upload.assert_called_once_with(digest, b'hello bytes')
+            upload.return_value = False
+            self.assertEqual(translate_attachments({'a.bin': tmp}, upload), {'a.bin': {
+                'content_b64': base64.b64encode(b'hello bytes').decode()}})
+        finally:
+            tmp.unlink()
+
     def testtranslate_attachments_url_str_forwarded(self):
         """An http(s):// string value is forwarded as a URL entry"""
         for url in ('http://x/a', 'https://y/b'):
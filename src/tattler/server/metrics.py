@@ -0,0 +1,109 @@
+"""In-process registry of operational metrics (counters, gauges and timings) for tattler server."""
+
+import threading
+from dataclasses import dataclass, replace
+from typing import Mapping, Any, Optional
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timings = {}
+
+
+@dataclass
+class TimingStats:
+    """Aggregate of the durations observed for one metric."""
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+    last: float = 0.0
+
+    def add(self, value: float) -> None:
+        """Account for one more observation."""
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.last = value
+
+    def as_dict(self) -> Mapping[str, float]:
+        """Return a serializable representation of the stats."""
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'last': self.last,
+        }
+
+
+def metric_key(name: str, labels: Mapping[str, Any]) -> str:
+    """Return the unique key of a metric and its labels, e.g. ``render_seconds{template=a/b}``."""
+    if not labels:
+        return name
+    labelstr = ','.join(f"{k}={v}" for k, v in sorted(labels.items()))
+    return f"{name}{{{labelstr}}}"
+
+def incr(name: str, value: int=1, **labels) -> None:
+    """Increase a counter by a value.
+
+    :param name:        Name of the counter, e.g. ``render_cache_hits``.
+    :param value:       Amount to increase the counter by.
+    :param labels:      Optional labels qualifying the counter, e.g. ``vector='email'``.
+    """
+    key = metric_key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    """Set a gauge to its current value.
+
+    :param name:        Name of the gauge, e.g. ``smtp_concurrency_limit``.
+    :param value:       Current value of the gauge.
+    :param labels:      Optional labels qualifying the gauge.
+    """
+    with _lock:
+        _gauges[metric_key(name, labels)] = value
+
+def observe(name: str, value: float, **labels) -> None:
+    """Record one observation of a duration (or other distribution).
+
+    :param name:        Name of the timing, e.g. ``template_render_seconds``.
+    :param value:       Value observed, e.g. duration in seconds.
+    :param labels:      Optional labels qualifying the timing, e.g. ``template='scope/event/email/body.html'``.
+    """
+    key = metric_key(name, labels)
+    with _lock:
+        if key not in _timings:
+            _timings[key] = TimingStats()
+        _timings[key].add(value)
+
+def get_timing(name: str, **labels) -> Optional[TimingStats]:
+    """Return the stats of a timing so far, or None if never observed.
+
+    :param name:        Name of the timing.
+    :param labels:      Labels qualifying the timing.
+
+    :return:            A copy of the stats of the timing, or None.
+    """
+    with _lock:
+        stats = _timings.get(metric_key(name, labels))
+        return replace(stats) if stats is not None else None
+
+def snapshot() -> Mapping[str, Mapping[str, Any]]:
+    """Return a copy of all metrics collected so far.
+
+    :return:        Dictionary ``{'counters': {...}, 'gauges': {...}, 'timings': {...}}`` mapping metric keys to values.
+    """
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timings': {k: v.as_dict() for k, v in _timings.items()},
+        }
+
+def reset() -> None:
+    """Discard all metrics collected so far."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
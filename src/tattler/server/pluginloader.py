@@ -7,7 +7,7 @@ import logging
 from datetime import datetime
 import os
 import inspect
-from typing import Mapping, Any, Iterable, Optional
+from typing import Mapping, Any, Iterable, Optional, AbstractSet
 
 ContextType = Mapping[str, Any]
 
@@ -41,6 +41,10 @@ class ContextPlugin(TattlerPlugin):
     This enables resource-intensive plug-ins to only "fire" when necessary, e.g. based on
     the event being notified, the recipient, or more.
 
+    Alternatively, a Context plug-in may declare the context variables it provides in
+    :attr:`provided_variables`. Tattler analyzes the templates of each event and vector to find
+    the variables they use, and skips plug-ins which provide none of them.
+
     If multiple context plug-ins are provided, tattler "pipelines" them, i.e. it passes the
     its native context to the first, and the resulting context to each subsequent context plug-in.
        
@@ -55,6 +59,15 @@ class ContextPlugin(TattlerPlugin):
 
     plugin_category = 'context'
 
+    provided_variables: Optional[AbstractSet[str]] = None
+    """Names of the context variables which this plug-in adds or changes, or None (default) if undeclared.
+
+    If declared, tattler skips this plug-in for notifications whose templates read none of these variables.
+    Only declare this if no other plug-in depends on the variables this plug-in provides.
+
+    .. versionadded:: 3.4.0
+    """
+
     def processing_required(self, context: ContextType) -> bool:
         """Return whether this plugin should be called, based on the context.
 
@@ -160,6 +173,14 @@ class AddressbookPlugin(TattlerPlugin):
         :return:                Telegram chat id to deliver to, or None if unknown."""
         return None
 
+    def webhook(self, recipient_id: str, role: Optional[str]=None) -> Optional[str]:
+        """Return the webhook to notify for the recipient, if any.
+
+        :param recipient_id:    Unique identifier for the intended recipient, e.g. user ID from IAM system.
+        :param role:            Intended role within the account to get address for, e.g. 'billing' or 'technical'.
+        :return:                Name of a webhook configured in the scope's ``_webhooks.json``, or its URL; or None if unknown."""
+        return None
+
     def account_type(self, recipient_id: str, role: Optional[str]=None) -> Optional[str]:
         """Return the type of account that the user is on, if known and relevant.
 
@@ -210,6 +231,7 @@ class AddressbookPlugin(TattlerPlugin):
             'email': self.email(recipient_id, role),
             'mobile': self.mobile(recipient_id, role),
             'telegram': self.telegram(recipient_id, role),
+            'webhook': self.webhook(recipient_id, role),
             'account_type': self.account_type(recipient_id, role),
             'first_name': self.first_name(recipient_id, role),
             'language': self.language(recipient_id, role),
@@ -333,11 +355,22 @@ def init(paths: Iterable[str]) -> None:
     global loaded_plugins
     loaded_plugins = load_plugins_from_modules(paths)
 
-def process_context(context: ContextType) -> ContextType:
-    """Process the context through pipelines of all plugins loaded, and return resulting context."""
+def process_context(context: ContextType, used_variables: Optional[AbstractSet[str]]=None) -> ContextType:
+    """Process the context through pipelines of all plugins loaded, and return resulting context.
+
+    :param context:         Native context to feed to the first plugin.
+    :param used_variables:  Names of the variables which the templates to expand read, or None if unknown. Plugins whose
+                            declared :attr:`ContextPlugin.provided_variables` are all outside of this set are skipped.
+
+    :return:                Context resulting from the last plugin in the pipeline.
+    """
     context_plugins = loaded_plugins.get('context', {})
     for i, (pname, proc) in enumerate(context_plugins.items()):
         log.info("Processing context through context plugin #%d '%s'", i, pname)
+        provided_variables = getattr(proc, 'provided_variables', None)
+        if used_variables is not None and provided_variables is not None and not set(provided_variables) & set(used_variables):
+            log.info("Skipping plugin %s as the templates use none of the variables it provides %s", pname, sorted(provided_variables))
+            continue
         try:
             preq = proc.processing_required(context)
         except:
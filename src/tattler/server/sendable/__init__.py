@@ -8,11 +8,13 @@ from .blacklist import Blacklist
 from tattler.server.sendable.vector_sendable import Sendable
 from tattler.server.sendable.vector_sms import SMSSendable
 from tattler.server.sendable.vector_email import EmailSendable
+from tattler.server.sendable.vector_webhook import WebhookSendable
 
 # map vector names to their associated Sendable class
 vector_sendables = {
         'sms':      SMSSendable,
         'email':    EmailSendable,
+        'webhook':  WebhookSendable,
         }
 
 modes = {'debug', 'staging', 'production'}
@@ -58,8 +60,8 @@ def make_notification(vector: str, event: str, recipient_list: Iterable[str], te
         kwargs['language_code'] = language_code
     return vector_class(event, recipient_list, **kwargs)
 
-def send_notification(vector: str, event: str, recipient_list: Iterable[str], context: Optional[Mapping[str, Any]]=None, template_processor: Optional[type[TemplateProcessor]]=None, template_base: Optional[str]=None, priority: Optional[int]=None, mode: Optional[str]=None, blacklist: Optional[str]=None, language_code: Optional[str]=None) -> None:
-    """Send a notification to a recipient list."""
+def send_notification(vector: str, event: str, recipient_list: Iterable[str], context: Optional[Mapping[str, Any]]=None, template_processor: Optional[type[TemplateProcessor]]=None, template_base: Optional[str]=None, priority: Optional[int]=None, mode: Optional[str]=None, blacklist: Optional[str]=None, language_code: Optional[str]=None) -> Sendable:
+    """Send a notification to a recipient list, and return it, e.g. to look up its pending recipients."""
     ntf = make_notification(vector, event, recipient_list, template_processor=template_processor, template_base=template_base, language_code=language_code)
     kwargs = {}
     if priority is not None:
@@ -72,3 +74,4 @@ def send_notification(vector: str, event: str, recipient_list: Iterable[str], co
         except OSError as e:
             log.warning("Error loading requested blacklist file '%s' -- I'll ignore it: %s", blacklist, e)
     ntf.send(context=context, **kwargs)
+    return ntf
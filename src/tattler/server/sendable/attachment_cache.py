@@ -0,0 +1,268 @@
+"""Disk cache of attachments fetched from URLs, to spare downloading unchanged files for every notification.
+
+Contents are stored once per digest, as ``blobs/<sha256>`` in the cache directory, so URLs serving identical
+files share storage. Each cached URL is described in ``urls/<sha256 of URL>.json`` with the digest of its
+content and the validators its server gave -- ``ETag`` and ``Last-Modified`` -- which the fetcher sends back
+in conditional requests to revalidate stale entries. Entries are fresh, and served without contacting the
+server, for the ``max-age`` given by the server's ``Cache-Control``, or a default otherwise.
+
+The cache is bounded in total size, evicting least recently used URLs first, and survives restarts.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# cache up to this many bytes of attachments fetched from URLs
+_default_cache_size = 256 * 1024 * 1024
+
+
+@dataclass
+class CachedURL:
+    """What is known about the content cached for a URL."""
+    url: str
+    digest: str
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # time after which the content must be revalidated with the server before use, as from time.time()
+    expires: float = 0
+
+    def is_fresh(self, now: Optional[float]=None) -> bool:
+        """Return whether the content can be used without revalidating it."""
+        return (now or time.time()) < self.expires
+
+    def conditional_headers(self) -> Dict[str, str]:
+        """Return the headers to request the URL only if its content changed."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+def parse_cache_control(value: Optional[str], default_max_age_s: float) -> Optional[float]:
+    """Return for how many seconds a response may be used without revalidation, or None if it must not be stored.
+
+    :param value:               Value of the response's Cache-Control header, if any.
+    :param default_max_age_s:   Seconds to return if the header gives no max-age.
+    """
+    max_age = default_max_age_s
+    for directive in (value or '').lower().split(','):
+        name, _, arg = directive.strip().partition('=')
+        if name in ('no-store', 'private'):
+            return None
+        if name == 'no-cache':
+            return 0
+        if name == 'max-age':
+            try:
+                max_age = max(0, int(arg.strip('"')))
+            except ValueError:
+                pass
+    return max_age
+
+
+class AttachmentCache:
+    """Size-bounded LRU cache of the contents of URLs, on disk."""
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int, max_age_s: float=0) -> None:
+        """Construct a cache in a directory, created if missing, loading the entries it holds already.
+
+        :param directory:   Directory to hold cached contents.
+        :param max_bytes:   Maximum total size of the contents to hold, beyond which least recently used URLs are evicted.
+        :param max_age_s:   Seconds to use contents without revalidation when their server gives no ``Cache-Control: max-age``.
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[str, CachedURL]' = OrderedDict()
+        # number of URLs sharing each blob
+        self._blob_refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        (self.directory / 'blobs').mkdir(parents=True, exist_ok=True)
+        (self.directory / 'urls').mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.directory / 'blobs' / digest
+
+    def _meta_path(self, url: str) -> Path:
+        return self.directory / 'urls' / f"{hashlib.sha256(url.encode('utf-8')).hexdigest()}.json"
+
+    def _write(self, path: Path, data: bytes) -> None:
+        """Write a file atomically, so that concurrent readers and crashes never see it partially written."""
+        fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmpf:
+                tmpf.write(data)
+            os.replace(tmpname, path)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def _load(self) -> None:
+        """Load the entries found in the directory, least recently used first."""
+        metas = sorted((self.directory / 'urls').glob('*.json'), key=lambda p: p.stat().st_mtime)
+        for path in metas:
+            try:
+                entry = CachedURL(**json.loads(path.read_text(encoding='utf-8')))
+                if self._blob_path(entry.digest).stat().st_size != entry.size:
+                    raise ValueError("size of content differs")
+            except (OSError, ValueError, TypeError) as err:
+                log.warning("Discarding invalid attachment cache entry %s: %s", path, err)
+                path.unlink(missing_ok=True)
+                continue
+            self._add(entry)
+        self._evict()
+        log.info("Loaded %d attachments totalling %d bytes from cache %s", len(self._entries), self.size, self.directory)
+
+    def _add(self, entry: CachedURL) -> None:
+        if not self._blob_refs.get(entry.digest):
+            self.size += entry.size
+        self._blob_refs[entry.digest] = self._blob_refs.get(entry.digest, 0) + 1
+        # reference the new blob before releasing the old one, which may be the same
+        old = self._entries.pop(entry.url, None)
+        if old is not None:
+            self._release_blob(old)
+        self._entries[entry.url] = entry
+
+    def _release_blob(self, entry: CachedURL) -> None:
+        """Drop a reference to the blob of an entry, deleting the blob once unreferenced."""
+        refs = self._blob_refs.get(entry.digest, 0) - 1
+        if refs > 0:
+            self._blob_refs[entry.digest] = refs
+            return
+        self._blob_refs.pop(entry.digest, None)
+        self.size -= entry.size
+        self._blob_path(entry.digest).unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._release_blob(evicted)
+            self._meta_path(evicted.url).unlink(missing_ok=True)
+            log.debug("Evicted attachment %s from cache", evicted.url)
+        metrics.set_gauge('attachment_cache_size', self.size)
+
+    def lookup(self, url: str) -> Optional[CachedURL]:
+        """Return what is cached for a URL, or None if nothing is."""
+        with self._lock:
+            return self._entries.get(url)
+
+    def read(self, entry: CachedURL) -> Optional[bytes]:
+        """Return the content of an entry, counting it as a cache hit; or None if it went missing meanwhile."""
+        try:
+            content = self._blob_path(entry.digest).read_bytes()
+        except OSError:
+            content = None
+        with self._lock:
+            if content is None or len(content) != entry.size:
+                log.warning("Content of %s vanished from attachment cache. Fetching it again.", entry.url)
+                if self._entries.get(entry.url) is entry:
+                    del self._entries[entry.url]
+                    self._release_blob(entry)
+                return None
+            if entry.url in self._entries:
+                self._entries.move_to_end(entry.url)
+            self.hits += 1
+        metrics.incr('attachment_cache_hits')
+        try:
+            # keep the order of use across restarts
+            os.utime(self._meta_path(entry.url))
+        except OSError:
+            pass
+        return content
+
+    def miss(self) -> None:
+        """Count that a URL had to be downloaded."""
+        with self._lock:
+            self.misses += 1
+        metrics.incr('attachment_cache_misses')
+
+    def refresh(self, entry: CachedURL, max_age_s: float) -> CachedURL:
+        """Mark an entry as fresh for some more seconds, after its server confirmed it unchanged."""
+        entry.expires = time.time() + max_age_s
+        self._write(self._meta_path(entry.url), json.dumps(asdict(entry)).encode())
+        metrics.incr('attachment_cache_revalidations')
+        return entry
+
+    def store(self, url: str, content: bytes, etag: Optional[str], last_modified: Optional[str], max_age_s: float) -> Optional[CachedURL]:
+        """Cache the content of a URL, and return its entry; or None if it cannot be revalidated nor is fresh, or is too large.
+
+        :param url:             URL fetched.
+        :param content:         Body of the response.
+        :param etag:            Value of the response's ETag header, if any.
+        :param last_modified:   Value of the response's Last-Modified header, if any.
+        :param max_age_s:       Seconds to use the content without revalidation.
+        """
+        if len(content) > self.max_bytes or not (etag or last_modified or max_age_s > 0):
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        entry = CachedURL(url, digest, len(content), etag, last_modified, time.time() + max_age_s)
+        blob = self._blob_path(digest)
+        if not blob.exists():
+            self._write(blob, content)
+        self._write(self._meta_path(url), json.dumps(asdict(entry)).encode())
+        with self._lock:
+            self._add(entry)
+            self._evict()
+        return entry
+
+    def clear(self) -> None:
+        """Remove all entries, and their contents from disk."""
+        with self._lock:
+            for entry in self._entries.values():
+                self._meta_path(entry.url).unlink(missing_ok=True)
+                self._blob_path(entry.digest).unlink(missing_ok=True)
+            self._entries.clear()
+            self._blob_refs.clear()
+            self.size = 0
+
+
+_cache: Optional[AttachmentCache] = None
+_cache_lock = threading.Lock()
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+def get_cache() -> Optional[AttachmentCache]:
+    """Return the process-wide cache of attachments fetched from URLs, or None if disabled.
+
+    The cache is enabled by setting TATTLER_ATTACHMENT_CACHE to the directory to hold it, up to TATTLER_ATTACHMENT_CACHE_SIZE
+    bytes. Contents are used without revalidation for TATTLER_ATTACHMENT_CACHE_MAX_AGE seconds, unless their server says otherwise."""
+    global _cache
+    directory = getenv('TATTLER_ATTACHMENT_CACHE')
+    try:
+        max_bytes = int(getenv('TATTLER_ATTACHMENT_CACHE_SIZE', _default_cache_size))
+        max_age_s = float(getenv('TATTLER_ATTACHMENT_CACHE_MAX_AGE', 0))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_ATTACHMENT_CACHE_SIZE='%s' or TATTLER_ATTACHMENT_CACHE_MAX_AGE='%s'. Set them to a number of bytes and seconds. Falling back to defaults.", getenv('TATTLER_ATTACHMENT_CACHE_SIZE'), getenv('TATTLER_ATTACHMENT_CACHE_MAX_AGE'))
+        max_bytes, max_age_s = _default_cache_size, 0
+    with _cache_lock:
+        if not directory:
+            _cache = None
+        elif _cache is None or str(_cache.directory) != directory or _cache.max_bytes != max_bytes:
+            _cache = AttachmentCache(directory, max_bytes, max_age_s)
+        else:
+            _cache.max_age_s = max_age_s
+        return _cache
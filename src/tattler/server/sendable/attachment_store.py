@@ -0,0 +1,187 @@
+"""Store of attachments uploaded by clients once, and referenced by their digest in notifications afterwards.
+
+Clients attaching the same file to many notifications upload it with ``PUT /attachments/<sha256>``, then
+reference it as ``{"ref": "<sha256>"}`` instead of embedding it base64-encoded in every request. Files are
+kept as ``<sha256>`` in the store's directory, and expire when unused for a given time. The store is bounded
+in total size, evicting least recently used files first, and survives restarts.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# keep up to this many bytes of attachments uploaded by clients, each until unused for this many seconds
+_default_store_size = 256 * 1024 * 1024
+_default_store_ttl_s = 24 * 3600
+
+digest_re = re.compile(r'[0-9a-f]{64}')
+
+
+class AttachmentStore:
+    """Size-bounded store of files on disk, addressed by the SHA-256 digest of their content."""
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int, ttl_s: float) -> None:
+        """Construct a store in a directory, created if missing, loading the files it holds already.
+
+        :param directory:   Directory to hold files.
+        :param max_bytes:   Maximum total size of the files to hold, beyond which least recently used ones are evicted.
+        :param ttl_s:       Discard files unused for this many seconds.
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.size = 0
+        # digest -> (size, time last used as from time.time()), least recently used first
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, digest: str) -> bool:
+        with self._lock:
+            return self._live(digest)
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest
+
+    def _load(self) -> None:
+        found = []
+        for path in self.directory.iterdir():
+            if digest_re.fullmatch(path.name):
+                stat = path.stat()
+                found.append((stat.st_mtime, path.name, stat.st_size))
+        with self._lock:
+            for used, digest, size in sorted(found):
+                self._entries[digest] = (size, used)
+                self.size += size
+            self._evict()
+        log.info("Loaded %d attachments totalling %d bytes from store %s", len(self._entries), self.size, self.directory)
+
+    def _drop(self, digest: str) -> None:
+        size, _ = self._entries.pop(digest)
+        self.size -= size
+        self._path(digest).unlink(missing_ok=True)
+
+    def _live(self, digest: str) -> bool:
+        """Return whether a file is held and unexpired, discarding it if expired."""
+        entry = self._entries.get(digest)
+        if entry is None:
+            return False
+        if time.time() - entry[1] > self.ttl_s:
+            log.debug("Attachment %s expired from store", digest)
+            self._drop(digest)
+            return False
+        return True
+
+    def _evict(self) -> None:
+        now = time.time()
+        while self._entries:
+            digest, (_, used) = next(iter(self._entries.items()))
+            if self.size <= self.max_bytes and now - used <= self.ttl_s:
+                break
+            self._drop(digest)
+        metrics.set_gauge('attachment_store_size', self.size)
+
+    def put(self, digest: str, content: bytes) -> bool:
+        """Store a file under its digest, and return whether it was missing before.
+
+        :param digest:      Hex SHA-256 digest the client claims for the content.
+        :param content:     Content of the file.
+
+        :raise ValueError:  The digest is malformed, does not match the content, or the content is too large.
+        """
+        if not digest_re.fullmatch(digest):
+            raise ValueError(f"Invalid attachment digest '{digest}'. Want the lowercase hex SHA-256 of the content.")
+        if hashlib.sha256(content).hexdigest() != digest:
+            raise ValueError(f"Content does not match digest {digest}.")
+        if len(content) > self.max_bytes:
+            raise ValueError(f"Attachment of {len(content)} bytes exceeds the size of the store, {self.max_bytes} bytes.")
+        with self._lock:
+            if self._live(digest):
+                self._entries[digest] = (len(content), time.time())
+                self._entries.move_to_end(digest)
+                os.utime(self._path(digest))
+                return False
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmpf:
+                tmpf.write(content)
+            os.replace(tmpname, self._path(digest))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        with self._lock:
+            if digest in self._entries:
+                self.size -= self._entries.pop(digest)[0]
+            self._entries[digest] = (len(content), time.time())
+            self.size += len(content)
+            self._evict()
+        metrics.incr('attachment_store_uploads')
+        log.info("Stored attachment %s of %d bytes", digest, len(content))
+        return True
+
+    def get(self, digest: str) -> Optional[bytes]:
+        """Return the content of a file, or None if not held."""
+        with self._lock:
+            if not self._live(digest):
+                metrics.incr('attachment_store_misses')
+                return None
+            self._entries[digest] = (self._entries[digest][0], time.time())
+            self._entries.move_to_end(digest)
+        try:
+            content = self._path(digest).read_bytes()
+            # keep the order of use across restarts
+            os.utime(self._path(digest))
+        except OSError as err:
+            log.warning("Attachment %s vanished from store: %s", digest, err)
+            with self._lock:
+                if digest in self._entries:
+                    self._drop(digest)
+            metrics.incr('attachment_store_misses')
+            return None
+        metrics.incr('attachment_store_hits')
+        return content
+
+
+_store: Optional[AttachmentStore] = None
+_store_lock = threading.Lock()
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+def get_store() -> Optional[AttachmentStore]:
+    """Return the process-wide store of attachments uploaded by clients, or None if disabled.
+
+    The store is enabled by setting TATTLER_ATTACHMENT_STORE to the directory to hold it, up to TATTLER_ATTACHMENT_STORE_SIZE
+    bytes. Attachments are discarded when unused for TATTLER_ATTACHMENT_STORE_TTL seconds."""
+    global _store
+    directory = getenv('TATTLER_ATTACHMENT_STORE')
+    try:
+        max_bytes = int(getenv('TATTLER_ATTACHMENT_STORE_SIZE', _default_store_size))
+        ttl_s = float(getenv('TATTLER_ATTACHMENT_STORE_TTL', _default_store_ttl_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_ATTACHMENT_STORE_SIZE='%s' or TATTLER_ATTACHMENT_STORE_TTL='%s'. Set them to a number of bytes and seconds. Falling back to defaults.", getenv('TATTLER_ATTACHMENT_STORE_SIZE'), getenv('TATTLER_ATTACHMENT_STORE_TTL'))
+        max_bytes, ttl_s = _default_store_size, _default_store_ttl_s
+    with _store_lock:
+        if not directory:
+            _store = None
+        elif _store is None or str(_store.directory) != directory:
+            _store = AttachmentStore(directory, max_bytes, ttl_s)
+        else:
+            _store.max_bytes, _store.ttl_s = max_bytes, ttl_s
+        return _store
@@ -16,18 +16,27 @@ without ``@`` is the filename of a regular attachment, and the key drives
 content type via :func:`mimetypes.guess_type`.
 
 Plugins use the same shape with ``content_bytes`` (raw ``bytes``) instead of
-``content_b64``.
+``content_b64``. Files uploaded to the server's attachment store beforehand are
+given as ``{"ref": "<sha256>"}``.
 """
 
 import base64
 import binascii
+import concurrent.futures
 import http.client
 import logging
 import mimetypes
+import socket
+import threading
+import time
 from dataclasses import dataclass
-from typing import Mapping, Optional, Tuple
+from typing import Dict, List, Mapping, Optional, Tuple
 from urllib.parse import urljoin, urlparse
 
+from tattler.server.sendable import http_pool
+from tattler.server.sendable.attachment_cache import AttachmentCache, parse_cache_control
+from tattler.server.sendable.attachment_store import AttachmentStore
+
 log = logging.getLogger(__name__)
 
 # Defaults chosen for SMTP relays with ~10 MB caps; ~7 MB raw -> ~9.5 MB after base64.
@@ -36,6 +45,18 @@ CONNECT_TIMEOUT_S = 3
 READ_TIMEOUT_S = 20
 MAX_REDIRECTS = 5
 CHUNK_SIZE = 64 * 1024
+# URLs of one email fetched at once, and idle connections kept open to each host across emails
+MAX_CONCURRENT_FETCHES = 8
+MAX_IDLE_PER_HOST = 4
+# reuse resolved addresses of hosts for this long
+DNS_TTL_S = 60
+
+_dns_cache: Dict[Tuple[str, int], Tuple[float, list]] = {}
+_dns_lock = threading.Lock()
+_pools: Dict[Tuple[str, str], '_FetchPool'] = {}
+_pools_lock = threading.Lock()
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
 
 
 @dataclass
@@ -48,12 +69,127 @@ class Attachment:
     cid: Optional[str] = None
 
 
-def _fetch_url(url: str, max_bytes: int) -> bytes:
+class _Budget:
+    """Bytes which concurrent fetches of one email's attachments may still download, altogether."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def take(self, num_bytes: int) -> bool:
+        """Account for bytes downloaded, and return whether the total still fits the budget."""
+        with self._lock:
+            self.used += num_bytes
+            return self.used <= self.max_bytes
+
+
+def _resolve(host: str, port: int) -> list:
+    """Return the addresses of a host as :func:`socket.getaddrinfo`, cached for DNS_TTL_S seconds."""
+    now = time.monotonic()
+    with _dns_lock:
+        cached = _dns_cache.get((host, port))
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    with _dns_lock:
+        _dns_cache[(host, port)] = (now + DNS_TTL_S, infos)
+    return infos
+
+
+def _create_connection(address: Tuple[str, int], timeout: Optional[float]=None, source_address=None) -> socket.socket:
+    """Connect like :func:`socket.create_connection`, resolving the host through the DNS cache."""
+    host, port = address
+    last_err: Optional[OSError] = None
+    for family, socktype, proto, _, sockaddr in _resolve(host, port):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as err:
+            sock.close()
+            last_err = err
+    # the host may have moved; resolve it anew next time
+    with _dns_lock:
+        _dns_cache.pop((host, port), None)
+    raise last_err or OSError(f"No address found for {host}")
+
+
+class _FetchPool(http_pool.HTTPConnectionPool):
+    """Persistent connections to one host serving attachments, opened through the DNS cache."""
+
+    def _connect(self) -> http.client.HTTPConnection:
+        conn = super()._connect()
+        conn._create_connection = _create_connection
+        return conn
+
+
+def _get_pool(scheme: str, netloc: str) -> _FetchPool:
+    """Return the process-wide pool of connections to a host, creating it if needed."""
+    with _pools_lock:
+        pool = _pools.get((scheme, netloc))
+        if pool is None:
+            pool = _FetchPool(f'{scheme}://{netloc}', CONNECT_TIMEOUT_S, MAX_IDLE_PER_HOST, name='attachments')
+            _pools[(scheme, netloc)] = pool
+        return pool
+
+
+def _get(pool: _FetchPool, path: str, headers: Mapping[str, str]) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+    """Send a GET request on a pooled connection, and return the connection with the response pending on it.
+
+    Requests failing because a reused connection was closed by the server are retried once on a new connection.
+    """
+    conn, reused = pool.acquire()
+    while True:
+        try:
+            if conn.sock is None:
+                conn.connect()
+                # swap to per-recv read timeout; a steady stream never trips, a stalled one does
+                conn.sock.settimeout(READ_TIMEOUT_S)
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except Exception as err:
+            conn.close()
+            if not (reused and isinstance(err, http_pool.stale_connection_errors)):
+                raise
+            log.debug("Reused connection to %s was closed (%s). Retrying on a new connection.", pool.host, type(err).__name__)
+            conn, reused = pool._connect(), False
+
+
+def _account(url: str, content: bytes, max_bytes: int, budget: Optional[_Budget]) -> bytes:
+    """Return content served from cache after checking it against the limits of downloads."""
+    if len(content) > max_bytes:
+        raise ValueError(f"Attachment from {url} exceeded {max_bytes} bytes")
+    if budget is not None and not budget.take(len(content)):
+        raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
+    return content
+
+
+def _fetch_url(url: str, max_bytes: int, budget: Optional[_Budget]=None, cache: Optional[AttachmentCache]=None) -> bytes:
     """Fetch an HTTP(S) URL and return the response body as bytes.
 
     Streams the response with a per-chunk read timeout and aborts as soon as
-    the running total exceeds max_bytes. Follows up to MAX_REDIRECTS hops.
+    the running total exceeds max_bytes, or the budget shared with the other
+    attachments being fetched runs out. Follows up to MAX_REDIRECTS hops.
+    Connections are kept open and reused across URLs and hops to the same host.
+
+    With a cache, fresh content is served from it without contacting the server,
+    and stale content is revalidated with a conditional request. Content served
+    from cache counts against max_bytes and the budget like downloaded content.
     """
+    cached = cache.lookup(url) if cache is not None else None
+    if cached is not None and cached.is_fresh():
+        content = cache.read(cached)
+        if content is not None:
+            return _account(url, content, max_bytes, budget)
+        cached = None
+    headers = {"User-Agent": "tattler"}
+    if cached is not None:
+        headers.update(cached.conditional_headers())
+
     visited = 0
     current = url
     while True:
@@ -66,41 +202,55 @@ def _fetch_url(url: str, max_bytes: int) -> bytes:
         if not parsed.hostname:
             raise ValueError(f"URL missing host: {current}")
 
-        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
         path = parsed.path or '/'
         if parsed.query:
             path = f"{path}?{parsed.query}"
 
-        ConnCls = http.client.HTTPSConnection if parsed.scheme == 'https' else http.client.HTTPConnection
-        conn = ConnCls(parsed.hostname, port, timeout=CONNECT_TIMEOUT_S)
-
+        pool = _get_pool(parsed.scheme, parsed.netloc)
+        conn, resp = _get(pool, path, {"Host": parsed.netloc, **headers})
+        buf = None
         try:
-            conn.connect()
-            # swap to per-recv read timeout; a steady stream never trips, a stalled one does
-            conn.sock.settimeout(READ_TIMEOUT_S)
-            conn.request("GET", path, headers={"Host": parsed.netloc, "User-Agent": "tattler"})
-            resp = conn.getresponse()
-
             if 300 <= resp.status < 400 and resp.getheader("Location"):
                 visited += 1
                 current = urljoin(current, resp.getheader("Location"))
-                resp.read()  # drain so the connection can close cleanly
-                continue
-
-            if resp.status != 200:
+                resp.read()  # drain so the connection can be reused
+            elif resp.status == 304 and cached is not None:
+                resp.read()
+            elif resp.status != 200:
                 raise ValueError(f"Fetch of {url} returned HTTP {resp.status}")
-
-            buf = bytearray()
-            while True:
-                chunk = resp.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                buf.extend(chunk)
-                if len(buf) > max_bytes:
-                    raise ValueError(f"Attachment from {url} exceeded {max_bytes} bytes")
-            return bytes(buf)
-        finally:
+            else:
+                buf = bytearray()
+                while True:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    buf.extend(chunk)
+                    if len(buf) > max_bytes:
+                        raise ValueError(f"Attachment from {url} exceeded {max_bytes} bytes")
+                    if budget is not None and not budget.take(len(chunk)):
+                        raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
             conn.close()
+        else:
+            pool.release(conn)
+        if resp.status == 304 and cached is not None:
+            content = cache.read(cached)
+            if content is None:
+                # evicted meanwhile; download it anew
+                return _fetch_url(url, max_bytes, budget, cache)
+            cache.refresh(cached, parse_cache_control(resp.getheader("Cache-Control"), cache.max_age_s) or 0)
+            return _account(url, content, max_bytes, budget)
+        if buf is not None:
+            content = bytes(buf)
+            if cache is not None:
+                cache.miss()
+                max_age = parse_cache_control(resp.getheader("Cache-Control"), cache.max_age_s)
+                if max_age is not None:
+                    cache.store(url, content, resp.getheader("ETag"), resp.getheader("Last-Modified"), max_age)
+            return content
 
 
 def _validate_filename(filename, label: str) -> None:
@@ -139,7 +289,39 @@ def _sniff_image(data: bytes) -> Optional[Tuple[str, str, str]]:
     return None
 
 
-def normalize_attachments(raw: Optional[Mapping]) -> list:
+def _fetch_all(pending: List[list], max_bytes: int, cache: Optional[AttachmentCache]=None) -> None:
+    """Fetch the contents of all URL entries in place, concurrently, within max_bytes altogether.
+
+    :param pending:     List of ``[key, label, content, url]``, with content None for entries to fetch.
+    :param max_bytes:   Maximum number of bytes to fetch for all entries together.
+    :param cache:       Cache to serve and store contents of URLs with, if any.
+    """
+    to_fetch = [item for item in pending if item[2] is None]
+    if not to_fetch:
+        return
+    if max_bytes <= 0:
+        raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
+    budget = _Budget(max_bytes)
+    if len(to_fetch) == 1:
+        to_fetch[0][2] = _fetch_url(to_fetch[0][3], max_bytes, budget, cache)
+        return
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_FETCHES, thread_name_prefix='tattler-attachments')
+    futures = [_executor.submit(_fetch_url, item[3], max_bytes, budget, cache) for item in to_fetch]
+    errors = []
+    for item, future in zip(to_fetch, futures):
+        try:
+            item[2] = future.result()
+        except Exception as err:
+            errors.append(err)
+    if errors:
+        # report the failure of the first entry, in the order given
+        raise errors[0]
+
+
+def normalize_attachments(raw: Optional[Mapping], cache: Optional[AttachmentCache]=None, store: Optional[AttachmentStore]=None) -> list:
     """Validate, fetch, and normalize an attachment dict.
 
     Each (key, entry) pair becomes one Attachment:
@@ -149,8 +331,10 @@ def normalize_attachments(raw: Optional[Mapping]) -> list:
     * key has no ``@``  -> regular attachment: key IS the filename and drives
       content type.
 
-    The entry must specify exactly one of ``url``, ``content_b64``, or
-    ``content_bytes`` for the payload. Raises ValueError on any invalid entry.
+    The entry must specify exactly one of ``url``, ``content_b64``,
+    ``content_bytes``, or ``ref`` for the payload. Raises ValueError on any invalid entry.
+    Contents of ``url`` entries are served from ``cache`` where possible, and
+    those of ``ref`` entries from ``store``.
     """
     if not raw:
         return []
@@ -158,7 +342,8 @@ def normalize_attachments(raw: Optional[Mapping]) -> list:
     if not isinstance(raw, Mapping):
         raise ValueError("Attachments must be a dict")
 
-    out = []
+    # validate every entry and decode inline contents before fetching anything
+    pending = []
     total = 0
 
     for key, entry in raw.items():
@@ -170,23 +355,26 @@ def normalize_attachments(raw: Optional[Mapping]) -> list:
 
         is_inline = '@' in key
         if is_inline:
-            cid = key
-            _validate_cid(cid, label)
+            _validate_cid(key, label)
         else:
-            cid = None
             _validate_filename(key, label)
 
-        sources = [k for k in ('url', 'content_b64', 'content_bytes') if k in entry]
+        sources = [k for k in ('url', 'content_b64', 'content_bytes', 'ref') if k in entry]
         if len(sources) != 1:
             raise ValueError(
-                f"{label}: must specify exactly one of 'url', 'content_b64', 'content_bytes'")
+                f"{label}: must specify exactly one of 'url', 'content_b64', 'content_bytes', 'ref'")
         source = sources[0]
 
         if source == 'url':
-            remaining = TOTAL_MAX_BYTES - total
-            if remaining <= 0:
-                raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
-            content = _fetch_url(entry['url'], remaining)
+            content = None
+        elif source == 'ref':
+            if store is None:
+                raise ValueError(f"{label}: 'ref' requires the attachment store, which is not enabled")
+            content = store.get(str(entry['ref']))
+            if content is None:
+                raise ValueError(
+                    f"{label}: unknown attachment ref '{entry['ref']}'; "
+                    "upload it first with PUT /attachments/<sha256>")
         elif source == 'content_b64':
             try:
                 content = base64.b64decode(entry['content_b64'], validate=True)
@@ -198,7 +386,23 @@ def normalize_attachments(raw: Optional[Mapping]) -> list:
                 raise ValueError(f"{label}: 'content_bytes' must be bytes")
             content = bytes(content)
 
-        if is_inline:
+        if not is_inline and not mimetypes.guess_type(key)[0]:
+            raise ValueError(
+                f"{label}: cannot determine content type for '{key}'; "
+                "rename with a recognized extension")
+
+        if content is not None:
+            total += len(content)
+            if total > TOTAL_MAX_BYTES:
+                raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
+        pending.append([key, label, content, entry.get('url')])
+
+    _fetch_all(pending, TOTAL_MAX_BYTES - total, cache)
+
+    out = []
+    for key, label, content, _ in pending:
+        if '@' in key:
+            cid = key
             sniffed = _sniff_image(content)
             if sniffed is None:
                 raise ValueError(
@@ -207,17 +411,9 @@ def normalize_attachments(raw: Optional[Mapping]) -> list:
             maintype, subtype, ext = sniffed
             filename = f"{cid.split('@', 1)[0]}{ext}"
         else:
+            cid = None
             filename = key
-            guessed, _ = mimetypes.guess_type(filename)
-            if not guessed:
-                raise ValueError(
-                    f"{label}: cannot determine content type for '{filename}'; "
-                    "rename with a recognized extension")
-            maintype, subtype = guessed.split('/', 1)
-
-        total += len(content)
-        if total > TOTAL_MAX_BYTES:
-            raise ValueError(f"Attachments exceed total cap of {TOTAL_MAX_BYTES} bytes")
+            maintype, subtype = mimetypes.guess_type(filename)[0].split('/', 1)
 
         out.append(Attachment(filename=filename, content=content,
                               maintype=maintype, subtype=subtype, cid=cid))
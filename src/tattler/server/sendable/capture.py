@@ -0,0 +1,159 @@
+"""Capture of notifications in place of their delivery, to load test tattler without reaching anybody.
+
+When capturing, every vector runs its whole pipeline -- rendering, building MIME messages, picking
+senders and endpoints -- and records the final payload it would deliver, instead of connecting to
+relays or APIs. Payloads are kept in memory, in a ring buffer of the latest ones, or appended to a
+file of JSON lines, which is rotated when it grows beyond a given size.
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Deque, Iterable, List, Mapping, Optional, Union
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# keep this many messages when capturing notifications in memory
+_default_capture_size = 1000
+# rotate files capturing notifications when they reach this many bytes
+_default_capture_max_bytes = 64 * 1024 * 1024
+
+
+@dataclass
+class CapturedMessage:
+    """The final payload of a notification, as it would have been delivered."""
+    vector: str
+    nid: str
+    event: str
+    sender: Optional[str]
+    recipients: List[str]
+    payload: bytes
+    captured: float = field(default_factory=time.time)
+
+    def as_dict(self) -> Mapping[str, Any]:
+        """Return a serializable representation of the message, with the payload decoded as UTF-8."""
+        res = dict(self.__dict__)
+        res['payload'] = self.payload.decode('utf-8', errors='backslashreplace')
+        return res
+
+
+class MemoryCapture:
+    """Keeps the latest captured messages in memory."""
+
+    def __init__(self, size: int) -> None:
+        """Construct an empty capture.
+
+        :param size:    Number of messages to keep; older ones are discarded.
+        """
+        self.size = size
+        self._messages: Deque[CapturedMessage] = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def record(self, msg: CapturedMessage) -> None:
+        """Add a message, discarding the oldest one if full."""
+        with self._lock:
+            self._messages.append(msg)
+
+    def messages(self) -> List[CapturedMessage]:
+        """Return the messages kept, oldest first."""
+        with self._lock:
+            return list(self._messages)
+
+    def clear(self) -> None:
+        """Discard all messages kept."""
+        with self._lock:
+            self._messages.clear()
+
+
+class FileCapture:
+    """Appends captured messages to a file, one JSON document per line, rotating it when it grows too large."""
+
+    def __init__(self, path: Union[str, Path], max_bytes: int, backups: int=3) -> None:
+        """Construct a capture into a file, created if missing.
+
+        :param path:        Path of the file.
+        :param max_bytes:   Rotate the file before it grows beyond this many bytes.
+        :param backups:     Number of rotated files to keep, as ``path.1`` (most recent) to ``path.<backups>``.
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._file = open(self.path, 'ab')
+
+    def _rotate(self) -> None:
+        self._file.close()
+        for num in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f'{self.path.name}.{num}')
+            if src.exists():
+                os.replace(src, self.path.with_name(f'{self.path.name}.{num + 1}'))
+        if self.backups > 0:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        self._file = open(self.path, 'wb')
+
+    def record(self, msg: CapturedMessage) -> None:
+        """Append a message to the file, rotating it first if it would grow too large."""
+        line = json.dumps(msg.as_dict()).encode() + b'\n'
+        with self._lock:
+            if self._file.tell() and self._file.tell() + len(line) > self.max_bytes:
+                self._rotate()
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def record(capture: Union[MemoryCapture, FileCapture], vector: str, nid: str, event: str, sender: Optional[str], recipients: Iterable[str], payload: bytes) -> CapturedMessage:
+    """Record the payload of a notification in a capture, and return it as captured."""
+    msg = CapturedMessage(vector, nid, event, sender, sorted(recipients), payload)
+    capture.record(msg)
+    metrics.incr('captured_messages', vector=vector)
+    metrics.incr('captured_bytes', len(payload), vector=vector)
+    log.debug("n%s: Captured %s payload of %d bytes for %s.", nid, vector, len(payload), msg.recipients)
+    return msg
+
+
+_capture: Optional[Union[MemoryCapture, FileCapture]] = None
+_capture_lock = threading.Lock()
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+def get_capture() -> Optional[Union[MemoryCapture, FileCapture]]:
+    """Return the process-wide capture recording notifications in place of delivering them, or None if disabled.
+
+    Capturing is enabled by setting TATTLER_CAPTURE to ``memory``, to keep the latest TATTLER_CAPTURE_SIZE
+    notifications in memory, or to the path of a file to append them to, rotated at TATTLER_CAPTURE_MAX_BYTES."""
+    global _capture
+    target = getenv('TATTLER_CAPTURE')
+    try:
+        size = int(getenv('TATTLER_CAPTURE_SIZE', _default_capture_size))
+        max_bytes = int(getenv('TATTLER_CAPTURE_MAX_BYTES', _default_capture_max_bytes))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_CAPTURE_SIZE='%s' or TATTLER_CAPTURE_MAX_BYTES='%s'. Set them to a number of notifications and bytes. Falling back to defaults.", getenv('TATTLER_CAPTURE_SIZE'), getenv('TATTLER_CAPTURE_MAX_BYTES'))
+        size, max_bytes = _default_capture_size, _default_capture_max_bytes
+    with _capture_lock:
+        if not target:
+            current = None
+        elif target.strip().lower() == 'memory':
+            current = _capture if isinstance(_capture, MemoryCapture) and _capture.size == size else MemoryCapture(size)
+        else:
+            current = _capture if isinstance(_capture, FileCapture) and str(_capture.path) == target else FileCapture(target, max_bytes)
+            current.max_bytes = max_bytes
+        if _capture is not current and isinstance(_capture, FileCapture):
+            _capture.close()
+        _capture = current
+        return _capture
@@ -0,0 +1,119 @@
+"""Pool of persistent HTTP(S) connections to one host, sparing the TCP and TLS handshakes of every request.
+
+Shared by the clients of HTTP APIs, e.g. BulkSMS and webhooks, and by the fetcher of attachments.
+Idle connections are kept open for a while and handed out most recently used first; requests on a
+reused connection which the server closed in the meantime are retried once on a new connection.
+"""
+
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# close connections idle for longer than this, before servers drop them on their own
+_default_idle_timeout_s = 30
+_default_pool_size = 4
+
+# errors meaning that a reused connection was closed by the server in the meantime
+stale_connection_errors = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+
+
+class HTTPConnectionPool:
+    """A bounded pool of persistent HTTP(S) connections to one host."""
+
+    def __init__(self, url: str, timeout: float, max_size: int=_default_pool_size, idle_timeout_s: float=_default_idle_timeout_s, name: str='http') -> None:
+        """Construct an empty pool.
+
+        :param url:             Base URL of the host, e.g. 'https://api.bulksms.com/v1'.
+        :param timeout:         Timeout of connections, in seconds.
+        :param max_size:        Maximum number of idle connections to keep open.
+        :param idle_timeout_s:  Close connections idle for longer than this many seconds.
+        :param name:            Prefix of the names of the pool's metrics, e.g. 'sms' for 'sms_connections_opened'.
+        """
+        parts = urllib.parse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.timeout = timeout
+        self.max_size = max_size
+        self.idle_timeout_s = idle_timeout_s
+        self.name = name
+        # stack of (connection, time released), most recently released last
+        self._idle: List[Tuple[http.client.HTTPConnection, float]] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        conn_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        metrics.incr(f'{self.name}_connections_opened')
+        return conn_class(self.host, timeout=self.timeout)
+
+    def acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """Take an idle connection from the pool, or open a new one, and return (connection, reused)."""
+        expired = []
+        conn = None
+        with self._lock:
+            now = time.monotonic()
+            while self._idle:
+                idle_conn, released = self._idle.pop()
+                if now - released <= self.idle_timeout_s:
+                    conn = idle_conn
+                    break
+                expired.append(idle_conn)
+        for old in expired:
+            old.close()
+        if conn is not None:
+            metrics.incr(f'{self.name}_connections_reused')
+            return conn, True
+        return self._connect(), False
+
+    def release(self, conn: http.client.HTTPConnection) -> None:
+        """Return a connection to the pool, or close it if the pool is full."""
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def request(self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]) -> Tuple[int, str, bytes]:
+        """Perform a request on a pooled connection, and return (status, reason, body) of its response.
+
+        Requests failing because a reused connection was closed by the server are retried once on a new
+        connection, unless the server may have received a non-idempotent request already.
+        """
+        conn, reused = self.acquire()
+        sent = False
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            sent = True
+            resp = conn.getresponse()
+            data = resp.read()
+        except Exception as err:
+            conn.close()
+            if not (reused and isinstance(err, stale_connection_errors) and (not sent or method == 'GET')):
+                raise
+            log.debug("Reused connection to %s was closed (%s). Retrying on a new connection.", self.host, type(err).__name__)
+            conn = self._connect()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except Exception:
+                conn.close()
+                raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return resp.status, resp.reason, data
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
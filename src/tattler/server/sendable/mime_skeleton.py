@@ -0,0 +1,279 @@
+"""Precompiled MIME skeletons, to assemble emails without rebuilding and serializing their whole structure.
+
+The structure of an email -- its multipart nesting, boundaries and structural headers -- only
+depends on which bodies and attachments it holds. A skeleton serializes that structure once,
+leaving slots for the headers, text bodies and attachment contents which change with every
+message. Assembling a message then only serializes those, and splices them into the skeleton.
+The result is byte for byte what serializing the fully assembled message gives with the same
+boundaries.
+
+Attachment contents are base64-encoded block by block while the message is written out, so
+large messages can be streamed to the relay without ever holding their encoded form whole.
+"""
+
+import binascii
+import logging
+import threading
+from collections import OrderedDict
+from email.message import EmailMessage, MIMEPart
+from email.policy import Policy
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+from tattler.server import metrics
+from tattler.server.sendable.smtp_encoding import EncodedMessage, flatten, text_cte, stream_threshold
+
+log = logging.getLogger(__name__)
+
+# number of skeletons to keep
+_max_skeletons = 64
+# lines of base64 to encode at once when writing attachments
+_base64_block_lines = 1024
+
+
+def _placeholder(slot: str) -> str:
+    return f'tattler-mime-skeleton-slot-{slot}'
+
+
+def encode_base64(data: bytes, line_bytes: int, linesep: str, binary: bool) -> Iterator[Union[str, bytes]]:
+    """Yield the base64 encoding of data in blocks of lines, as the email package encodes attachments.
+
+    :param data:        Content to encode.
+    :param line_bytes:  Bytes of content per line of base64.
+    :param linesep:     Line separator.
+    :param binary:      Whether to yield bytes rather than text.
+    """
+    view = memoryview(data)
+    step = line_bytes * _base64_block_lines
+    nl = linesep.encode('ascii')
+    for start in range(0, len(data), step):
+        block = b''.join(binascii.b2a_base64(view[i:i + line_bytes]) for i in range(start, min(start + step, len(data)), line_bytes))
+        if nl != b'\n':
+            block = block.replace(b'\n', nl)
+        yield block if binary else block.decode('ascii')
+
+
+class Skeleton:
+    """Serialized structure of a multipart message, with slots for its headers, text parts and attachment contents."""
+
+    def __init__(self, structure: EmailMessage, placeholders: Mapping[str, str]) -> None:
+        """Construct a skeleton.
+
+        :param structure:       Multipart message without per-message headers, whose text parts hold placeholders,
+                                and whose attachments hold placeholders encoded in ASCII.
+        :param placeholders:    Dictionary mapping the name of each slot to the placeholder its part holds.
+
+        :raise ValueError:      if the structure is not multipart, or lacks some placeholder.
+        """
+        if not structure.is_multipart():
+            raise ValueError("MIME skeletons require a multipart message.")
+        self.structure = structure
+        self.placeholders = dict(placeholders)
+        self.leaves: Dict[str, MIMEPart] = {}
+        self.attachments = set()
+        for part in structure.walk():
+            if part.is_multipart():
+                continue
+            for slot, placeholder in placeholders.items():
+                if part.get('Content-Transfer-Encoding') == 'base64':
+                    if part.get_payload(decode=True) == placeholder.encode('ascii'):
+                        self.attachments.add(slot)
+                elif part.get_content_maintype() == 'text' and part.get_payload() == placeholder + '\n':
+                    self.leaves[slot] = part
+        missing = set(placeholders) - set(self.leaves) - self.attachments
+        if missing:
+            raise ValueError(f"MIME structure lacks parts for slots {missing}.")
+        # bytes of content per line of base64, like email.contentmanager encodes them
+        self.base64_line_bytes = structure.policy.max_line_length // 4 * 3
+        self.boundaries = []
+        self._segments: Dict[Tuple, Optional[Tuple[Sequence, Sequence[str]]]] = {}
+        self._lock = threading.Lock()
+
+    def _leaf(self, slot: str, text: str, cte: Optional[str]) -> MIMEPart:
+        """Return a text part for a slot, built as the email package builds it within the structure."""
+        model = self.leaves[slot]
+        part = MIMEPart(policy=self.structure.policy)
+        part.set_content(text, subtype=model.get_content_subtype(), cte=cte)
+        for name, value in model.raw_items():
+            if not name.lower().startswith('content-'):
+                part.set_raw(name, value)
+        return part
+
+    def _compile(self, policy: Policy, binary: bool) -> Optional[Tuple[Sequence, Sequence[str]]]:
+        """Split the serialization of the structure around its slots; call with lock held.
+
+        :return:    Pair (literals, slots) with literals[0] the structural headers, and the content of slots[i]
+                    going between literals[i + 1] and literals[i + 2]; or None if the structure cannot be split.
+        """
+        full = flatten(self.structure, policy, binary)
+        self.boundaries = [p.get_boundary() for p in self.structure.walk() if p.is_multipart()]
+        fold = policy.fold_binary if binary else policy.fold
+        head = (b'' if binary else '').join(fold(name, value) for name, value in self.structure.raw_items())
+        linesep = policy.linesep.encode('ascii') if binary else policy.linesep
+        if not full.startswith(head + linesep):
+            return None
+        body = full[len(head):]
+        positions = []
+        for slot in self.leaves:
+            leaf = flatten(self.leaves[slot], policy, binary)
+            if body.count(leaf) != 1 or leaf != flatten(self._leaf(slot, self.leaves[slot].get_content(), None), policy, binary):
+                return None
+            positions.append((body.index(leaf), len(leaf), slot))
+        for slot in self.attachments:
+            content = (b'' if binary else '').join(encode_base64(self.placeholders[slot].encode('ascii'), self.base64_line_bytes, policy.linesep, binary))
+            if body.count(content) != 1:
+                return None
+            positions.append((body.index(content), len(content), slot))
+        literals = [head]
+        offset = 0
+        for start, length, _ in sorted(positions):
+            literals.append(body[offset:start])
+            offset = start + length
+        literals.append(body[offset:])
+        return literals, [slot for _, _, slot in sorted(positions)]
+
+    def pieces(self, headers: Iterable[Tuple[str, str]], texts: Mapping[str, Tuple[str, Optional[str]]], attachments: Mapping[str, bytes],
+               policy: Policy, binary: bool) -> Optional[List[Union[str, bytes, Iterator]]]:
+        """Return the pieces serializing a message with this structure, attachment contents as iterators of blocks.
+
+        :param headers:     Per-message headers, as (name, value) in order, following the structural headers.
+        :param texts:       Dictionary mapping each text slot to the (text, Content-Transfer-Encoding or None) of its part.
+        :param attachments: Dictionary mapping each attachment slot to its content.
+        :param policy:      Policy to serialize with, like :meth:`EmailMessage.as_bytes` would.
+        :param binary:      Whether to serialize to bytes rather than text.
+
+        :return:            The pieces of the message, or None if it cannot be assembled from the skeleton.
+        :raise ValueError:  if a header value is invalid, e.g. contains a linefeed.
+        """
+        key = (binary, policy.linesep, policy.utf8, policy.cte_type, policy.max_line_length)
+        with self._lock:
+            if key not in self._segments:
+                self._segments[key] = self._compile(policy, binary)
+            segments = self._segments[key]
+            boundaries = self.boundaries
+        if segments is None:
+            return None
+        literals, slots = segments
+        fold = policy.fold_binary if binary else policy.fold
+        out = [literals[0]]
+        for name, value in headers:
+            out.append(fold(*policy.header_store_parse(name, value)))
+        for slot, literal in zip(slots, literals[1:]):
+            out.append(literal)
+            if slot in self.attachments:
+                # base64 never contains a boundary
+                out.append(encode_base64(attachments[slot], self.base64_line_bytes, policy.linesep, binary))
+                continue
+            leaf = flatten(self._leaf(slot, *texts[slot]), policy, binary)
+            # a boundary within a text part would break the structure; only fresh boundaries avoid that
+            if any(('--' + b).encode('ascii') in leaf if binary else '--' + b in leaf for b in boundaries):
+                return None
+            out.append(leaf)
+        out.append(literals[-1])
+        return out
+
+    def assemble(self, headers: Iterable[Tuple[str, str]], texts: Mapping[str, Tuple[str, Optional[str]]], attachments: Mapping[str, bytes],
+                 policy: Policy, binary: bool) -> Optional[Union[str, bytes]]:
+        """Return the serialization of a message with this structure, or None if it cannot be assembled from the skeleton.
+
+        See :meth:`pieces` for parameters.
+        """
+        pieces = self.pieces(headers, texts, attachments, policy, binary)
+        if pieces is None:
+            return None
+        return (b'' if binary else '').join(iter_pieces(pieces))
+
+
+def iter_pieces(pieces: Iterable[Union[str, bytes, Iterator]]) -> Iterator[Union[str, bytes]]:
+    """Yield the chunks of a message given as pieces by :meth:`Skeleton.pieces`."""
+    for piece in pieces:
+        if isinstance(piece, (str, bytes)):
+            yield piece
+        else:
+            yield from piece
+
+
+_skeletons: 'OrderedDict[Hashable, Optional[Skeleton]]' = OrderedDict()
+_skeletons_lock = threading.Lock()
+
+def get_skeleton(key: Hashable, build: Callable[[Mapping[str, str]], EmailMessage], slots: Iterable[str]) -> Optional[Skeleton]:
+    """Return the skeleton of a message structure, compiling it upon first use.
+
+    :param key:     Key identifying the structure, e.g. from its parts and the names and types of its attachments.
+    :param build:   Function returning the structure, given a dictionary mapping slots to the placeholder for their part.
+    :param slots:   Names of the slots for text parts and attachments.
+
+    :return:        The skeleton, or None if the structure is not suitable for one.
+    """
+    with _skeletons_lock:
+        if key in _skeletons:
+            _skeletons.move_to_end(key)
+            metrics.incr('mime_skeleton_hits')
+            return _skeletons[key]
+    metrics.incr('mime_skeleton_misses')
+    placeholders = {slot: _placeholder(slot) for slot in slots}
+    try:
+        skeleton = Skeleton(build(placeholders), placeholders)
+    except ValueError as err:
+        log.debug("Not caching MIME structure: %s", err)
+        skeleton = None
+    with _skeletons_lock:
+        _skeletons[key] = skeleton
+        while len(_skeletons) > _max_skeletons:
+            _skeletons.popitem(last=False)
+    return skeleton
+
+def clear() -> None:
+    """Forget all skeletons."""
+    with _skeletons_lock:
+        _skeletons.clear()
+
+
+class SkeletonMessage(EncodedMessage):
+    """A message to deliver, assembled from a skeleton, and built in full only if the skeleton cannot be used."""
+
+    def __init__(self, build: Callable[[bool], EmailMessage], sender: str, recipients: Iterable[str],
+                 skeleton: Skeleton, headers: List[Tuple[str, str]], contents: Mapping[str, Union[str, bytes]]) -> None:
+        """Construct a message.
+
+        :param build:       Function returning the message in full, with 8-bit bodies if its argument is True.
+        :param sender:      Envelope sender.
+        :param recipients:  Envelope recipients.
+        :param skeleton:    Skeleton of the structure of the message.
+        :param headers:     Per-message headers, as (name, value) in order.
+        :param contents:    Dictionary mapping each slot of the skeleton to its text, or to its bytes for attachments.
+        """
+        super().__init__(build, sender, recipients)
+        self.skeleton = skeleton
+        self.headers = headers
+        self.contents = contents
+
+    def _pieces(self, eightbit: bool, binary: bool, **policy_changes) -> Optional[List]:
+        policy = self.skeleton.structure.policy.clone(**policy_changes)
+        texts = {slot: (text, text_cte(text, eightbit)) for slot, text in self.contents.items() if isinstance(text, str)}
+        attachments = {slot: data for slot, data in self.contents.items() if isinstance(data, bytes)}
+        pieces = self.skeleton.pieces(self.headers, texts, attachments, policy, binary)
+        if pieces is None:
+            metrics.incr('mime_skeleton_fallbacks')
+        return pieces
+
+    def _flatten(self, eightbit: bool, binary: bool, **policy_changes) -> Union[str, bytes]:
+        pieces = self._pieces(eightbit, binary, **policy_changes)
+        if pieces is None:
+            return super()._flatten(eightbit, binary, **policy_changes)
+        return (b'' if binary else '').join(iter_pieces(pieces))
+
+    def size_hint(self) -> int:
+        return sum(len(c) if isinstance(c, str) else len(c) * 4 // 3 for c in self.contents.values())
+
+    def stream(self, has_extn: Callable[[str], bool]) -> Optional[Tuple[Iterator[bytes], List[str]]]:
+        if self.size_hint() < stream_threshold:
+            return None
+        smtputf8 = has_extn('8bitmime') and has_extn('smtputf8') and self.needs_smtputf8()
+        eightbit = smtputf8 or (has_extn('8bitmime') and not all(c.isascii() for c in self.contents.values() if isinstance(c, str)))
+        pieces = self._pieces(eightbit, True, linesep='\r\n', utf8=smtputf8, cte_type='8bit' if eightbit else '7bit')
+        if pieces is None:
+            return None
+        return iter_pieces(pieces), (['BODY=8BITMIME'] if eightbit else []) + (['SMTPUTF8'] if smtputf8 else [])
+
+    def needs_smtputf8(self) -> bool:
+        return not all(value.isascii() for _, value in self.headers) or not all(a.isascii() for a in [self.sender] + self.recipients)
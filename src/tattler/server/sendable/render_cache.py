@@ -0,0 +1,150 @@
+"""Cache of expanded template elements, to spare re-expanding identical content.
+
+Entries are keyed by the template processor and version of the template (its fingerprint,
+which covers base templates and partials), plus a digest of the values of the context
+variables which the template reads. Notifications whose contexts differ only in variables
+that the template ignores -- e.g. recipient-specific fields -- therefore share entries.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, time, timedelta
+from decimal import Decimal
+from typing import Mapping, Any, Optional, Callable
+
+from tattler.server.sendable.template_processor import TemplateProcessor
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+
+def _canonical(value: Any) -> Any:
+    """Serialize values which JSON does not natively support, or raise TypeError if they cannot be reliably digested."""
+    if isinstance(value, (date, time)):
+        return f'{type(value).__name__}:{value.isoformat()}'
+    if isinstance(value, timedelta):
+        return f'timedelta:{value.total_seconds()}'
+    if isinstance(value, Decimal):
+        return f'decimal:{value}'
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    raise TypeError(f"Cannot digest values of type {type(value)}")
+
+def context_digest(context: Mapping[str, Any], variables: Optional[Any]) -> Optional[str]:
+    """Return a canonical digest of the values of some variables of a context.
+
+    :param context:     Context to digest.
+    :param variables:   Names of the variables to consider; or None to give up (unknown variables).
+
+    :return:            Hex digest of the variables' values, or None if some value cannot be reliably digested.
+    """
+    if variables is None:
+        return None
+    # base_template would override the base template
+    relevant = {k: context[k] for k in set(variables) | {'base_template'} if k in context}
+    try:
+        serialized = json.dumps(relevant, sort_keys=True, default=_canonical, ensure_ascii=False)
+    except (TypeError, ValueError) as err:
+        log.debug("Context cannot be digested, so expansion won't be cached: %s", err)
+        return None
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """Size-bounded LRU cache mapping expansion keys to expanded content."""
+
+    def __init__(self, max_size: int) -> None:
+        """Construct an empty cache.
+
+        :param max_size:    Maximum total length (in characters) of the content to hold, beyond which least recently used entries are evicted.
+        """
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the content cached for a key, or None if not cached."""
+        with self._lock:
+            content = self._entries.get(key)
+            if content is None:
+                self.misses += 1
+                metrics.incr('render_cache_misses')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        metrics.incr('render_cache_hits')
+        return content
+
+    def put(self, key: str, content: str) -> None:
+        """Store content for a key, evicting least recently used entries to stay within max_size."""
+        if len(content) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = content
+            self.size += len(content)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+            size = self.size
+        metrics.set_gauge('render_cache_size', size)
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def expand(self, processor: TemplateProcessor, context: Mapping[str, Any], expander: Optional[Callable[[TemplateProcessor, Mapping[str, Any]], str]]=None) -> str:
+        """Return the expansion of a template with a context, from cache if available.
+
+        :param processor:   Template processor loaded with the template to expand.
+        :param context:     Variables to expand the template with.
+        :param expander:    Function to expand the template with upon cache misses; None to call the processor's expand().
+
+        :return:            The expanded content.
+        """
+        expander = expander or (lambda proc, ctx: proc.expand(ctx))
+        digest = context_digest(context, processor.variables())
+        if digest is None:
+            return expander(processor, context)
+        key = f'{type(processor).__name__}:{processor.fingerprint()}:{digest}'
+        content = self.get(key)
+        if content is None:
+            content = expander(processor, context)
+            self.put(key, content)
+        return content
+
+
+_cache: Optional[RenderCache] = None
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+def get_cache() -> Optional[RenderCache]:
+    """Return the process-wide cache of expanded template elements, or None if disabled.
+
+    The cache is enabled by setting TATTLER_RENDER_CACHE_SIZE to the maximum total size (in characters) of content to cache."""
+    global _cache
+    try:
+        max_size = int(getenv('TATTLER_RENDER_CACHE_SIZE', 0))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_RENDER_CACHE_SIZE='%s'. Set it to a number of characters. Disabling cache.", getenv('TATTLER_RENDER_CACHE_SIZE'))
+        max_size = 0
+    if max_size <= 0:
+        _cache = None
+    elif _cache is None or _cache.max_size != max_size:
+        _cache = RenderCache(max_size)
+    return _cache
@@ -0,0 +1,164 @@
+"""Pool of worker processes to expand heavy templates in parallel, outside of the GIL.
+
+Templates are shipped to workers as the arguments constructing their template processor,
+i.e. their source, base template and settings like partials folders. Workers live as long
+as the pool, so their caches of compiled templates and partials stay warm across requests.
+
+Only templates whose expansion is observed to be slow are shipped to workers. Others are expanded
+in-process, where the cost of serializing the context to a worker would outweigh the benefit.
+Other heavy rendering steps, like compiling MJML, are shipped to workers with :meth:`RenderPool.run`.
+
+Workers are spawned rather than forked, as the server process runs threads -- retry schedulers,
+pollers, connection pools -- whose locks a forked child would inherit in an arbitrary state.
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Mapping, Any, Callable, Optional, Tuple
+
+from tattler.server.sendable.template_processor import TemplateProcessor
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# expand templates in worker processes if their expansion takes on average this many seconds or more
+_default_threshold_s = 0.05
+
+# errors raised when the arguments of a call cannot be pickled to ship them to a worker
+_unshippable_errors = (pickle.PicklingError, TypeError, AttributeError)
+
+
+def _expand_in_worker(processor_class: type, content: str, base_content: Optional[str], kwargs: Mapping[str, Any], context: Mapping[str, Any]) -> Tuple[str, float]:
+    """Expand a template within a worker process, and return the content and the time taken."""
+    processor = processor_class(content, base_content=base_content, **kwargs)
+    template_name = kwargs.get('template_name', '<string>')
+    content = processor.expand(context)
+    stats = metrics.get_timing('template_render_seconds', template=template_name)
+    return content, stats.last if stats is not None else 0.0
+
+
+class RenderPool:
+    """Expands templates in a pool of worker processes, falling back to in-process expansion for light templates."""
+
+    def __init__(self, processes: int, threshold_s: float) -> None:
+        """Construct a pool of worker processes.
+
+        Workers are started upon the first expansion shipped to them.
+
+        :param processes:       Number of worker processes.
+        :param threshold_s:     Ship templates to workers only if their average expansion time is at least this many seconds.
+        """
+        self.processes = processes
+        self.threshold_s = threshold_s
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                log.info("Starting pool of %d processes for expanding templates.", self.processes)
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def _reset_executor(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self) -> None:
+        """Terminate the worker processes, if any."""
+        self._reset_executor()
+
+    def is_heavy(self, processor: TemplateProcessor) -> bool:
+        """Return whether a template is worth expanding in a worker process, based on its past expansion times."""
+        stats = metrics.get_timing('template_render_seconds', template=processor.kwargs.get('template_name', '<string>'))
+        return stats is not None and stats.count > 0 and stats.total / stats.count >= self.threshold_s
+
+    def _call(self, name: str, func: Callable, *args) -> Tuple[bool, Any]:
+        """Call a function in a worker process, and return (True, its result); or (False, None) if it could not be shipped to a worker.
+
+        Errors raised by the function in the worker are raised as is.
+        """
+        try:
+            # find out before submitting, so that errors of the call itself are never mistaken for shipping errors
+            pickle.dumps((func, args))
+        except _unshippable_errors as err:
+            log.info("Cannot render '%s' in worker process (%s: %s). Rendering in-process.", name, type(err).__name__, err)
+            return False, None
+        try:
+            return True, self._get_executor().submit(func, *args).result()
+        except BrokenProcessPool:
+            log.error("Pool of template processes broke while rendering '%s'. Restarting it, and rendering in-process.", name)
+            self._reset_executor()
+        return False, None
+
+    def run(self, name: str, func: Callable, *args) -> Any:
+        """Call a function in a worker process and return its result, or call it in-process if it cannot be shipped to a worker.
+
+        :param name:        Name of what the function renders, for logging.
+        :param func:        Function to call, defined at module level so that workers can import it.
+        :param args:        Arguments to call the function with.
+
+        :return:            The result of the function.
+        """
+        shipped, result = self._call(name, func, *args)
+        return result if shipped else func(*args)
+
+    def expand(self, processor: TemplateProcessor, context: Mapping[str, Any]) -> str:
+        """Expand a template with a context, in a worker process if the template is heavy, or in-process otherwise.
+
+        If the template or context cannot be shipped to a worker, e.g. because the context holds
+        objects which cannot be pickled, the template is expanded in-process. Errors raised by the
+        expansion in the worker are raised as is, without expanding the template again.
+
+        :param processor:   Template processor loaded with the template to expand.
+        :param context:     Variables to expand the template with.
+
+        :return:            The expanded content.
+        """
+        if not self.is_heavy(processor):
+            return processor.expand(context)
+        template_name = processor.kwargs.get('template_name', '<string>')
+        shipped, result = self._call(template_name, _expand_in_worker, type(processor), processor.content, processor.base_content, processor.kwargs, context)
+        if not shipped:
+            return processor.expand(context)
+        content, duration = result
+        metrics.observe('template_render_seconds', duration, template=template_name)
+        metrics.incr('template_render_offloaded', template=template_name)
+        return content
+
+_pool: Optional[RenderPool] = None
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+def get_pool() -> Optional[RenderPool]:
+    """Return the process-wide pool of processes for expanding heavy templates, or None if disabled.
+
+    The pool is enabled by setting TATTLER_RENDER_PROCESSES to the number of worker processes. Templates
+    are shipped to workers if their expansion takes on average at least TATTLER_RENDER_PROCESS_THRESHOLD seconds."""
+    global _pool
+    try:
+        processes = int(getenv('TATTLER_RENDER_PROCESSES', 0))
+        threshold_s = float(getenv('TATTLER_RENDER_PROCESS_THRESHOLD', _default_threshold_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_RENDER_PROCESSES='%s' or TATTLER_RENDER_PROCESS_THRESHOLD='%s'. Set them to a number of processes and seconds. Disabling pool.", getenv('TATTLER_RENDER_PROCESSES'), getenv('TATTLER_RENDER_PROCESS_THRESHOLD'))
+        processes = 0
+    if processes <= 0:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = None
+    elif _pool is None or _pool.processes != processes:
+        if _pool is not None:
+            _pool.shutdown()
+        _pool = RenderPool(processes, threshold_s)
+    else:
+        _pool.threshold_s = threshold_s
+    return _pool
@@ -0,0 +1,132 @@
+"""Micro-batching of SMS submissions across concurrent notifications.
+
+The BulkSMS API accepts many recipients per call. :class:`SMSBatcher` collects the recipients of messages
+with identical body, sender and priority submitted within a short window, and submits them in one call.
+
+The first submission of a batch waits for the window to pass, or for the batch to fill up, then submits
+the batch on behalf of all its members. Each member gets back the message IDs of its own recipients, or
+the error of the call.
+
+Batches only form among submitters running concurrently, e.g. the threads of an application sending
+notifications through :class:`~tattler.server.sendable.vector_sms.SMSSendable`. A submission made while no
+other is under way is submitted at once, as nobody could join it. This is always the case under
+``tattlersrv_http``, which serves one request at a time, so batching has no effect there and delays nothing.
+"""
+
+import logging
+import threading
+import time
+from typing import Dict, Hashable, Iterable, List, Optional
+
+from bulksms import BulkSMS
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+
+class _Batch:
+    """Recipients collected for one API call."""
+
+    def __init__(self) -> None:
+        self.recipients: List[str] = []
+        self.members = 0
+        # set when the batch must be submitted without waiting for the window to end
+        self.full = threading.Event()
+        # set when the batch was submitted
+        self.done = threading.Event()
+        self.message_ids: List[str] = []
+        self.error: Optional[BaseException] = None
+
+
+class SMSBatcher:
+    """Collects SMS submissions with identical content over a short window, and submits each collection in one API call."""
+
+    def __init__(self, window_s: float, max_recipients: int) -> None:
+        """Construct a batcher.
+
+        :param window_s:        Seconds to wait for further submissions to join a batch.
+        :param max_recipients:  Submit batches as soon as they reach this many recipients.
+        """
+        self.window_s = window_s
+        self.max_recipients = max_recipients
+        self._open: Dict[Hashable, _Batch] = {}
+        # number of submissions under way
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def submit(self, client: BulkSMS, recipients: Iterable[str], content: str, sender: Optional[str]=None, priority: bool=False) -> List[str]:
+        """Submit a message in the next batch, and return the IDs of the messages to its recipients.
+
+        :param client:      Client to submit the batch with.
+        :param recipients:  Recipients of the message.
+        :param content:     Text of the message.
+        :param sender:      Sender ID of the message, or None for the default.
+        :param priority:    Whether the message should be routed with top priority.
+
+        :raises Exception:  Any error raised by the client when submitting the batch.
+
+        :return:            Message IDs, one for each recipient in order, as returned by the client's send().
+        """
+        recipients = list(recipients)
+        key = (id(client), content, sender, bool(priority))
+        with self._lock:
+            self._active += 1
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+                # with no other submission under way, nobody could join the batch within its window
+                wait = self._active > 1
+            start = len(batch.recipients)
+            batch.recipients += recipients
+            batch.members += 1
+            end = len(batch.recipients)
+            if end >= self.max_recipients:
+                # close the batch to new members, and have the leader submit it at once
+                del self._open[key]
+                batch.full.set()
+        try:
+            if leader:
+                self._run(key, batch, client, content, sender, priority, wait)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._active -= 1
+        if batch.error is not None:
+            raise batch.error
+        return batch.message_ids[start:end]
+
+    def _run(self, key: Hashable, batch: _Batch, client: BulkSMS, content: str, sender: Optional[str], priority: bool, wait: bool) -> None:
+        """Wait for a batch to fill up or its window to end if 'wait', then submit it and wake its members."""
+        started = time.monotonic()
+        if wait:
+            batch.full.wait(self.window_s)
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+        metrics.incr('sms_batches')
+        metrics.observe('sms_batch_recipients', len(batch.recipients))
+        log.debug("Submitting SMS batch of %d recipients from %d notifications after %.3fs.", len(batch.recipients), batch.members, time.monotonic() - started)
+        try:
+            batch.message_ids = client.send(batch.recipients, content, sender=sender, priority=priority)
+        except BaseException as err:
+            batch.error = err
+        finally:
+            batch.done.set()
+
+
+_batcher: Optional[SMSBatcher] = None
+_batcher_lock = threading.Lock()
+
+def get_batcher(window_s: float, max_recipients: int) -> SMSBatcher:
+    """Return the process-wide SMS batcher, with the given settings."""
+    global _batcher
+    with _batcher_lock:
+        if _batcher is None:
+            _batcher = SMSBatcher(window_s, max_recipients)
+        _batcher.window_s = window_s
+        _batcher.max_recipients = max_recipients
+        return _batcher
@@ -0,0 +1,198 @@
+"""Long-lived BulkSMS clients over persistent HTTP connections, and background polling of delivery reports.
+
+The bulksms library opens a new HTTPS connection for every API call. :class:`PooledBulkSMS` keeps
+connections open across calls instead, sparing the TCP and TLS handshakes of every SMS, and
+:func:`get_client` shares one client per credentials across the process.
+
+Delivery reports are not awaited when sending. :class:`DeliveryReportPoller` collects the IDs of
+submitted messages instead, and queries their status on a background thread until each reaches a
+final status or expires. BulkSMS answers status queries one message at a time, so each message is
+queried at exponentially growing intervals, and the number of messages followed is capped.
+"""
+
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+from dataclasses import dataclass
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from bulksms import BulkSMS
+
+from tattler.server import metrics
+from tattler.server.sendable.http_pool import HTTPConnectionPool
+
+log = logging.getLogger(__name__)
+
+_default_pool_size = 4
+
+# statuses after which a message's delivery status no longer changes
+final_statuses = {'DELIVERED', 'FAILED'}
+# stop polling for messages still not in a final status after this many seconds
+_default_report_max_age_s = 3600
+# follow at most this many messages at a time; messages submitted beyond are not followed
+_default_report_max_pending = 10000
+# longest interval between two queries of the status of a message, in seconds
+_max_report_backoff_s = 900
+
+class PooledBulkSMS(BulkSMS):
+    """A BulkSMS client sending its API calls over persistent, pooled connections."""
+
+    def __init__(self, *args, api_base: Optional[str]=None, pool_size: int=_default_pool_size, **kwargs) -> None:
+        """Construct a client.
+
+        :param api_base:    Base URL of the API, e.g. of a simulator; None for BulkSMS's.
+        :param pool_size:   Maximum number of idle connections to keep open.
+
+        See BulkSMS for further parameters.
+        """
+        super().__init__(*args, **kwargs)
+        if api_base:
+            self.api_base = api_base.rstrip('/')
+        self.pool = HTTPConnectionPool(self.api_base, self.timeout_s, pool_size, name='sms')
+
+    def do_send(self, url: str, content: bytes=b'', method: str='GET', js: Optional[Any]=None) -> Any:
+        if js is not None:
+            content += json.dumps(js).encode()
+        method = method.upper()
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        status, reason, data = self.pool.request(method, path, content or None, dict(self.get_headers()))
+        if status >= 400:
+            log.error("Error submitting request to %s: HTTP %s %s", url, status, reason)
+            raise urllib.error.HTTPError(url, status, reason, None, None)
+        return json.loads(data.decode())
+
+
+_clients: Dict[Hashable, PooledBulkSMS] = {}
+_clients_lock = threading.Lock()
+
+def get_client(token_id: str, token_secret: str, api_base: Optional[str]=None) -> PooledBulkSMS:
+    """Return the process-wide client for some credentials and API base URL, creating it if needed."""
+    key = (token_id, token_secret, api_base)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = PooledBulkSMS(token_id=token_id, token_secret=token_secret, api_base=api_base)
+            _clients[key] = client
+        return client
+
+
+@dataclass
+class PendingReport:
+    """A submitted message awaiting a final delivery status."""
+    client: BulkSMS
+    message_id: str
+    nid: str
+    submitted: float
+    status: Optional[str] = None
+    # time of the next query of the status, as from time.time()
+    next_poll: float = 0.0
+    polls: int = 0
+
+
+class DeliveryReportPoller:
+    """Polls the delivery status of submitted messages on a background thread, backing off for each message."""
+
+    def __init__(self, interval_s: float, max_age_s: float=_default_report_max_age_s, max_pending: int=_default_report_max_pending) -> None:
+        """Construct a poller.
+
+        :param interval_s:  Seconds between sweeps, and before the first query of a message's status,
+                            doubling after each further query of the same message.
+        :param max_age_s:   Stop polling messages without a final status this many seconds after submission.
+        :param max_pending: Maximum number of messages to follow at a time.
+        """
+        self.interval_s = interval_s
+        self.max_age_s = max_age_s
+        self.max_pending = max_pending
+        self._pending: Dict[str, PendingReport] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        """Return the number of messages awaiting a final status."""
+        return len(self._pending)
+
+    def watch(self, client: BulkSMS, message_ids: Iterable[str], nid: str='') -> None:
+        """Poll the delivery status of some submitted messages in the background.
+
+        Messages beyond the maximum number to follow are not followed.
+
+        :param client:      Client the messages were submitted with.
+        :param message_ids: IDs of the messages, as returned by the client's send().
+        :param nid:         ID of the notification, for logs.
+        """
+        now = time.time()
+        dropped = 0
+        with self._cond:
+            for message_id in message_ids:
+                if len(self._pending) >= self.max_pending:
+                    dropped += 1
+                    continue
+                self._pending[message_id] = PendingReport(client, message_id, nid, now, next_poll=now + self.interval_s)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tattler-sms-reports', daemon=True)
+                self._thread.start()
+            metrics.set_gauge('sms_reports_pending', len(self._pending))
+        if dropped:
+            metrics.incr('sms_reports_dropped', dropped)
+            log.warning("n%s: Already following delivery of %d SMS. Not following %d more.", nid, self.max_pending, dropped)
+
+    def _backoff(self, report: PendingReport, now: float) -> None:
+        report.polls += 1
+        report.next_poll = now + min(_max_report_backoff_s, self.interval_s * 2 ** report.polls)
+
+    def poll(self) -> List[PendingReport]:
+        """Query the status of the outstanding messages due for it or expiring, and return those which reached a final status or expired."""
+        now = time.time()
+        with self._cond:
+            batch = [r for r in self._pending.values() if r.next_poll <= now or now - r.submitted > self.max_age_s]
+        done = []
+        for report in batch:
+            try:
+                report.status = report.client.msg_delivery_status(report.message_id)
+            except Exception as err:
+                log.debug("n%s: Failed to query delivery status of SMS %s: %s", report.nid, report.message_id, err)
+            metrics.incr('sms_report_queries')
+            if report.status in final_statuses:
+                metrics.incr('sms_delivery_reports', status=report.status.lower())
+                if report.status == 'FAILED':
+                    log.warning("n%s: SMS %s failed delivery.", report.nid, report.message_id)
+                else:
+                    log.info("n%s: SMS %s delivered.", report.nid, report.message_id)
+                done.append(report)
+            elif now - report.submitted > self.max_age_s:
+                metrics.incr('sms_delivery_reports', status='expired')
+                log.warning("n%s: SMS %s still not delivered after %ds (status %s). No longer tracking it.", report.nid, report.message_id, self.max_age_s, report.status)
+                done.append(report)
+            else:
+                self._backoff(report, now)
+        with self._cond:
+            for report in done:
+                self._pending.pop(report.message_id, None)
+            metrics.set_gauge('sms_reports_pending', len(self._pending))
+        return done
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait(self.interval_s)
+            try:
+                self.poll()
+            except Exception:
+                log.exception("Polling SMS delivery reports failed:")
+
+
+_poller: Optional[DeliveryReportPoller] = None
+_poller_lock = threading.Lock()
+
+def get_poller(interval_s: float) -> DeliveryReportPoller:
+    """Return the process-wide poller of delivery reports, sweeping every interval_s seconds."""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = DeliveryReportPoller(interval_s)
+        _poller.interval_s = interval_s
+        return _poller
@@ -0,0 +1,430 @@
+"""Asynchronous SMTP delivery engine, keeping many transactions in flight over few connections.
+
+A background thread runs an asyncio event loop, on which a minimal SMTP client delivers
+messages submitted from any thread. Each relay gets a bounded number of concurrent sessions,
+which are kept open and reused across transactions; when the relay advertises PIPELINING,
+the envelope and DATA commands of each transaction are sent in a single round trip.
+
+Errors are reported with the exceptions of :mod:`smtplib`, so callers handle them alike.
+"""
+
+import asyncio
+import atexit
+import base64
+import concurrent.futures
+import logging
+import re
+import smtplib
+import socket
+import ssl
+import threading
+import time
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Hashable, Iterable, List, Mapping, Optional, Tuple, Union
+
+from tattler.server import metrics
+from tattler.server.sendable.smtp_pool import is_connection_broken
+from tattler.server.sendable.smtp_encoding import EncodedMessage, bdat_chunk_size, dot_stuff, rechunk, stream_chunk_size
+
+log = logging.getLogger(__name__)
+
+_eol_re = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+_leading_dot_re = re.compile(rb'(?m)^\.')
+
+
+@lru_cache(maxsize=1)
+def _local_fqdn() -> str:
+    return socket.getfqdn()
+
+def encode_data(msg: Union[str, bytes]) -> bytes:
+    """Encode a message for the DATA command: CRLF line endings, dot-stuffed, and terminated."""
+    if isinstance(msg, str):
+        msg = _eol_re.sub('\r\n', msg).encode('ascii')
+    data = _leading_dot_re.sub(b'..', msg)
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class AsyncSMTPConnection:
+    """A minimal asyncio SMTP client session, supporting TLS, STARTTLS, AUTH PLAIN/LOGIN and PIPELINING."""
+
+    def __init__(self, host: str, port: int, timeout: float, tls: bool=False, starttls: bool=False, auth: Optional[str]=None, local_hostname: Optional[str]=None) -> None:
+        """Construct an unconnected session; call :meth:`connect` to open it.
+
+        :param host:            Hostname or IP address of the SMTP server.
+        :param port:            Port of the SMTP server.
+        :param timeout:         Timeout for each SMTP operation, in seconds.
+        :param tls:             Whether to connect with TLS from the start (SMTPS).
+        :param starttls:        Whether to upgrade the session to TLS with STARTTLS.
+        :param auth:            Credentials as 'username:password' for AUTH, or None to skip authentication.
+        :param local_hostname:  Name to introduce ourselves with in EHLO, or None for the local FQDN.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.tls = tls
+        self.starttls = starttls
+        self.auth = auth
+        self.local_hostname = local_hostname
+        self.extensions: Dict[str, str] = {}
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    @property
+    def pipelining(self) -> bool:
+        return 'pipelining' in self.extensions
+
+    async def connect(self) -> 'AsyncSMTPConnection':
+        """Open the session, up to the point where it's ready for transactions, and return it."""
+        ssl_context = ssl.create_default_context() if (self.tls or self.starttls) else None
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=ssl_context if self.tls else None), self.timeout)
+        except asyncio.TimeoutError as err:
+            raise TimeoutError(f"Timeout connecting to SMTP server {self.host}:{self.port}") from err
+        try:
+            code, msg = await self.read_reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, msg)
+            await self.ehlo()
+            if self.starttls:
+                if 'starttls' not in self.extensions:
+                    raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+                await self.command('STARTTLS', 220)
+                await self._start_tls(ssl_context)
+                await self.ehlo()
+            if self.auth:
+                await self.login(*self.auth.split(':', 1))
+        except BaseException:
+            # don't leak the connection of sessions failing to set up, e.g. upon wrong credentials
+            self.close()
+            raise
+        return self
+
+    async def _start_tls(self, ssl_context: ssl.SSLContext) -> None:
+        if hasattr(self.writer, 'start_tls'):
+            await self.writer.start_tls(ssl_context, server_hostname=self.host)
+            return
+        # python < 3.11: upgrade the transport below the existing stream reader and writer
+        transport = self.writer.transport
+        loop = asyncio.get_running_loop()
+        new_transport = await loop.start_tls(transport, transport.get_protocol(), ssl_context, server_hostname=self.host)
+        self.writer._transport = new_transport
+
+    async def read_reply(self) -> Tuple[int, bytes]:
+        """Read a (possibly multi-line) reply, and return its code and text."""
+        lines = []
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            except asyncio.TimeoutError as err:
+                raise TimeoutError(f"Timeout waiting for SMTP server {self.host}:{self.port}") from err
+            if not line:
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            try:
+                code = int(line[:3])
+            except ValueError:
+                raise smtplib.SMTPResponseException(-1, line) from None
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def write(self, data: bytes) -> None:
+        self.writer.write(data)
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except asyncio.TimeoutError as err:
+            raise TimeoutError(f"Timeout writing to SMTP server {self.host}:{self.port}") from err
+
+    async def command(self, cmd: str, expect: Optional[int]=250) -> Tuple[int, bytes]:
+        """Send a command and return its reply, raising SMTPResponseException if the reply code is not 'expect'."""
+        await self.write(cmd.encode('ascii') + b'\r\n')
+        code, msg = await self.read_reply()
+        if expect is not None and code != expect:
+            raise smtplib.SMTPResponseException(code, msg)
+        return code, msg
+
+    async def ehlo(self) -> None:
+        name = self.local_hostname or await asyncio.get_running_loop().run_in_executor(None, _local_fqdn)
+        _, msg = await self.command(f'EHLO {name}')
+        self.extensions = {}
+        for line in msg.decode('ascii', 'replace').split('\n')[1:]:
+            keyword, _, params = line.partition(' ')
+            self.extensions[keyword.lower()] = params
+
+    async def login(self, user: str, password: str) -> None:
+        methods = self.extensions.get('auth', '').upper().split()
+        if 'PLAIN' in methods or 'LOGIN' not in methods:
+            token = base64.b64encode(f'\0{user}\0{password}'.encode('utf-8')).decode('ascii')
+            code, msg = await self.command(f'AUTH PLAIN {token}', None)
+        else:
+            await self.command('AUTH LOGIN', 334)
+            await self.command(base64.b64encode(user.encode('utf-8')).decode('ascii'), 334)
+            code, msg = await self.command(base64.b64encode(password.encode('utf-8')).decode('ascii'), None)
+        if code != 235:
+            raise smtplib.SMTPAuthenticationError(code, msg)
+
+    async def sendmail(self, sender: str, recipients: Iterable[str], msg: Union[str, bytes, EncodedMessage]) -> Dict[str, Tuple[int, bytes]]:
+        """Deliver a message, like :meth:`smtplib.SMTP.sendmail`.
+
+        Messages given as :class:`EncodedMessage` are sent in 8-bit and with UTF-8 headers if the server
+        supports 8BITMIME and SMTPUTF8. All messages are sent with BDAT if the server supports CHUNKING.
+
+        :return:    Dictionary of refused recipients, mapped to the (code, text) of their refusal.
+        """
+        recipients = list(recipients)
+        chunking = 'chunking' in self.extensions
+        options = []
+        chunks = None
+        if isinstance(msg, EncodedMessage):
+            streamed = msg.stream(lambda name: name in self.extensions)
+            if streamed is not None:
+                chunks, options = streamed
+            else:
+                msg, options = msg.for_extensions(lambda name: name in self.extensions, chunking)
+        if chunks is not None:
+            data = None
+        elif chunking:
+            data = msg if isinstance(msg, bytes) else _eol_re.sub('\r\n', msg).encode('ascii')
+        else:
+            data = encode_data(msg)
+        encoding = 'utf-8' if 'SMTPUTF8' in options else 'ascii'
+        envelope = [f'MAIL FROM:<{sender}>' + ''.join(f' {o}' for o in options)] + [f'RCPT TO:<{r}>' for r in recipients]
+        code, resp = None, b''
+        if self.pipelining:
+            # envelope and DATA in one round trip
+            await self.write(''.join(f'{c}\r\n' for c in envelope + ([] if chunking else ['DATA'])).encode(encoding))
+            replies = [await self.read_reply() for _ in envelope]
+            if not chunking:
+                code, resp = await self.read_reply()
+        else:
+            replies = []
+            for cmd in envelope:
+                await self.write(cmd.encode(encoding) + b'\r\n')
+                replies.append(await self.read_reply())
+                if replies[0][0] != 250:
+                    break
+        refused = {r: reply for r, reply in zip(recipients, replies[1:]) if reply[0] not in (250, 251)}
+        if replies[0][0] != 250 or len(refused) == len(recipients):
+            if code == 354:
+                # pipelined DATA accepted anyway: send an empty message and discard it with RSET
+                await self.write(b'.\r\n')
+                await self.read_reply()
+            await self.rset()
+            if replies[0][0] != 250:
+                raise smtplib.SMTPSenderRefused(replies[0][0], replies[0][1], sender)
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if chunking:
+            await self._bdat(data if chunks is None else chunks, bdat_chunk_size if chunks is None else stream_chunk_size)
+            return refused
+        if code is None:
+            code, resp = await self.command('DATA', None)
+        if code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        if chunks is None:
+            await self.write(data)
+        else:
+            for chunk in rechunk(dot_stuff(chunks), stream_chunk_size):
+                await self.write(chunk)
+        code, resp = await self.read_reply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    async def _bdat(self, data: Union[bytes, Iterable[bytes]], chunk_size: int=bdat_chunk_size) -> None:
+        """Send message data in BDAT chunks, from the whole message or an iterator of chunks."""
+        chunks = rechunk([data] if isinstance(data, bytes) else data, chunk_size)
+        chunk = next(chunks, b'')
+        while True:
+            following = next(chunks, None)
+            await self.write(f"BDAT {len(chunk)}{' LAST' if following is None else ''}\r\n".encode('ascii') + chunk)
+            code, resp = await self.read_reply()
+            if code != 250:
+                raise smtplib.SMTPDataError(code, resp)
+            if following is None:
+                return
+            chunk = following
+
+    async def noop(self) -> Tuple[int, bytes]:
+        return await self.command('NOOP', None)
+
+    async def rset(self) -> Tuple[int, bytes]:
+        return await self.command('RSET', None)
+
+    async def quit(self) -> None:
+        try:
+            await self.command('QUIT', None)
+        except Exception:
+            pass
+        self.close()
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class AsyncSMTPRelay:
+    """Sessions towards one SMTP relay, with a bound on concurrent transactions."""
+
+    def __init__(self, connect: Callable[[], Awaitable[AsyncSMTPConnection]], concurrency: int, idle_timeout_s: float, name: str='smtp') -> None:
+        """Construct a relay with no open sessions; call from within the event loop.
+
+        :param connect:         Coroutine function returning a new session ready for transactions.
+        :param concurrency:     Maximum number of concurrent transactions, hence of open sessions.
+        :param idle_timeout_s:  Close sessions idle for longer than this many seconds.
+        :param name:            Name of the relay for logs and metrics.
+        """
+        self.connect = connect
+        self.concurrency = concurrency
+        self.idle_timeout_s = idle_timeout_s
+        self.name = name
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._idle: List[Tuple[AsyncSMTPConnection, float]] = []
+        self.in_flight = 0
+
+    async def _acquire(self) -> Tuple[AsyncSMTPConnection, bool]:
+        now = time.monotonic()
+        while self._idle:
+            conn, released = self._idle.pop()
+            if now - released <= self.idle_timeout_s:
+                metrics.incr('smtp_connections_reused', relay=self.name)
+                return conn, True
+            await conn.quit()
+        conn = await self.connect()
+        metrics.incr('smtp_connections_opened', relay=self.name)
+        return conn, False
+
+    async def _release(self, conn: AsyncSMTPConnection, err: Optional[Exception]=None) -> None:
+        if err is not None:
+            if not isinstance(err, smtplib.SMTPException) or is_connection_broken(err):
+                conn.close()
+                return
+            if isinstance(err, smtplib.SMTPDataError):
+                # the server may or may not have completed the transaction
+                try:
+                    if (await conn.rset())[0] != 250:
+                        raise smtplib.SMTPException()
+                except Exception:
+                    conn.close()
+                    return
+        self._idle.append((conn, time.monotonic()))
+
+    async def sendmail(self, sender: str, recipients: Iterable[str], msg: Union[str, bytes, EncodedMessage]) -> Dict[str, Tuple[int, bytes]]:
+        """Deliver a message on a session to this relay, waiting for a free slot if needed.
+
+        A transaction failing because a reused session turns out broken is retried once on a new session.
+        """
+        async with self._semaphore:
+            self.in_flight += 1
+            metrics.set_gauge('smtp_async_in_flight', self.in_flight, relay=self.name)
+            try:
+                conn, reused = await self._acquire()
+                try:
+                    result = await conn.sendmail(sender, recipients, msg)
+                except Exception as err:
+                    await self._release(conn, err)
+                    if not (reused and is_connection_broken(err)):
+                        raise
+                    log.info("Reused SMTP session to %s broke (%s: %s). Retrying on a new session.", self.name, type(err).__name__, err)
+                else:
+                    await self._release(conn)
+                    return result
+                conn = await self.connect()
+                metrics.incr('smtp_connections_opened', relay=self.name)
+                try:
+                    result = await conn.sendmail(sender, recipients, msg)
+                except Exception as err:
+                    await self._release(conn, err)
+                    raise
+                await self._release(conn)
+                return result
+            finally:
+                self.in_flight -= 1
+                metrics.set_gauge('smtp_async_in_flight', self.in_flight, relay=self.name)
+
+    async def close(self) -> None:
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            await conn.quit()
+
+
+class AsyncSMTPEngine:
+    """Runs SMTP transactions on an event loop in a background thread, accepting submissions from any thread."""
+
+    def __init__(self) -> None:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._relays: Dict[Hashable, AsyncSMTPRelay] = {}
+        self._lock = threading.Lock()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='tattler-smtp-async', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _get_relay(self, key: Hashable, connect: Callable[[], Awaitable[AsyncSMTPConnection]], concurrency: int, idle_timeout_s: float, name: str) -> AsyncSMTPRelay:
+        relay = self._relays.get(key)
+        if relay is None or relay.concurrency != concurrency:
+            if relay is not None:
+                asyncio.ensure_future(relay.close())
+            relay = AsyncSMTPRelay(connect, concurrency, idle_timeout_s, name)
+            self._relays[key] = relay
+        relay.idle_timeout_s = idle_timeout_s
+        return relay
+
+    def submit(self, relay_settings: Mapping, concurrency: int, idle_timeout_s: float, sender: str, recipients: Iterable[str], msg: Union[str, bytes, EncodedMessage]) -> concurrent.futures.Future:
+        """Submit a message for delivery, without waiting for it.
+
+        :param relay_settings:  Arguments for :class:`AsyncSMTPConnection` identifying the relay and how to connect to it.
+        :param concurrency:     Maximum number of concurrent transactions towards the relay.
+        :param idle_timeout_s:  Close sessions to the relay idle for longer than this many seconds.
+        :param sender:          Envelope sender address.
+        :param recipients:      Envelope recipient addresses.
+        :param msg:             Message to deliver.
+
+        :return:                Future resolving to the dictionary of refused recipients, like :meth:`smtplib.SMTP.sendmail`.
+        """
+        key = tuple(sorted(relay_settings.items()))
+        name = f"{relay_settings['host']}:{relay_settings['port']}"
+        recipients = list(recipients)
+
+        async def connect():
+            return await AsyncSMTPConnection(**relay_settings).connect()
+
+        async def deliver():
+            relay = self._get_relay(key, connect, concurrency, idle_timeout_s, name)
+            return await relay.sendmail(sender, recipients, msg)
+
+        return asyncio.run_coroutine_threadsafe(deliver(), self._get_loop())
+
+    def close(self, timeout: float=5) -> None:
+        """Close idle sessions, and stop the event loop."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+            relays, self._relays = list(self._relays.values()), {}
+        if loop is None:
+            return
+
+        async def close_relays():
+            for relay in relays:
+                await relay.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(close_relays(), loop).result(timeout)
+        except Exception as err:
+            log.debug("Failed to close SMTP sessions cleanly: %s", err)
+        loop.call_soon_threadsafe(loop.stop)
+
+
+_engine = AsyncSMTPEngine()
+atexit.register(_engine.close)
+
+def get_engine() -> AsyncSMTPEngine:
+    """Return the process-wide asynchronous SMTP engine."""
+    return _engine
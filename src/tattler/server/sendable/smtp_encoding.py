@@ -0,0 +1,248 @@
+"""Encoding of email messages according to the extensions advertised by the SMTP relay.
+
+By default, non-ASCII bodies are sent base64 or quoted-printable encoded, which inflates them by
+a third or more. Relays advertising 8BITMIME accept 8-bit bodies as they are, relays advertising
+SMTPUTF8 accept UTF-8 headers and addresses as they are, and relays advertising CHUNKING accept
+the message in BDAT chunks, sparing the dot-stuffing and scanning for the end of DATA.
+"""
+
+import smtplib
+from email.generator import BytesGenerator, Generator
+from email.message import EmailMessage, Message
+from email.policy import Policy
+from io import BytesIO, StringIO
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+# longest line allowed by SMTP, excluding CRLF
+_max_line_bytes = 998
+# size of BDAT chunks
+bdat_chunk_size = 1024 * 1024
+# stream messages estimated larger than this many bytes to the relay, rather than encoding them whole
+stream_threshold = 256 * 1024
+# size of the writes of streamed messages
+stream_chunk_size = 64 * 1024
+
+
+def text_cte(text: str, eightbit: bool) -> Optional[str]:
+    """Return the Content-Transfer-Encoding to set text with, or None to let the email package choose.
+
+    :param text:        Text of the MIME part.
+    :param eightbit:    Whether 8-bit content may be sent.
+    """
+    if not eightbit or text.isascii():
+        return None
+    if max((len(line) for line in text.encode('utf-8').splitlines()), default=0) > _max_line_bytes:
+        return None
+    return '8bit'
+
+
+def flatten(msg: Message, policy: Policy, binary: bool) -> Union[str, bytes]:
+    """Serialize a message like :meth:`EmailMessage.as_string` or :meth:`EmailMessage.as_bytes` do, with a given policy."""
+    if binary:
+        buf = BytesIO()
+        BytesGenerator(buf, mangle_from_=False, policy=policy).flatten(msg)
+    else:
+        buf = StringIO()
+        Generator(buf, mangle_from_=False, policy=policy).flatten(msg)
+    return buf.getvalue()
+
+
+class EncodedMessage:
+    """A message to deliver, encoded on demand according to the extensions of the relay it's delivered to."""
+
+    def __init__(self, build: Callable[[bool], EmailMessage], sender: str, recipients: Iterable[str]) -> None:
+        """Construct a message.
+
+        :param build:       Function returning the message, with 8-bit bodies if its argument is True.
+        :param sender:      Envelope sender.
+        :param recipients:  Envelope recipients.
+        """
+        self.build = build
+        self.sender = sender
+        self.recipients = list(recipients)
+        self._messages: Dict[bool, EmailMessage] = {}
+        self._encoded: Dict[Tuple, Union[str, bytes]] = {}
+
+    def _message(self, eightbit: bool) -> EmailMessage:
+        if eightbit not in self._messages:
+            self._messages[eightbit] = self.build(eightbit)
+        return self._messages[eightbit]
+
+    def _flatten(self, eightbit: bool, binary: bool, **policy_changes) -> Union[str, bytes]:
+        """Serialize the message, as text or bytes, with its policy changed as given."""
+        msg = self._message(eightbit)
+        return flatten(msg, msg.policy.clone(**policy_changes), binary)
+
+    def as_string(self) -> str:
+        """Return the message encoded in 7-bit, as text."""
+        if 'str' not in self._encoded:
+            self._encoded['str'] = self._flatten(False, False)
+        return self._encoded['str']
+
+    def as_bytes(self, eightbit: bool, smtputf8: bool=False) -> bytes:
+        """Return the message encoded for the wire, with CRLF line endings.
+
+        :param eightbit:    Whether to send non-ASCII bodies in 8-bit.
+        :param smtputf8:    Whether to send non-ASCII headers in UTF-8.
+        """
+        key = (eightbit, smtputf8)
+        if key not in self._encoded:
+            self._encoded[key] = self._flatten(eightbit, True, linesep='\r\n', utf8=smtputf8, cte_type='8bit' if eightbit else '7bit')
+        return self._encoded[key]
+
+    def needs_smtputf8(self) -> bool:
+        """Return whether the headers or addresses of the message hold non-ASCII characters."""
+        msg = self._message(True)
+        return not all(str(v).isascii() for v in msg.values()) or not all(a.isascii() for a in [self.sender] + self.recipients)
+
+    def size_hint(self) -> int:
+        """Return an estimate of the size of the message in bytes, or 0 if unknown."""
+        return 0
+
+    def stream(self, has_extn: Callable[[str], bool]) -> Optional[Tuple[Iterator[bytes], List[str]]]:
+        """Return the message as an iterator of chunks best encoded for a relay, and the options for MAIL FROM.
+
+        Large messages are generated while they are sent, so they are never held whole in memory.
+
+        :param has_extn:    Function returning whether the relay supports the ESMTP extension named.
+        :return:            Pair (chunks with CRLF line endings, mail options); or None if the message is better sent whole.
+        """
+        return None
+
+    def for_extensions(self, has_extn: Callable[[str], bool], chunking: bool=False) -> Tuple[Union[str, bytes], List[str]]:
+        """Return the message as best encoded for a relay, and the options for MAIL FROM.
+
+        :param has_extn:    Function returning whether the relay supports the ESMTP extension named.
+        :param chunking:    Whether the message will be sent with BDAT, hence is needed in bytes.
+
+        :return:            Pair (message, mail options), with the message as text if 7-bit and not chunking, as bytes otherwise.
+        """
+        if not has_extn('8bitmime'):
+            if chunking:
+                return self.as_bytes(False), []
+            return self.as_string(), []
+        smtputf8 = has_extn('smtputf8') and self.needs_smtputf8()
+        data = self.as_bytes(True, smtputf8)
+        if data.isascii():
+            return (data if chunking else self.as_string()), []
+        return data, ['BODY=8BITMIME'] + (['SMTPUTF8'] if smtputf8 else [])
+
+
+def rechunk(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """Yield the data of some chunks in chunks of a given size, the last one possibly shorter."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+def dot_stuff(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield message data for the DATA command, dot-stuffed and terminated, from chunks with CRLF line endings."""
+    line_start = True
+    last = b'\r\n'
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if line_start and chunk.startswith(b'.'):
+            chunk = b'.' + chunk
+        chunk = chunk.replace(b'\n.', b'\n..')
+        line_start = chunk.endswith(b'\n')
+        last = chunk
+        yield chunk
+    yield (b'' if last.endswith(b'\r\n') else b'\r\n') + b'.\r\n'
+
+def _envelope(server: smtplib.SMTP, sender: str, recipients: List[str], mail_options: Iterable[str]) -> Dict[str, Tuple[int, bytes]]:
+    """Send MAIL FROM and RCPT TO like :meth:`smtplib.SMTP.sendmail` does, and return refused recipients."""
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(sender, list(mail_options))
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    refused = {}
+    for rcpt in recipients:
+        code, resp = server.rcpt(rcpt)
+        if code not in (250, 251):
+            refused[rcpt] = (code, resp)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        _reset(server, 0)
+        raise smtplib.SMTPRecipientsRefused(refused)
+    return refused
+
+def bdat_sendmail(server: smtplib.SMTP, sender: str, recipients: Iterable[str], data: Union[bytes, Iterable[bytes]], mail_options: Iterable[str]=(), chunk_size: int=bdat_chunk_size) -> Mapping[str, Tuple[int, bytes]]:
+    """Deliver a message with BDAT, like :meth:`smtplib.SMTP.sendmail` does with DATA.
+
+    :param data:    Message with CRLF line endings, whole or as an iterator of chunks.
+    :return:        Dictionary of refused recipients, mapped to the (code, text) of their refusal.
+    """
+    refused = _envelope(server, sender, list(recipients), mail_options)
+    chunks = rechunk([data] if isinstance(data, bytes) else data, chunk_size)
+    chunk = next(chunks, b'')
+    while True:
+        following = next(chunks, None)
+        server.send(f"BDAT {len(chunk)}{' LAST' if following is None else ''}\r\n".encode('ascii') + chunk)
+        code, resp = server.getreply()
+        if code != 250:
+            _reset(server, code)
+            raise smtplib.SMTPDataError(code, resp)
+        if following is None:
+            return refused
+        chunk = following
+
+def data_sendmail(server: smtplib.SMTP, sender: str, recipients: Iterable[str], chunks: Iterable[bytes], mail_options: Iterable[str]=()) -> Mapping[str, Tuple[int, bytes]]:
+    """Deliver a message given as an iterator of chunks with DATA, writing them to the connection as they come.
+
+    :param chunks:  Chunks of the message, with CRLF line endings.
+    :return:        Dictionary of refused recipients, mapped to the (code, text) of their refusal.
+    """
+    refused = _envelope(server, sender, list(recipients), mail_options)
+    code, resp = server.docmd('data')
+    if code != 354:
+        _reset(server, code)
+        raise smtplib.SMTPDataError(code, resp)
+    for chunk in rechunk(dot_stuff(chunks), stream_chunk_size):
+        server.send(chunk)
+    code, resp = server.getreply()
+    if code != 250:
+        _reset(server, code)
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+def _reset(server: smtplib.SMTP, code: int) -> None:
+    if code == 421:
+        server.close()
+    else:
+        try:
+            server.rset()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+def sendmail(server: smtplib.SMTP, sender: str, recipients: Iterable[str], message: Union[str, EncodedMessage]) -> Mapping[str, Tuple[int, bytes]]:
+    """Deliver a message on a connection, encoded as compactly as the relay allows, and with BDAT if available.
+
+    Large messages are streamed to the connection while they are generated.
+
+    :return:    Dictionary of refused recipients, like :meth:`smtplib.SMTP.sendmail`.
+    """
+    if not isinstance(message, EncodedMessage):
+        return server.sendmail(sender, recipients, message)
+    server.ehlo_or_helo_if_needed()
+    features = server.esmtp_features
+    chunking = 'chunking' in features
+    streamed = message.stream(lambda name: name in features)
+    if streamed is not None:
+        chunks, options = streamed
+        if chunking:
+            return bdat_sendmail(server, sender, recipients, chunks, options, chunk_size=stream_chunk_size)
+        return data_sendmail(server, sender, recipients, chunks, options)
+    data, options = message.for_extensions(lambda name: name in features, chunking)
+    if chunking:
+        return bdat_sendmail(server, sender, recipients, data, options)
+    if options:
+        return server.sendmail(sender, recipients, data, options)
+    return server.sendmail(sender, recipients, data)
@@ -0,0 +1,151 @@
+"""Adaptive limit on concurrent SMTP sessions towards a relay, with additive-increase/multiplicative-decrease.
+
+The limit grows by one session for every "limit" transactions completing healthily, i.e. by
+about one session per round of transactions. It is cut by a constant factor when the relay
+answers with temporary failures -- like 421 or 451, for whole transactions or for some of their
+recipients -- when connections break, or when latency rises well above the lowest latency observed.
+Cuts happen at most once per round trip, so a burst of failures from one overloaded round backs off once.
+
+The current limit and the backoff events are exported as metrics ``smtp_concurrency_limit``
+and ``smtp_concurrency_backoffs``.
+"""
+
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterator, Mapping, Optional, Tuple
+
+from tattler.server import metrics
+from tattler.server.sendable.smtp_pool import is_connection_broken
+
+log = logging.getLogger(__name__)
+
+# weight of the latest observation in the moving average of latency
+_ewma_alpha = 0.2
+
+
+def is_temporary_failure(err: Exception) -> bool:
+    """Return whether an error from an SMTP transaction suggests that the relay is overloaded."""
+    if is_connection_broken(err):
+        return True
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return bool(err.recipients) and all(400 <= code < 500 for code, _ in err.recipients.values())
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 400 <= err.smtp_code < 500
+    return isinstance(err, (TimeoutError, ConnectionError))
+
+
+def temporary_refusal(refused: Optional[Mapping[str, Tuple[int, bytes]]]) -> Optional[smtplib.SMTPRecipientsRefused]:
+    """Return the recipients which a transaction accepted by the relay refused temporarily, as an error to release a slot with; or None if there are none.
+
+    :param refused:     Recipients refused by the transaction, mapped to the (code, message) of their refusal.
+    """
+    temporary = {rcpt: answer for rcpt, answer in (refused or {}).items() if 400 <= answer[0] < 500}
+    return smtplib.SMTPRecipientsRefused(temporary) if temporary else None
+
+
+class AIMDLimiter:
+    """Bounds the number of concurrent operations, adapting the bound to the health of their outcomes."""
+
+    def __init__(self, max_limit: int, min_limit: int=1, initial: Optional[int]=None, backoff_factor: float=0.5, latency_tolerance: float=2.0, name: str='smtp') -> None:
+        """Construct a limiter.
+
+        :param max_limit:           Highest limit to grow to.
+        :param min_limit:           Lowest limit to back off to.
+        :param initial:             Initial limit; None for min(2, max_limit).
+        :param backoff_factor:      Multiply the limit by this factor upon backoff.
+        :param latency_tolerance:   Back off when the average latency exceeds this many times the lowest observed.
+        :param name:                Name of the limiter, e.g. the relay, for logs and metrics.
+        """
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.name = name
+        self.limit = float(initial if initial is not None else min(2, max_limit))
+        self.in_flight = 0
+        self.latency_ewma: Optional[float] = None
+        self.latency_min: Optional[float] = None
+        self._backoff_at = 0.0
+        self._cond = threading.Condition()
+        self._update_gauge()
+
+    def acquire(self, timeout: float) -> None:
+        """Wait until fewer operations than the limit are in flight, and count one more in.
+
+        :raise TimeoutError: if no slot became available within timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No SMTP session slot to {self.name} became available within {timeout}s (limit {int(self.limit)}).")
+                self._cond.wait(remaining)
+            self.in_flight += 1
+
+    def release(self, latency: float, err: Optional[Exception]=None) -> None:
+        """Count an operation out, and adapt the limit to its outcome.
+
+        :param latency:     Duration of the operation, in seconds.
+        :param err:         Error the operation failed with, or None if it succeeded.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if err is not None:
+                if is_temporary_failure(err):
+                    self._backoff(f"{type(err).__name__}: {err}")
+            else:
+                # let the baseline creep up, lest a fluke low latency hold the limit down for good
+                self.latency_min = latency if self.latency_min is None else min(latency, self.latency_min * 1.01)
+                self.latency_ewma = latency if self.latency_ewma is None else _ewma_alpha * latency + (1 - _ewma_alpha) * self.latency_ewma
+                if self.latency_ewma > self.latency_tolerance * self.latency_min and self.latency_ewma - self.latency_min > 0.01:
+                    self._backoff(f"latency {self.latency_ewma:.3f}s vs {self.latency_min:.3f}s")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+        self._update_gauge()
+
+    def _backoff(self, reason: str) -> None:
+        """Cut the limit, unless it was already cut within the last round trip or is at its minimum; call with lock held."""
+        now = time.monotonic()
+        if self.limit <= self.min_limit or now - self._backoff_at < (self.latency_ewma or 0.0):
+            return
+        self._backoff_at = now
+        old = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        if self.latency_ewma is not None and self.latency_min is not None:
+            # re-learn latency at the new concurrency
+            self.latency_ewma = self.latency_min
+        log.info("Backing off SMTP concurrency to %s from %d to %d (%s).", self.name, old, int(self.limit), reason)
+        metrics.incr('smtp_concurrency_backoffs', relay=self.name)
+
+    @contextmanager
+    def slot(self, timeout: float) -> Iterator[None]:
+        """Context manager holding a slot for the duration of an operation, and adapting the limit to its outcome."""
+        self.acquire(timeout)
+        t0 = time.monotonic()
+        try:
+            yield
+        except Exception as err:
+            self.release(time.monotonic() - t0, err)
+            raise
+        self.release(time.monotonic() - t0)
+
+    def _update_gauge(self) -> None:
+        metrics.set_gauge('smtp_concurrency_limit', int(self.limit), relay=self.name)
+
+
+_limiters: Dict[Hashable, AIMDLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(key: Hashable, max_limit: int, name: str='smtp') -> AIMDLimiter:
+    """Return the process-wide limiter for a relay, creating it if needed."""
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = AIMDLimiter(max_limit, name=name)
+        limiter.max_limit = max_limit
+        return limiter
@@ -0,0 +1,138 @@
+"""Per-recipient outcomes of SMTP transactions, and scheduling of retries for temporary failures.
+
+Replies in the 4xx range, and connections failing mid-way, are temporary: the affected recipients
+may be retried later, with exponential backoff and jitter. Replies in the 5xx range are permanent.
+Only the recipients affected by a failure are retried, never those the relay already accepted.
+Recipients with a retry scheduled are reported as pending, not delivered.
+"""
+
+import heapq
+import itertools
+import logging
+import random
+import smtplib
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Mapping, Optional, Tuple
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+DELIVERED = 'delivered'
+RETRY = 'retry'
+FAILED = 'failed'
+# deferred to a later delivery attempt, e.g. a retry or by pacing
+PENDING = 'pending'
+
+# longest delay between retries, in seconds
+_max_backoff_s = 3600
+
+
+@dataclass
+class RecipientOutcome:
+    """Outcome of a delivery attempt to one recipient."""
+    recipient: str
+    status: str
+    code: Optional[int] = None
+    message: str = ''
+    attempt: int = 0
+
+    @property
+    def retryable(self) -> bool:
+        return self.status == RETRY
+
+
+def is_retryable_code(code: Optional[int]) -> bool:
+    """Return whether an SMTP reply code denotes a temporary failure. Unknown codes (None) are temporary."""
+    return code is None or 400 <= code < 500
+
+def _decode(msg) -> str:
+    return msg.decode('utf-8', 'replace') if isinstance(msg, bytes) else str(msg)
+
+def _failure(recipient: str, code: Optional[int], msg, attempt: int) -> RecipientOutcome:
+    return RecipientOutcome(recipient, RETRY if is_retryable_code(code) else FAILED, code, _decode(msg), attempt)
+
+def outcomes_from_refused(recipients: Iterable[str], refused: Mapping[str, Tuple[int, bytes]], attempt: int=0) -> List[RecipientOutcome]:
+    """Return outcomes of a transaction which succeeded for all recipients but those refused.
+
+    :param recipients:  Recipients of the transaction.
+    :param refused:     Refused recipients, mapped to the (code, message) of their refusal, as returned by ``sendmail()``.
+    :param attempt:     Number of the attempt, 0 for the first.
+    """
+    return [_failure(r, *refused[r], attempt) if r in refused else RecipientOutcome(r, DELIVERED, 250, '', attempt) for r in recipients]
+
+def outcomes_from_error(recipients: Iterable[str], err: Exception, attempt: int=0) -> List[RecipientOutcome]:
+    """Return outcomes of a transaction which failed with an error.
+
+    :param recipients:  Recipients of the transaction.
+    :param err:         Error raised by the transaction.
+    :param attempt:     Number of the attempt, 0 for the first.
+
+    :raise Exception:   err itself, if it does not come from SMTP delivery.
+    """
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return [_failure(r, *err.recipients.get(r, (None, str(err))), attempt) for r in recipients]
+    if isinstance(err, smtplib.SMTPResponseException):
+        return [_failure(r, err.smtp_code, err.smtp_error, attempt) for r in recipients]
+    if isinstance(err, (smtplib.SMTPException, OSError)):
+        return [_failure(r, None, f"{type(err).__name__}: {err}", attempt) for r in recipients]
+    raise err
+
+def backoff_delay(attempt: int, base_s: float, cap_s: float=_max_backoff_s) -> float:
+    """Return the delay before retry number 'attempt' (from 1), with exponential backoff and full jitter."""
+    return random.uniform(0, min(cap_s, base_s * 2 ** (attempt - 1)))
+
+
+class RetryScheduler:
+    """Runs functions after a delay, on a background thread."""
+
+    def __init__(self) -> None:
+        self._queue: List[Tuple[float, int, Callable[[], None]]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        """Return the number of functions waiting to run."""
+        return len(self._queue)
+
+    def schedule(self, delay: float, func: Callable[[], None]) -> None:
+        """Run func in 'delay' seconds."""
+        with self._cond:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._seq), func))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='tattler-smtp-retry', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    self._cond.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                _, _, func = heapq.heappop(self._queue)
+            try:
+                func()
+            except Exception:
+                log.exception("Scheduled SMTP retry failed:")
+
+
+_scheduler = RetryScheduler()
+
+def get_scheduler() -> RetryScheduler:
+    """Return the process-wide scheduler of retries."""
+    return _scheduler
+
+def record(outcomes: Iterable[RecipientOutcome], nid: str='') -> None:
+    """Log outcomes and account for them in metrics."""
+    for outcome in outcomes:
+        metrics.incr('smtp_recipient_outcomes', status=outcome.status)
+        if outcome.status == DELIVERED:
+            log.debug("n%s: Recipient %s accepted by relay (attempt %d).", nid, outcome.recipient, outcome.attempt)
+        elif outcome.status == PENDING:
+            log.info("n%s: Recipient %s deferred: %s (attempt %d).", nid, outcome.recipient, ' '.join(str(x) for x in (outcome.code, outcome.message) if x), outcome.attempt)
+        else:
+            log.warning("n%s: Recipient %s %s with %s %s (attempt %d).", nid, outcome.recipient,
+                        'failed temporarily' if outcome.retryable else 'failed permanently', outcome.code, outcome.message, outcome.attempt)
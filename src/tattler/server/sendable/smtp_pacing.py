@@ -0,0 +1,156 @@
+"""Pacing of email deliveries per recipient domain, with token buckets.
+
+Large mailbox providers defer senders who deliver too many messages at once. Pacing spreads
+deliveries to each configured domain at a sustained rate, allowing short bursts. Recipients are
+grouped by domain, and each recipient takes one token from its domain's bucket. Recipients whose
+domain has tokens are delivered at once; the others are handed to a scheduler to deliver when their
+bucket refills, so a throttled domain never holds up the deliveries to other domains.
+"""
+
+import logging
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# domain pattern applying to domains not listed explicitly
+default_domain = '*'
+
+
+def recipient_domain(recipient: str) -> str:
+    """Return the domain of a (normalized) email address."""
+    return recipient.rsplit('@', 1)[-1].lower()
+
+
+class TokenBucket:
+    """Allow operations at a sustained rate, with bursts up to a capacity."""
+
+    def __init__(self, rate: float, burst: Optional[float]=None) -> None:
+        """Construct a full bucket.
+
+        :param rate:    Sustained rate of operations per second.
+        :param burst:   Capacity of the bucket, i.e. the operations allowed at once; None for max(1, rate).
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: Optional[float]=None) -> float:
+        """Return the number of seconds until a token is available, 0 if one is available now."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: Optional[float]=None) -> bool:
+        """Take a token if one is available, and return whether one was taken."""
+        return self.take_upto(1, now) == 1
+
+    def take_upto(self, count: int, now: Optional[float]=None) -> int:
+        """Take as many tokens as available, up to count, and return how many were taken."""
+        self.delay(now)
+        taken = min(count, int(self.tokens))
+        self.tokens -= taken
+        return taken
+
+
+def parse_rates(spec: str) -> Mapping[str, Tuple[float, Optional[float]]]:
+    """Parse a pacing specification like ``gmail.com=10,outlook.com=5:20,*=50``.
+
+    :param spec:    Comma-separated list of ``domain=rate[:burst]``, rates in messages per second; ``*`` applies to other domains.
+
+    :return:        Dictionary mapping domain to (rate, burst or None).
+    :raise ValueError: if the specification is malformed.
+    """
+    rates = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        domain, sep, value = item.partition('=')
+        rate, _, burst = value.partition(':')
+        try:
+            rate = float(rate)
+            burst = float(burst) if burst.strip() else None
+        except ValueError:
+            raise ValueError(f"Invalid pacing rate '{item.strip()}'. Use domain=rate[:burst], e.g. gmail.com=10:20.") from None
+        if not sep or not domain.strip() or rate <= 0 or (burst is not None and burst < 1):
+            raise ValueError(f"Invalid pacing rate '{item.strip()}'. Use domain=rate[:burst], e.g. gmail.com=10:20.")
+        rates[domain.strip().lower()] = (rate, burst)
+    return rates
+
+
+class DomainPacer:
+    """Token buckets per recipient domain, telling which recipients may be delivered now and when the others may."""
+
+    def __init__(self, rates: Mapping[str, Tuple[float, Optional[float]]]) -> None:
+        """Construct a pacer.
+
+        :param rates:   Dictionary mapping domain to (rate per second, burst or None), see :func:`parse_rates`.
+                        Domains not listed use the rate of ``*`` if given, and are not paced otherwise.
+        """
+        self.rates = dict(rates)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, domain: str) -> Optional[TokenBucket]:
+        """Return the bucket pacing a domain, or None if the domain is not paced; call with lock held."""
+        key = domain if domain in self.rates else default_domain
+        if key not in self.rates:
+            return None
+        bucket = self._buckets.get(domain)
+        if bucket is None:
+            bucket = self._buckets[domain] = TokenBucket(*self.rates[key])
+        return bucket
+
+    def reserve(self, domain: str, count: int=1) -> Tuple[int, float]:
+        """Take one token per message for up to count messages to a domain.
+
+        :return:    (number of messages which may be delivered now, seconds until the next one may be if not all may now).
+        """
+        with self._lock:
+            bucket = self._bucket(domain)
+            if bucket is None:
+                return count, 0.0
+            granted = bucket.take_upto(count)
+            return granted, (bucket.delay() if granted < count else 0.0)
+
+    def dispatch(self, recipients: Iterable[str]) -> Tuple[List[Tuple[str, List[str]]], List[Tuple[float, str, List[str]]]]:
+        """Group recipients by domain, and tell which may be delivered now and when the others may.
+
+        :param recipients:  Recipients to deliver a message to.
+
+        :return:            (ready, deferred): ready lists (domain, recipients) to deliver now, and deferred
+                            lists (delay, domain, recipients) to deliver in delay seconds at the earliest.
+        """
+        ready, deferred = [], []
+        for domain, rcpts in group_by_domain(recipients):
+            granted, delay = self.reserve(domain, len(rcpts))
+            if granted:
+                ready.append((domain, rcpts[:granted]))
+            if granted < len(rcpts):
+                metrics.incr('smtp_pacing_waits', domain=domain)
+                log.debug("Pacing deliveries to %s: deferring %d recipients by %.3fs.", domain, len(rcpts) - granted, delay)
+                deferred.append((delay, domain, rcpts[granted:]))
+        return ready, deferred
+
+
+def group_by_domain(recipients: Iterable[str]) -> List[Tuple[str, List[str]]]:
+    """Group recipients by domain, in order of first appearance, and return a list of (domain, recipients)."""
+    groups: Dict[str, List[str]] = {}
+    for rcpt in recipients:
+        groups.setdefault(recipient_domain(rcpt), []).append(rcpt)
+    return list(groups.items())
+
+
+@lru_cache(maxsize=8)
+def get_pacer(spec: str) -> DomainPacer:
+    """Return the process-wide pacer for a pacing specification, see :func:`parse_rates`."""
+    return DomainPacer(parse_rates(spec))
@@ -0,0 +1,242 @@
+"""Process-wide pools of persistent SMTP connections, one per relay.
+
+Reusing connections spares the TCP and TLS handshakes, EHLO and AUTH of every delivery.
+Connections idle for long are checked with NOOP before reuse, connections left in an unknown
+state by a failed transaction are reset with RSET, and deliveries failing because a reused
+connection turns out broken (e.g. a 421 reply or a broken pipe) are retried once on a new connection.
+"""
+
+import atexit
+import logging
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple, TypeVar, Hashable
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# check with NOOP connections which have been idle for longer than this many seconds before reusing them
+_default_check_after_s = 5
+
+T = TypeVar('T')
+
+
+def is_connection_broken(err: Exception) -> bool:
+    """Return whether an error from an SMTP session means that its connection is no longer usable."""
+    if isinstance(err, (smtplib.SMTPServerDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError, TimeoutError)):
+        return True
+    return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code == 421
+
+
+def close_connection(conn: smtplib.SMTP) -> None:
+    """Close an SMTP connection, politely if possible."""
+    try:
+        conn.quit()
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class SMTPConnectionPool:
+    """A bounded pool of persistent connections to one SMTP relay."""
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], max_size: int, idle_timeout_s: float, check_after_s: float=_default_check_after_s, name: str='smtp') -> None:
+        """Construct an empty pool.
+
+        :param connect:         Function returning a new connection to the relay, ready for sending (i.e. past STARTTLS and AUTH).
+        :param max_size:        Maximum number of connections to hold open at once.
+        :param idle_timeout_s:  Close connections idle for longer than this many seconds.
+        :param check_after_s:   Check with NOOP connections idle for longer than this many seconds before reusing them.
+        :param name:            Name of the pool, e.g. the relay address, for logs and metrics.
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout_s = idle_timeout_s
+        self.check_after_s = check_after_s
+        self.name = name
+        # stack of (connection, time released), most recently released last
+        self._idle: List[Tuple[smtplib.SMTP, float]] = []
+        self._open = 0
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        """Return the number of connections currently open, idle or in use."""
+        return self._open
+
+    def _expire_idle(self) -> List[smtplib.SMTP]:
+        """Remove connections idle for too long and return them for closing; call with lock held."""
+        now = time.monotonic()
+        expired = [conn for conn, released in self._idle if now - released > self.idle_timeout_s]
+        if expired:
+            self._idle = [(conn, released) for conn, released in self._idle if now - released <= self.idle_timeout_s]
+            self._open -= len(expired)
+        return expired
+
+    def acquire(self, timeout: float) -> Tuple[smtplib.SMTP, bool]:
+        """Take a connection from the pool, opening one if none is idle, or waiting for one if the pool is full.
+
+        :param timeout:     Wait for a connection to be released for up to this many seconds if the pool is full.
+
+        :return:            Pair (connection, reused) with a connection ready for sending, and whether it was previously used.
+        :raise TimeoutError: if no connection became available within timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                expired = self._expire_idle()
+                while not self._idle and self._open >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No SMTP connection to {self.name} became available within {timeout}s (pool size {self.max_size}).")
+                    self._cond.wait(remaining)
+                    expired += self._expire_idle()
+                if self._idle:
+                    conn, released = self._idle.pop()
+                else:
+                    conn, released = None, None
+                    self._open += 1
+            for old in expired:
+                close_connection(old)
+            if conn is None:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    self._discard(None)
+                    raise
+                metrics.incr('smtp_connections_opened', relay=self.name)
+                self._update_gauge()
+                return conn, False
+            if time.monotonic() - released <= self.check_after_s or self._is_alive(conn):
+                metrics.incr('smtp_connections_reused', relay=self.name)
+                return conn, True
+            log.debug("Discarding dead SMTP connection to %s.", self.name)
+            self._discard(conn)
+
+    def _is_alive(self, conn: smtplib.SMTP) -> bool:
+        """Return whether a connection answers NOOP successfully."""
+        try:
+            return conn.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _discard(self, conn) -> None:
+        """Close a connection taken from the pool, and free its slot."""
+        if conn is not None:
+            close_connection(conn)
+        with self._cond:
+            self._open -= 1
+            self._cond.notify()
+        self._update_gauge()
+
+    def release(self, conn: smtplib.SMTP, reusable: bool=True) -> None:
+        """Return a connection to the pool.
+
+        :param conn:        Connection previously acquired.
+        :param reusable:    Whether the connection is in a clean state for further transactions; it's closed otherwise.
+        """
+        if not reusable:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _release_after_error(self, conn: smtplib.SMTP, err: Exception) -> None:
+        """Return a connection to the pool after a failed transaction, resetting it with RSET if it's still usable."""
+        reusable = False
+        if isinstance(err, smtplib.SMTPException) and not is_connection_broken(err):
+            try:
+                reusable = conn.rset()[0] == 250
+            except Exception:
+                reusable = False
+        self.release(conn, reusable)
+
+    @contextmanager
+    def connection(self, timeout: float) -> Iterator[Tuple[smtplib.SMTP, bool]]:
+        """Context manager acquiring a connection, and releasing it or discarding it upon errors.
+
+        After an SMTP error leaving the connection usable, the connection is reset with RSET before reuse.
+
+        :param timeout:     See :meth:`acquire`.
+
+        :return:            Pair (connection, reused), see :meth:`acquire`.
+        """
+        conn, reused = self.acquire(timeout)
+        try:
+            yield conn, reused
+        except Exception as err:
+            self._release_after_error(conn, err)
+            raise
+        self.release(conn)
+
+    def run(self, func: Callable[[smtplib.SMTP], T], timeout: float) -> T:
+        """Run an SMTP transaction on a pooled connection, retrying once on a new connection if a reused one turns out broken.
+
+        :param func:        Function performing the transaction on the connection given as argument.
+        :param timeout:     See :meth:`acquire`.
+
+        :return:            The return value of func.
+        """
+        conn, reused = self.acquire(timeout)
+        try:
+            result = func(conn)
+        except Exception as err:
+            self._release_after_error(conn, err)
+            if not (reused and is_connection_broken(err)):
+                raise
+            log.info("Reused SMTP connection to %s broke (%s: %s). Retrying on a new connection.", self.name, type(err).__name__, err)
+        else:
+            self.release(conn)
+            return result
+        with self.connection(timeout) as (conn, _):
+            return func(conn)
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn, _ in idle:
+            close_connection(conn)
+        self._update_gauge()
+
+    def _update_gauge(self) -> None:
+        metrics.set_gauge('smtp_pool_connections', self._open, relay=self.name)
+
+
+_pools: Dict[Hashable, SMTPConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+def get_pool(key: Hashable, connect: Callable[[], smtplib.SMTP], max_size: int, idle_timeout_s: float, name: str='smtp') -> SMTPConnectionPool:
+    """Return the process-wide pool of connections for a relay, creating it if needed.
+
+    :param key:             Hashable identifier of the relay and the settings of its connections, e.g. address and credentials.
+    :param connect:         Function opening a new connection to the relay, see :class:`SMTPConnectionPool`.
+    :param max_size:        Maximum number of connections to hold open at once.
+    :param idle_timeout_s:  Close connections idle for longer than this many seconds.
+    :param name:            Name of the pool for logs and metrics.
+
+    :return:                The pool for the relay.
+    """
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(connect, max_size, idle_timeout_s, name=name)
+            _pools[key] = pool
+        pool.connect = connect
+        pool.max_size = max_size
+        pool.idle_timeout_s = idle_timeout_s
+        return pool
+
+@atexit.register
+def close_all() -> None:
+    """Close the idle connections of every pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
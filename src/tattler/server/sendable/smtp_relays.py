@@ -0,0 +1,199 @@
+"""Health-aware selection among multiple SMTP relays, with failover and hedged connections.
+
+The health of each relay is tracked from the outcome of the connections opened to it:
+a moving average of latency and error rate, and a window of recent latencies for percentiles.
+Relays are tried in their configured order, primary first. Relays which failed recently are held
+in cooldown, and only tried once all others failed. Relays which are clearly degraded -- failing
+often, or much slower than the fastest healthy relay -- are tried after the healthy ones.
+
+When hedging is enabled and the preferred relay takes longer to answer than its 95th percentile
+latency, a connection to the next relay is attempted in parallel, and the first to succeed is used.
+Hedging applies to opening connections only, never to delivering a message, so it cannot cause
+duplicate deliveries.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from tattler.server import metrics
+
+log = logging.getLogger(__name__)
+
+# weight of the latest observation in moving averages
+_ewma_alpha = 0.2
+# minimum number of latency observations before computing percentiles
+_min_samples = 5
+# longest cooldown after consecutive failures, in seconds
+_max_cooldown_s = 60
+# relays failing at least this share of operations are degraded
+_degraded_error_rate = 0.5
+# relays slower than the fastest healthy relay by this factor are degraded
+_degraded_latency_factor = 3
+
+Relay = Tuple[str, int]
+T = TypeVar('T')
+
+
+class RelayHealth:
+    """Latency and error statistics of one relay."""
+
+    def __init__(self, window: int=100) -> None:
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.latencies = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.failed_at = 0.0
+        self._lock = threading.Lock()
+
+    def success(self, latency: float) -> None:
+        """Record a successful operation which took 'latency' seconds."""
+        with self._lock:
+            self.latencies.append(latency)
+            self.latency_ewma = latency if self.latency_ewma is None else _ewma_alpha * latency + (1 - _ewma_alpha) * self.latency_ewma
+            self.error_ewma *= 1 - _ewma_alpha
+            self.consecutive_failures = 0
+
+    def failure(self) -> None:
+        """Record a failed operation."""
+        with self._lock:
+            self.error_ewma = _ewma_alpha + (1 - _ewma_alpha) * self.error_ewma
+            self.consecutive_failures += 1
+            self.failed_at = time.monotonic()
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """Return the given percentile of recent latencies, or None if too few were observed."""
+        with self._lock:
+            samples = sorted(self.latencies)
+        if len(samples) < _min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(pct / 100 * len(samples)))]
+
+    def in_cooldown(self) -> bool:
+        """Return whether the relay failed recently enough to be avoided."""
+        if not self.consecutive_failures:
+            return False
+        return time.monotonic() - self.failed_at < min(_max_cooldown_s, 2 ** self.consecutive_failures)
+
+    def is_degraded(self, best_latency: Optional[float]) -> bool:
+        """Return whether the relay performs clearly worse than it should.
+
+        Relays never observed are not degraded, so they keep their configured rank.
+
+        :param best_latency:    Average latency of the fastest relay not in cooldown, if any was observed.
+        """
+        if self.error_ewma >= _degraded_error_rate:
+            return True
+        return self.latency_ewma is not None and best_latency is not None and self.latency_ewma > _degraded_latency_factor * best_latency
+
+
+_health: Dict[Relay, RelayHealth] = {}
+_health_lock = threading.Lock()
+
+def get_health(relay: Relay) -> RelayHealth:
+    """Return the health statistics of a relay."""
+    with _health_lock:
+        health = _health.get(relay)
+        if health is None:
+            health = _health[relay] = RelayHealth()
+        return health
+
+def reset() -> None:
+    """Forget the health statistics of all relays."""
+    with _health_lock:
+        _health.clear()
+
+def order(relays: Iterable[Relay]) -> List[Relay]:
+    """Return relays in order of preference: healthy ones, then degraded ones, then those in cooldown.
+
+    Within each group, relays keep their configured order.
+    """
+    relays = list(relays)
+    cooldown = {r: get_health(r).in_cooldown() for r in relays}
+    latencies = [get_health(r).latency_ewma for r in relays if not cooldown[r]]
+    best = min((lat for lat in latencies if lat is not None), default=None)
+    return sorted(relays, key=lambda r: (cooldown[r], get_health(r).is_degraded(best)))
+
+def relay_name(relay: Relay) -> str:
+    return f"{relay[0]}:{relay[1]}"
+
+def record_success(relay: Relay, latency: float) -> None:
+    get_health(relay).success(latency)
+    metrics.observe('smtp_relay_latency_seconds', latency, relay=relay_name(relay))
+
+def record_failure(relay: Relay, err: Exception) -> None:
+    log.warning("SMTP relay %s failed (%s: %s).", relay_name(relay), type(err).__name__, err)
+    get_health(relay).failure()
+    metrics.incr('smtp_relay_failures', relay=relay_name(relay))
+
+
+def _timed(func: Callable[[Relay], T], relay: Relay) -> T:
+    t0 = time.monotonic()
+    try:
+        result = func(relay)
+    except Exception as err:
+        record_failure(relay, err)
+        raise
+    record_success(relay, time.monotonic() - t0)
+    return result
+
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='tattler-smtp-connect')
+
+def connect(relays: Iterable[Relay], connect_one: Callable[[Relay], T], hedge: bool=False, discard: Optional[Callable[[T], None]]=None) -> T:
+    """Open a connection to the preferred relay, failing over to the others in order of preference.
+
+    :param relays:      Relays to choose from.
+    :param connect_one: Function opening a connection to the relay given as argument.
+    :param hedge:       Whether to also start connecting to the next relay when one takes longer than its 95th percentile latency.
+    :param discard:     Function closing connections opened by hedging but not used.
+
+    :return:            The first connection successfully opened.
+    :raise Exception:   The error of the last relay tried, if connecting to every relay failed.
+    """
+    remaining = order(relays)
+    if not remaining:
+        raise ValueError("No SMTP relay configured.")
+    if not hedge:
+        for i, relay in enumerate(remaining):
+            try:
+                return _timed(connect_one, relay)
+            except Exception:
+                if i == len(remaining) - 1:
+                    raise
+                log.info("Failing over to SMTP relay %s.", relay_name(remaining[i + 1]))
+    pending: Dict[Future, Relay] = {}
+    last_started: List[Relay] = []
+    last_error: Optional[Exception] = None
+
+    def start_next() -> None:
+        relay = remaining.pop(0)
+        pending[_executor.submit(_timed, connect_one, relay)] = relay
+        last_started[:] = [relay]
+
+    start_next()
+    while pending:
+        budget = get_health(last_started[0]).percentile(95) if remaining else None
+        done, _ = wait(list(pending), timeout=budget, return_when=FIRST_COMPLETED)
+        if not done:
+            log.info("SMTP relay %s slower than its p95 latency (%.3fs). Hedging with relay %s.", relay_name(last_started[0]), budget, relay_name(remaining[0]))
+            metrics.incr('smtp_relay_hedges', relay=relay_name(last_started[0]))
+            start_next()
+            continue
+        for fut in done:
+            pending.pop(fut)
+            try:
+                conn = fut.result()
+            except Exception as err:
+                last_error = err
+                continue
+            for other in pending:
+                other.add_done_callback(lambda f: discard(f.result()) if discard and not f.exception() else None)
+            return conn
+        if not pending and remaining:
+            log.info("Failing over to SMTP relay %s.", relay_name(remaining[0]))
+            start_next()
+    raise last_error
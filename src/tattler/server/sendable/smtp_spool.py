@@ -0,0 +1,270 @@
+"""Local spool of emails, handing them off at once for a separate worker to deliver over SMTP.
+
+The spool is a directory with maildir semantics: messages are written whole into ``tmp/``, then
+atomically renamed into ``new/``, so readers never see partial files. Workers claim a message by
+renaming it into ``cur/``, deliver it, and delete it. Recipients failing temporarily are put back
+into ``new/`` with a later due time, held in the modification time of the file; recipients failing
+permanently are moved into ``failed/`` for inspection, as are messages whose envelope cannot be read.
+
+Each file holds the envelope as one line of JSON, followed by the message as sent over SMTP:
+in 7-bit, with CRLF line endings.
+"""
+
+import itertools
+import json
+import logging
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from tattler.server import metrics
+from tattler.server.sendable import smtp_outcomes
+from tattler.server.sendable.smtp_encoding import EncodedMessage, stream_threshold, stream_chunk_size
+
+log = logging.getLogger(__name__)
+
+subdirs = ('tmp', 'new', 'cur', 'failed')
+
+_seq = itertools.count()
+
+Deliver = Callable[[str, EncodedMessage, List[str]], Mapping[str, Tuple[int, bytes]]]
+
+
+def _unique_name() -> str:
+    """Return a unique filename, following the maildir convention."""
+    now = time.time()
+    return f"{int(now)}.M{int(now % 1 * 1e6)}P{os.getpid()}Q{next(_seq)}.{socket.gethostname().replace('/', '_')}"
+
+def _fsync_dir(path: Path) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def ensure_dirs(spool_dir: Union[str, Path]) -> Path:
+    """Create the subdirectories of a spool if needed, and return its path."""
+    spool_dir = Path(spool_dir)
+    for subdir in subdirs:
+        (spool_dir / subdir).mkdir(parents=True, exist_ok=True)
+    return spool_dir
+
+def write(spool_dir: Union[str, Path], subdir: str, envelope: Mapping, chunks: Iterable[bytes], due: Optional[float]=None) -> Path:
+    """Write a message into a subdirectory of the spool atomically, and return its path.
+
+    :param spool_dir:   Directory of the spool.
+    :param subdir:      Subdirectory to write into, e.g. 'new'.
+    :param envelope:    Envelope of the message.
+    :param chunks:      Message, as chunks of bytes.
+    :param due:         Time (from epoch) from which the message may be delivered; None for now.
+    """
+    spool_dir = ensure_dirs(spool_dir)
+    name = _unique_name()
+    tmp_path = spool_dir / 'tmp' / name
+    with open(tmp_path, 'wb') as fout:
+        fout.write(json.dumps(envelope, ensure_ascii=False).encode('utf-8') + b'\n')
+        for chunk in chunks:
+            fout.write(chunk)
+        fout.flush()
+        os.fsync(fout.fileno())
+    if due is not None:
+        os.utime(tmp_path, (due, due))
+    path = spool_dir / subdir / name
+    os.rename(tmp_path, path)
+    _fsync_dir(path.parent)
+    return path
+
+def enqueue(spool_dir: Union[str, Path], message: EncodedMessage, sender: str, recipients: Iterable[str], nid: str='') -> Path:
+    """Hand a message off to the spool for later delivery, and return the path it was spooled to.
+
+    :param spool_dir:   Directory of the spool.
+    :param message:     Message to deliver.
+    :param sender:      Envelope sender.
+    :param recipients:  Envelope recipients.
+    :param nid:         ID of the notification, for logs.
+    """
+    streamed = message.stream(lambda name: False)
+    chunks = streamed[0] if streamed is not None else [message.as_bytes(False)]
+    envelope = {'sender': sender, 'recipients': list(recipients), 'nid': nid, 'attempt': 0, 'queued': time.time()}
+    path = write(spool_dir, 'new', envelope, chunks)
+    metrics.incr('smtp_spool_enqueued')
+    return path
+
+
+class SpooledMessage(EncodedMessage):
+    """A message read back from the spool, already encoded in 7-bit with CRLF line endings."""
+
+    def __init__(self, path: Path, offset: int, sender: str, recipients: Iterable[str]) -> None:
+        """Construct a message.
+
+        :param path:        Path of the spool file.
+        :param offset:      Offset of the message in the file, past the envelope.
+        :param sender:      Envelope sender.
+        :param recipients:  Envelope recipients.
+        """
+        super().__init__(None, sender, recipients)
+        self.path = path
+        self.offset = offset
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the message in chunks, read from the spool file."""
+        with open(self.path, 'rb') as fin:
+            fin.seek(self.offset)
+            while True:
+                chunk = fin.read(stream_chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _flatten(self, eightbit: bool, binary: bool, **policy_changes) -> Union[str, bytes]:
+        data = b''.join(self.chunks())
+        return data if binary else data.decode('ascii').replace('\r\n', '\n')
+
+    def size_hint(self) -> int:
+        return os.path.getsize(self.path) - self.offset
+
+    def stream(self, has_extn: Callable[[str], bool]) -> Optional[Tuple[Iterator[bytes], List[str]]]:
+        if self.size_hint() < stream_threshold:
+            return None
+        return self.chunks(), []
+
+    def needs_smtputf8(self) -> bool:
+        return False
+
+
+def read(path: Path) -> Tuple[dict, SpooledMessage]:
+    """Return the envelope and message of a spool file.
+
+    :raises ValueError: if the envelope is corrupt, e.g. because the file is truncated.
+    """
+    with open(path, 'rb') as fin:
+        line = fin.readline()
+    try:
+        envelope = json.loads(line)
+        return envelope, SpooledMessage(path, len(line), envelope['sender'], list(envelope['recipients']))
+    except (ValueError, KeyError, TypeError) as err:
+        raise ValueError(f"Corrupt envelope in spool file {path}: {err!r}") from err
+
+def pending(spool_dir: Union[str, Path], now: Optional[float]=None) -> List[str]:
+    """Return the names of the messages due for delivery, oldest first."""
+    now = time.time() if now is None else now
+    due = []
+    for entry in os.scandir(Path(spool_dir) / 'new'):
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if mtime <= now:
+            due.append((mtime, entry.name))
+    return [name for _, name in sorted(due)]
+
+def claim(spool_dir: Union[str, Path], name: str) -> Optional[Path]:
+    """Claim a message for delivery by moving it into cur/, and return its new path; or None if another worker claimed it first."""
+    path = Path(spool_dir) / 'cur' / name
+    try:
+        os.rename(Path(spool_dir) / 'new' / name, path)
+    except FileNotFoundError:
+        return None
+    # mark the time of the claim, to tell claims abandoned by crashed workers
+    os.utime(path)
+    return path
+
+def recover(spool_dir: Union[str, Path], stale_after_s: float) -> int:
+    """Put messages claimed longer than stale_after_s seconds ago back for delivery, e.g. after a worker crashed, and return how many."""
+    recovered = 0
+    threshold = time.time() - stale_after_s
+    for entry in os.scandir(Path(spool_dir) / 'cur'):
+        try:
+            if entry.stat().st_mtime < threshold:
+                os.rename(entry.path, Path(spool_dir) / 'new' / entry.name)
+                recovered += 1
+        except FileNotFoundError:
+            continue
+    if recovered:
+        log.warning("Recovered %d spooled emails abandoned during delivery.", recovered)
+    return recovered
+
+def process(spool_dir: Union[str, Path], path: Path, deliver: Deliver, retries: int, backoff_s: float) -> List[smtp_outcomes.RecipientOutcome]:
+    """Deliver a claimed message, put back recipients failing temporarily, set aside those failing permanently, and remove it.
+
+    :param spool_dir:   Directory of the spool.
+    :param path:        Path of the claimed message, as returned by :func:`claim`.
+    :param deliver:     Function delivering (sender, message, recipients) and returning refused recipients.
+    :param retries:     Maximum number of retries for recipients failing temporarily.
+    :param backoff_s:   Base delay before retries, in seconds, doubled at every retry.
+
+    :return:            The outcome of the delivery for each recipient; empty if the message is corrupt.
+    """
+    try:
+        envelope, message = read(path)
+    except ValueError as err:
+        failed_path = Path(spool_dir) / 'failed' / path.name
+        os.rename(path, failed_path)
+        metrics.incr('smtp_spool_corrupt')
+        log.error("%s. Email set aside in %s.", err, failed_path)
+        return []
+    recipients, attempt = envelope['recipients'], envelope.get('attempt', 0)
+    try:
+        outcomes = smtp_outcomes.outcomes_from_refused(recipients, deliver(envelope['sender'], message, recipients) or {}, attempt)
+    except Exception as err:
+        outcomes = smtp_outcomes.outcomes_from_error(recipients, err, attempt)
+    retry = [o.recipient for o in outcomes if o.retryable]
+    if retry and attempt < retries:
+        delay = smtp_outcomes.backoff_delay(attempt + 1, backoff_s)
+        log.info("n%s: Retrying delivery to %s in %.1fs (retry %d of %d).", envelope.get('nid', ''), retry, delay, attempt + 1, retries)
+        write(spool_dir, 'new', dict(envelope, recipients=retry, attempt=attempt + 1), message.chunks(), due=time.time() + delay)
+        for outcome in outcomes:
+            if outcome.retryable:
+                outcome.status = smtp_outcomes.PENDING
+    else:
+        for outcome in outcomes:
+            if outcome.retryable:
+                outcome.status = smtp_outcomes.FAILED
+    failed = [o for o in outcomes if o.status == smtp_outcomes.FAILED]
+    if failed:
+        failures = {o.recipient: f"{o.code} {o.message}" for o in failed}
+        failed_path = write(spool_dir, 'failed', dict(envelope, recipients=list(failures), failures=failures), message.chunks())
+        log.error("n%s: Delivery to %s failed permanently. Email set aside in %s.", envelope.get('nid', ''), list(failures), failed_path)
+    smtp_outcomes.record(outcomes, envelope.get('nid', ''))
+    os.unlink(path)
+    return outcomes
+
+def flush(spool_dir: Union[str, Path], deliver: Deliver, retries: int, backoff_s: float, concurrency: int=1) -> int:
+    """Deliver the messages due in the spool, and return how many were processed.
+
+    :param spool_dir:   Directory of the spool.
+    :param deliver:     Function delivering (sender, message, recipients) and returning refused recipients.
+    :param retries:     Maximum number of retries for recipients failing temporarily.
+    :param backoff_s:   Base delay before retries, in seconds, doubled at every retry.
+    :param concurrency: Number of messages to deliver in parallel.
+    """
+    ensure_dirs(spool_dir)
+    names = pending(spool_dir)
+    if not names:
+        return 0
+
+    def process_one(name: str) -> int:
+        path = claim(spool_dir, name)
+        if path is None:
+            return 0
+        try:
+            process(spool_dir, path, deliver, retries, backoff_s)
+        except Exception:
+            log.exception("Failed to process spooled email %s. Leaving it for recovery.", path)
+        return 1
+
+    if concurrency <= 1:
+        processed = sum(process_one(name) for name in names)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='tattler-spool') as tpe:
+            processed = sum(tpe.map(process_one, names))
+    metrics.incr('smtp_spool_processed', processed)
+    return processed
@@ -1,6 +1,7 @@
 """Base processor class based on vanilla python-style string expansion."""
 
-from typing import Mapping, Optional, Any
+import hashlib
+from typing import Mapping, Optional, Any, AbstractSet
 
 class TemplateProcessor:
     """A basic template processor based on python string interpolation, suitable for inheriting more complex processors.
@@ -38,3 +39,26 @@ class TemplateProcessor:
         :raises TypeError: if the template could not be expanded.
         """
         raise NotImplementedError
+
+    def variables(self) -> Optional[AbstractSet[str]]:
+        """Return the names of the context variables which the template may read during expansion.
+
+        Override this in processors which can analyze their templates. The default implementation
+        returns None, meaning that the variables cannot be determined and all must be assumed used.
+
+        :return:    Set of variable names the template reads, or None if unknown.
+        """
+        return None
+
+    def fingerprint(self) -> str:
+        """Return a digest identifying the version of the template.
+
+        The digest changes whenever the template or anything it is based upon changes.
+        Override this in processors whose templates depend on further sources, e.g. partials.
+
+        :return:    Hex digest of the template's version.
+        """
+        digest = hashlib.sha256(self.content.encode('utf-8'))
+        if self.base_content is not None:
+            digest.update(b'\0' + self.base_content.encode('utf-8'))
+        return digest.hexdigest()
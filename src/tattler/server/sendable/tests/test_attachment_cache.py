@@ -0,0 +1,134 @@
+"""Tests for the disk cache of attachments fetched from URLs"""
+
+import http.server
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server.sendable import attachment_cache, attachments
+from tattler.server.sendable.attachment_cache import AttachmentCache, parse_cache_control
+from tattler.server.sendable.attachments import normalize_attachments
+
+
+class _ETagHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's body with its ETag and Cache-Control, replying 304 to matching conditional requests."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        srv.requests.append((self.path, self.headers.get('If-None-Match')))
+        if srv.etag and self.headers.get('If-None-Match') == srv.etag:
+            self.send_response(304)
+        else:
+            self.send_response(200)
+        if srv.etag:
+            self.send_header('ETag', srv.etag)
+        if srv.cache_control:
+            self.send_header('Cache-Control', srv.cache_control)
+        body = srv.body if srv.etag is None or self.headers.get('If-None-Match') != srv.etag else b''
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestAttachmentCache(unittest.TestCase):
+    def setUp(self):
+        self.srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _ETagHandler)
+        self.srv.daemon_threads = True
+        self.srv.requests = []
+        self.srv.body, self.srv.etag, self.srv.cache_control = b'%PDF-1.4 terms v1', '"v1"', None
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.addCleanup(self.srv.server_close)
+        self.addCleanup(self.srv.shutdown)
+        self.base = f'http://127.0.0.1:{self.srv.server_address[1]}'
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.cachedir = Path(tmpdir.name)
+        self.cache = AttachmentCache(self.cachedir, 1024 * 1024)
+
+    def fetch(self, *paths):
+        out = normalize_attachments({f'doc{num}.pdf': {'url': f'{self.base}{path}'} for num, path in enumerate(paths)}, self.cache)
+        return [a.content for a in out]
+
+    def test_revalidation(self):
+        """Stale contents are revalidated with a conditional request, and downloaded again if changed"""
+        self.assertEqual([b'%PDF-1.4 terms v1'], self.fetch('/terms.pdf'))
+        self.assertEqual([b'%PDF-1.4 terms v1'], self.fetch('/terms.pdf'))
+        self.assertEqual([('/terms.pdf', None), ('/terms.pdf', '"v1"')], self.srv.requests)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.srv.body, self.srv.etag = b'%PDF-1.4 terms v2', '"v2"'
+        self.assertEqual([b'%PDF-1.4 terms v2'], self.fetch('/terms.pdf'))
+        self.assertEqual((1, 2), (self.cache.hits, self.cache.misses))
+        self.assertEqual(1, len(self.cache))
+
+    def test_fresh_served_without_request(self):
+        """Contents within their max-age are served without contacting the server; no-store ones are not cached"""
+        self.srv.cache_control = 'public, max-age=60'
+        self.fetch('/logo.png')
+        self.fetch('/logo.png')
+        self.assertEqual(1, len(self.srv.requests))
+        self.srv.cache_control, self.srv.etag = 'no-store', None
+        self.fetch('/private.pdf')
+        self.assertIsNone(self.cache.lookup(f'{self.base}/private.pdf'))
+
+    def test_total_cap_applies_to_cached(self):
+        """Contents served from cache count against the total size of attachments"""
+        self.srv.body, self.srv.cache_control = b'\x00' * 400, 'max-age=60'
+        with mock.patch.object(attachments, 'TOTAL_MAX_BYTES', 1000):
+            self.fetch('/a.pdf', '/b.pdf')
+            with self.assertRaisesRegex(ValueError, "exceed total cap"):
+                self.fetch('/a.pdf', '/b.pdf', '/a.pdf?again')
+            with self.assertRaisesRegex(ValueError, "exceed total cap"):
+                self.fetch('/a.pdf', '/b.pdf', '/a.pdf')
+
+    def test_lru_eviction_and_persistence(self):
+        """Least recently used URLs are evicted beyond the maximum size, identical contents are stored once, and entries survive restarts"""
+        cache = AttachmentCache(self.cachedir / 'small', 10)
+        cache.store('http://x/a', b'aaaa', '"a"', None, 0)
+        cache.store('http://x/a2', b'aaaa', '"a"', None, 0)
+        cache.store('http://x/b', b'bbbb', '"b"', None, 0)
+        self.assertEqual(8, cache.size)
+        time.sleep(0.01)
+        self.assertEqual(b'aaaa', cache.read(cache.lookup('http://x/a')))
+        cache.store('http://x/c', b'cccc', None, 'Mon, 01 Jan 2024 00:00:00 GMT', 0)
+        self.assertIsNone(cache.lookup('http://x/a2'))
+        self.assertIsNone(cache.lookup('http://x/b'))
+        self.assertEqual(2, len(list((self.cachedir / 'small' / 'blobs').iterdir())))
+        self.assertIsNone(cache.store('http://x/d', b'd' * 11, '"d"', None, 0))
+        self.assertIsNone(cache.store('http://x/e', b'eeee', None, None, 0))
+        reopened = AttachmentCache(self.cachedir / 'small', 10)
+        self.assertEqual({'http://x/a', 'http://x/c'}, set(reopened._entries))
+        self.assertEqual({'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}, reopened.lookup('http://x/c').conditional_headers())
+        self.assertEqual(b'aaaa', reopened.read(reopened.lookup('http://x/a')))
+
+    def test_parse_cache_control(self):
+        """Cache-Control gives the freshness of responses, or forbids storing them"""
+        self.assertEqual(30, parse_cache_control(None, 30))
+        self.assertEqual(120, parse_cache_control('public, max-age=120', 30))
+        self.assertEqual(0, parse_cache_control('no-cache', 30))
+        self.assertIsNone(parse_cache_control('no-store', 30))
+
+    def test_get_cache(self):
+        """get_cache() follows TATTLER_ATTACHMENT_CACHE, and keeps its cache across calls"""
+        env = {}
+        with mock.patch('tattler.server.sendable.attachment_cache.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: env.get(k, v)
+            self.assertIsNone(attachment_cache.get_cache())
+            env['TATTLER_ATTACHMENT_CACHE'] = str(self.cachedir / 'env')
+            env['TATTLER_ATTACHMENT_CACHE_MAX_AGE'] = '60'
+            cache = attachment_cache.get_cache()
+            self.assertEqual((60, 256 * 1024 * 1024), (cache.max_age_s, cache.max_bytes))
+            self.assertIs(cache, attachment_cache.get_cache())
+            del env['TATTLER_ATTACHMENT_CACHE']
+            self.assertIsNone(attachment_cache.get_cache())
+
+
+if __name__ == '__main__':
+    unittest.main()
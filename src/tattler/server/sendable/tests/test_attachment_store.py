@@ -0,0 +1,82 @@
+"""Tests for the store of attachments uploaded by clients"""
+
+import hashlib
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server.sendable import attachment_store
+from tattler.server.sendable.attachment_store import AttachmentStore
+from tattler.server.sendable.attachments import normalize_attachments
+
+
+def sha(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class TestAttachmentStore(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = Path(tmpdir.name)
+
+    def test_put_get(self):
+        """Files are stored under their digest, which must match their content"""
+        store = AttachmentStore(self.dir, 1000, 60)
+        self.assertTrue(store.put(sha(b'terms'), b'terms'))
+        self.assertFalse(store.put(sha(b'terms'), b'terms'))
+        self.assertIn(sha(b'terms'), store)
+        self.assertEqual(b'terms', store.get(sha(b'terms')))
+        self.assertIsNone(store.get(sha(b'other')))
+        with self.assertRaisesRegex(ValueError, "does not match"):
+            store.put(sha(b'terms'), b'forged')
+        with self.assertRaisesRegex(ValueError, "Invalid attachment digest"):
+            store.put('../../etc/passwd', b'x')
+        with self.assertRaisesRegex(ValueError, "exceeds"):
+            store.put(sha(b'x' * 1001), b'x' * 1001)
+
+    def test_eviction_and_expiry(self):
+        """Least recently used files are evicted beyond the maximum size, unused ones expire, and files survive restarts"""
+        store = AttachmentStore(self.dir, 10, 60)
+        for content in [b'aaaa', b'bbbb']:
+            store.put(sha(content), content)
+        store.get(sha(b'aaaa'))
+        store.put(sha(b'cccc'), b'cccc')
+        self.assertEqual({sha(b'aaaa'), sha(b'cccc')}, {p.name for p in self.dir.iterdir()})
+        self.assertEqual(8, store.size)
+        self.assertEqual(2, len(AttachmentStore(self.dir, 10, 60)))
+        with mock.patch('tattler.server.sendable.attachment_store.time.time', return_value=time.time() + 61):
+            self.assertNotIn(sha(b'aaaa'), store)
+            self.assertIsNone(store.get(sha(b'cccc')))
+        self.assertEqual((0, []), (store.size, list(self.dir.iterdir())))
+
+    def test_normalize_ref(self):
+        """Attachments referenced by digest are resolved from the store"""
+        store = AttachmentStore(self.dir, 1000, 60)
+        store.put(sha(b'%PDF-1.4 terms'), b'%PDF-1.4 terms')
+        out = normalize_attachments({'terms.pdf': {'ref': sha(b'%PDF-1.4 terms')}}, store=store)
+        self.assertEqual((b'%PDF-1.4 terms', 'application', 'pdf'), (out[0].content, out[0].maintype, out[0].subtype))
+        with self.assertRaisesRegex(ValueError, "unknown attachment ref"):
+            normalize_attachments({'terms.pdf': {'ref': sha(b'missing')}}, store=store)
+        with self.assertRaisesRegex(ValueError, "not enabled"):
+            normalize_attachments({'terms.pdf': {'ref': sha(b'%PDF-1.4 terms')}})
+
+    def test_get_store(self):
+        """get_store() follows TATTLER_ATTACHMENT_STORE, and keeps its store across calls"""
+        env = {}
+        with mock.patch('tattler.server.sendable.attachment_store.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: env.get(k, v)
+            self.assertIsNone(attachment_store.get_store())
+            env['TATTLER_ATTACHMENT_STORE'] = str(self.dir / 'env')
+            env['TATTLER_ATTACHMENT_STORE_TTL'] = '60'
+            store = attachment_store.get_store()
+            self.assertEqual((60, 256 * 1024 * 1024), (store.ttl_s, store.max_bytes))
+            self.assertIs(store, attachment_store.get_store())
+            del env['TATTLER_ATTACHMENT_STORE']
+            self.assertIsNone(attachment_store.get_store())
+
+
+if __name__ == '__main__':
+    unittest.main()
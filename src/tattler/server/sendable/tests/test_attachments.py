@@ -8,6 +8,7 @@ import threading
 import time
 import unittest
 from pathlib import Path
+from unittest import mock
 
 from tattler.server.sendable import attachments
 from tattler.server.sendable.attachments import (
@@ -72,6 +73,49 @@ def _start_server(**attrs):
     return srv, t
 
 
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the server's body for any path over persistent connections, counting connections and requests in flight."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.in_flight += 1
+            srv.max_in_flight = max(srv.max_in_flight, srv.in_flight)
+        time.sleep(srv.latency)
+        with srv.lock:
+            srv.in_flight -= 1
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/file.pdf')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(srv.body)))
+        self.end_headers()
+        self.wfile.write(srv.body)
+
+
+def _start_keepalive_server(body=PDF_BYTES, latency=0):
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+    srv.daemon_threads = True
+    srv.lock = threading.Lock()
+    srv.connections = srv.in_flight = srv.max_in_flight = 0
+    srv.body, srv.latency = body, latency
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
 class TestSniffImage(unittest.TestCase):
 
     def test_png(self):
@@ -403,3 +447,63 @@ class TestEmailMimeStructure(unittest.TestCase):
         })
         # The literal context-key name should not leak into the rendered output.
         self.assertNotIn("'_attachments'", raw)
+
+
+def _close_pools():
+    for pool in attachments._pools.values():
+        pool.close()
+    attachments._pools.clear()
+
+
+class TestConcurrentFetch(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(_close_pools)
+        self.srv = _start_keepalive_server()
+        self.addCleanup(self.srv.server_close)
+        self.addCleanup(self.srv.shutdown)
+        self.base = f'http://127.0.0.1:{self.srv.server_address[1]}'
+
+    def test_connections_reused_across_urls_and_redirects(self):
+        for num in range(3):
+            out = normalize_attachments({f'doc{num}.pdf': {'url': f'{self.base}/redirect{num}'}})
+            self.assertEqual(out[0].content, PDF_BYTES)
+        self.assertEqual(self.srv.connections, 1)
+
+    def test_urls_fetched_concurrently_in_order(self):
+        self.srv.latency = 0.2
+        raw = {f'doc{num}.pdf': {'url': f'{self.base}/doc{num}.pdf'} for num in range(5)}
+        raw['logo@x'] = {'content_bytes': PNG_BYTES}
+        t0 = time.monotonic()
+        out = normalize_attachments(raw)
+        self.assertLess(time.monotonic() - t0, 0.8)
+        self.assertGreater(self.srv.max_in_flight, 1)
+        self.assertEqual([a.filename for a in out], [f'doc{num}.pdf' for num in range(5)] + ['logo.png'])
+
+    def test_total_cap_shared_by_concurrent_fetches(self):
+        self.srv.body = b'\x00' * 400
+        raw = {f'doc{num}.pdf': {'url': f'{self.base}/doc{num}.pdf'} for num in range(3)}
+        with mock.patch.object(attachments, 'TOTAL_MAX_BYTES', 1000):
+            with self.assertRaisesRegex(ValueError, "exceed total cap"):
+                normalize_attachments(raw)
+            raw['small.pdf'] = raw.pop('doc2.pdf')
+            raw['inline.pdf'] = {'content_bytes': b'\x00' * 300}
+            with self.assertRaisesRegex(ValueError, "exceed total cap"):
+                normalize_attachments(raw)
+            del raw['inline.pdf']
+            self.assertEqual(len(normalize_attachments({'a.pdf': raw['doc0.pdf'], 'b.pdf': raw['doc1.pdf']})), 2)
+
+    def test_invalid_entries_rejected_before_fetching(self):
+        with self.assertRaisesRegex(ValueError, "cannot determine content type"):
+            normalize_attachments({'doc.pdf': {'url': f'{self.base}/doc.pdf'}, 'noext': {'url': f'{self.base}/x'}})
+        self.assertEqual(self.srv.connections, 0)
+
+    def test_dns_results_cached(self):
+        attachments._dns_cache.clear()
+        port = self.srv.server_address[1]
+        with mock.patch('socket.getaddrinfo', wraps=socket.getaddrinfo) as mgai:
+            for num in range(2):
+                # new host names each time, so that no pooled connection is reused
+                normalize_attachments({'doc.pdf': {'url': f'http://localhost:{port}/doc{num}.pdf'}})
+                _close_pools()
+        self.assertEqual(mgai.call_count, 1)
@@ -0,0 +1,99 @@
+"""Tests for capturing notifications in place of delivering them"""
+
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server.sendable import capture
+from tattler.server.sendable.vector_email import EmailSendable
+from tattler.server.sendable.vector_sms import SMSSendable
+from tattler.server.sendable.vector_webhook import WebhookSendable
+
+tbase_path = Path(__file__).parent / 'fixtures' / 'templates'
+
+
+def mkmsg(num: int, payload: bytes=b'hello') -> capture.CapturedMessage:
+    return capture.CapturedMessage('sms', f'n{num}', 'event', None, ['+41000'], payload)
+
+
+class CaptureTest(unittest.TestCase):
+    """Test cases for the captures"""
+
+    def test_memory_capture_keeps_latest(self):
+        """MemoryCapture keeps the latest messages up to its size"""
+        mcap = capture.MemoryCapture(3)
+        for num in range(5):
+            mcap.record(mkmsg(num))
+        self.assertEqual(['n2', 'n3', 'n4'], [m.nid for m in mcap.messages()])
+        mcap.clear()
+        self.assertEqual(0, len(mcap))
+
+    def test_file_capture_rotates(self):
+        """FileCapture appends JSON lines, and rotates files beyond their size"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / 'capture.jsonl'
+            fcap = capture.FileCapture(path, max_bytes=1000, backups=2)
+            for num in range(20):
+                fcap.record(mkmsg(num, b'x' * 100))
+            fcap.close()
+            self.assertEqual({'capture.jsonl', 'capture.jsonl.1', 'capture.jsonl.2'}, {p.name for p in Path(tmpdir).iterdir()})
+            for name in ['capture.jsonl', 'capture.jsonl.1']:
+                self.assertLessEqual((Path(tmpdir) / name).stat().st_size, 1000)
+            lines = path.read_text().splitlines()
+            self.assertEqual('n19', json.loads(lines[-1])['nid'])
+            self.assertEqual('x' * 100, json.loads(lines[-1])['payload'])
+
+    def test_get_capture(self):
+        """get_capture() follows TATTLER_CAPTURE, and keeps its capture across calls"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = {}
+            with mock.patch('tattler.server.sendable.capture.getenv') as mgetenv:
+                mgetenv.side_effect = lambda k, v=None: env.get(k, v)
+                self.assertIsNone(capture.get_capture())
+                env['TATTLER_CAPTURE'] = 'memory'
+                mcap = capture.get_capture()
+                self.assertIsInstance(mcap, capture.MemoryCapture)
+                self.assertIs(mcap, capture.get_capture())
+                env['TATTLER_CAPTURE'] = str(Path(tmpdir) / 'capture.jsonl')
+                fcap = capture.get_capture()
+                self.assertIsInstance(fcap, capture.FileCapture)
+                self.assertIs(fcap, capture.get_capture())
+                del env['TATTLER_CAPTURE']
+                self.assertIsNone(capture.get_capture())
+                self.assertTrue(fcap._file.closed)
+
+    def test_vectors_capture(self):
+        """Every vector records its final payload instead of delivering it"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tbase = Path(tmpdir)
+            (tbase / '_webhooks.json').write_text(json.dumps({'hook': {'url': 'http://127.0.0.1:1/hook'}}))
+            (tbase / 'event' / 'webhook').mkdir(parents=True)
+            (tbase / 'event' / 'webhook' / 'body.txt').write_text('Hook {{ one }}')
+            with mock.patch.dict(os.environ, {'TATTLER_CAPTURE': 'memory', 'TATTLER_EMAIL_SENDER': 'from@bar.com', 'TATTLER_SMS_SENDER': '+4100,+3900'}):
+                mcap = capture.get_capture()
+                mcap.clear()
+                with mock.patch('tattler.server.sendable.vector_email.smtplib.SMTP') as msmtp:
+                    with mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as msms:
+                        with mock.patch('tattler.server.sendable.vector_webhook.webhook_client.submit') as mhook:
+                            EmailSendable('event_with_email_and_sms', ['foo@bar.com'], template_base=tbase_path).send(context={'one': '#1#'})
+                            SMSSendable('event_with_email_and_sms', ['+41123', '+39456'], template_base=tbase_path).send(context={'one': '#1#'})
+                            WebhookSendable('event', ['hook'], template_base=tbase).send(context={'one': '#1#'})
+                msmtp.assert_not_called()
+                msms.assert_not_called()
+                mhook.assert_not_called()
+                captured = mcap.messages()
+        self.assertEqual(['email', 'sms', 'sms', 'webhook'], [m.vector for m in captured])
+        email, sms1, sms2, hook = captured
+        self.assertEqual(('from@bar.com', ['foo@bar.com']), (email.sender, email.recipients))
+        self.assertIn(b'\r\nTo: foo@bar.com\r\n', email.payload)
+        self.assertEqual({('+4100', ('+41123',)), ('+3900', ('+39456',))}, {(m.sender, tuple(m.recipients)) for m in [sms1, sms2]})
+        self.assertIn(b'#1#', sms1.payload)
+        self.assertEqual(['http://127.0.0.1:1/hook'], hook.recipients)
+        self.assertEqual('Hook #1#', json.loads(hook.payload)['body'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Tests for precompiled MIME skeletons"""
+
+import os
+import unittest
+from unittest import mock
+
+from tattler.server.sendable import mime_skeleton
+from tattler.server.sendable.attachments import Attachment
+from tattler.server.sendable.smtp_encoding import EncodedMessage
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+logo = Attachment('logo.png', os.urandom(2000), 'image', 'png', 'logo@local')
+invoice = Attachment('Rechnung-für-Müller.pdf', b'%PDF-1.4 ' + os.urandom(3000), 'application', 'pdf')
+
+
+class TestMimeSkeleton(unittest.TestCase):
+    def setUp(self) -> None:
+        mime_skeleton.clear()
+        self.sendable = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+
+    def rendered(self, plain='Hello Mr Miller,\nthanks for your order.\n', html='<p>Hello Mr Miller, thanks for your order.</p>\n' * 50,
+                 subject='Your order', inline=(), regular=()):
+        rendered = self.sendable._render_msg({})
+        rendered.plain, rendered.html, rendered.subject = plain, html, subject
+        rendered.inline, rendered.regular = list(inline), list(regular)
+        return rendered
+
+    def assertSameAsFull(self, rendered):
+        """Assert that the message assembled from skeleton is identical to the message built in full, in every encoding"""
+        msg = self.sendable._encode_msg(rendered, ['foo@bar.com'])
+        self.assertIsInstance(msg, mime_skeleton.SkeletonMessage)
+        # boundaries are chosen upon first serialization
+        data = msg.as_string()
+        def build(eightbit):
+            full = self.sendable._assemble_body(rendered, eightbit)
+            for name, value in msg.headers:
+                full[name] = value
+            for part, boundary in zip([p for p in full.walk() if p.is_multipart()], msg.skeleton.boundaries):
+                part.set_boundary(boundary)
+            return full
+        full = EncodedMessage(build, msg.sender, msg.recipients)
+        self.assertEqual(full.as_string(), data)
+        for eightbit, smtputf8 in [(False, False), (True, False), (True, True)]:
+            self.assertEqual(full.as_bytes(eightbit, smtputf8), msg.as_bytes(eightbit, smtputf8))
+        return msg
+
+    def test_alternative(self):
+        """Messages with plain and HTML bodies are identical to those built in full"""
+        self.assertSameAsFull(self.rendered())
+
+    def test_attachments(self):
+        """Messages with inline and regular attachments are identical to those built in full"""
+        self.assertSameAsFull(self.rendered(inline=[logo], regular=[invoice]))
+        self.assertSameAsFull(self.rendered(html=None, regular=[invoice]))
+
+    def test_non_ascii(self):
+        """Messages with non-ASCII bodies and headers are identical to those built in full"""
+        msg = self.assertSameAsFull(self.rendered(plain='Grüße aus München\n' * 10, html='<p>' + 'ご注文ありがとうございます' * 20 + '</p>\n',
+                                                  subject='Ihre Bestellung bei Müller', regular=[invoice]))
+        self.assertTrue(msg.needs_smtputf8())
+        self.assertIn('Grüße aus München'.encode('utf-8'), msg.as_bytes(True))
+        self.assertTrue(msg.as_bytes(False).isascii())
+
+    def test_reuse(self):
+        """Skeletons are compiled once per structure, and reused across messages with different content"""
+        build = mock.Mock(side_effect=lambda placeholders: self.sendable._assemble_body(self.rendered(plain=placeholders['plain'], html=placeholders['html'])))
+        skeleton = mime_skeleton.get_skeleton('key', build, ['plain', 'html'])
+        self.assertIs(skeleton, mime_skeleton.get_skeleton('key', build, ['plain', 'html']))
+        self.assertEqual(1, build.call_count)
+        msg1 = self.assertSameAsFull(self.rendered(plain='first\n'))
+        msg2 = self.assertSameAsFull(self.rendered(plain='second\n', subject='Another'))
+        self.assertIs(msg1.skeleton, msg2.skeleton)
+        self.assertIsNot(msg1.skeleton, self.assertSameAsFull(self.rendered(inline=[logo])).skeleton)
+
+    def test_boundary_in_text(self):
+        """Messages whose text contains a boundary of the skeleton are built in full, with fresh boundaries"""
+        msg = self.assertSameAsFull(self.rendered())
+        boundary = msg.skeleton.boundaries[0]
+        msg = self.sendable._encode_msg(self.rendered(plain=f'--{boundary}\nforged\n'), ['foo@bar.com'])
+        data = msg.as_string()
+        self.assertIn(f'--{boundary}\nforged', data)
+        self.assertNotIn(f'boundary="{boundary}"', data)
+
+    def test_single_part(self):
+        """Plain-text messages without attachments have no skeleton"""
+        msg = self.sendable._encode_msg(self.rendered(html=None), ['foo@bar.com'])
+        self.assertNotIsInstance(msg, mime_skeleton.SkeletonMessage)
+        self.assertIsNone(mime_skeleton.get_skeleton('plain', lambda placeholders: self.sendable._assemble_body(self.rendered(plain=placeholders['plain'], html=None)), ['plain']))
+
+    def test_attachment_contents(self):
+        """Skeletons hold no attachment contents, and serve attachments differing by content"""
+        other = Attachment(invoice.filename, b'%PDF-1.4 other', invoice.maintype, invoice.subtype)
+        msg1 = self.assertSameAsFull(self.rendered(regular=[invoice]))
+        msg2 = self.assertSameAsFull(self.rendered(regular=[other]))
+        self.assertIs(msg1.skeleton, msg2.skeleton)
+        self.assertNotIn(invoice.content[-50:], msg1.skeleton.structure.as_bytes())
+        self.assertSameAsFull(self.rendered(regular=[Attachment('empty.txt', b'', 'text', 'plain')]))
+
+    def test_stream(self):
+        """Large messages are streamed in chunks of bounded size, identical to the message whole"""
+        large = Attachment('large.bin', os.urandom(3 * 1024 * 1024), 'application', 'octet-stream')
+        msg = self.assertSameAsFull(self.rendered(plain='Grüße\n', inline=[logo], regular=[large]))
+        self.assertIsNone(self.sendable._encode_msg(self.rendered(), ['foo@bar.com']).stream(lambda name: True))
+        for extensions, options in [(set(), []), ({'8bitmime'}, ['BODY=8BITMIME'])]:
+            chunks, got_options = msg.stream(lambda name: name in extensions)
+            chunks = list(chunks)
+            self.assertEqual(options, got_options)
+            self.assertEqual(msg.as_bytes(bool(extensions)), b''.join(chunks))
+            self.assertLess(max(len(c) for c in chunks), 128 * 1024)
+
+    def test_invalid_header(self):
+        """Header values with linefeeds are refused as when building in full"""
+        msg = self.sendable._encode_msg(self.rendered(subject='Injected\nBcc: foo@evil.com'), ['foo@bar.com'])
+        with self.assertRaises(ValueError):
+            msg.as_string()
+
+
+if __name__ == '__main__':
+    unittest.main()
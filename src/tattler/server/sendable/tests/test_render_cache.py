@@ -0,0 +1,76 @@
+"""Tests for cache of expanded templates"""
+
+import os
+import unittest
+from unittest import mock
+from datetime import datetime
+from pathlib import Path
+
+from tattler.server.sendable import EmailSendable
+from tattler.server.sendable import render_cache
+from tattler.server.sendable.render_cache import RenderCache, context_digest
+from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor
+
+tbase_standard_path = Path(__file__).parent / 'fixtures' / 'templates'
+
+
+class TestRenderCache(unittest.TestCase):
+    def test_digest_only_covers_variables_read(self):
+        """context_digest() ignores variables that are not read, and differs when read variables differ"""
+        d1 = context_digest({'a': 1, 'user_email': 'x@y.com'}, {'a'})
+        self.assertEqual(d1, context_digest({'user_email': 'z@y.com', 'a': 1}, {'a'}))
+        self.assertNotEqual(d1, context_digest({'a': 2, 'user_email': 'x@y.com'}, {'a'}))
+        self.assertNotEqual(d1, context_digest({'a': '1'}, {'a'}))
+
+    def test_digest_gives_up_on_unknown(self):
+        """context_digest() returns None if variables are unknown, or values cannot be reliably digested"""
+        self.assertIsNone(context_digest({'a': 1}, None))
+        self.assertIsNone(context_digest({'a': object()}, {'a'}))
+        self.assertIsNotNone(context_digest({'a': datetime.now()}, {'a'}))
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted once the size bound is exceeded"""
+        cache = RenderCache(10)
+        cache.put('a', '1234')
+        cache.put('b', '1234')
+        self.assertEqual('1234', cache.get('a'))
+        cache.put('c', '1234')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual('1234', cache.get('a'))
+        self.assertEqual('1234', cache.get('c'))
+        self.assertLessEqual(cache.size, 10)
+        cache.put('d', 'x' * 11)
+        self.assertIsNone(cache.get('d'))
+
+    def test_expand_reuses_identical_content(self):
+        """Expansions with identical read variables are served from cache"""
+        cache = RenderCache(1000)
+        tpj = JinjaTemplateProcessor("Alert {{ alert }}")
+        with mock.patch.object(tpj, 'expand', wraps=tpj.expand) as mexpand:
+            self.assertEqual('Alert 1', cache.expand(tpj, {'alert': '1', 'user_email': 'a@b.com'}))
+            self.assertEqual('Alert 1', cache.expand(tpj, {'alert': '1', 'user_email': 'c@d.com'}))
+            self.assertEqual(1, mexpand.call_count)
+            self.assertEqual('Alert 2', cache.expand(tpj, {'alert': '2', 'user_email': 'c@d.com'}))
+            self.assertEqual(2, mexpand.call_count)
+        self.assertEqual(1, cache.hits)
+        # different template version
+        self.assertEqual('New alert 1', cache.expand(JinjaTemplateProcessor("New alert {{ alert }}"), {'alert': '1'}))
+
+    def test_sendable_uses_cache_if_enabled(self):
+        """Sendables serve subject and bodies from cache when TATTLER_RENDER_CACHE_SIZE is set"""
+        with mock.patch('tattler.server.sendable.render_cache.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_RENDER_CACHE_SIZE': '100000'}.get(k, os.getenv(k, v))
+            cache = render_cache.get_cache()
+            self.assertIsNotNone(cache)
+            cache.clear()
+            hits = cache.hits
+            for rcpt in ['a@b.com', 'c@d.com']:
+                e = EmailSendable('event_with_email_and_sms', [rcpt], template_base=tbase_standard_path)
+                self.assertIn('#1234#', e.content({'one': '#1234#', 'user_email': rcpt}))
+            self.assertEqual(hits + 3, cache.hits)
+            mgetenv.side_effect = lambda k, v=None: os.getenv(k, v) if k != 'TATTLER_RENDER_CACHE_SIZE' else v
+            self.assertIsNone(render_cache.get_cache())
+
+
+if __name__ == '__main__':
+    unittest.main()
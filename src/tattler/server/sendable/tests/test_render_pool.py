@@ -0,0 +1,112 @@
+"""Tests for pool of processes expanding templates"""
+
+import os
+import threading
+import unittest
+from unittest import mock
+
+from tattler.server import metrics
+from tattler.server.sendable import render_pool, vector_email
+from tattler.server.sendable.render_pool import RenderPool
+from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor, TemplateLimitExceeded
+
+
+class TestRenderPool(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.pool = RenderPool(2, threshold_s=0.0)
+
+    def tearDown(self) -> None:
+        self.pool.shutdown()
+
+    def test_unknown_templates_expanded_in_process(self):
+        """Templates never expanded before are expanded in-process, to learn their cost"""
+        tpj = JinjaTemplateProcessor("Hi {{ name }}", template_name='t/light')
+        self.assertEqual('Hi you', self.pool.expand(tpj, {'name': 'you'}))
+        self.assertIsNone(self.pool._executor)
+
+    def test_light_templates_expanded_in_process(self):
+        """Templates expanding faster than the threshold are expanded in-process"""
+        pool = RenderPool(2, threshold_s=1000)
+        tpj = JinjaTemplateProcessor("Hi {{ name }}", template_name='t/light')
+        for _ in range(3):
+            self.assertEqual('Hi you', pool.expand(tpj, {'name': 'you'}))
+        self.assertIsNone(pool._executor)
+
+    def test_heavy_templates_expanded_in_workers(self):
+        """Templates slower than the threshold are expanded in worker processes"""
+        tpj = JinjaTemplateProcessor("{% for r in rows %}<tr><td>{{ r }}</td></tr>{% endfor %}", template_name='t/heavy')
+        ctx = {'rows': list(range(100))}
+        want = ''.join(f'<tr><td>{i}</td></tr>' for i in range(100))
+        self.assertEqual(want, self.pool.expand(tpj, ctx))
+        self.assertEqual(want, self.pool.expand(tpj, ctx))
+        self.assertIsNotNone(self.pool._executor)
+        self.assertEqual(1, metrics.snapshot()['counters']['template_render_offloaded{template=t/heavy}'])
+        self.assertEqual(2, metrics.get_timing('template_render_seconds', template='t/heavy').count)
+
+    def test_unpicklable_context_expanded_in_process(self):
+        """Contexts which cannot be shipped to workers are expanded in-process"""
+        tpj = JinjaTemplateProcessor("{{ lock.locked() }}", template_name='t/unpicklable')
+        ctx = {'lock': threading.Lock()}
+        self.assertEqual('False', self.pool.expand(tpj, ctx))
+        self.assertEqual('False', self.pool.expand(tpj, ctx))
+
+    def test_limits_enforced_in_workers(self):
+        """Templates exceeding their limits in workers fail without being re-expanded in-process"""
+        tpj = JinjaTemplateProcessor("{% for i in range(n) %}0123456789{% endfor %}", template_name='t/big')
+        self.pool.expand(tpj, {'n': 1})
+        with mock.patch.dict(os.environ, {'TATTLER_TEMPLATE_MAX_SIZE': '100'}):
+            with mock.patch.object(tpj, 'expand') as mexpand:
+                with self.assertRaises(TemplateLimitExceeded):
+                    self.pool.expand(tpj, {'n': 1000})
+                mexpand.assert_not_called()
+
+    def test_worker_errors_not_expanded_again(self):
+        """Templates failing in workers for other reasons than shipping fail without being re-expanded in-process"""
+        tpj = JinjaTemplateProcessor("{{ 1 // n }}", template_name='t/failing')
+        self.pool.expand(tpj, {'n': 1})
+        with mock.patch.object(tpj, 'expand') as mexpand:
+            with self.assertRaises(ZeroDivisionError):
+                self.pool.expand(tpj, {'n': 0})
+            mexpand.assert_not_called()
+
+    def test_worker_type_errors_not_expanded_again(self):
+        """Templates raising TypeError in workers fail without being mistaken for unshippable and re-expanded in-process"""
+        tpj = JinjaTemplateProcessor("{{ 1 + n }}", template_name='t/mistyped')
+        self.pool.expand(tpj, {'n': 1})
+        with mock.patch.object(tpj, 'expand') as mexpand:
+            with self.assertRaisesRegex(TypeError, "unsupported operand"):
+                self.pool.expand(tpj, {'n': 'x'})
+            mexpand.assert_not_called()
+
+    def test_workers_spawned(self):
+        """Workers are spawned, not forked from the threaded server process"""
+        self.assertEqual('spawn', self.pool._get_executor()._mp_context.get_start_method())
+
+    def test_mjml_compiled_in_workers(self):
+        """MJML templates are compiled in worker processes if the pool is enabled"""
+        vector_email.compile_mjml.cache_clear()
+        self.addCleanup(vector_email.compile_mjml.cache_clear)
+        with mock.patch('tattler.server.sendable.render_pool.get_pool', return_value=self.pool):
+            with mock.patch.object(self.pool, 'run', wraps=self.pool.run) as mrun:
+                html = vector_email.compile_mjml('<mjml><mj-body><mj-text>Hello</mj-text></mj-body></mjml>')
+        mrun.assert_called_once()
+        self.assertIn('Hello', html)
+        self.assertNotIn('<mj-', html)
+        self.assertIsNotNone(self.pool._executor)
+
+    def test_get_render_pool_from_settings(self):
+        """get_pool() returns a pool only if TATTLER_RENDER_PROCESSES is set"""
+        with mock.patch('tattler.server.sendable.render_pool.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_RENDER_PROCESSES': '3', 'TATTLER_RENDER_PROCESS_THRESHOLD': '0.2'}.get(k, v)
+            pool = render_pool.get_pool()
+            self.assertEqual(3, pool.processes)
+            self.assertEqual(0.2, pool.threshold_s)
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_RENDER_PROCESSES': 'foo'}.get(k, v)
+            self.assertIsNone(render_pool.get_pool())
+            mgetenv.side_effect = lambda k, v=None: v
+            self.assertIsNone(render_pool.get_pool())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,6 +13,7 @@ from tattler.server import sendable
 data_recipients = {
     'email': ['support@test123.com'],
     'sms': ['+11234567898', '00417689876'],
+    'webhook': ['https://hooks.test123.com/tattler'],
 }
 
 
@@ -32,9 +33,14 @@ class SendableTest(unittest.TestCase):
 
     def setUp(self):
         os.environ['TATTLER_BULKSMS_TOKEN'] = 'foo:bar'
+        # keep webhooks off the network; email and SMS tests mock their delivery where they send
+        patcher = unittest.mock.patch('tattler.server.sendable.vector_webhook.webhook_client.submit')
+        self.mwebhook_submit = patcher.start()
+        self.addCleanup(patcher.stop)
         self.supervisor_addrs = {
             'sms': '+5432156',
             'email': 'supervisor_foo@bar.com',
+            'webhook': 'https://hooks.test123.com/supervisor',
         }
 
     def test_notification_id(self):
@@ -88,7 +94,7 @@ class SendableTest(unittest.TestCase):
         """sender() returns expected envvar name"""
         with unittest.mock.patch('tattler.server.sendable.vector_sendable.log') as mlog:
             with unittest.mock.patch('tattler.server.sendable.vector_sendable.getenv') as mgetenv:
-                sndconf = {'TATTLER_SMS_SENDER': 'snd_sms', 'TATTLER_EMAIL_SENDER': 'snd_email', }
+                sndconf = {'TATTLER_SMS_SENDER': 'snd_sms', 'TATTLER_EMAIL_SENDER': 'snd_email', 'TATTLER_WEBHOOK_SENDER': 'snd_webhook', }
                 mgetenv.side_effect = lambda x, y=None: sndconf.get(x, y)
                 for vname, vclass in sendable.vector_sendables.items():
                     want = sndconf[f'TATTLER_{vname.upper()}_SENDER']
@@ -167,6 +173,7 @@ class SendableTest(unittest.TestCase):
             with unittest.mock.patch('tattler.server.sendable.vector_sms.SMSSendable.do_send') as s:
                 mocks['email'] = e
                 mocks['sms'] = s
+                mocks['webhook'] = self.mwebhook_submit
                 for vname, vclass in sendable.vector_sendables.items():
                     s = vclass('event_with_email_and_sms', data_recipients[vname], template_base=self.template_base)
                     s.send(context={'one': 1})
@@ -188,7 +195,7 @@ class SendableTest(unittest.TestCase):
             e.content(context={})
 
     def test_sms_send_triggers_delivery(self):
-        with unittest.mock.patch('tattler.server.sendable.vector_sms.BulkSMS') as msms:
+        with unittest.mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as msms:
             e = sendable.SMSSendable('event_with_email_and_sms', data_recipients['sms'], template_base=self.template_base)
             e.send(context={'one': '1'})
             msms.assert_called()
@@ -201,7 +208,7 @@ class SendableTest(unittest.TestCase):
         blacklisted_rcpt = '+12345678'
         recipients_full = {blacklisted_rcpt, '+29876'}
         recipients_blacklisted = {'+29876'}
-        with unittest.mock.patch('tattler.server.sendable.vector_sms.BulkSMS') as msms:
+        with unittest.mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as msms:
             e = sendable.SMSSendable('event_with_email_and_sms', recipients_full, template_base=self.template_base)
             # send without blacklist
             e.send(context={'one': '1'})
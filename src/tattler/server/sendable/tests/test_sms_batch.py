@@ -0,0 +1,125 @@
+"""Tests for micro-batching of SMS submissions"""
+
+import contextlib
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from tattler.server.sendable import sms_batch
+from tattler.server.sendable.vector_sms import SMSSendable
+
+
+class FakeClient:
+    """Mimics BulkSMS.send(), numbering messages"""
+    def __init__(self, error=None, hold=None):
+        self.calls = []
+        self.error = error
+        self.hold = hold
+        self.lock = threading.Lock()
+
+    def send(self, recipients, content, sender=None, priority=False):
+        if self.hold is not None:
+            self.hold.wait()
+        with self.lock:
+            self.calls.append((list(recipients), content, sender, priority))
+            if self.error:
+                raise self.error
+            return [f'{len(self.calls)}.{i}:{r}' for i, r in enumerate(recipients)]
+
+
+class TestSMSBatch(unittest.TestCase):
+    @contextlib.contextmanager
+    def in_flight(self, batcher):
+        """Keep a submission of other content under way, as from a concurrent notification"""
+        hold = threading.Event()
+        thread = threading.Thread(target=batcher.submit, args=(FakeClient(hold=hold), ['+10'], 'busy'))
+        thread.start()
+        while batcher._active == 0:
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            hold.set()
+            thread.join()
+
+    def submit_concurrently(self, batcher, client, submissions):
+        with self.in_flight(batcher):
+            with ThreadPoolExecutor(max_workers=len(submissions)) as tpe:
+                return list(tpe.map(lambda args: batcher.submit(client, *args), submissions))
+
+    def test_batching(self):
+        """Concurrent submissions of identical content share one call, and get back the IDs of their own recipients"""
+        batcher = sms_batch.SMSBatcher(0.2, 100)
+        client = FakeClient()
+        results = self.submit_concurrently(batcher, client, [(['+11', '+12'], 'hi'), (['+13'], 'hi'), (['+11'], 'hi')])
+        self.assertEqual(1, len(client.calls))
+        self.assertEqual(['+11', '+11', '+12', '+13'], sorted(client.calls[0][0]))
+        self.assertEqual(['+11', '+12'], [i.split(':')[1] for i in results[0]])
+        self.assertEqual(['+13'], [i.split(':')[1] for i in results[1]])
+        self.assertEqual(['+11'], [i.split(':')[1] for i in results[2]])
+        self.assertEqual(4, len(set(sum(results, []))))
+
+    def test_lone_submission(self):
+        """Submissions made while no other is under way, as under tattlersrv_http, are submitted without waiting"""
+        batcher = sms_batch.SMSBatcher(10, 100)
+        client = FakeClient()
+        started = time.monotonic()
+        self.assertEqual(['1.0:+11'], batcher.submit(client, ['+11'], 'hi'))
+        self.assertEqual(['2.0:+12'], batcher.submit(client, ['+12'], 'hi'))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(0, batcher._active)
+
+    def test_distinct_content(self):
+        """Submissions differing in body, sender or priority are submitted separately"""
+        batcher = sms_batch.SMSBatcher(0.1, 100)
+        client = FakeClient()
+        self.submit_concurrently(batcher, client, [(['+11'], 'hi'), (['+12'], 'hello'), (['+13'], 'hi', '+4411'), (['+14'], 'hi', None, True)])
+        self.assertEqual(4, len(client.calls))
+
+    def test_full_batch(self):
+        """Batches are submitted as soon as they reach their maximum size"""
+        batcher = sms_batch.SMSBatcher(10, 3)
+        client = FakeClient()
+        started = time.monotonic()
+        results = self.submit_concurrently(batcher, client, [(['+11', '+12'], 'hi'), (['+13'], 'hi')])
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(1, len(client.calls))
+        self.assertEqual([['+11', '+12'], ['+13']], [[i.split(':')[1] for i in ids] for ids in results])
+
+    def test_error(self):
+        """Errors submitting a batch are raised to all of its members"""
+        batcher = sms_batch.SMSBatcher(0.1, 100)
+        client = FakeClient(error=ValueError('refused'))
+        with self.in_flight(batcher):
+            with ThreadPoolExecutor(max_workers=2) as tpe:
+                futures = [tpe.submit(batcher.submit, client, [rcpt], 'hi') for rcpt in ['+11', '+12']]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result()
+        self.assertEqual(1, len(client.calls))
+
+    def test_sendable_batching(self):
+        """SMSSendable submits through the batcher iff TATTLER_SMS_BATCH_WINDOW is set"""
+        with mock.patch('tattler.server.sendable.vector_sms.getenv') as mgetenv:
+            with mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as mclient, mock.patch('tattler.server.sendable.vector_sms.sms_client.get_poller'):
+                with mock.patch('tattler.server.sendable.vector_sms.vector_sendable.Sendable.content'):
+                    env = {'TATTLER_BULKSMS_TOKEN': '12:aas', 'TATTLER_SMS_BATCH_WINDOW': '0.05'}
+                    mgetenv.side_effect = lambda x, y=None: env.get(x, os.getenv(x, y))
+                    mclient.return_value = client = FakeClient()
+                    with self.in_flight(sms_batch.get_batcher(0.05, 500)):
+                        self.submit_concurrently_sendables([['+123456789'], ['+16548351']])
+                    self.assertEqual(1, len(client.calls))
+                    env['TATTLER_SMS_BATCH_WINDOW'] = '0'
+                    self.submit_concurrently_sendables([['+123456789'], ['+16548351']])
+                    self.assertEqual(3, len(client.calls))
+
+    def submit_concurrently_sendables(self, recipients):
+        with ThreadPoolExecutor(max_workers=len(recipients)) as tpe:
+            list(tpe.map(lambda rcpts: SMSSendable('event', rcpts).send(), recipients))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+"""Tests for pooled SMS clients and polling of delivery reports"""
+
+import json
+import socket
+import threading
+import time
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from tattler.server.sendable import http_pool, sms_client
+
+
+class BulkSMSHandler(BaseHTTPRequestHandler):
+    """Mimics the BulkSMS JSON API"""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if req['body'] == 'error':
+            self.reply(400, {'detail': 'invalid'})
+            return
+        ids = []
+        for rcpt in req['to']:
+            self.server.next_id += 1
+            ids.append(str(self.server.next_id))
+            self.server.statuses[str(self.server.next_id)] = 'DELIVERED' if rcpt.endswith('11') else 'SENT'
+        self.reply(201, [{'id': i, 'to': r} for i, r in zip(ids, req['to'])])
+
+    def do_GET(self):
+        message_id = self.path.split('?')[0].rsplit('/', 1)[-1]
+        self.server.queries.append(message_id)
+        self.reply(200, {'id': message_id, 'status': {'type': self.server.statuses[message_id]}})
+
+
+class TestSMSClient(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), BulkSMSHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.next_id = 0
+        self.server.statuses = {}
+        self.server.queries = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = sms_client.PooledBulkSMS(token_id='id', token_secret='secret')
+        self.client.api_base = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+        self.client.pool = http_pool.HTTPConnectionPool(self.client.api_base, 4, name='sms')
+
+    def tearDown(self) -> None:
+        self.client.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        """API calls reuse one persistent connection"""
+        self.assertEqual(['1', '2'], self.client.send(['+4111', '+4122'], 'hello'))
+        self.assertEqual(['3'], self.client.send('+4133', 'hello again'))
+        self.assertEqual('DELIVERED', self.client.msg_delivery_status('1'))
+        self.assertEqual(1, self.server.connections)
+
+    def test_connection_closed(self):
+        """API calls succeed on a new connection when the server closed the idle one"""
+        self.client.send('+4111', 'hello')
+        for conn, _ in self.client.pool._idle:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual('DELIVERED', self.client.msg_delivery_status('1'))
+        self.assertEqual(2, self.server.connections)
+        self.client.pool.idle_timeout_s = 0
+        time.sleep(0.01)
+        self.client.send('+4111', 'hello')
+        self.assertEqual(3, self.server.connections)
+
+    def test_http_error(self):
+        """Error replies of the API raise HTTPError, and leave the connection usable"""
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            self.client.send('+4111', 'error')
+        self.assertEqual(400, err.exception.code)
+        self.client.send('+4111', 'hello')
+        self.assertEqual(1, self.server.connections)
+
+    def test_get_client(self):
+        """Clients are shared per credentials"""
+        self.assertIs(sms_client.get_client('a', 'b'), sms_client.get_client('a', 'b'))
+        self.assertIsNot(sms_client.get_client('a', 'b'), sms_client.get_client('a', 'c'))
+
+    def test_poller(self):
+        """The poller queries outstanding messages at growing intervals, until each reaches a final status or expires"""
+        poller = sms_client.DeliveryReportPoller(10, max_age_s=60)
+        t0 = time.time()
+        with mock.patch.object(poller, '_run'):
+            poller.watch(self.client, self.client.send(['+4111', '+4122', '+4133'], 'hello'), 'nid1')
+        self.assertEqual(3, len(poller))
+        self.assertEqual([], poller.poll())
+        self.assertEqual([], self.server.queries)
+        with mock.patch('tattler.server.sendable.sms_client.time.time', return_value=t0 + 11):
+            done = poller.poll()
+        self.assertEqual(['1'], [r.message_id for r in done])
+        self.assertEqual(['1', '2', '3'], self.server.queries)
+        self.assertEqual(2, len(poller))
+        with mock.patch('tattler.server.sendable.sms_client.time.time', return_value=t0 + 29):
+            self.assertEqual([], poller.poll())
+        self.assertEqual(3, len(self.server.queries))
+        self.server.statuses['2'] = 'FAILED'
+        with mock.patch('tattler.server.sendable.sms_client.time.time', return_value=t0 + 120):
+            done = poller.poll()
+        self.assertEqual({'2': 'FAILED', '3': 'SENT'}, {r.message_id: r.status for r in done})
+        self.assertEqual(0, len(poller))
+        self.assertEqual(1, self.server.connections)
+
+    def test_poller_bounded(self):
+        """The poller follows a bounded number of messages"""
+        poller = sms_client.DeliveryReportPoller(10, max_pending=2)
+        with mock.patch.object(poller, '_run'):
+            poller.watch(mock.Mock(), ['1', '2', '3'])
+        self.assertEqual(2, len(poller))
+
+    def test_poller_errors(self):
+        """Messages whose status fails to be queried stay outstanding"""
+        poller = sms_client.DeliveryReportPoller(3600, max_age_s=7200)
+        client = mock.Mock()
+        client.msg_delivery_status.side_effect = urllib.error.URLError('down')
+        with mock.patch.object(poller, '_run'):
+            poller.watch(client, ['1'])
+        with mock.patch('tattler.server.sendable.sms_client.time.time', return_value=time.time() + 3600):
+            self.assertEqual([], poller.poll())
+        client.msg_delivery_status.assert_called_once()
+        self.assertEqual(1, len(poller))
+
+
+if __name__ == '__main__':
+    unittest.main()
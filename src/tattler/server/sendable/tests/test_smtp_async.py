@@ -0,0 +1,202 @@
+"""Tests for asynchronous SMTP delivery engine"""
+
+import asyncio
+import os
+import smtplib
+import socketserver
+import threading
+import unittest
+from email.message import EmailMessage
+from unittest import mock
+
+from tattler.server import metrics
+from tattler.server.sendable import smtp_async
+from tattler.server.sendable.smtp_async import AsyncSMTPEngine, encode_data
+from tattler.server.sendable.attachments import Attachment
+from tattler.server.sendable.smtp_encoding import EncodedMessage
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """SMTP server accepting messages, refusing recipients starting with 'bad' or temporarily 'busy', and recording commands"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        srv = self.server
+        srv.connections += 1
+        accepted = 0
+        self.reply('220 test ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            srv.commands.append(line.strip())
+            cmd = line[:4].upper()
+            if cmd == b'EHLO':
+                extensions = (['PIPELINING'] if srv.pipelining else []) + getattr(srv, 'extensions', [])
+                self.wfile.write(b''.join(f'250-{e}\r\n'.encode('ascii') for e in ['test'] + extensions) + b'250 HELP\r\n')
+            elif cmd in (b'MAIL', b'RSET'):
+                accepted = 0
+                self.reply('250 OK')
+            elif cmd == b'RCPT':
+                if line[9:12].lower() == b'bad':
+                    self.reply('550 no such user')
+                elif line[9:13].lower() == b'busy':
+                    self.reply('450 mailbox busy')
+                else:
+                    accepted += 1
+                    self.reply('250 OK')
+            elif cmd == b'DATA' and not accepted:
+                self.reply('554 no valid recipients')
+            elif cmd == b'DATA':
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    dline = self.rfile.readline()
+                    if dline in (b'.\r\n', b''):
+                        break
+                    data.append(dline)
+                srv.messages.append(b''.join(data))
+                self.reply('250 queued')
+            elif cmd == b'BDAT':
+                args = line.split()
+                data = getattr(self, 'bdat', b'') + self.rfile.read(int(args[1]))
+                if len(args) > 2:
+                    srv.messages.append(data)
+                    data = b''
+                self.bdat = data
+                self.reply('250 chunk received')
+            elif cmd == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class Sink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TestAsyncSMTPEngine(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.sink = Sink(('127.0.0.1', 0), SinkHandler)
+        self.sink.connections = 0
+        self.sink.commands = []
+        self.sink.messages = []
+        self.sink.pipelining = True
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        self.relay = {'host': '127.0.0.1', 'port': self.sink.server_address[1], 'timeout': 5, 'local_hostname': 'localhost'}
+        self.engine = AsyncSMTPEngine()
+
+    def tearDown(self) -> None:
+        self.engine.close()
+        self.sink.shutdown()
+        self.sink.server_close()
+
+    def submit(self, recipients, msg='Subject: hi\n\nHello\n.hidden dot\n', concurrency=2):
+        return self.engine.submit(self.relay, concurrency, 60, 'from@test.com', recipients, msg)
+
+    def test_encode_data(self):
+        """Messages are sent with CRLF line endings, dot-stuffed and terminated"""
+        self.assertEqual(b'a\r\n..b\r\nc\r\n.\r\n', encode_data('a\n.b\rc'))
+        self.assertEqual(b'a\r\n.\r\n', encode_data(b'a\r\n'))
+
+    def test_sendmail(self):
+        """Messages are delivered, and connections reused across transactions"""
+        for _ in range(3):
+            self.assertEqual({}, self.submit(['to@test.com']).result(5))
+        self.assertEqual(3, len(self.sink.messages))
+        self.assertEqual(b'Subject: hi\r\n\r\nHello\r\n..hidden dot\r\n', self.sink.messages[0])
+        self.assertEqual(1, self.sink.connections)
+
+    def test_sendmail_without_pipelining(self):
+        """Messages are delivered one command at a time if the server does not support PIPELINING"""
+        self.sink.pipelining = False
+        self.assertEqual({}, self.submit(['to@test.com']).result(5))
+        self.assertEqual(1, len(self.sink.messages))
+
+    def test_concurrency_bound(self):
+        """No more sessions than the concurrency cap are opened towards a relay"""
+        futures = [self.submit([f'to{i}@test.com'], concurrency=3) for i in range(30)]
+        for fut in futures:
+            fut.result(5)
+        self.assertEqual(30, len(self.sink.messages))
+        self.assertLessEqual(self.sink.connections, 3)
+
+    def test_refused_recipients(self):
+        """Refused recipients are reported, or raise SMTPRecipientsRefused if all are refused"""
+        refused = self.submit(['to@test.com', 'bad@test.com']).result(5)
+        self.assertEqual(['bad@test.com'], list(refused))
+        self.assertEqual(550, refused['bad@test.com'][0])
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.submit(['bad@test.com']).result(5)
+        self.assertEqual(1, len(self.sink.messages))
+        # the session stays usable
+        self.submit(['to@test.com']).result(5)
+        self.assertEqual(1, self.sink.connections)
+
+    def test_extensions(self):
+        """Encoded messages are sent in 8-bit and with BDAT if the server supports it"""
+        self.sink.extensions = ['8BITMIME', 'CHUNKING']
+        msg = EmailMessage()
+        msg.set_content('Grüße\n', cte='8bit')
+        msg['Subject'] = 'Test'
+        encoded = EncodedMessage(lambda eightbit: msg, 'from@test.com', ['to@test.com'])
+        self.engine.submit(self.relay, 2, 60, 'from@test.com', ['to@test.com'], encoded).result(5)
+        self.assertIn(b'MAIL FROM:<from@test.com> BODY=8BITMIME', self.sink.commands)
+        self.assertIn('Grüße'.encode('utf-8'), self.sink.messages[0])
+        self.assertFalse(any(c.startswith(b'DATA') for c in self.sink.commands))
+
+    def test_stream(self):
+        """Large messages are streamed to the relay, with DATA or BDAT"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        rendered = s._render_msg({})
+        rendered.regular = [Attachment('large.bin', os.urandom(1024 * 1024), 'application', 'octet-stream')]
+        for extensions in [[], ['CHUNKING']]:
+            self.sink.extensions = extensions
+            msg = s._encode_msg(rendered, ['foo@bar.com'])
+            self.assertIsNotNone(msg.stream(lambda name: False))
+            self.engine.submit(self.relay, 2, 60, 'from@test.com', ['foo@bar.com'], msg).result(5)
+            self.assertEqual(msg.as_bytes(False), self.sink.messages[-1])
+
+    def test_failed_setup_closes_connection(self):
+        """Sessions failing after connecting, e.g. upon missing STARTTLS or refused credentials, close their connection"""
+        for settings in [{'starttls': True}, {'auth': 'user:wrong'}]:
+            conn = smtp_async.AsyncSMTPConnection(**self.relay, **settings)
+            with mock.patch.object(conn, 'close', wraps=conn.close) as mclose:
+                with self.assertRaises(smtplib.SMTPException):
+                    asyncio.run(conn.connect())
+                mclose.assert_called_once()
+            self.assertIsNone(conn.writer)
+
+    def test_connection_refused(self):
+        """Failures to connect are raised to the caller"""
+        self.relay['port'] = 1
+        with self.assertRaises(OSError):
+            self.submit(['to@test.com']).result(5)
+
+
+class TestEmailSendableAsync(unittest.TestCase):
+    def test_send_async(self):
+        """EmailSendable delivers through the asynchronous engine if TATTLER_SMTP_ASYNC_CONCURRENCY is set"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:2525", 'TATTLER_SMTP_ASYNC_CONCURRENCY': '4' }.get(k, os.getenv(k, v))
+            with mock.patch.object(smtp_async.get_engine(), 'submit') as msubmit, mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                s.send()
+                msubmit.assert_called_once()
+                relay, concurrency = msubmit.call_args.args[:2]
+                self.assertEqual(('127.0.0.1', 2525), (relay['host'], relay['port']))
+                self.assertEqual(4, concurrency)
+                msubmit.return_value.result.assert_called_once()
+                msmtp.SMTP.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
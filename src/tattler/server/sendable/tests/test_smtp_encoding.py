@@ -0,0 +1,136 @@
+"""Tests for encoding of email messages according to SMTP extensions"""
+
+import os
+import smtplib
+import threading
+import unittest
+from unittest import mock
+
+from tattler.server.sendable.smtp_encoding import EncodedMessage, text_cte, sendmail, bdat_sendmail, data_sendmail, dot_stuff, rechunk, stream_chunk_size
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_smtp_async import Sink, SinkHandler
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+german = 'Sehr geehrte Frau Müller,\nvielen Dank für Ihre Bestellung. Grüße aus München!\n' * 20
+
+
+class TestSMTPEncoding(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sink = Sink(('127.0.0.1', 0), SinkHandler)
+        self.sink.connections = 0
+        self.sink.commands = []
+        self.sink.messages = []
+        self.sink.pipelining = False
+        self.sink.extensions = []
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+
+    def tearDown(self) -> None:
+        self.sink.shutdown()
+        self.sink.server_close()
+
+    def encoded(self, subject='Ihre Bestellung'):
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        rendered = s._render_msg({})
+        rendered.plain = german
+        rendered.subject = subject
+        return EncodedMessage(lambda eightbit: s._assemble_msg(rendered, eightbit), 'from@test.com', ['foo@bar.com'])
+
+    def send(self, message):
+        with smtplib.SMTP('127.0.0.1', self.sink.server_address[1]) as server:
+            return sendmail(server, 'from@test.com', ['foo@bar.com'], message)
+
+    def test_text_cte(self):
+        """Non-ASCII text is sent 8-bit if allowed, and unless it has lines too long for SMTP"""
+        self.assertIsNone(text_cte('ascii only', True))
+        self.assertIsNone(text_cte('Grüße', False))
+        self.assertEqual('8bit', text_cte('Grüße', True))
+        self.assertIsNone(text_cte('ü' * 500, True))
+
+    def test_7bit_relay(self):
+        """Messages are sent 7-bit as before to relays without 8BITMIME"""
+        message = self.encoded()
+        data, options = message.for_extensions(lambda e: False)
+        self.assertEqual(message.as_string(), data)
+        self.assertEqual([], options)
+        self.send(message)
+        self.assertIn(b'Content-Transfer-Encoding: base64', self.sink.messages[0])
+
+    def test_8bitmime_relay(self):
+        """Messages are sent 8-bit to relays with 8BITMIME, and smaller"""
+        self.sink.extensions = ['8BITMIME']
+        message = self.encoded()
+        self.send(message)
+        received = self.sink.messages[0]
+        self.assertIn(b'Content-Transfer-Encoding: 8bit', received)
+        self.assertIn('Grüße aus München'.encode('utf-8'), received)
+        self.assertTrue(any(c.startswith(b'mail FROM:<from@test.com>') and c.endswith(b'BODY=8BITMIME') for c in self.sink.commands))
+        self.assertLess(len(received), len(message.as_string()) * 0.9)
+
+    def test_chunking_7bit_relay(self):
+        """Messages are sent 7-bit with BDAT to relays with CHUNKING but without 8BITMIME"""
+        self.sink.extensions = ['CHUNKING']
+        self.send(self.encoded())
+        self.assertTrue(self.sink.messages[0].isascii())
+        self.assertTrue(any(c.startswith(b'BDAT') for c in self.sink.commands))
+
+    def test_smtputf8_relay(self):
+        """Non-ASCII headers are sent in UTF-8 to relays with SMTPUTF8, and encoded otherwise"""
+        self.sink.extensions = ['8BITMIME', 'SMTPUTF8']
+        self.send(self.encoded(subject='Grüße'))
+        self.assertIn('Subject: Grüße'.encode('utf-8'), self.sink.messages[0])
+        self.sink.extensions = ['8BITMIME']
+        self.send(self.encoded(subject='Grüße'))
+        self.assertIn(b'Subject: =?utf-8?', self.sink.messages[1])
+
+    def test_chunking_relay(self):
+        """Messages are sent with BDAT to relays with CHUNKING"""
+        self.sink.extensions = ['8BITMIME', 'CHUNKING']
+        message = self.encoded()
+        self.assertEqual({}, self.send(message))
+        self.assertTrue(any(c.startswith(b'BDAT') for c in self.sink.commands))
+        self.assertFalse(any(c.startswith(b'data') for c in self.sink.commands))
+        self.assertEqual(message.as_bytes(True), self.sink.messages[0])
+
+    def test_dot_stuff(self):
+        """Streamed data is dot-stuffed across chunk boundaries, and terminated"""
+        self.assertEqual(b'..a\r\nb\r\n..c\r\n.\r\n', b''.join(dot_stuff([b'.a\r\nb\r\n', b'.c'])))
+        self.assertEqual(b'a.\r\n.\r\n', b''.join(dot_stuff([b'a', b'.\r\n'])))
+        self.assertEqual(b'.\r\n', b''.join(dot_stuff([])))
+
+    def test_rechunk(self):
+        """Chunks are regrouped in chunks of a given size"""
+        self.assertEqual([b'abc', b'def', b'g'], list(rechunk([b'a', b'bcde', b'', b'fg'], 3)))
+        self.assertEqual([], list(rechunk([], 3)))
+
+    def test_stream_data(self):
+        """Streamed messages are written to the connection in bounded chunks with DATA"""
+        sent = []
+        with smtplib.SMTP('127.0.0.1', self.sink.server_address[1]) as server:
+            server.send = mock.Mock(side_effect=lambda data: sent.append(len(data)) or smtplib.SMTP.send(server, data))
+            chunks = [b'.line %d\r\n' % i * 1000 for i in range(100)]
+            self.assertEqual({}, data_sendmail(server, 'from@test.com', ['foo@bar.com'], iter(chunks)))
+        self.assertEqual(b'.' + b''.join(chunks).replace(b'\r\n.', b'\r\n..'), self.sink.messages[0])
+        self.assertLessEqual(max(sent), stream_chunk_size)
+
+    def test_stream_bdat(self):
+        """Streamed messages are written to the connection in bounded BDAT chunks"""
+        self.sink.extensions = ['CHUNKING']
+        chunks = [b'line %d\r\n' % i * 1000 for i in range(100)]
+        with smtplib.SMTP('127.0.0.1', self.sink.server_address[1]) as server:
+            self.assertEqual({}, bdat_sendmail(server, 'from@test.com', ['foo@bar.com'], iter(chunks), chunk_size=stream_chunk_size))
+        self.assertEqual(b''.join(chunks), self.sink.messages[0])
+        self.assertEqual(1 + len(b''.join(chunks)) // stream_chunk_size, len([c for c in self.sink.commands if c.startswith(b'BDAT')]))
+
+    def test_send_email_8bit(self):
+        """EmailSendable delivers 8-bit to relays supporting it"""
+        self.sink.extensions = ['8BITMIME']
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_SMTP_ADDRESS': f'127.0.0.1:{self.sink.server_address[1]}'}.get(k, os.getenv(k, v))
+            s.send(context={'name': 'Jürgen'}, mode='production')
+        self.assertEqual(1, len(self.sink.messages))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests for adaptive concurrency control towards SMTP relays"""
+
+import smtplib
+import unittest
+from unittest import mock
+
+from tattler.server import metrics
+from tattler.server.sendable import smtp_limiter
+from tattler.server.sendable.smtp_limiter import AIMDLimiter, is_temporary_failure, temporary_refusal
+from tattler.server.sendable.vector_email import SMTPDelivery
+
+
+class TestAIMDLimiter(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_is_temporary_failure(self):
+        """Temporary SMTP failures and broken connections are told apart from permanent failures"""
+        self.assertTrue(is_temporary_failure(smtplib.SMTPSenderRefused(451, b'try later', 'a@b.com')))
+        self.assertTrue(is_temporary_failure(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_temporary_failure(smtplib.SMTPRecipientsRefused({'a@b.com': (452, b'too many')})))
+        self.assertFalse(is_temporary_failure(smtplib.SMTPRecipientsRefused({'a@b.com': (550, b'no such user')})))
+        self.assertFalse(is_temporary_failure(smtplib.SMTPDataError(554, b'rejected')))
+        self.assertFalse(is_temporary_failure(ValueError()))
+
+    def test_additive_increase(self):
+        """The limit grows by about one per round of healthy transactions, up to max_limit"""
+        lim = AIMDLimiter(max_limit=4, initial=2)
+        for _ in range(3):
+            lim.acquire(1)
+            lim.release(0.01)
+        self.assertEqual(3, int(lim.limit))
+        for _ in range(100):
+            lim.acquire(1)
+            lim.release(0.01)
+        self.assertEqual(4, lim.limit)
+        self.assertEqual(4, metrics.snapshot()['gauges']['smtp_concurrency_limit{relay=smtp}'])
+
+    def test_backoff_on_temporary_failure(self):
+        """The limit is cut upon temporary failures, but not below min_limit, and not upon permanent failures"""
+        lim = AIMDLimiter(max_limit=16, initial=8)
+        lim.acquire(1)
+        lim.release(0.01, smtplib.SMTPRecipientsRefused({'a@b.com': (550, b'no such user')}))
+        self.assertEqual(8, lim.limit)
+        for _ in range(5):
+            lim._backoff_at = 0
+            lim.acquire(1)
+            lim.release(0.01, smtplib.SMTPSenderRefused(421, b'busy', 'a@b.com'))
+        self.assertEqual(1, lim.limit)
+        self.assertEqual(3, metrics.snapshot()['counters']['smtp_concurrency_backoffs{relay=smtp}'])
+
+    def test_one_backoff_per_round_trip(self):
+        """A burst of failures within one round trip cuts the limit once"""
+        lim = AIMDLimiter(max_limit=16, initial=8)
+        lim.latency_ewma = 10
+        for _ in range(3):
+            lim.acquire(1)
+            lim.release(0.01, smtplib.SMTPServerDisconnected())
+        self.assertEqual(4, lim.limit)
+
+    def test_backoff_on_rising_latency(self):
+        """The limit is cut when latency rises well above the lowest observed"""
+        lim = AIMDLimiter(max_limit=16, initial=8)
+        lim.acquire(1)
+        lim.release(0.05)
+        for _ in range(10):
+            lim.acquire(1)
+            lim.release(1.0)
+        self.assertLess(lim.limit, 8)
+
+    def test_acquire_bounded(self):
+        """No more operations than the limit run at once"""
+        lim = AIMDLimiter(max_limit=4, initial=2)
+        lim.acquire(1)
+        lim.acquire(1)
+        with self.assertRaises(TimeoutError):
+            lim.acquire(0.05)
+        lim.release(0.01)
+        lim.acquire(1)
+
+    def test_slot(self):
+        """slot() releases upon errors too, and re-raises them"""
+        lim = AIMDLimiter(max_limit=4, initial=4)
+        with self.assertRaises(smtplib.SMTPSenderRefused):
+            with lim.slot(1):
+                raise smtplib.SMTPSenderRefused(451, b'later', 'a@b.com')
+        self.assertEqual(0, lim.in_flight)
+        self.assertEqual(2, lim.limit)
+
+    def test_temporary_refusal(self):
+        """Recipients refused with 4xx by accepted transactions are reported as temporary failures"""
+        self.assertIsNone(temporary_refusal({}))
+        self.assertIsNone(temporary_refusal({'a@b.com': (550, b'no such user')}))
+        err = temporary_refusal({'a@b.com': (550, b'no such user'), 'c@d.com': (451, b'try later')})
+        self.assertEqual({'c@d.com': (451, b'try later')}, err.recipients)
+        self.assertTrue(is_temporary_failure(err))
+
+    def test_delivery_reports_temporary_refusals(self):
+        """SMTPDelivery backs off when the relay defers some recipients of an accepted transaction"""
+        smtp = SMTPDelivery(pool_size=0)
+        smtp.max_concurrency = 8
+        self.addCleanup(smtp_limiter._limiters.clear)
+        with mock.patch.object(smtp, '_transact', return_value={'c@d.com': (452, b'too many recipients')}):
+            self.assertEqual({'c@d.com': (452, b'too many recipients')}, smtp.deliver('a@b.com', 'msg', ['a@b.com', 'c@d.com']))
+        limiter = smtp_limiter.get_limiter(tuple(smtp.relays), 8)
+        self.assertEqual((1, 0), (limiter.limit, limiter.in_flight))
+
+
+if __name__ == '__main__':
+    unittest.main()
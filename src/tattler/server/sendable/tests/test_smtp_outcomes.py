@@ -0,0 +1,122 @@
+"""Tests for per-recipient SMTP outcomes and retries"""
+
+import os
+import smtplib
+import threading
+import unittest
+from unittest import mock
+
+from tattler.server.sendable import smtp_outcomes
+from tattler.server.sendable.smtp_outcomes import outcomes_from_refused, outcomes_from_error, backoff_delay, RetryScheduler
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+
+class TestSMTPOutcomes(unittest.TestCase):
+    def test_outcomes_from_refused(self):
+        """Refused recipients are classified as retryable with 4xx replies, and failed with 5xx replies"""
+        outcomes = outcomes_from_refused(['a@x.com', 'b@x.com', 'c@x.com'], {'b@x.com': (451, b'later'), 'c@x.com': (550, b'unknown')})
+        self.assertEqual(['delivered', 'retry', 'failed'], [o.status for o in outcomes])
+        self.assertEqual('later', outcomes[1].message)
+
+    def test_outcomes_from_error(self):
+        """Errors of whole transactions apply to all their recipients"""
+        outcomes = outcomes_from_error(['a@x.com', 'b@x.com'], smtplib.SMTPRecipientsRefused({'a@x.com': (452, b'full'), 'b@x.com': (550, b'no')}))
+        self.assertEqual(['retry', 'failed'], [o.status for o in outcomes])
+        outcomes = outcomes_from_error(['a@x.com'], smtplib.SMTPDataError(554, b'spam'))
+        self.assertEqual(('failed', 554), (outcomes[0].status, outcomes[0].code))
+        outcomes = outcomes_from_error(['a@x.com'], smtplib.SMTPServerDisconnected('gone'))
+        self.assertEqual(('retry', None), (outcomes[0].status, outcomes[0].code))
+        with self.assertRaises(KeyError):
+            outcomes_from_error(['a@x.com'], KeyError('foo'))
+
+    def test_backoff_delay(self):
+        """Backoff delays grow exponentially, with jitter, up to a cap"""
+        for attempt, bound in [(1, 10), (2, 20), (3, 40), (10, 100)]:
+            delays = [backoff_delay(attempt, 10, cap_s=100) for _ in range(50)]
+            self.assertTrue(all(0 <= d <= bound for d in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_retry_scheduler(self):
+        """The scheduler runs functions after their delay, in order"""
+        sched = RetryScheduler()
+        done = threading.Event()
+        ran = []
+        sched.schedule(0.05, lambda: (ran.append(2), done.set()))
+        sched.schedule(0.0, lambda: ran.append(1))
+        self.assertTrue(done.wait(5))
+        self.assertEqual([1, 2], ran)
+
+
+class TestEmailSendableOutcomes(unittest.TestCase):
+    def setUp(self) -> None:
+        self.env = {'TATTLER_SMTP_ADDRESS': '127.0.0.1:25', 'TATTLER_SMTP_RETRIES': '2', 'TATTLER_SUPERVISOR_RECIPIENT_EMAIL': 'boss@x.com'}
+        patcher = mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv')
+        self.mgetenv = patcher.start()
+        self.mgetenv.side_effect = lambda k, v=None: self.env.get(k, os.getenv(k, v))
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('tattler.server.sendable.vector_email.smtplib')
+        self.msmtp = patcher.start()
+        self.msmtp.SMTPRecipientsRefused = smtplib.SMTPRecipientsRefused
+        self.addCleanup(patcher.stop)
+        self.scheduled = []
+        patcher = mock.patch.object(smtp_outcomes.get_scheduler(), 'schedule', side_effect=lambda delay, func: self.scheduled.append(func))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retry_only_affected_recipients(self):
+        """Only recipients refused with 4xx replies are retried"""
+        s = EmailSendable('event1', ['a@x.com', 'b@x.com'], template_base=tbase_path)
+        sendmail = self.msmtp.SMTP.return_value.sendmail
+        sendmail.side_effect = [{'b@x.com': (451, b'later')}, {}]
+        s.send(mode='production')
+        self.assertEqual(1, len(self.scheduled))
+        self.assertEqual({'a@x.com': 'delivered', 'b@x.com': 'pending'}, {r: o.status for r, o in s.recipient_outcomes.items()})
+        self.assertEqual(['b@x.com'], s.pending_recipients())
+        self.scheduled.pop()()
+        self.assertEqual(['b@x.com'], sendmail.call_args.args[1])
+        self.assertEqual({'a@x.com': 'delivered', 'b@x.com': 'delivered'}, {r: o.status for r, o in s.recipient_outcomes.items()})
+        self.assertEqual([], s.pending_recipients())
+        self.assertEqual(1, s.recipient_outcomes['b@x.com'].attempt)
+
+    def test_retries_exhausted(self):
+        """Recipients still failing after the last retry are marked failed"""
+        s = EmailSendable('event1', ['a@x.com'], template_base=tbase_path)
+        self.msmtp.SMTP.return_value.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        s.send(mode='production')
+        while self.scheduled:
+            self.scheduled.pop()()
+        self.assertEqual(3, self.msmtp.SMTP.return_value.sendmail.call_count)
+        self.assertEqual('failed', s.recipient_outcomes['a@x.com'].status)
+
+    def test_permanent_failure_raises(self):
+        """Recipients refused with 5xx replies fail the delivery, and are not retried"""
+        s = EmailSendable('event1', ['a@x.com', 'b@x.com'], template_base=tbase_path)
+        self.msmtp.SMTP.return_value.sendmail.return_value = {'b@x.com': (550, b'unknown')}
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as ctx:
+            s.send(mode='production')
+        self.assertEqual(['b@x.com'], list(ctx.exception.recipients))
+        self.assertEqual([], self.scheduled)
+
+    def test_supervisor_failure_tolerated(self):
+        """In staging mode, failing to deliver the supervisor copy does not fail the delivery"""
+        s = EmailSendable('event1', ['a@x.com'], template_base=tbase_path)
+        self.msmtp.SMTP.return_value.sendmail.return_value = {'boss@x.com': (550, b'mailbox full')}
+        s.send(mode='staging')
+        self.assertEqual('failed', s.recipient_outcomes['boss@x.com'].status)
+        self.msmtp.SMTP.return_value.sendmail.return_value = {'a@x.com': (550, b'unknown')}
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            s.send(mode='staging')
+
+    def test_transaction_error_raised(self):
+        """Errors failing the whole transaction permanently are raised as they are"""
+        self.env['TATTLER_SMTP_RETRIES'] = '0'
+        s = EmailSendable('event1', ['a@x.com'], template_base=tbase_path)
+        self.msmtp.SMTP.side_effect = ConnectionRefusedError()
+        with self.assertRaises(ConnectionRefusedError):
+            s.send(mode='production')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""Tests for pacing of email deliveries per recipient domain"""
+
+import os
+import unittest
+from unittest import mock
+
+from tattler.server.sendable import smtp_outcomes, smtp_pacing
+from tattler.server.sendable.smtp_pacing import DomainPacer, TokenBucket, group_by_domain, parse_rates
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+
+class FakeClock:
+    """Replaces time.monotonic() with a clock advancing only when told"""
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class TestSMTPPacing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        patcher = mock.patch('tattler.server.sendable.smtp_pacing.time.monotonic', self.clock.monotonic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parse_rates(self):
+        """Pacing specifications list domain=rate[:burst]"""
+        self.assertEqual({'gmail.com': (10.0, None), 'outlook.com': (0.5, 5.0), '*': (50.0, None)}, parse_rates('gmail.com=10, Outlook.com=0.5:5,*=50'))
+        for invalid in ['gmail.com', 'gmail.com=0', 'gmail.com=x', '=3', 'gmail.com=1:0']:
+            with self.assertRaises(ValueError, msg=invalid):
+                parse_rates(invalid)
+
+    def test_token_bucket(self):
+        """Token buckets allow bursts, then operations at their rate"""
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([True, True, True, False], [bucket.take() for _ in range(4)])
+        self.assertAlmostEqual(0.5, bucket.delay())
+        self.clock.now += 0.5
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_group_by_domain(self):
+        """Recipients are grouped by domain in order of first appearance"""
+        self.assertEqual([('a.com', ['x@a.com', 'z@a.com']), ('b.com', ['y@b.com'])], group_by_domain(['x@a.com', 'y@b.com', 'z@a.com']))
+
+    def test_token_per_message(self):
+        """Every message to a domain takes a token, and messages beyond those available wait for the bucket"""
+        pacer = DomainPacer(parse_rates('slow.com=2:3'))
+        self.assertEqual((3, 0.5), pacer.reserve('slow.com', 5))
+        self.assertEqual((0, 0.5), pacer.reserve('slow.com', 2))
+        self.clock.now += 1
+        self.assertEqual((2, 0.0), pacer.reserve('slow.com', 2))
+        self.assertEqual((7, 0.0), pacer.reserve('other.com', 7))
+
+    def test_dispatch_defers_throttled_domains(self):
+        """Recipients of throttled domains are deferred, while other domains are ready at once"""
+        pacer = DomainPacer(parse_rates('slow.com=1'))
+        ready, deferred = pacer.dispatch(['1@slow.com', '2@slow.com', '3@fast.com', '4@slow.com', '5@fast.com'])
+        self.assertEqual([('slow.com', ['1@slow.com']), ('fast.com', ['3@fast.com', '5@fast.com'])], ready)
+        self.assertEqual([(1.0, 'slow.com', ['2@slow.com', '4@slow.com'])], deferred)
+
+    def test_default_rate(self):
+        """Domains not listed are paced with the '*' rate, if any"""
+        pacer = DomainPacer(parse_rates('*=2:1'))
+        ready, deferred = pacer.dispatch(['a@x.com', 'b@x.com', 'c@y.com'])
+        self.assertEqual([('x.com', ['a@x.com']), ('y.com', ['c@y.com'])], ready)
+        self.assertEqual([(0.5, 'x.com', ['b@x.com'])], deferred)
+
+    def test_send_paced(self):
+        """EmailSendable delivers one transaction per recipient domain when pacing is configured"""
+        s = EmailSendable('event1', ['a@foo.com', 'b@bar.com', 'c@foo.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:25", 'TATTLER_SMTP_PACING': 'foo.com=10' }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                s.send(mode='production')
+                rcpts = sorted(sorted(c.args[1]) for c in msmtp.SMTP().sendmail.call_args_list)
+                self.assertEqual([['a@foo.com', 'c@foo.com'], ['b@bar.com']], rcpts)
+
+    def test_send_paced_defers_throttled(self):
+        """EmailSendable hands recipients beyond their domain's rate to the scheduler, without waiting for them"""
+        smtp_pacing.get_pacer.cache_clear()
+        self.addCleanup(smtp_pacing.get_pacer.cache_clear)
+        s = EmailSendable('event1', ['a@foo.com', 'b@bar.com', 'c@foo.com', 'd@foo.com'], template_base=tbase_path)
+        scheduled = []
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:25", 'TATTLER_SMTP_PACING': 'foo.com=1' }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                with mock.patch.object(smtp_outcomes.get_scheduler(), 'schedule', side_effect=lambda delay, func: scheduled.append((delay, func))):
+                    s.send(mode='production')
+                    sendmail = msmtp.SMTP().sendmail
+                    delivered = [c.args[1] for c in sendmail.call_args_list]
+                    self.assertEqual([1, 1], [len(rcpts) for rcpts in delivered])
+                    self.assertIn(['b@bar.com'], delivered)
+                    statuses = sorted(o.status for o in s.recipient_outcomes.values())
+                    self.assertEqual(['delivered', 'delivered', 'pending', 'pending'], statuses)
+                    for _ in range(2):
+                        self.assertEqual([1.0], [delay for delay, _ in scheduled])
+                        self.clock.now += 1
+                        scheduled.pop()[1]()
+                        self.assertEqual(1, len(sendmail.call_args.args[1]))
+                    self.assertEqual([], scheduled)
+        self.assertEqual(4, sendmail.call_count)
+        self.assertEqual({'delivered'}, {o.status for o in s.recipient_outcomes.values()})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""Tests for pool of persistent SMTP connections"""
+
+import os
+import smtplib
+import unittest
+from unittest import mock
+
+from tattler.server import metrics
+from tattler.server.sendable import smtp_pool
+from tattler.server.sendable.smtp_pool import SMTPConnectionPool
+from tattler.server.sendable.vector_email import EmailSendable
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+
+class TestSMTPConnectionPool(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+        self.conns = []
+        self.pool = SMTPConnectionPool(self.connect, max_size=2, idle_timeout_s=60, check_after_s=0, name='relay')
+
+    def connect(self):
+        conn = mock.MagicMock(name=f'conn{len(self.conns)}')
+        conn.noop.return_value = (250, b'OK')
+        conn.rset.return_value = (250, b'OK')
+        self.conns.append(conn)
+        return conn
+
+    def test_connections_reused(self):
+        """Connections released to the pool are reused by later transactions"""
+        for _ in range(3):
+            self.pool.run(lambda conn: conn.sendmail('a@b.com', ['c@d.com'], 'msg'), timeout=1)
+        self.assertEqual(1, len(self.conns))
+        self.assertEqual(3, len(self.conns[0].sendmail.mock_calls))
+        self.conns[0].quit.assert_not_called()
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(1, counters['smtp_connections_opened{relay=relay}'])
+        self.assertEqual(2, counters['smtp_connections_reused{relay=relay}'])
+
+    def test_dead_connection_replaced(self):
+        """Connections failing NOOP before reuse are replaced with new ones"""
+        self.pool.run(lambda conn: None, timeout=1)
+        self.conns[0].noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.run(lambda conn: None, timeout=1)
+        self.assertEqual(2, len(self.conns))
+        self.assertEqual(1, len(self.pool))
+
+    def test_retry_on_broken_connection(self):
+        """Transactions failing with 421 on a reused connection are retried on a new connection"""
+        self.pool.run(lambda conn: None, timeout=1)
+        self.conns[0].sendmail.side_effect = smtplib.SMTPSenderRefused(421, b'closing', 'a@b.com')
+        self.pool.run(lambda conn: conn.sendmail('a@b.com', ['c@d.com'], 'msg'), timeout=1)
+        self.assertEqual(2, len(self.conns))
+        self.conns[1].sendmail.assert_called_once()
+        self.assertEqual(1, len(self.pool))
+
+    def test_no_retry_on_new_connection(self):
+        """Transactions failing on a new connection are not retried"""
+        def fail(conn):
+            raise BrokenPipeError()
+        with self.assertRaises(BrokenPipeError):
+            self.pool.run(fail, timeout=1)
+        self.assertEqual(1, len(self.conns))
+        self.assertEqual(0, len(self.pool))
+
+    def test_reset_after_error(self):
+        """Connections are reset with RSET after transactions failing with a regular SMTP error, and kept"""
+        def refuse(conn):
+            raise smtplib.SMTPRecipientsRefused({'c@d.com': (550, b'no such user')})
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.pool.run(refuse, timeout=1)
+        self.conns[0].rset.assert_called_once()
+        self.pool.run(lambda conn: None, timeout=1)
+        self.assertEqual(1, len(self.conns))
+
+    def test_max_size(self):
+        """No more than max_size connections are opened, and acquiring beyond that times out"""
+        c1, _ = self.pool.acquire(1)
+        c2, _ = self.pool.acquire(1)
+        with self.assertRaises(TimeoutError):
+            self.pool.acquire(0.05)
+        self.pool.release(c1)
+        c3, reused = self.pool.acquire(1)
+        self.assertIs(c1, c3)
+        self.assertTrue(reused)
+        self.assertEqual(2, len(self.conns))
+
+    def test_idle_connections_expire(self):
+        """Connections idle for longer than idle_timeout_s are closed instead of reused"""
+        self.pool.idle_timeout_s = 0
+        self.pool.run(lambda conn: None, timeout=1)
+        self.pool.run(lambda conn: None, timeout=1)
+        self.assertEqual(2, len(self.conns))
+        self.conns[0].quit.assert_called_once()
+
+    def test_close(self):
+        """close() quits idle connections"""
+        self.pool.run(lambda conn: None, timeout=1)
+        self.pool.close()
+        self.conns[0].quit.assert_called_once()
+        self.assertEqual(0, len(self.pool))
+
+
+class TestEmailSendablePooled(unittest.TestCase):
+    def tearDown(self) -> None:
+        smtp_pool.close_all()
+        smtp_pool._pools.clear()
+
+    def test_send_pooled(self):
+        """EmailSendable reuses connections across deliveries if TATTLER_SMTP_POOL_SIZE is set"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:25", 'TATTLER_SMTP_POOL_SIZE': '2' }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                s.send()
+                s.send()
+                self.assertEqual(1, msmtp.SMTP.call_count)
+                self.assertEqual(2, msmtp.SMTP().sendmail.call_count)
+                msmtp.SMTP().quit.assert_not_called()
+
+    def test_send_unpooled(self):
+        """EmailSendable opens and quits a connection per delivery by default"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:25" }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                s.send()
+                s.send()
+                self.assertEqual(2, msmtp.SMTP.call_count)
+                self.assertEqual(2, len(msmtp.SMTP().quit.mock_calls))
+
+    def test_send_unpooled_closes_on_error(self):
+        """EmailSendable closes its connection if delivery fails mid-transaction"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "127.0.0.1:25" }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                msmtp.SMTP().sendmail.side_effect = smtplib.SMTPServerDisconnected("gone")
+                msmtp.SMTP().quit.side_effect = smtplib.SMTPServerDisconnected("gone")
+                with self.assertRaises(smtplib.SMTPServerDisconnected):
+                    s.send()
+                msmtp.SMTP().close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+"""Tests for selection among multiple SMTP relays"""
+
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from tattler.server import metrics
+from tattler.server.sendable import smtp_relays
+from tattler.server.sendable.vector_email import EmailSendable, get_smtp_servers
+
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+r1, r2, r3 = ('relay1', 25), ('relay2', 25), ('relay3', 25)
+
+
+class TestSMTPRelays(unittest.TestCase):
+    def setUp(self) -> None:
+        smtp_relays.reset()
+        metrics.reset()
+
+    def test_get_smtp_servers(self):
+        """TATTLER_SMTP_ADDRESS accepts a comma-separated list of relays"""
+        self.assertEqual([('127.0.0.1', 25)], get_smtp_servers('127.0.0.1'))
+        self.assertEqual([('smtp1.foo.com', 25), ('12:34::1', 587)], get_smtp_servers('smtp1.foo.com, [12:34::1]:587'))
+        with self.assertRaises(ValueError):
+            get_smtp_servers(' , ')
+
+    def test_percentile(self):
+        """Percentiles of latency are computed only with enough observations"""
+        health = smtp_relays.get_health(r1)
+        for lat in range(4):
+            health.success(lat)
+        self.assertIsNone(health.percentile(95))
+        for lat in range(4, 100):
+            health.success(lat)
+        self.assertEqual(95, health.percentile(95))
+
+    def test_order(self):
+        """Relays keep their configured order, except degraded ones come after healthy ones, and those in cooldown last"""
+        self.assertEqual([r1, r2, r3], smtp_relays.order([r1, r2, r3]))
+        smtp_relays.record_success(r1, 0.05)
+        self.assertEqual([r1, r2, r3], smtp_relays.order([r1, r2, r3]))
+        smtp_relays.get_health(r1).success(2.0)
+        smtp_relays.get_health(r2).success(0.1)
+        smtp_relays.get_health(r3).success(0.2)
+        self.assertEqual([r2, r3, r1], smtp_relays.order([r1, r2, r3]))
+        # compared to the fastest relay out of cooldown, r1 is no longer degraded
+        smtp_relays.get_health(r2).failure()
+        self.assertEqual([r1, r3, r2], smtp_relays.order([r1, r2, r3]))
+
+    def test_order_degraded_by_errors(self):
+        """Relays failing often are tried after healthy ones once out of cooldown"""
+        for _ in range(4):
+            smtp_relays.get_health(r1).failure()
+        smtp_relays.get_health(r1).consecutive_failures = 0
+        self.assertEqual([r2, r1], smtp_relays.order([r1, r2]))
+
+    def test_failover(self):
+        """Connections fail over to the next relay, and failing relays are avoided afterwards"""
+        tried = []
+        def connect_one(relay):
+            tried.append(relay)
+            if relay == r1:
+                raise ConnectionRefusedError()
+            return f'conn-{relay[0]}'
+        self.assertEqual('conn-relay2', smtp_relays.connect([r1, r2], connect_one))
+        self.assertEqual([r1, r2], tried)
+        self.assertEqual('conn-relay2', smtp_relays.connect([r1, r2], connect_one))
+        self.assertEqual([r1, r2, r2], tried)
+        self.assertEqual(1, metrics.snapshot()['counters']['smtp_relay_failures{relay=relay1:25}'])
+
+    def test_all_relays_fail(self):
+        """The error of the last relay is raised if no relay can be connected to"""
+        def connect_one(relay):
+            raise ConnectionRefusedError(relay[0])
+        for hedge in (False, True):
+            with self.assertRaises(ConnectionRefusedError):
+                smtp_relays.connect([r1, r2], connect_one, hedge=hedge)
+
+    def test_hedged_connect(self):
+        """When the primary relay is slower than its p95 latency, the next relay is tried in parallel"""
+        for _ in range(10):
+            smtp_relays.record_success(r1, 0.01)
+            smtp_relays.record_success(r2, 0.02)
+        release = threading.Event()
+        discarded = []
+        def connect_one(relay):
+            if relay == r1:
+                release.wait(5)
+            return f'conn-{relay[0]}'
+        t0 = time.monotonic()
+        self.assertEqual('conn-relay2', smtp_relays.connect([r1, r2], connect_one, hedge=True, discard=discarded.append))
+        self.assertLess(time.monotonic() - t0, 1)
+        self.assertEqual(1, metrics.snapshot()['counters']['smtp_relay_hedges{relay=relay1:25}'])
+        release.set()
+        for _ in range(100):
+            if discarded:
+                break
+            time.sleep(0.01)
+        self.assertEqual(['conn-relay1'], discarded)
+
+    def test_send_failover(self):
+        """EmailSendable fails over to the next relay if the first refuses connections"""
+        s = EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path)
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k,v=None: { 'TATTLER_SMTP_ADDRESS': "10.0.0.1:25,10.0.0.2:25" }.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+                def mk_smtp(host, port, timeout):
+                    if host == '10.0.0.1':
+                        raise ConnectionRefusedError()
+                    return mock.DEFAULT
+                msmtp.SMTP.side_effect = mk_smtp
+                s.send()
+                self.assertEqual(['10.0.0.1', '10.0.0.2'], [c.args[0] for c in msmtp.SMTP.call_args_list])
+                msmtp.SMTP.return_value.sendmail.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
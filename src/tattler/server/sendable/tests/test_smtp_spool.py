@@ -0,0 +1,141 @@
+"""Tests for the local spool of emails"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server.sendable import smtp_spool
+from tattler.server.sendable.attachments import Attachment
+from tattler.server.sendable.vector_email import EmailSendable, SMTPDelivery
+
+from tattler.server.sendable.tests.test_smtp_async import Sink, SinkHandler
+from tattler.server.sendable.tests.test_vector_email import tbase_path
+
+
+class TestSMTPSpool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.spool = Path(self.tmpdir.name) / 'spool'
+        self.sink = Sink(('127.0.0.1', 0), SinkHandler)
+        self.sink.connections = 0
+        self.sink.commands = []
+        self.sink.messages = []
+        self.sink.pipelining = False
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        env = {'TATTLER_SMTP_ADDRESS': f'127.0.0.1:{self.sink.server_address[1]}', 'TATTLER_SMTP_SPOOL': str(self.spool)}
+        patcher = mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv')
+        mgetenv = patcher.start()
+        mgetenv.side_effect = lambda k, v=None: env.get(k, os.getenv(k, v))
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.sink.shutdown()
+        self.sink.server_close()
+        self.tmpdir.cleanup()
+
+    def spool_email(self, recipients=('foo@bar.com',), regular=()):
+        s = EmailSendable('event1', list(recipients), template_base=tbase_path)
+        rendered = s._render_msg({})
+        rendered.regular = list(regular)
+        message = s._encode_msg(rendered, list(recipients))
+        return smtp_spool.enqueue(self.spool, message, s.sender(), recipients, s.nid), message
+
+    def flush(self, retries=3):
+        return smtp_spool.flush(self.spool, SMTPDelivery().deliver, retries, 30)
+
+    def test_send_spools(self):
+        """Emails are written to the spool instead of delivered when TATTLER_SMTP_SPOOL is set"""
+        with mock.patch('tattler.server.sendable.vector_email.smtplib') as msmtp:
+            EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path).send()
+            msmtp.SMTP.assert_not_called()
+        self.assertEqual([], os.listdir(self.spool / 'tmp'))
+        names = os.listdir(self.spool / 'new')
+        self.assertEqual(1, len(names))
+        with open(self.spool / 'new' / names[0], 'rb') as fin:
+            envelope = json.loads(fin.readline())
+            data = fin.read()
+        self.assertEqual(['foo@bar.com'], envelope['recipients'])
+        self.assertEqual(0, envelope['attempt'])
+        self.assertIn(b'\r\nTo: foo@bar.com\r\n', data)
+        self.assertTrue(data.isascii())
+
+    def test_flush(self):
+        """Spooled emails are delivered as spooled, then removed"""
+        _, message = self.spool_email()
+        self.assertEqual(1, self.flush())
+        self.assertEqual([message.as_bytes(False)], self.sink.messages)
+        for subdir in smtp_spool.subdirs:
+            self.assertEqual([], os.listdir(self.spool / subdir))
+        self.assertEqual(0, self.flush())
+
+    def test_flush_large(self):
+        """Large spooled emails are streamed from the spool"""
+        large = Attachment('large.bin', os.urandom(1024 * 1024), 'application', 'octet-stream')
+        _, message = self.spool_email(regular=[large])
+        self.assertEqual(1, self.flush())
+        self.assertEqual(message.as_bytes(False), self.sink.messages[0])
+
+    def test_retry(self):
+        """Recipients failing temporarily are put back with a later due time, others are set aside or delivered"""
+        self.spool_email(['foo@bar.com', 'busy@bar.com', 'bad@bar.com'])
+        self.flush()
+        self.assertEqual(1, len(self.sink.messages))
+        names = os.listdir(self.spool / 'new')
+        self.assertEqual(1, len(names))
+        self.assertEqual([], smtp_spool.pending(self.spool))
+        envelope, _ = smtp_spool.read(self.spool / 'new' / names[0])
+        self.assertEqual((['busy@bar.com'], 1), (envelope['recipients'], envelope['attempt']))
+        self.assertEqual(names, smtp_spool.pending(self.spool, now=time.time() + 3600))
+        failed = os.listdir(self.spool / 'failed')
+        envelope, _ = smtp_spool.read(self.spool / 'failed' / failed[0])
+        self.assertEqual(['bad@bar.com'], envelope['recipients'])
+        self.assertIn('550', envelope['failures']['bad@bar.com'])
+
+    def test_retries_exhausted(self):
+        """Recipients still failing temporarily after all retries are set aside"""
+        self.spool_email(['busy@bar.com'])
+        self.flush(retries=0)
+        self.assertEqual([], os.listdir(self.spool / 'new'))
+        self.assertEqual(1, len(os.listdir(self.spool / 'failed')))
+
+    def test_relay_down(self):
+        """Spooled emails are kept while the relay is down"""
+        self.spool_email()
+        self.sink.shutdown()
+        self.sink.server_close()
+        with mock.patch('tattler.server.sendable.smtp_relays.get_health'):
+            self.flush()
+        envelope, _ = smtp_spool.read(self.spool / 'new' / os.listdir(self.spool / 'new')[0])
+        self.assertEqual((['foo@bar.com'], 1), (envelope['recipients'], envelope['attempt']))
+
+    def test_corrupt_envelope(self):
+        """Spooled emails with a corrupt or truncated envelope are set aside instead of retried forever"""
+        path, _ = self.spool_email()
+        smtp_spool.write(self.spool, 'new', {'sender': 'foo@bar.com'}, [b'Subject: x\r\n\r\nx\r\n'])
+        with open(path, 'r+b') as fout:
+            fout.truncate(20)
+        self.assertEqual(2, self.flush())
+        self.assertEqual([], self.sink.messages)
+        for subdir in ('new', 'cur'):
+            self.assertEqual([], os.listdir(self.spool / subdir))
+        self.assertIn(path.name, os.listdir(self.spool / 'failed'))
+        self.assertEqual(2, len(os.listdir(self.spool / 'failed')))
+
+    def test_claim(self):
+        """Each spooled email is claimed by one worker only, and claims abandoned are recovered"""
+        path, _ = self.spool_email()
+        self.assertIsNotNone(smtp_spool.claim(self.spool, path.name))
+        self.assertIsNone(smtp_spool.claim(self.spool, path.name))
+        self.assertEqual(0, smtp_spool.recover(self.spool, 60))
+        os.utime(self.spool / 'cur' / path.name, (time.time() - 120, time.time() - 120))
+        self.assertEqual(1, smtp_spool.recover(self.spool, 60))
+        self.assertEqual([path.name], smtp_spool.pending(self.spool))
+
+
+if __name__ == '__main__':
+    unittest.main()
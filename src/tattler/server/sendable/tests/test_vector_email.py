@@ -106,6 +106,13 @@ class TestVectorEmail(unittest.TestCase):
             with self.assertRaises(ValueError):
                 e.send(context={'one': '1'}, priority='invalid_value')
 
+    def test_template_variables(self):
+        """template_variables() returns the variables read by all expanded parts, plus attachments"""
+        e = EmailSendable('event_with_email_and_sms', data_recipients['email'], template_base=tbase_standard_path)
+        variables = e.template_variables()
+        self.assertIn('_attachments', variables)
+        self.assertIn('one', variables)
+
     def test_email_plain(self):
         """Plain email contains no HTML declaration"""
         e = EmailSendable('event_with_email_plain', data_recipients['email'], template_base=tbase_standard_path)
@@ -39,7 +39,7 @@ class TestVectorSMS(unittest.TestCase):
     def test_invalid_auth_data(self):
         """SMSSendable constructor raises iff TATTLER_BULKSMS_TOKEN malformed"""
         with mock.patch('tattler.server.sendable.vector_sms.getenv') as mgetenv:
-            with mock.patch('tattler.server.sendable.vector_sms.BulkSMS') as msms:
+            with mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as msms:
                 mgetenv.side_effect = lambda x, y=None: {'TATTLER_BULKSMS_TOKEN': 'foobar'}.get(x, os.getenv(x, y))
                 with self.assertRaises(ValueError):
                     s0 = SMSSendable('event', ['00123456789'])
@@ -76,20 +76,34 @@ class TestVectorSMS(unittest.TestCase):
             self.assertEqual(SMSSendable.sender('+4191'), '+41987654311')
             self.assertEqual(SMSSendable.sender('+41432'), '+41234567')
 
+    def test_sender_index(self):
+        """The sender index is compiled once per configuration, and matches senders identical to the recipient"""
+        index = vector_sms.get_sender_index('+12345678,+41234567,+41987654311')
+        self.assertIs(index, vector_sms.get_sender_index('+12345678,+41234567,+41987654311'))
+        self.assertEqual('+41987654311', index.lookup('+41987654311'))
+        self.assertEqual('+41234567', index.lookup('+4'))
+        self.assertEqual('+12345678', index.lookup('+5'))
+        self.assertEqual('+12345678', index.lookup(None))
+
     def test_send_splits_by_senderid(self):
         """send() calls one delivery for each different sender_id, when multiple are required"""
         with mock.patch('tattler.server.sendable.vector_sms.getenv') as mgetenv:
             with mock.patch('tattler.server.sendable.vector_sms.vector_sendable.getenv') as mgetenv2:
-                with mock.patch('tattler.server.sendable.vector_sms.BulkSMS') as msms:
+                with mock.patch('tattler.server.sendable.vector_sms.sms_client.get_client') as msms, mock.patch('tattler.server.sendable.vector_sms.sms_client.get_poller') as mpoller:
                     with mock.patch('tattler.server.sendable.vector_sms.vector_sendable.Sendable.content'):
                         mgetenv.side_effect = lambda x, y=None: {
                             'TATTLER_SMS_SENDER': '+12345678,+41234567,+41987654311',
-                            'TATTLER_BULKSMS_TOKEN': '12:aas'
+                            'TATTLER_BULKSMS_TOKEN': '12:aas',
+                            'TATTLER_SMS_REPORT_INTERVAL': '60',
                         }.get(x, os.getenv(x, y))
                         mgetenv2.side_effect = mgetenv.side_effect
+                        msms.return_value.send.side_effect = lambda rcpts, *args, **kwargs: [f'id{r}' for r in sorted(rcpts)]
                         snd = SMSSendable('event', ['+123456789', '+16548351', '+4156894562'])
                         snd.send()
-                        msms.assert_called()
+                        msms.assert_called_with('12', 'aas', None)
+                        msms.return_value.msg_delivery_status.assert_not_called()
+                        watched = mpoller.return_value.watch.call_args.args[1]
+                        self.assertEqual({'id+123456789', 'id+16548351', 'id+4156894562'}, set(watched))
                         self.assertEqual(2, msms.return_value.send.call_count)
                         self.assertIn('sender', msms.return_value.send.call_args_list[0].kwargs)
                         self.assertIn('sender', msms.return_value.send.call_args_list[1].kwargs)
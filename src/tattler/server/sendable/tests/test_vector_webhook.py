@@ -0,0 +1,155 @@
+"""Tests for WebhookSendable"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+from tattler.server import sendable
+from tattler.server.sendable import webhook_client
+from tattler.server.sendable.vector_webhook import WebhookSendable
+
+tbase_path = Path(__file__).parent / 'fixtures' / 'templates'
+
+
+class HookHandler(BaseHTTPRequestHandler):
+    """Records requests, replying with the statuses queued by the test, then 200."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.in_flight -= 1
+            self.server.requests.append((self.path, dict(self.headers), json.loads(body)))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class TestVectorWebhook(unittest.TestCase):
+    def setUp(self):
+        self.srv = ThreadingHTTPServer(('127.0.0.1', 0), HookHandler)
+        self.srv.daemon_threads = True
+        self.srv.lock = threading.Lock()
+        self.srv.requests, self.srv.statuses = [], []
+        self.srv.connections = self.srv.in_flight = self.srv.max_in_flight = 0
+        self.srv.latency = 0
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.addCleanup(self.srv.server_close)
+        self.addCleanup(self.srv.shutdown)
+        self.url = f'http://127.0.0.1:{self.srv.server_address[1]}'
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.scope = Path(tmpdir.name) / 'myscope'
+        (self.scope / 'myevent' / 'webhook').mkdir(parents=True)
+        (self.scope / 'myevent' / 'webhook' / 'body.txt').write_text('Hi {{ name }}!')
+        (self.scope / '_webhooks.json').write_text(json.dumps({
+            'incidents': {'url': f'{self.url}/hooks/incidents', 'headers': {'Authorization': 'Bearer ${HOOK_TOKEN}'}},
+            'chatbot': {'url': f'{self.url}/hooks/chatbot?channel=ops'},
+        }))
+        env = {'TATTLER_WEBHOOK_RETRY_BACKOFF': '0.01', 'TATTLER_WEBHOOK_TIMEOUT': '5', 'HOOK_TOKEN': 's3cret'}
+        patcher = mock.patch('tattler.server.sendable.vector_webhook.getenv')
+        mgetenv = patcher.start()
+        mgetenv.side_effect = lambda k, v=None: env.get(k, os.getenv(k, v))
+        self.addCleanup(patcher.stop)
+        self.env = env
+
+    def send(self, recipients, context=None):
+        WebhookSendable('myevent', recipients, template_base=self.scope).send(context=context or {'name': 'Jane'})
+
+    def test_delivery(self):
+        """Notifications are POSTed as JSON with the configured headers, over one persistent connection"""
+        for _ in range(3):
+            self.send(['incidents', 'chatbot'], {'name': 'Jane', 'correlation_id': 'c123'})
+        self.assertEqual(6, len(self.srv.requests))
+        self.assertLessEqual(self.srv.connections, 2)
+        by_path = {path: (headers, payload) for path, headers, payload in self.srv.requests}
+        self.assertEqual({'/hooks/incidents', '/hooks/chatbot?channel=ops'}, set(by_path))
+        headers, payload = by_path['/hooks/incidents']
+        self.assertEqual('Bearer s3cret', headers['Authorization'])
+        self.assertEqual(payload['nid'], headers['Idempotency-Key'])
+        self.assertEqual({'scope': 'myscope', 'event': 'myevent', 'body': 'Hi Jane!', 'correlation_id': 'c123'},
+                         {k: v for k, v in payload.items() if k != 'nid'})
+        self.assertNotIn('Authorization', by_path['/hooks/chatbot?channel=ops'][0])
+
+    def test_url_recipient(self):
+        """Recipients may be given as URLs directly"""
+        self.send([f'{self.url}/direct'])
+        self.assertEqual('/direct', self.srv.requests[0][0])
+
+    def test_retries(self):
+        """Temporary failures are retried, permanent failures are not"""
+        self.srv.statuses = [503, 429]
+        self.send(['incidents'])
+        self.assertEqual(3, len(self.srv.requests))
+        self.srv.statuses = [400]
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            self.send(['incidents'])
+        self.assertEqual(400, err.exception.code)
+        self.assertEqual(4, len(self.srv.requests))
+        self.env['TATTLER_WEBHOOK_RETRIES'] = '1'
+        self.srv.statuses = [500, 500]
+        with self.assertRaises(urllib.error.HTTPError):
+            self.send(['incidents'])
+        self.assertEqual(6, len(self.srv.requests))
+
+    def test_concurrency(self):
+        """Requests in flight to one host stay within TATTLER_WEBHOOK_CONCURRENCY"""
+        self.env['TATTLER_WEBHOOK_CONCURRENCY'] = '2'
+        self.srv.latency = 0.05
+        self.send([f'{self.url}/hook{i}' for i in range(6)])
+        self.assertEqual(6, len(self.srv.requests))
+        self.assertEqual(2, self.srv.max_in_flight)
+
+    def test_invalid_recipients(self):
+        """Malformed recipients are rejected, and names must be configured"""
+        with self.assertRaises(ValueError):
+            WebhookSendable('myevent', ['not a name'], template_base=self.scope)
+        with self.assertRaises(ValueError):
+            self.send(['unknown'])
+        del self.env['HOOK_TOKEN']
+        with self.assertRaises(ValueError):
+            self.send(['incidents'])
+        self.assertEqual([], self.srv.requests)
+
+    def test_fixture_event(self):
+        """Webhook templates are found, validated and sent like those of other vectors, supervisors included"""
+        self.assertTrue(WebhookSendable.exists('event_with_webhook', tbase_path))
+        self.assertFalse(WebhookSendable.exists('event_with_email_plain', tbase_path))
+        n = sendable.make_notification('webhook', 'event_with_webhook', [f'{self.url}/hook'], template_base=tbase_path)
+        n.validate_template()
+        with mock.patch.dict(os.environ, {'TATTLER_SUPERVISOR_RECIPIENT_WEBHOOK': f'{self.url}/supervisor'}):
+            n.send(mode='staging', context={'one': '1'})
+        self.assertEqual({('/hook', 'Foobar123 1'), ('/supervisor', 'Foobar123 1')}, {(path, payload['body']) for path, _, payload in self.srv.requests})
+
+    def test_is_retryable(self):
+        """Connection errors, 429 and 5xx are retryable"""
+        self.assertTrue(webhook_client.is_retryable(ConnectionRefusedError()))
+        self.assertTrue(webhook_client.is_retryable(urllib.error.HTTPError('', 429, '', None, None)))
+        self.assertTrue(webhook_client.is_retryable(urllib.error.HTTPError('', 502, '', None, None)))
+        self.assertFalse(webhook_client.is_retryable(urllib.error.HTTPError('', 404, '', None, None)))
+        self.assertFalse(webhook_client.is_retryable(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
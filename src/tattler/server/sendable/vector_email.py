@@ -3,8 +3,11 @@ import re
 import logging
 import socket
 import getpass
+import time
 
-from typing import Mapping, Iterable, Optional, Any, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Mapping, Iterable, Optional, Any, Tuple, List, Union
 from email.message import EmailMessage
 from email.policy import default as default_policy
 from email.utils import formatdate
@@ -13,12 +16,29 @@ import smtplib
 from mjml import mjml_to_html
 
 from tattler.server.sendable import vector_sendable
-from tattler.server.sendable.attachments import normalize_attachments
+from tattler.server.sendable import smtp_pool
+from tattler.server.sendable import smtp_async
+from tattler.server.sendable import smtp_relays
+from tattler.server.sendable import smtp_limiter
+from tattler.server.sendable import smtp_pacing
+from tattler.server.sendable import smtp_outcomes
+from tattler.server.sendable import smtp_encoding
+from tattler.server.sendable import mime_skeleton
+from tattler.server.sendable import render_pool
+from tattler.server.sendable import smtp_spool
+from tattler.server.sendable import attachment_cache
+from tattler.server.sendable import attachment_store
+from tattler.server.sendable.attachments import Attachment, normalize_attachments
+from tattler.server.sendable.capture import get_capture, record as record_capture
 
 # SMTP X-Priority header
 _valid_priorities = [1, 2, 3, 4, 5]
 _default_priority = 3
 _smtp_timeout_s = 30
+# close pooled SMTP connections after being idle this many seconds
+_smtp_pool_idle_timeout_s = 60
+# base delay for retrying recipients which failed temporarily, doubled at every retry
+_smtp_retry_backoff_s = 30
 
 logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
 log = logging.getLogger(__name__)
@@ -46,6 +66,221 @@ def get_smtp_server(connstr: str) -> Tuple[str, int]:
             return retres(mtc.group('srv'), port)
     raise ValueError(f"Invalid connection string {connstr}: can't detect server and (optional) port parts. Use srv:port or [srv6]:port")
 
+def get_smtp_servers(connstr: str) -> List[Tuple[str, int]]:
+    """Acquire the list of SMTP (host, port) pairs from a comma-separated list of connection strings, in order of preference"""
+    servers = [get_smtp_server(c.strip()) for c in connstr.split(',') if c.strip()]
+    if not servers:
+        raise ValueError(f"Invalid connection string {connstr}: no SMTP server given.")
+    return servers
+
+
+def get_smtp_timeout() -> int:
+    """Return the configured timeout for SMTP operations, in seconds."""
+    try:
+        smtp_conn_timeout = int(vector_sendable.getenv("TATTLER_SMTP_TIMEOUT", _smtp_timeout_s))
+        if smtp_conn_timeout <= 0:
+            raise ValueError
+    except ValueError:
+        smtp_conn_timeout = int(_smtp_timeout_s)
+        log.warning("Invalid value given for TATTLER_SMTP_TIMEOUT='%s'. Set to number of seconds as a positive integer (e.g. 1, 5, 99). Falling back to default %s", vector_sendable.getenv("TATTLER_SMTP_TIMEOUT"), smtp_conn_timeout)
+    return smtp_conn_timeout
+
+def get_smtp_pool_size() -> int:
+    """Return the maximum number of pooled connections per SMTP relay, or 0 if pooling is disabled."""
+    try:
+        return max(0, int(vector_sendable.getenv("TATTLER_SMTP_POOL_SIZE", 0)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_POOL_SIZE='%s'. Set to a number of connections. Disabling pooling.", vector_sendable.getenv("TATTLER_SMTP_POOL_SIZE"))
+        return 0
+
+def get_smtp_pool_idle_timeout() -> float:
+    """Return the number of seconds after which idle pooled SMTP connections are closed."""
+    try:
+        return float(vector_sendable.getenv("TATTLER_SMTP_POOL_IDLE_TIMEOUT", _smtp_pool_idle_timeout_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_POOL_IDLE_TIMEOUT='%s'. Set to a number of seconds. Falling back to default %s", vector_sendable.getenv("TATTLER_SMTP_POOL_IDLE_TIMEOUT"), _smtp_pool_idle_timeout_s)
+        return _smtp_pool_idle_timeout_s
+
+def get_smtp_async_concurrency() -> int:
+    """Return the maximum number of concurrent SMTP transactions for asynchronous delivery, or 0 if it's disabled."""
+    try:
+        return max(0, int(vector_sendable.getenv("TATTLER_SMTP_ASYNC_CONCURRENCY", 0)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_ASYNC_CONCURRENCY='%s'. Set to a number of transactions. Disabling asynchronous delivery.", vector_sendable.getenv("TATTLER_SMTP_ASYNC_CONCURRENCY"))
+        return 0
+
+def get_smtp_max_concurrency() -> int:
+    """Return the highest number of concurrent SMTP sessions for adaptive concurrency control, or 0 if it's disabled."""
+    try:
+        return max(0, int(vector_sendable.getenv("TATTLER_SMTP_MAX_CONCURRENCY", 0)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_MAX_CONCURRENCY='%s'. Set to a number of sessions. Disabling adaptive concurrency.", vector_sendable.getenv("TATTLER_SMTP_MAX_CONCURRENCY"))
+        return 0
+
+def get_smtp_retries() -> int:
+    """Return the maximum number of retries for recipients failing temporarily, 0 to never retry."""
+    try:
+        return max(0, int(vector_sendable.getenv("TATTLER_SMTP_RETRIES", 0)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_RETRIES='%s'. Set to a number of retries. Disabling retries.", vector_sendable.getenv("TATTLER_SMTP_RETRIES"))
+        return 0
+
+def get_smtp_retry_backoff() -> float:
+    """Return the base delay for retrying recipients failing temporarily, in seconds."""
+    try:
+        return float(vector_sendable.getenv("TATTLER_SMTP_RETRY_BACKOFF", _smtp_retry_backoff_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMTP_RETRY_BACKOFF='%s'. Set to a number of seconds. Falling back to default %s", vector_sendable.getenv("TATTLER_SMTP_RETRY_BACKOFF"), _smtp_retry_backoff_s)
+        return _smtp_retry_backoff_s
+
+def smtp_connect(smtp_server: str, smtp_server_port: int, timeout: int) -> smtplib.SMTP:
+    """Open a connection to an SMTP server, ready for sending: upgraded to TLS and authenticated if so configured.
+
+    :param smtp_server:         Hostname or IP address of the SMTP server.
+    :param smtp_server_port:    Port of the SMTP server; ports 465 and 587 are connected to with TLS.
+    :param timeout:             Timeout for SMTP operations, in seconds.
+
+    :return:                    The SMTP connection.
+    """
+    tls_connect = smtp_server_port in (465, 587)
+    try:
+        log.debug("Connecting via SMTP%s to %s:%s (timeout=%ss)...", '_TLS' if tls_connect else '', smtp_server, smtp_server_port, timeout)
+        if tls_connect:
+            server = smtplib.SMTP_SSL(smtp_server, smtp_server_port, timeout=timeout)
+        else:
+            server = smtplib.SMTP(smtp_server, smtp_server_port, timeout=timeout)
+    except ConnectionRefusedError:
+        log.error("Failed to connect to SMTP server (%s:%s) to deliver email.", smtp_server, smtp_server_port)
+        raise
+    smtp_tls = vector_sendable.getenv("TATTLER_SMTP_TLS", None)
+    if smtp_tls:
+        log.debug("Changing SMTP connection to TLS (STARTTLS).")
+        server.starttls()
+    smtp_auth = vector_sendable.getenv("TATTLER_SMTP_AUTH", None)
+    if smtp_auth:
+        log.debug("Attempting SMTP auth ...")
+        u, p = smtp_auth.split(':', 1)
+        server.login(u, p)
+    return server
+
+class SMTPDelivery:
+    """Delivers messages through the configured SMTP relays, directly, over pooled connections or via the asynchronous engine."""
+
+    def __init__(self, pool_size: Optional[int]=None) -> None:
+        """Load the SMTP settings.
+
+        :param pool_size:   Number of connections to pool; None for TATTLER_SMTP_POOL_SIZE.
+        """
+        self.relays = get_smtp_servers(vector_sendable.getenv("TATTLER_SMTP_ADDRESS", '127.0.0.1'))
+        self.description = ', '.join(smtp_relays.relay_name(r) for r in self.relays)
+        self.timeout = get_smtp_timeout()
+        self.hedge = bool(vector_sendable.getenv("TATTLER_SMTP_HEDGE", None))
+        self.async_concurrency = get_smtp_async_concurrency()
+        self.pool_size = get_smtp_pool_size() if pool_size is None else pool_size
+        self.max_concurrency = get_smtp_max_concurrency()
+
+    def connect(self) -> smtplib.SMTP:
+        """Open a connection to the preferred relay."""
+        return smtp_relays.connect(self.relays, lambda relay: smtp_connect(relay[0], relay[1], self.timeout), hedge=self.hedge, discard=smtp_pool.close_connection)
+
+    def deliver(self, sender: str, message: Union[str, smtp_encoding.EncodedMessage], recipients: List[str]) -> Mapping[str, Tuple[int, bytes]]:
+        """Deliver a message to some recipients, and return the recipients refused, mapped to the (code, message) of their refusal.
+
+        :raise Exception:   the error of the SMTP transaction, if it failed for all recipients.
+        """
+        if not self.max_concurrency:
+            return self._transact(sender, message, recipients)
+        limiter = smtp_limiter.get_limiter(tuple(self.relays), self.max_concurrency, name=self.description)
+        limiter.acquire(self.timeout)
+        t0 = time.monotonic()
+        try:
+            refused = self._transact(sender, message, recipients)
+        except Exception as err:
+            limiter.release(time.monotonic() - t0, err)
+            raise
+        # recipients deferred with 4xx by an accepted transaction signal an overloaded relay too
+        limiter.release(time.monotonic() - t0, smtp_limiter.temporary_refusal(refused))
+        return refused
+
+    def _transact(self, sender: str, message: Union[str, smtp_encoding.EncodedMessage], recipients: List[str]) -> Mapping[str, Tuple[int, bytes]]:
+        """Run the SMTP transaction delivering a message, asynchronously, on a pooled connection or on a new one."""
+        def transaction(server):
+            log.debug("Delivering SMTP content to actual recipients %s ...", recipients)
+            return smtp_encoding.sendmail(server, sender, recipients, message)
+        if self.async_concurrency:
+            return self._send_async(sender, message, recipients)
+        if self.pool_size:
+            pool_key = (tuple(self.relays), self.timeout, self.hedge, vector_sendable.getenv("TATTLER_SMTP_TLS", None), vector_sendable.getenv("TATTLER_SMTP_AUTH", None))
+            pool = smtp_pool.get_pool(pool_key, self.connect, self.pool_size, get_smtp_pool_idle_timeout(), name=self.description)
+            return pool.run(transaction, self.timeout)
+        server = self.connect()
+        try:
+            refused = transaction(server)
+        except BaseException:
+            smtp_pool.close_connection(server)
+            raise
+        server.quit()
+        return refused
+
+    def _send_async(self, sender: str, msg: Union[str, smtp_encoding.EncodedMessage], recipients: List[str]) -> Mapping[str, Tuple[int, bytes]]:
+        """Deliver a message through the asynchronous SMTP engine, failing over across relays upon connection errors, and return refused recipients."""
+        ordered = smtp_relays.order(self.relays)
+        for i, (smtp_server, smtp_server_port) in enumerate(ordered):
+            relay_settings = {
+                'host': smtp_server,
+                'port': smtp_server_port,
+                'timeout': self.timeout,
+                'tls': smtp_server_port in (465, 587),
+                'starttls': bool(vector_sendable.getenv("TATTLER_SMTP_TLS", None)),
+                'auth': vector_sendable.getenv("TATTLER_SMTP_AUTH", None),
+            }
+            t0 = time.monotonic()
+            try:
+                refused = smtp_async.get_engine().submit(relay_settings, self.async_concurrency, get_smtp_pool_idle_timeout(), sender, recipients, msg).result()
+            except Exception as err:
+                if not isinstance(err, (OSError, smtplib.SMTPConnectError)) and not smtp_pool.is_connection_broken(err):
+                    raise
+                smtp_relays.record_failure(ordered[i], err)
+                if i == len(ordered) - 1:
+                    raise
+                log.info("Failing over to SMTP relay %s.", smtp_relays.relay_name(ordered[i + 1]))
+            else:
+                smtp_relays.record_success(ordered[i], time.monotonic() - t0)
+                return refused
+
+
+@dataclass
+class RenderedEmail:
+    """Parts of an email expanded from its templates, before assembly into a MIME message."""
+    plain: str
+    html: Optional[str]
+    subject: str
+    inline: List[Attachment] = field(default_factory=list)
+    regular: List[Attachment] = field(default_factory=list)
+
+
+def _mjml_to_html(source: str) -> Tuple[str, Optional[str]]:
+    """Compile an MJML template, and return the resulting HTML and the compilation errors, if any."""
+    result = mjml_to_html(source)
+    return result.html, (str(result.errors) if result.errors else None)
+
+
+@lru_cache(maxsize=256)
+def compile_mjml(source: str) -> str:
+    """Compile an MJML template into HTML, caching the result by source.
+
+    Compilation runs in the render pool if enabled.
+
+    :param source:      MJML source of the template.
+    :return:            HTML resulting from the compilation.
+    :raises ValueError: if the MJML source fails to compile.
+    """
+    pool = render_pool.get_pool()
+    html, errors = pool.run('body.mjml', _mjml_to_html, source) if pool is not None else _mjml_to_html(source)
+    if errors:
+        raise ValueError(f"Failed to compile MJML template 'body.mjml': {errors}")
+    return html
+
 
 class EmailSendable(vector_sendable.Sendable):
     """An e-mail message."""
@@ -57,6 +292,8 @@ class EmailSendable(vector_sendable.Sendable):
         'TATTLER_SMTP_ADDRESS': [False, lambda x: (ip4_re.match(x) or ip6_re.match(x) or hostname_re.match(x))],
     }
 
+    context_variables = frozenset({'_attachments'})
+
     filename_aliases = {
         'subject.txt': ['subject'],
         'body.txt': ['body_plain'],
@@ -73,6 +310,9 @@ class EmailSendable(vector_sendable.Sendable):
         }
         return {ptype: pname for pname, ptype in part_types.items() if pname in parts}
 
+    def _get_rendered_elements(self) -> Iterable[str]:
+        return ['subject.txt'] + list(self._get_available_parts().values())
+
     def validate_template(self):
         """Raise iff any required part is missing or a part is not well-formed."""
         parts = self._get_template_elements_standardized()
@@ -117,50 +357,115 @@ class EmailSendable(vector_sendable.Sendable):
             html = None
         return plain, html
 
-    def _build_msg(self, context: Optional[Mapping[str, Any]]=None) -> EmailMessage:
-        """Load all parts of the message and return a final email assembly.
+    def _render_msg(self, context: Optional[Mapping[str, Any]]=None) -> RenderedEmail:
+        """Expand the templates of all parts of the message, and load its attachments.
 
         :param context:         Optional variables to expand template with.
 
-        :return:                Email object with all required parts filled out.
+        :return:                The rendered parts of the message, ready for assembly.
         """
         context = dict(context or {})
-        attachments = normalize_attachments(context.pop('_attachments', None))
+        attachments = normalize_attachments(context.pop('_attachments', None), attachment_cache.get_cache(), attachment_store.get_store())
         inline = [a for a in attachments if a.cid is not None]
         regular = [a for a in attachments if a.cid is None]
-
         plain, html = self._get_body_parts(context)
+        if html is None and inline:
+            # No HTML to reference cid:; downgrade inline to regular attachments.
+            regular = inline + regular
+            inline = []
+        return RenderedEmail(plain, html, self.subject(context), inline, regular)
 
+    def _assemble_body(self, rendered: RenderedEmail, eightbit: bool=False) -> EmailMessage:
+        """Assemble the bodies and attachments of the message into its MIME structure, without per-message headers.
+
+        :param rendered:        Parts of the message, as returned by :meth:`_render_msg`.
+        :param eightbit:        Whether to encode non-ASCII text parts in 8-bit rather than base64 or quoted-printable.
+
+        :return:                Email object with all bodies and attachments.
+        """
         msg = EmailMessage(policy=default_policy)
-        msg.set_content(plain)
-        if html is not None:
-            msg.add_alternative(html, subtype='html')
+        msg.set_content(rendered.plain, cte=smtp_encoding.text_cte(rendered.plain, eightbit))
+        if rendered.html is not None:
+            msg.add_alternative(rendered.html, subtype='html', cte=smtp_encoding.text_cte(rendered.html, eightbit))
             # Attach inline parts under the HTML alternative, producing
             # multipart/alternative > [text/plain, multipart/related > [text/html, ...]]
             html_part = msg.get_payload()[1]
-            for att in inline:
+            for att in rendered.inline:
                 html_part.add_related(att.content,
                                       maintype=att.maintype, subtype=att.subtype,
                                       cid=f'<{att.cid}>', filename=att.filename,
                                       disposition='inline')
-        elif inline:
-            # No HTML to reference cid:; downgrade inline to regular attachments.
-            regular = inline + regular
 
-        for att in regular:
+        for att in rendered.regular:
             msg.add_attachment(att.content,
                                maintype=att.maintype, subtype=att.subtype,
                                filename=att.filename)
+        return msg
 
-        msg['From'] = self.sender()
-        msg['To'] = ", ".join(self.recipients)
-        msg['Date'] = formatdate()
-        msg['Subject'] = self.subject(context)
+    def _message_headers(self, rendered: RenderedEmail) -> List[Tuple[str, str]]:
+        """Return the per-message headers of the message, as (name, value) in order."""
         # gmail requires a Message-ID to be present. E.g. <A5A1B9EB-DBD6-4DE4-902D-F32E2D7D6B86@email.com>
         sender_domain = self.sender().split('@')[1].lower()
-        msg['Message-ID'] = f'<{self.nid}@{sender_domain}>'
+        headers = [
+            ('From', self.sender()),
+            ('To', ", ".join(self.recipients)),
+            ('Date', formatdate()),
+            ('Subject', rendered.subject),
+            ('Message-ID', f'<{self.nid}@{sender_domain}>'),
+        ]
+        priority = self._get_priority()
+        if priority is not None:
+            headers.append(('X-Priority', str(priority)))
+        return headers
+
+    def _assemble_msg(self, rendered: RenderedEmail, eightbit: bool=False) -> EmailMessage:
+        """Assemble the rendered parts of the message into an email.
+
+        :param rendered:        Parts of the message, as returned by :meth:`_render_msg`.
+        :param eightbit:        Whether to encode non-ASCII text parts in 8-bit rather than base64 or quoted-printable.
+
+        :return:                Email object with all required parts filled out.
+        """
+        msg = self._assemble_body(rendered, eightbit)
+        for name, value in self._message_headers(rendered):
+            msg[name] = value
+        return msg
+
+    def _encode_msg(self, rendered: RenderedEmail, recipients: Iterable[str]) -> smtp_encoding.EncodedMessage:
+        """Return the message to deliver to some recipients, assembled from a precompiled MIME skeleton if it is multipart.
+
+        :param rendered:        Parts of the message, as returned by :meth:`_render_msg`.
+        :param recipients:      Envelope recipients.
+        """
+        build = lambda eightbit: self._assemble_msg(rendered, eightbit)
+        if rendered.html is None and not rendered.regular:
+            return smtp_encoding.EncodedMessage(build, self.sender(), recipients)
+        inline = {f'inline{i}': att for i, att in enumerate(rendered.inline)}
+        regular = {f'regular{i}': att for i, att in enumerate(rendered.regular)}
+        texts = {'plain': rendered.plain, 'html': rendered.html} if rendered.html is not None else {'plain': rendered.plain}
+        # attachment contents are not part of the structure, so skeletons serve e.g. invoices differing by recipient
+        key = (tuple(texts),
+               tuple((a.filename, a.maintype, a.subtype, a.cid) for a in rendered.inline),
+               tuple((a.filename, a.maintype, a.subtype) for a in rendered.regular))
+        def build_structure(placeholders):
+            placeholder = lambda slot, att: Attachment(att.filename, placeholders[slot].encode('ascii'), att.maintype, att.subtype, att.cid)
+            return self._assemble_body(RenderedEmail(placeholders['plain'], placeholders.get('html'), '',
+                                                     [placeholder(slot, att) for slot, att in inline.items()],
+                                                     [placeholder(slot, att) for slot, att in regular.items()]))
+        skeleton = mime_skeleton.get_skeleton(key, build_structure, list(texts) + list(inline) + list(regular))
+        if skeleton is None:
+            return smtp_encoding.EncodedMessage(build, self.sender(), recipients)
+        contents = dict(texts, **{slot: att.content for slot, att in {**inline, **regular}.items()})
+        return mime_skeleton.SkeletonMessage(build, self.sender(), recipients, skeleton, self._message_headers(rendered), contents)
+
+    def _build_msg(self, context: Optional[Mapping[str, Any]]=None) -> EmailMessage:
+        """Load all parts of the message and return a final email assembly.
+
+        :param context:         Optional variables to expand template with.
 
-        return self._add_priority_info(msg)
+        :return:                Email object with all required parts filled out.
+        """
+        return self._assemble_msg(self._render_msg(context))
 
     def validate_recipient(self, recipient: str) -> None:
         """Check that recipient is valid for current vector, and raise ValueError otherwise."""
@@ -184,16 +489,16 @@ class EmailSendable(vector_sendable.Sendable):
     def vector(cls) -> str:
         return 'email'
 
-    def _add_priority_info(self, msg: str):
+    def _get_priority(self) -> Optional[int]:
+        """Return the priority of this notification (X-Priority), loading it from the template if not set; None if neither."""
         self.priority = getattr(self, 'priority', None)
         if self.priority is None:
             # try to load it from template
             try:
                 self.set_priority(self._get_template_raw_element('priority.txt').strip())
             except FileNotFoundError:
-                return msg
-        msg.add_header('X-Priority', str(self.priority))
-        return msg
+                return None
+        return self.priority
 
     def set_priority(self, priority: int=_default_priority) -> None:
         """Set the priority (X-Priority) of this notification.
@@ -221,11 +526,7 @@ class EmailSendable(vector_sendable.Sendable):
         if name == 'body.html':
             mjml_path = self._get_template_pathname(base) / 'body.mjml'
             if mjml_path.exists():
-                content = mjml_path.read_text(encoding='utf-8')
-                result = mjml_to_html(content)
-                if result.errors:
-                    raise ValueError(f"Failed to compile MJML template 'body.mjml': {result.errors}")
-                return result.html
+                return compile_mjml(mjml_path.read_text(encoding='utf-8'))
         return super()._get_template_raw_element(name, base)
 
     def content(self, context: Mapping[str, Any]) -> str:
@@ -235,35 +536,124 @@ class EmailSendable(vector_sendable.Sendable):
         assert isinstance(context, dict), f"context must be a dictionary in do_send(); not {type(context)}"
         if priority is not None:
             self.set_priority(priority)
-        msg = self.content(context)
-        smtp_server, smtp_server_port = get_smtp_server(vector_sendable.getenv("TATTLER_SMTP_ADDRESS", '127.0.0.1'))
-        tls_connect = smtp_server_port in (465, 587)
+        rendered = self._render_msg(context)
+        message = self._encode_msg(rendered, recipients)
+        capture = get_capture()
+        if capture is not None:
+            captured = record_capture(capture, self.vector(), self.nid, self.event(), self.sender(), recipients, message.as_bytes(False))
+            log.info("n%s: Email '%s' captured instead of delivered (%d bytes).", self.nid, self.event(), len(captured.payload))
+            return
+        spool_dir = vector_sendable.getenv("TATTLER_SMTP_SPOOL", None)
+        if spool_dir:
+            path = smtp_spool.enqueue(spool_dir, message, self.sender(), recipients, self.nid)
+            log.info("n%s: Email '%s' spooled to %s for delivery.", self.nid, self.event(), path)
+            return
+        smtp = SMTPDelivery()
+        log.info("Attempting email delivery of '%s' via SMTP %s (timeout=%ss)...", self.event(), smtp.description, smtp.timeout)
+        def deliver(rcpts):
+            return smtp.deliver(self.sender(), message, rcpts)
+        self.recipient_outcomes = {}
+        errors = {}
+        retries = get_smtp_retries()
+        def attempt(rcpts):
+            self._attempt(deliver, list(rcpts), 0, retries, errors)
+        pacing = vector_sendable.getenv("TATTLER_SMTP_PACING", None)
+        if pacing:
+            self._send_paced(pacing, recipients, attempt)
+        else:
+            attempt(recipients)
+        failed = [o for o in self.recipient_outcomes.values() if o.status == smtp_outcomes.FAILED]
+        if any(self._is_supervisor_copy(o.recipient) for o in failed):
+            log.warning("n%s: Delivery of supervisor copy failed. Ignoring.", self.nid)
+            failed = [o for o in failed if not self._is_supervisor_copy(o.recipient)]
+        for outcome in failed:
+            if outcome.recipient in errors:
+                raise errors[outcome.recipient]
+        if failed:
+            raise smtplib.SMTPRecipientsRefused({o.recipient: (o.code, o.message.encode()) for o in failed})
+        pending = self.pending_recipients()
+        if pending:
+            # held in memory only: lost if the process stops before they are delivered; TATTLER_SMTP_SPOOL keeps them on disk
+            log.warning("n%s: SMTP delivery via %s deferred for %s. They will be delivered in the background.", self.nid, smtp.description, pending)
+        else:
+            log.info("SMTP delivery via %s completed successfully.", smtp.description)
+
+    def pending_recipients(self) -> Iterable[str]:
+        """Return the recipients awaiting a retry or their turn under pacing, except the supervisor's copy."""
+        outcomes = getattr(self, 'recipient_outcomes', {}).values()
+        return [o.recipient for o in outcomes if o.status == smtp_outcomes.PENDING and not self._is_supervisor_copy(o.recipient)]
+
+    def _is_supervisor_copy(self, recipient: str) -> bool:
+        """Return whether a recipient is the supervisor receiving a copy in staging mode, as opposed to an actual recipient."""
+        supervisor = self.supervisor_recipient()
+        return bool(supervisor) and recipient == supervisor.strip().lower() and recipient not in self.recipients
+
+    def _attempt(self, deliver: Callable[[List[str]], Mapping[str, Tuple[int, bytes]]], recipients: List[str], attempt: int, retries: int, errors: Optional[dict]=None) -> None:
+        """Attempt a delivery, record the outcome for each recipient, and schedule a retry of recipients failing temporarily.
+
+        :param deliver:     Function delivering the message to the recipients given, and returning those refused.
+        :param recipients:  Recipients to deliver to.
+        :param attempt:     Number of this attempt, 0 for the first.
+        :param retries:     Maximum number of retries.
+        :param errors:      Dictionary to map recipients to the error their delivery failed with, if any.
+        """
         try:
-            smtp_conn_timeout = int(vector_sendable.getenv("TATTLER_SMTP_TIMEOUT", _smtp_timeout_s))
-            if smtp_conn_timeout <= 0:
-                raise ValueError
-        except ValueError:
-            smtp_conn_timeout = int(_smtp_timeout_s)
-            log.warning("Invalid value given for TATTLER_SMTP_TIMEOUT='%s'. Set to number of seconds as a positive integer (e.g. 1, 5, 99). Falling back to default %s", vector_sendable.getenv("TATTLER_SMTP_TIMEOUT"), smtp_conn_timeout)
+            outcomes = smtp_outcomes.outcomes_from_refused(recipients, deliver(recipients) or {}, attempt)
+        except Exception as err:
+            outcomes = smtp_outcomes.outcomes_from_error(recipients, err, attempt)
+            if errors is not None:
+                errors.update({r: err for r in recipients})
+        retry = [o.recipient for o in outcomes if o.retryable]
+        if retry and attempt < retries:
+            delay = smtp_outcomes.backoff_delay(attempt + 1, get_smtp_retry_backoff())
+            log.info("n%s: Retrying delivery to %s in %.1fs (retry %d of %d).", self.nid, retry, delay, attempt + 1, retries)
+            smtp_outcomes.get_scheduler().schedule(delay, lambda: self._attempt(deliver, retry, attempt + 1, retries))
+            for outcome in outcomes:
+                if outcome.retryable:
+                    outcome.status = smtp_outcomes.PENDING
+        else:
+            for outcome in outcomes:
+                if outcome.retryable:
+                    outcome.status = smtp_outcomes.FAILED
+        smtp_outcomes.record(outcomes, self.nid)
+        self.recipient_outcomes.update({o.recipient: o for o in outcomes})
+
+    def _send_paced(self, pacing: str, recipients: Iterable[str], deliver: Callable[[List[str]], None]) -> None:
+        """Deliver a message with one transaction per recipient domain, pacing recipients according to the rates of their domains.
+
+        Recipients whose domain has capacity are delivered now. The others are recorded as pending, and
+        delivered by the background scheduler when their domain's bucket allows. If delivery to some domain
+        fails, the other domains are still attempted, and the first error is raised afterwards.
+        """
         try:
-            log.info("Attempting email delivery of '%s' via SMTP%s %s:%s (timeout=%ss)...", self.event(), '_TLS' if tls_connect else '', smtp_server, smtp_server_port, smtp_conn_timeout)
-            if tls_connect:
-                server = smtplib.SMTP_SSL(smtp_server, smtp_server_port, timeout=smtp_conn_timeout)
-            else:
-                server = smtplib.SMTP(smtp_server, smtp_server_port, timeout=smtp_conn_timeout)
-        except ConnectionRefusedError:
-            log.error("Failed to connect to SMTP server (%s:%s) to deliver email. Giving up.", smtp_server, smtp_server_port)
-            raise
-        smtp_tls = vector_sendable.getenv("TATTLER_SMTP_TLS", None)
-        if smtp_tls:
-            log.debug("Changing SMTP connection to TLS (STARTTLS).")
-            server.starttls()
-        smtp_auth = vector_sendable.getenv("TATTLER_SMTP_AUTH", None)
-        if smtp_auth:
-            log.debug("Attempting SMTP auth ...")
-            u, p = smtp_auth.split(':', 1)
-            server.login(u, p)
-        log.debug("Delivering SMTP content to actual recipients %s ...", recipients)
-        server.sendmail(self.sender(), recipients, msg)
-        server.quit()
-        log.info("SMTP delivery to %s:%s completed successfully.", smtp_server, smtp_server_port)
+            pacer = smtp_pacing.get_pacer(pacing)
+        except ValueError as err:
+            log.warning("Invalid value given for TATTLER_SMTP_PACING='%s': %s Delivering without pacing.", pacing, err)
+            deliver(list(recipients))
+            return
+        ready, deferred = pacer.dispatch(recipients)
+        for delay, domain, rcpts in deferred:
+            outcomes = [smtp_outcomes.RecipientOutcome(r, smtp_outcomes.PENDING, message=f"pacing deliveries to {domain}") for r in rcpts]
+            smtp_outcomes.record(outcomes, self.nid)
+            self.recipient_outcomes.update({o.recipient: o for o in outcomes})
+            self._schedule_paced(pacer, domain, rcpts, delay, deliver)
+        errors = []
+        for domain, rcpts in ready:
+            try:
+                deliver(rcpts)
+            except Exception as err:
+                log.error("n%s: SMTP delivery to domain %s failed: %s", self.nid, domain, err)
+                errors.append(err)
+        if errors:
+            raise errors[0]
+
+    def _schedule_paced(self, pacer: smtp_pacing.DomainPacer, domain: str, recipients: List[str], delay: float, deliver: Callable[[List[str]], None]) -> None:
+        """Deliver to recipients of a domain in delay seconds, as far as the domain's bucket allows then, and schedule the rest again."""
+        def release():
+            granted, next_delay = pacer.reserve(domain, len(recipients))
+            if granted < len(recipients):
+                self._schedule_paced(pacer, domain, recipients[granted:], next_delay, deliver)
+            if granted:
+                log.info("n%s: Delivering to %d paced recipients in domain %s.", self.nid, granted, domain)
+                deliver(recipients[:granted])
+        smtp_outcomes.get_scheduler().schedule(delay, release)
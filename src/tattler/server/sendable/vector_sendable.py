@@ -5,10 +5,12 @@ import os.path
 import logging
 import uuid
 from pathlib import Path
-from typing import Iterable, Mapping, Optional, Any, Union
+from typing import Iterable, Mapping, Optional, Any, Union, AbstractSet
 
 from . import TemplateProcessor
 from . import Blacklist
+from tattler.server.sendable import render_cache
+from tattler.server.sendable import render_pool
 from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor
 
 logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
@@ -31,6 +33,9 @@ class Sendable:
         # name:     [required: bool, validator: Optional[callable]]
     }
 
+    # context variables which the vector itself reads, in addition to those read by templates
+    context_variables = frozenset()
+
     # backwards compatibility: look for additional filename aliases when one filename is required.
     # Override this in children that need to customize it
     filename_aliases = {
@@ -134,6 +139,15 @@ class Sendable:
             raise ValueError(f"No template exists for '{self.vector()}:{self.event()}:{self.language_code}' (missing file: {template_pathname}).")
         return template_pathname
 
+    def _get_partials_pathnames(self) -> Iterable[Path]:
+        """Return the folders where partials for the template can be found, in order of precedence.
+
+        Partials are looked up in the ``_partials`` folder of the scope first, then in that of the template base.
+
+        :return:        The list of existing partials folders, possibly empty."""
+        loc_candidates = [loc / '_partials' for loc in [self.template_base, self.template_base.parent]]
+        return [loc for loc in loc_candidates if loc.is_dir()]
+
     def _get_template_raw_element(self, name: str, base: bool=False) -> str:
         """Return the content of a specific template element within the event template for the vector.
         
@@ -174,16 +188,53 @@ class Sendable:
             stdnames.append(found_alias_stdname[0] if found_alias_stdname else name)
         return set(stdnames)
 
-    def _get_content_element(self, element: str, context: Mapping[str, Any]) -> str:
-        """Return the final display content by expanding the requested element with the given context."""
+    def _get_element_processor(self, element: str) -> TemplateProcessor:
+        """Return the template processor for a template element, loaded with the element and its base template, if any."""
         template = self._get_template_raw_element(element)
         try:
             base_template = self._get_template_raw_element(element, True)
         except ValueError:
             base_template = None
             log.debug("n%s: No base template provided for '%s:%s'. Ignoring.", self.nid, self.event_name, self.vector())
-        t: TemplateProcessor = self.template_processor(template, base_content=base_template)
-        return t.expand(context)
+        return self.template_processor(template, base_content=base_template, template_name=self._get_template_name(element), partials_paths=self._get_partials_pathnames())
+
+    def _expand(self, processor: TemplateProcessor, context: Mapping[str, Any]) -> str:
+        """Expand a template with a context, serving it from the render cache and expanding it in the render pool if enabled."""
+        pool = render_pool.get_pool()
+        expander = pool.expand if pool is not None else None
+        cache = render_cache.get_cache()
+        if cache is None:
+            return expander(processor, context) if expander else processor.expand(context)
+        return cache.expand(processor, context, expander)
+
+    def _get_content_element(self, element: str, context: Mapping[str, Any]) -> str:
+        """Return the final display content by expanding the requested element with the given context."""
+        return self._expand(self._get_element_processor(element), context)
+
+    def _get_rendered_elements(self) -> Iterable[str]:
+        """Return the names of the template elements which are expanded with the context upon delivery."""
+        return ['body.txt']
+
+    def template_variables(self) -> Optional[AbstractSet[str]]:
+        """Return the names of the context variables which delivering this sendable may read.
+
+        These are the variables read by the templates of every element expanded upon delivery,
+        plus those read by the vector itself (see ``context_variables``).
+
+        :return:        Set of variable names, or None if the template processor cannot determine them.
+        """
+        variables = set(self.context_variables)
+        available_elements = self._get_template_elements_standardized()
+        for element in [e for e in self._get_rendered_elements() if e in available_elements]:
+            evars = self._get_element_processor(element).variables()
+            if evars is None:
+                return None
+            variables |= evars
+        return frozenset(variables)
+
+    def _get_template_name(self, element: str) -> str:
+        """Return a name identifying a template element in logs and metrics, e.g. ``myscope/myevent/email/body.html``."""
+        return f"{self.template_base.name}/{self.event()}/{self.vector()}/{element}"
 
     @classmethod
     def exists(cls, event: str, template_base: Union[str, Path]) -> bool:
@@ -225,8 +276,8 @@ class Sendable:
     def content(self, context: Mapping[str, Any]) -> str:
         """Return the content of the sendable."""
         templbody = self.raw_content()
-        templ: TemplateProcessor = self.template_processor(templbody)
-        return templ.expand(context).strip()
+        templ: TemplateProcessor = self.template_processor(templbody, template_name=self._get_template_name('body.txt'), partials_paths=self._get_partials_pathnames())
+        return self._expand(templ, context).strip()
     
     def debug_recipient(self) -> str:
         """Return recipient to send to when in debug mode."""
@@ -257,6 +308,14 @@ class Sendable:
         """Concretely send the message, regardless of what mode we're in."""
         raise NotImplementedError("Cannot send untyped Sendable object.")   # pragma: no cover
 
+    def pending_recipients(self) -> Iterable[str]:
+        """Return the recipients whose delivery was deferred by send(), to complete in the background.
+
+        Override this in vectors which may return before delivery completes. The default implementation
+        returns no recipients, i.e. delivery is complete when send() returns.
+        """
+        return []
+
     def send(self, context: Optional[Mapping[str, Any]]=None, priority: Optional[int]=None, mode: str=default_mode) -> None:
         """Send the message honoring the mode we're in."""
         self.setup()
@@ -3,12 +3,12 @@
 import re
 import logging
 import os
-from typing import Iterable, Optional, Mapping, Any
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Mapping, Any
 
-from bulksms import BulkSMS
-
-from tattler.server.sendable import vector_sendable
+from tattler.server.sendable import sms_batch, sms_client, vector_sendable
 from tattler.server.sendable.vector_sendable import getenv
+from tattler.server.sendable.capture import get_capture, record as record_capture
 
 
 logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
@@ -16,6 +16,10 @@ log = logging.getLogger(__name__)
 
 ENVVAR_NAME = 'TATTLER_BULKSMS_TOKEN'
 
+_sms_report_interval_s = 0.0
+_sms_batch_window_s = 0.0
+_sms_batch_size = 500
+
 
 def get_auth_from_environment():
     """Get authentication data configured."""
@@ -29,6 +33,70 @@ def get_auth_from_environment():
         raise ValueError(f"Envvar '{ENVVAR_NAME}' is malformed: required 'user:pass' or 'tokenid:secret'.") from err
     return tid, tsecr
 
+def get_sms_report_interval() -> float:
+    """Return the interval for polling delivery reports in the background, in seconds; 0 if disabled."""
+    try:
+        return float(getenv("TATTLER_SMS_REPORT_INTERVAL", _sms_report_interval_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMS_REPORT_INTERVAL='%s'. Set to a number of seconds. Falling back to default %s", getenv("TATTLER_SMS_REPORT_INTERVAL"), _sms_report_interval_s)
+        return _sms_report_interval_s
+
+def get_sms_batch_window() -> float:
+    """Return the time to collect SMS with identical content into one submission, in seconds; 0 if disabled."""
+    try:
+        return float(getenv("TATTLER_SMS_BATCH_WINDOW", _sms_batch_window_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMS_BATCH_WINDOW='%s'. Set to a number of seconds. Falling back to default %s", getenv("TATTLER_SMS_BATCH_WINDOW"), _sms_batch_window_s)
+        return _sms_batch_window_s
+
+def get_sms_batch_size() -> int:
+    """Return the maximum number of recipients to collect into one SMS submission."""
+    try:
+        return max(1, int(getenv("TATTLER_SMS_BATCH_SIZE", _sms_batch_size)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_SMS_BATCH_SIZE='%s'. Set to a number of recipients. Falling back to default %s", getenv("TATTLER_SMS_BATCH_SIZE"), _sms_batch_size)
+        return _sms_batch_size
+
+
+class SenderIndex:
+    """Index of multiple sender IDs, to find the one sharing the longest prefix with a recipient in one pass over it."""
+
+    # shortest prefix to consider a match, e.g. the '+' and first digit of the country code
+    min_prefix = 2
+
+    def __init__(self, senders: List[str]) -> None:
+        """Construct the index.
+
+        :param senders:     Sender IDs, by decreasing preference among those sharing the same prefix with a recipient.
+        """
+        self.senders = senders
+        # trie of characters; each node maps '' to the first sender passing through it
+        self.root: Dict[str, Any] = {}
+        for snd in senders:
+            node = self.root
+            for char in snd:
+                node = node.setdefault(char, {})
+                node.setdefault('', snd)
+
+    def lookup(self, recipient: Optional[str]) -> str:
+        """Return the first sender sharing the longest prefix with a recipient, or the first sender if none does."""
+        if not recipient or len(self.senders) == 1:
+            return self.senders[0]
+        node, match = self.root, self.senders[0]
+        for depth, char in enumerate(recipient, 1):
+            node = node.get(char)
+            if node is None:
+                break
+            if depth >= self.min_prefix:
+                match = node['']
+        return match
+
+
+@lru_cache(maxsize=16)
+def get_sender_index(confsender: str) -> SenderIndex:
+    """Return the index of the senders configured in a value of TATTLER_SMS_SENDER, compiled once per value."""
+    return SenderIndex(confsender.strip().split(','))
+
 
 class SMSSendable(vector_sendable.Sendable):
     """An SMS message."""
@@ -36,6 +104,7 @@ class SMSSendable(vector_sendable.Sendable):
     required_settings = {
         'TATTLER_BULKSMS_TOKEN': [True, lambda v: re.match(r'.+:.+', v)],
         'TATTLER_SMS_SENDER': [False, lambda v: re.match(r'\+[0-9]+', v)],
+        'TATTLER_BULKSMS_URL': [False, lambda v: re.match(r'https?://[^/]+', v)],
     }
 
     @classmethod
@@ -55,23 +124,13 @@ class SMSSendable(vector_sendable.Sendable):
         confsender = super().sender(recipient)
         if not confsender:
             return None
-        senders = confsender.strip().split(',')
-        if not recipient or len(senders) == 1:
-            return senders[0]
-        # got multiple sender numbers. Find matching country code
-        matching_prefixes = []
-        for snd in senders:
-            matching_prefixes += [snd[:i] for i in range(2, max(len(snd), len(recipient))) if snd[:i] == recipient[:i]]
-        if matching_prefixes:
-            mpref = max(matching_prefixes, key=len)
-            return [x for x in senders if x.startswith(mpref)][0]
-        return senders[0]
-
-    def get_sms_server(self):
-        """Prepare SMS server object."""
+        return get_sender_index(confsender).lookup(recipient)
+
+    def get_sms_server(self) -> sms_client.PooledBulkSMS:
+        """Return the SMS client, shared across messages to reuse its connections."""
         credentials = get_auth_from_environment()
         # configure sender_id at delivery time, as it may be function of the recipient
-        return BulkSMS(token_id=credentials[0], token_secret=credentials[1])
+        return sms_client.get_client(credentials[0], credentials[1], getenv('TATTLER_BULKSMS_URL', None))
 
     def validate_recipient(self, recipient: str) -> str:
         if re.match(r'(00|\+)[1-9][0-9]+', recipient):
@@ -88,14 +147,32 @@ class SMSSendable(vector_sendable.Sendable):
         # generate message content first, to avoid loading rest if template has issues
         context = context or {}
         msg_content = self.content(context=context)
-        smssrv = self.get_sms_server()
         log.info("n%s: Sending SMS to '%s'", self.nid, recipients)
         log.debug("n%s: Body: %s", self.nid, msg_content)
         # split notifications by sender
-        sms_senderids = {}
+        sms_senderids: Dict[Optional[str], set] = {}
+        # look the configuration up once, rather than once per recipient
+        confsender = super().sender()
+        index = get_sender_index(confsender) if confsender else None
         for r in recipients:
-            sms_senderids[self.sender(r)] = sms_senderids.get(self.sender(r), set()) | {r}
+            sms_senderids.setdefault(index.lookup(r) if index else None, set()).add(r)
+        capture = get_capture()
+        if capture is not None:
+            for senderid, rcpts in sms_senderids.items():
+                record_capture(capture, self.vector(), self.nid, self.event(), senderid, rcpts, msg_content.encode())
+            log.info("n%s: SMS captured instead of delivered.", self.nid)
+            return
+        smssrv = self.get_sms_server()
+        batch_window = get_sms_batch_window()
+        taskids = []
         for senderid, rcpts in sms_senderids.items():
-            taskids = smssrv.send(rcpts, msg_content, sender=senderid, priority=priority)
-        report = smssrv.msg_delivery_status(taskids[0])
-        log.info("n%s: Delivery report: %s", self.nid, report)
+            if batch_window > 0:
+                # share one submission with concurrent notifications of identical content
+                batcher = sms_batch.get_batcher(batch_window, get_sms_batch_size())
+                taskids += batcher.submit(smssrv, rcpts, msg_content, sender=senderid, priority=priority)
+            else:
+                taskids += smssrv.send(rcpts, msg_content, sender=senderid, priority=priority)
+        log.info("n%s: SMS accepted for delivery as %s", self.nid, taskids)
+        report_interval = get_sms_report_interval()
+        if report_interval > 0:
+            sms_client.get_poller(report_interval).watch(smssrv, taskids, self.nid)
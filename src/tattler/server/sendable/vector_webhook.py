@@ -0,0 +1,180 @@
+"""Webhook sendable"""
+
+import re
+import json
+import logging
+import os
+import string
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Mapping, Any
+
+from tattler.server.sendable import vector_sendable, webhook_client
+from tattler.server.sendable.vector_sendable import getenv
+from tattler.server.sendable.webhook_client import WebhookEndpoint
+from tattler.server.sendable.capture import get_capture, record as record_capture
+
+
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
+log = logging.getLogger(__name__)
+
+# file in a scope, or in the template base, configuring the webhooks which can be notified
+webhooks_filename = '_webhooks.json'
+
+endpoint_name_re = re.compile(r'[a-zA-Z0-9_.-]+')
+url_re = re.compile(r'https?://[^/\s]+\S*')
+
+_webhook_timeout_s = 10.0
+_webhook_concurrency = 8
+_webhook_retries = 2
+_webhook_retry_backoff_s = 1.0
+
+
+def get_webhook_timeout() -> float:
+    """Return the timeout for each request to a webhook, in seconds."""
+    try:
+        return float(getenv("TATTLER_WEBHOOK_TIMEOUT", _webhook_timeout_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_WEBHOOK_TIMEOUT='%s'. Set to a number of seconds. Falling back to default %s", getenv("TATTLER_WEBHOOK_TIMEOUT"), _webhook_timeout_s)
+        return _webhook_timeout_s
+
+def get_webhook_concurrency() -> int:
+    """Return the maximum number of requests in flight to each webhook host."""
+    try:
+        return max(1, int(getenv("TATTLER_WEBHOOK_CONCURRENCY", _webhook_concurrency)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_WEBHOOK_CONCURRENCY='%s'. Set to a number of requests. Falling back to default %s", getenv("TATTLER_WEBHOOK_CONCURRENCY"), _webhook_concurrency)
+        return _webhook_concurrency
+
+def get_webhook_retries() -> int:
+    """Return the maximum number of retries for requests failing temporarily, 0 to never retry."""
+    try:
+        return max(0, int(getenv("TATTLER_WEBHOOK_RETRIES", _webhook_retries)))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_WEBHOOK_RETRIES='%s'. Set to a number of retries. Falling back to default %s", getenv("TATTLER_WEBHOOK_RETRIES"), _webhook_retries)
+        return _webhook_retries
+
+def get_webhook_retry_backoff() -> float:
+    """Return the base delay for retrying requests failing temporarily, in seconds."""
+    try:
+        return float(getenv("TATTLER_WEBHOOK_RETRY_BACKOFF", _webhook_retry_backoff_s))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_WEBHOOK_RETRY_BACKOFF='%s'. Set to a number of seconds. Falling back to default %s", getenv("TATTLER_WEBHOOK_RETRY_BACKOFF"), _webhook_retry_backoff_s)
+        return _webhook_retry_backoff_s
+
+
+class _Environment(dict):
+    """Environment variables looked up with getenv(), to substitute into header values."""
+
+    def __missing__(self, name: str) -> str:
+        value = getenv(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+@lru_cache(maxsize=64)
+def _load_webhooks(path: str, mtime_ns: int) -> Dict[str, WebhookEndpoint]:
+    """Return the webhooks configured in a file, parsed once per version of the file."""
+    try:
+        conf = json.loads(Path(path).read_text(encoding='utf-8'))
+    except ValueError as err:
+        raise ValueError(f"Webhook configuration {path} is not valid JSON: {err}") from err
+    if not isinstance(conf, dict):
+        raise ValueError(f"Webhook configuration {path} must map webhook names to their settings.")
+    endpoints = {}
+    for name, settings in conf.items():
+        if not isinstance(settings, dict) or not url_re.fullmatch(str(settings.get('url', ''))):
+            raise ValueError(f"Webhook '{name}' in {path} requires a 'url' starting with http:// or https://.")
+        headers = settings.get('headers', {})
+        if not isinstance(headers, dict):
+            raise ValueError(f"Headers of webhook '{name}' in {path} must map header names to values.")
+        endpoints[name] = WebhookEndpoint(settings['url'], headers)
+    return endpoints
+
+def load_webhooks(template_base: Path) -> Dict[str, WebhookEndpoint]:
+    """Return the webhooks configured for a scope, by name.
+
+    Webhooks are configured in file ``_webhooks.json`` of the scope, or of the template base, the former
+    taking precedence. ``${VAR}`` in header values is replaced with the value of environment variable VAR,
+    to keep credentials out of the templates.
+
+    :param template_base:   Path of the scope's templates.
+
+    :return:                Map of webhook names to their configuration.
+    """
+    endpoints = {}
+    for loc in [template_base.parent, template_base]:
+        path = loc / webhooks_filename
+        if path.is_file():
+            endpoints.update(_load_webhooks(str(path), path.stat().st_mtime_ns))
+    return endpoints
+
+
+class WebhookSendable(vector_sendable.Sendable):
+    """A notification POSTed to a webhook as JSON."""
+
+    context_variables = frozenset({'correlation_id'})
+
+    def validate_recipient(self, recipient: str) -> str:
+        recipient = recipient.strip()
+        if endpoint_name_re.fullmatch(recipient) or url_re.fullmatch(recipient):
+            return recipient
+        raise ValueError(f"Recipient must be the name of a webhook configured in {webhooks_filename}, or a URL starting with http:// or https://, not '{recipient}'.")
+
+    @classmethod
+    def vector(cls: type[vector_sendable.Sendable]) -> str:
+        return 'webhook'
+
+    def endpoint(self, recipient: str) -> WebhookEndpoint:
+        """Return the webhook to deliver to for a recipient, given as either a configured name or a URL."""
+        endpoints = load_webhooks(self.template_base)
+        if recipient in endpoints:
+            endpoint = endpoints[recipient]
+        elif url_re.fullmatch(recipient):
+            endpoint = WebhookEndpoint(recipient)
+        else:
+            raise ValueError(f"No webhook named '{recipient}' is configured in {webhooks_filename} for scope {self.template_base.name}.")
+        try:
+            headers = {name: string.Template(str(val)).substitute(_Environment()) for name, val in endpoint.headers.items()}
+        except (KeyError, ValueError) as err:
+            raise ValueError(f"Headers of webhook '{recipient}' reference an unset or malformed environment variable: {err}") from err
+        return WebhookEndpoint(endpoint.url, headers)
+
+    def payload(self, context: Mapping[str, Any]) -> Dict[str, Any]:
+        """Return the JSON document to POST to webhooks for a given context."""
+        payload = {
+            'nid': self.nid,
+            'scope': self.template_base.name,
+            'event': self.event(),
+            'body': self.content(context),
+        }
+        if context.get('correlation_id'):
+            payload['correlation_id'] = context['correlation_id']
+        return payload
+
+    def do_send(self, recipients: Iterable[str], priority: Optional[int]=None, context: Optional[Mapping[str, Any]]=None):
+        context = context or {}
+        body = json.dumps(self.payload(context)).encode()
+        endpoints = {r: self.endpoint(r) for r in recipients}
+        headers = {'Content-Type': 'application/json; charset=utf-8', 'Idempotency-Key': self.nid}
+        capture = get_capture()
+        if capture is not None:
+            for endpoint in endpoints.values():
+                record_capture(capture, self.vector(), self.nid, self.event(), None, [endpoint.url], body)
+            log.info("n%s: Webhook notification captured instead of posted to %s.", self.nid, list(endpoints))
+            return
+        timeout, concurrency = get_webhook_timeout(), get_webhook_concurrency()
+        retries, backoff_s = get_webhook_retries(), get_webhook_retry_backoff()
+        log.info("n%s: Posting to webhooks %s", self.nid, list(endpoints))
+        futures = {r: webhook_client.submit(ep, body, headers, timeout, concurrency, retries, backoff_s, self.nid) for r, ep in endpoints.items()}
+        errors = []
+        for recipient, future in futures.items():
+            try:
+                status = future.result()
+                log.info("n%s: Webhook %s accepted the notification with status %s.", self.nid, recipient, status)
+            except Exception as err:
+                log.error("n%s: Delivery to webhook %s failed: %s", self.nid, recipient, err)
+                errors.append(err)
+        if errors:
+            raise errors[0]
@@ -0,0 +1,135 @@
+"""Delivery of notifications to webhooks, as JSON requests over pooled, persistent HTTP connections.
+
+Each webhook host gets one :class:`WebhookClient`, which keeps connections to it open across
+deliveries and bounds the number of requests in flight to it. Deliveries run on a shared pool of
+threads, so a notification to several webhooks takes about as long as the slowest of them, and
+requests failing with a connection error, a timeout, ``429`` or ``5xx`` are retried with backoff.
+"""
+
+import concurrent.futures
+import http.client
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+from dataclasses import dataclass, field
+from typing import Dict, Hashable, Mapping, Optional, Tuple
+
+from tattler.server import metrics
+from tattler.server.sendable.http_pool import HTTPConnectionPool
+from tattler.server.sendable.smtp_outcomes import backoff_delay
+
+log = logging.getLogger(__name__)
+
+# threads delivering to webhooks, across all hosts
+_default_workers = 32
+
+
+@dataclass(frozen=True)
+class WebhookEndpoint:
+    """A webhook to deliver notifications to."""
+    url: str
+    headers: Mapping[str, str] = field(default_factory=dict)
+
+
+def is_retryable(err: Exception) -> bool:
+    """Return whether a request failing with an error may succeed if retried later."""
+    if isinstance(err, urllib.error.HTTPError):
+        return err.code == 429 or err.code >= 500
+    return isinstance(err, (OSError, http.client.HTTPException))
+
+
+class WebhookClient:
+    """Delivers requests to one webhook host over persistent connections, with a bounded number in flight."""
+
+    def __init__(self, url: str, timeout: float, concurrency: int) -> None:
+        """Construct a client.
+
+        :param url:             URL of any webhook on the host, e.g. 'https://hooks.example.com/tattler'.
+        :param timeout:         Timeout of connections, and of waiting for a free request slot, in seconds.
+        :param concurrency:     Maximum number of requests in flight to the host.
+        """
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.pool = HTTPConnectionPool(url, timeout, max_size=concurrency, name='webhook')
+        self._slots = threading.BoundedSemaphore(concurrency)
+
+    def post(self, url: str, body: bytes, headers: Mapping[str, str]) -> Tuple[int, bytes]:
+        """POST a request body to a URL on the host, and return (status, body) of the response.
+
+        :raise urllib.error.HTTPError:  if the webhook replies with an error status.
+        :raise TimeoutError:            if no request slot frees up within the timeout.
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No request slot to {self.pool.host} freed up within {self.timeout}s ({self.concurrency} requests in flight).")
+        try:
+            status, reason, data = self.pool.request('POST', path, body, dict(headers))
+        finally:
+            self._slots.release()
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, None, None)
+        return status, data
+
+
+_clients: Dict[Hashable, WebhookClient] = {}
+_clients_lock = threading.Lock()
+
+def get_client(url: str, timeout: float, concurrency: int) -> WebhookClient:
+    """Return the process-wide client for the host of a webhook URL, creating it if needed."""
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, timeout, concurrency)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = WebhookClient(url, timeout, concurrency)
+            _clients[key] = client
+        return client
+
+
+def deliver(endpoint: WebhookEndpoint, body: bytes, headers: Mapping[str, str], timeout: float, concurrency: int, retries: int, backoff_s: float, nid: str='') -> int:
+    """POST a request body to a webhook, retrying temporary failures, and return the status of the response.
+
+    :param endpoint:        Webhook to deliver to; its headers take precedence over those given.
+    :param body:            Body of the request.
+    :param headers:         Headers of the request.
+    :param timeout:         Timeout of each attempt, in seconds.
+    :param concurrency:     Maximum number of requests in flight to the webhook's host.
+    :param retries:         Maximum number of retries of temporary failures.
+    :param backoff_s:       Base delay between retries, doubled at every retry.
+    :param nid:             ID of the notification, for logs.
+
+    :return:                HTTP status of the webhook's response.
+    """
+    client = get_client(endpoint.url, timeout, concurrency)
+    headers = {**headers, **endpoint.headers}
+    attempt = 0
+    while True:
+        try:
+            status, _ = client.post(endpoint.url, body, headers)
+        except Exception as err:
+            if attempt >= retries or not is_retryable(err):
+                metrics.incr('webhook_deliveries', status='failed')
+                raise
+            attempt += 1
+            delay = backoff_delay(attempt, backoff_s)
+            log.info("n%s: Delivery to webhook %s failed (%s). Retrying in %.1fs (retry %d of %d).", nid, endpoint.url, err, delay, attempt, retries)
+            metrics.incr('webhook_retries')
+            time.sleep(delay)
+            continue
+        metrics.incr('webhook_deliveries', status='delivered')
+        return status
+
+
+_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def submit(*args, **kwargs) -> concurrent.futures.Future:
+    """Run :func:`deliver` with the arguments given in the background, and return its future."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_default_workers, thread_name_prefix='tattler-webhook')
+    return _executor.submit(deliver, *args, **kwargs)
@@ -0,0 +1,249 @@
+"""Local stand-in for the BulkSMS JSON API, to test and benchmark SMS delivery without a BulkSMS account.
+
+It implements the endpoints tattler uses -- submitting messages and querying their status -- with
+configurable latency, error rate, rate limit and delivery failures. Point tattler at it with e.g.
+``TATTLER_BULKSMS_URL=http://127.0.0.1:11504/v1``. Any credentials are accepted.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from tattler.server.tattler_utils import getenv
+from tattler.server.sendable.smtp_pacing import TokenBucket
+
+
+logging.basicConfig(level=getenv('LOG_LEVEL', 'info').upper())
+log = logging.getLogger(__name__)
+
+default_listen_address = '127.0.0.1:11504'
+
+message_req_re = re.compile(r'/v1/messages/(?P<id>[^/?]+)')
+
+
+@dataclass
+class SimulatorSettings:
+    """Behavior of the simulated API."""
+    # seconds to wait before replying to each request
+    latency_s: float = 0.0
+    # share of requests failing with a temporary error (503)
+    error_rate: float = 0.0
+    # requests per second accepted, beyond which requests are refused with 429; 0 for no limit
+    rate_limit: float = 0.0
+    # seconds after submission at which messages reach their final status
+    delivery_delay_s: float = 0.0
+    # share of messages whose delivery fails
+    failure_rate: float = 0.0
+
+
+@dataclass
+class SimulatedMessage:
+    """A message submitted to the simulator."""
+    id: str
+    sender: Optional[str]
+    recipient: str
+    body: str
+    submitted: float
+    final_status: str
+
+
+@dataclass
+class SimulatorStats:
+    """Counters of the simulator's activity."""
+    requests: int = 0
+    submissions: int = 0
+    messages: int = 0
+    status_queries: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    connections: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class SMSSimulatorHandler(BaseHTTPRequestHandler):
+    """Handles requests to the simulated BulkSMS API, over persistent connections."""
+
+    protocol_version = 'HTTP/1.1'
+    server: 'SMSSimulator'
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.lock:
+            self.server.stats.connections += 1
+
+    def log_message(self, format: str, *args: Any) -> None:
+        log.debug("%s - %s", self.client_address[0], format % args)
+
+    def reply(self, code: int, payload: Any) -> None:
+        """Send a JSON response."""
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_error(self, code: int, title: str, detail: str) -> None:
+        """Send an error in the format of the BulkSMS API."""
+        self.reply(code, {'type': 'https://developer.bulksms.com/json/v1/errors#' + title.lower().replace(' ', '-'), 'title': title, 'status': code, 'detail': detail})
+
+    def admit(self) -> bool:
+        """Apply latency and inject faults; return whether to serve the request, having replied otherwise."""
+        if self.headers.get('Content-Length'):
+            self.body = self.rfile.read(int(self.headers['Content-Length']))
+        else:
+            self.body = b''
+        settings = self.server.settings
+        if settings.latency_s:
+            time.sleep(settings.latency_s)
+        with self.server.lock:
+            self.server.stats.requests += 1
+            limited = self.server.bucket is not None and not self.server.bucket.take()
+            failed = not limited and self.server.random.random() < settings.error_rate
+            if limited:
+                self.server.stats.rate_limited += 1
+            if failed:
+                self.server.stats.errors += 1
+        if limited:
+            self.reply_error(429, 'Too Many Requests', f"Rate limit of {settings.rate_limit} requests per second exceeded.")
+            return False
+        if failed:
+            self.reply_error(503, 'Service Unavailable', "Simulated temporary failure.")
+            return False
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            self.reply_error(401, 'Unauthorized', "Missing credentials.")
+            return False
+        return True
+
+    def do_POST(self) -> None:
+        """Submit messages."""
+        if not self.admit():
+            return
+        if self.path.split('?')[0] != '/v1/messages':
+            self.reply_error(404, 'Not Found', f"No resource at {self.path}.")
+            return
+        try:
+            req = json.loads(self.body)
+            recipients = req['to'] if isinstance(req['to'], list) else [req['to']]
+            body = req['body']
+        except (ValueError, KeyError, TypeError) as err:
+            self.reply_error(400, 'Bad Request', f"Invalid request: {err}")
+            return
+        messages = self.server.submit(req.get('from'), recipients, body)
+        self.reply(201, [{'id': msg.id, 'type': 'SENT', 'from': msg.sender, 'to': msg.recipient, 'body': msg.body,
+                          'encoding': req.get('encoding', 'TEXT'), 'status': {'type': 'ACCEPTED'}} for msg in messages])
+
+    def do_GET(self) -> None:
+        """Query the status of a message, or the counters of the simulator."""
+        if not self.admit():
+            return
+        if self.path == '/v1/simulator/stats':
+            with self.server.lock:
+                self.reply(200, self.server.stats.as_dict())
+            return
+        match = message_req_re.fullmatch(self.path.split('?')[0])
+        if not match:
+            self.reply_error(404, 'Not Found', f"No resource at {self.path}.")
+            return
+        found = self.server.status(match.group('id'))
+        if found is None:
+            self.reply_error(404, 'Not Found', f"No message with id {match.group('id')}.")
+            return
+        msg, status = found
+        self.reply(200, {'id': msg.id, 'type': 'SENT', 'from': msg.sender, 'to': msg.recipient, 'body': msg.body,
+                         'status': {'type': status}, 'creditCost': 1})
+
+
+class SMSSimulator(ThreadingHTTPServer):
+    """HTTP server simulating the BulkSMS API."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], settings: SimulatorSettings, seed: Optional[int]=None) -> None:
+        super().__init__(address, SMSSimulatorHandler)
+        self.settings = settings
+        self.stats = SimulatorStats()
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.bucket = TokenBucket(settings.rate_limit) if settings.rate_limit > 0 else None
+        self.messages: Dict[str, SimulatedMessage] = {}
+        self._ids = itertools.count(1)
+
+    def submit(self, sender: Optional[str], recipients: List[str], body: str) -> List[SimulatedMessage]:
+        """Record submitted messages, one per recipient, and return them."""
+        now = time.time()
+        with self.lock:
+            messages = [SimulatedMessage(str(next(self._ids)), sender, rcpt, body, now,
+                                         'FAILED' if self.random.random() < self.settings.failure_rate else 'DELIVERED') for rcpt in recipients]
+            for msg in messages:
+                self.messages[msg.id] = msg
+            self.stats.submissions += 1
+            self.stats.messages += len(messages)
+        return messages
+
+    def status(self, message_id: str) -> Optional[Tuple[SimulatedMessage, str]]:
+        """Return a message and its current status, or None if unknown."""
+        with self.lock:
+            self.stats.status_queries += 1
+            msg = self.messages.get(message_id)
+        if msg is None:
+            return None
+        if time.time() - msg.submitted < self.settings.delivery_delay_s:
+            return msg, 'ACCEPTED'
+        return msg, msg.final_status
+
+
+def get_cmdline_args() -> List[str]:     # pragma: no cover
+    """Wrap sys.argv for mocking"""
+    return sys.argv[1:]
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='tattler_sms_simulator', description='Simulate the BulkSMS API locally, for testing and benchmarking SMS delivery.')
+    parser.add_argument('--listen', default=default_listen_address, help=f'Address and port to listen on. Default {default_listen_address}.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before replying to each request. Default 0.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests failing with a temporary error, in [0, 1]. Default 0.')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='Requests per second to accept before replying 429. Default 0 (no limit).')
+    parser.add_argument('--delivery-delay', type=float, default=0.0, help='Seconds after submission at which messages are reported delivered or failed. Default 0.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of messages reported as failed, in [0, 1]. Default 0.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the random injection of faults, for reproducible runs.')
+    return parser.parse_args(args)
+
+def make_simulator(args: argparse.Namespace) -> SMSSimulator:
+    """Return a simulator bound to the address given in the arguments, ready to serve."""
+    host, port = args.listen.rsplit(':', 1)
+    settings = SimulatorSettings(args.latency, args.error_rate, args.rate_limit, args.delivery_delay, args.failure_rate)
+    return SMSSimulator((host, int(port)), settings, args.seed)
+
+def main():
+    """Entry point function for command line execution."""
+    args = parse_args(get_cmdline_args())
+    try:
+        srv = make_simulator(args)
+    except OSError as err:
+        log.error("Unable to bind %s: %s", args.listen, err)
+        return 1
+    host, port = srv.server_address[:2]
+    log.warning("Simulating BulkSMS at http://%s:%s/v1 . Set TATTLER_BULKSMS_URL to it.", host, port)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+    log.info("Served: %s", srv.stats.as_dict())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""Local SMTP sink, to test and benchmark email delivery on one machine.
+
+It accepts SMTP with the extensions tattler uses (PIPELINING, 8BITMIME, SMTPUTF8, CHUNKING, and
+optionally STARTTLS and AUTH), counts messages and bytes, and optionally stores messages to disk.
+Delays, temporary and permanent refusals of recipients and dropped connections can be injected at
+configurable rates. Point tattler at it with e.g. ``TATTLER_SMTP_ADDRESS=127.0.0.1:2525``.
+"""
+
+import argparse
+import base64
+import itertools
+import logging
+import random
+import socket
+import socketserver
+import ssl
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from tattler.server.tattler_utils import getenv
+
+
+logging.basicConfig(level=getenv('LOG_LEVEL', 'info').upper())
+log = logging.getLogger(__name__)
+
+default_listen_address = '127.0.0.1:2525'
+default_extensions = ['PIPELINING', '8BITMIME', 'SMTPUTF8', 'CHUNKING']
+
+
+@dataclass
+class SinkSettings:
+    """Behavior of the SMTP sink."""
+    # extensions to advertise in reply to EHLO, besides STARTTLS and AUTH
+    extensions: List[str] = field(default_factory=lambda: list(default_extensions))
+    # seconds to wait before accepting each message, e.g. the queueing time of a relay
+    latency_s: float = 0.0
+    # share of recipients refused temporarily (451) or permanently (550)
+    tempfail_rate: float = 0.0
+    permfail_rate: float = 0.0
+    # share of messages upon which the connection is dropped instead of accepting them
+    disconnect_rate: float = 0.0
+    # credentials 'username:password' to require with AUTH, or None to accept unauthenticated sessions
+    auth: Optional[str] = None
+    # directory to store messages received into, or None to discard them
+    store_dir: Optional[Path] = None
+
+
+@dataclass
+class SinkStats:
+    """Counters of the sink's activity."""
+    connections: int = 0
+    messages: int = 0
+    recipients: int = 0
+    # bytes received over the wire, including commands
+    bytes_received: int = 0
+    # bytes of the messages accepted
+    message_bytes: int = 0
+    tempfails: int = 0
+    permfails: int = 0
+    disconnects: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class Disconnect(Exception):
+    """Raised to drop the connection."""
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """Speaks SMTP to one client."""
+
+    server: 'SMTPSink'
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def readline(self) -> bytes:
+        line = self.rfile.readline()
+        self.server.count(bytes_received=len(line))
+        return line
+
+    def read(self, size: int) -> bytes:
+        data = self.rfile.read(size)
+        self.server.count(bytes_received=len(data))
+        return data
+
+    def starttls(self) -> None:
+        """Upgrade the connection to TLS."""
+        self.connection = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb', buffering=0)
+
+    def authenticate(self, args: List[bytes]) -> bool:
+        """Run an AUTH PLAIN or AUTH LOGIN exchange, and return whether the credentials are valid."""
+        mechanism = args[0].upper() if args else b''
+        if mechanism == b'PLAIN':
+            if len(args) > 1:
+                response = args[1]
+            else:
+                self.reply('334 ')
+                response = self.readline().strip()
+            _, username, password = base64.b64decode(response).split(b'\0', 2)
+        elif mechanism == b'LOGIN':
+            self.reply('334 ' + base64.b64encode(b'Username:').decode('ascii'))
+            username = base64.b64decode(self.readline().strip())
+            self.reply('334 ' + base64.b64encode(b'Password:').decode('ascii'))
+            password = base64.b64decode(self.readline().strip())
+        else:
+            return False
+        return f"{username.decode('utf-8')}:{password.decode('utf-8')}" == self.server.settings.auth
+
+    def rcpt_reply(self) -> str:
+        """Return the reply to a recipient, with faults injected at the configured rates."""
+        settings = self.server.settings
+        draw = self.server.draw()
+        if draw < settings.permfail_rate:
+            self.server.count(permfails=1)
+            return '550 5.1.1 Simulated permanent failure'
+        if draw < settings.permfail_rate + settings.tempfail_rate:
+            self.server.count(tempfails=1)
+            return '451 4.3.0 Simulated temporary failure'
+        return '250 2.1.5 OK'
+
+    def accept(self, sender: bytes, recipients: List[bytes], data: bytes) -> None:
+        """Accept a message, dropping the connection instead at the configured rate."""
+        if self.server.draw() < self.server.settings.disconnect_rate:
+            self.server.count(disconnects=1)
+            raise Disconnect()
+        if self.server.settings.latency_s:
+            time.sleep(self.server.settings.latency_s)
+        self.server.store(sender, recipients, data)
+        self.reply('250 2.0.0 queued')
+
+    def handle(self) -> None:
+        self.server.count(connections=1)
+        try:
+            self.session()
+        except (Disconnect, ConnectionError, ssl.SSLError, ValueError):
+            pass
+
+    def finish(self) -> None:
+        super().finish()
+        if self.connection is not self.request:
+            # close the TLS layer set up by STARTTLS
+            self.connection.close()
+
+    def session(self) -> None:
+        settings = self.server.settings
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls = False
+        authenticated = settings.auth is None
+        sender, recipients, chunks = None, [], []
+        self.reply('220 tattler-smtp-sink ESMTP')
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            args = line.split()
+            cmd = args[0].upper() if args else b''
+            if cmd == b'EHLO':
+                extensions = list(settings.extensions)
+                if self.server.ssl_context is not None and not tls:
+                    extensions.append('STARTTLS')
+                if settings.auth is not None:
+                    extensions.append('AUTH PLAIN LOGIN')
+                self.wfile.write(b''.join(f'250-{e}\r\n'.encode('ascii') for e in ['tattler-smtp-sink'] + extensions) + b'250 HELP\r\n')
+            elif cmd == b'HELO':
+                self.reply('250 tattler-smtp-sink')
+            elif cmd == b'STARTTLS' and self.server.ssl_context is not None and not tls:
+                self.reply('220 2.0.0 Ready to start TLS')
+                self.starttls()
+                tls = True
+            elif cmd == b'AUTH' and settings.auth is not None:
+                authenticated = self.authenticate(args[1:])
+                self.reply('235 2.7.0 Authentication successful' if authenticated else '535 5.7.8 Authentication credentials invalid')
+            elif cmd in (b'MAIL', b'RCPT', b'DATA', b'BDAT') and not authenticated:
+                if cmd == b'BDAT':
+                    self.read(int(args[1]))
+                self.reply('530 5.7.0 Authentication required')
+            elif cmd == b'MAIL':
+                sender, recipients, chunks = line[10:].split(b'>')[0].strip(b' <'), [], []
+                self.reply('250 2.1.0 OK')
+            elif cmd == b'RCPT':
+                reply = self.rcpt_reply()
+                if reply.startswith('250'):
+                    recipients.append(line[8:].split(b'>')[0].strip(b' <'))
+                self.reply(reply)
+            elif cmd == b'DATA':
+                if not recipients:
+                    self.reply('554 5.5.1 No valid recipients')
+                    continue
+                self.reply('354 Go ahead')
+                data = []
+                while True:
+                    dline = self.readline()
+                    if dline in (b'.\r\n', b''):
+                        break
+                    data.append(dline[1:] if dline.startswith(b'..') else dline)
+                self.accept(sender, recipients, b''.join(data))
+                sender, recipients = None, []
+            elif cmd == b'BDAT':
+                chunks.append(self.read(int(args[1])))
+                if len(args) > 2 and args[2].upper() == b'LAST':
+                    if recipients:
+                        self.accept(sender, recipients, b''.join(chunks))
+                    else:
+                        self.reply('554 5.5.1 No valid recipients')
+                    sender, recipients, chunks = None, [], []
+                else:
+                    self.reply('250 2.0.0 Chunk received')
+            elif cmd == b'RSET':
+                sender, recipients, chunks = None, [], []
+                self.reply('250 2.0.0 OK')
+            elif cmd == b'QUIT':
+                self.reply('221 2.0.0 Bye')
+                return
+            else:
+                self.reply('250 2.0.0 OK')
+
+
+class SMTPSink(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """SMTP server accepting messages, counting and optionally storing them."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address: Tuple[str, int], settings: Optional[SinkSettings]=None, ssl_context: Optional[ssl.SSLContext]=None, seed: Optional[int]=None) -> None:
+        """Construct a sink, and bind it to an address.
+
+        :param address:     Address and port to listen on; port 0 for any free port.
+        :param settings:    Behavior of the sink; None for defaults, accepting everything.
+        :param ssl_context: Server context to offer STARTTLS with, or None to not offer it.
+        :param seed:        Seed for the random injection of faults.
+        """
+        super().__init__(address, SMTPSinkHandler)
+        self.settings = settings or SinkSettings()
+        self.ssl_context = ssl_context
+        self.stats = SinkStats()
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self._seq = itertools.count(1)
+        if self.settings.store_dir is not None:
+            Path(self.settings.store_dir).mkdir(parents=True, exist_ok=True)
+
+    def draw(self) -> float:
+        """Return a random number in [0, 1), for injecting faults."""
+        with self.lock:
+            return self.random.random()
+
+    def count(self, **counters: int) -> None:
+        """Add to the counters of the sink."""
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self.stats, name, getattr(self.stats, name) + value)
+
+    def store(self, sender: bytes, recipients: List[bytes], data: bytes) -> None:
+        """Account for a message accepted, and store it if so configured."""
+        self.count(messages=1, recipients=len(recipients), message_bytes=len(data))
+        if self.settings.store_dir is None:
+            return
+        envelope = b'X-Sink-Mail-From: ' + sender + b'\r\n' + b''.join(b'X-Sink-Rcpt-To: ' + r + b'\r\n' for r in recipients)
+        path = Path(self.settings.store_dir) / f'{int(time.time())}.{next(self._seq)}.eml'
+        path.write_bytes(envelope + data)
+
+
+def get_cmdline_args() -> List[str]:     # pragma: no cover
+    """Wrap sys.argv for mocking"""
+    return sys.argv[1:]
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='tattler_smtp_sink', description='Accept email over SMTP locally, for testing and benchmarking email delivery.')
+    parser.add_argument('--listen', default=default_listen_address, help=f'Address and port to listen on. Default {default_listen_address}.')
+    parser.add_argument('--extensions', default=','.join(default_extensions), help=f"Comma-separated SMTP extensions to advertise. Default {','.join(default_extensions)}.")
+    parser.add_argument('--tls-cert', help='Certificate file (PEM) to offer STARTTLS with.')
+    parser.add_argument('--tls-key', help='Private key file (PEM) of --tls-cert, if not included in it.')
+    parser.add_argument('--auth', help="Credentials 'username:password' to require with AUTH PLAIN or LOGIN.")
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before accepting each message. Default 0.')
+    parser.add_argument('--tempfail-rate', type=float, default=0.0, help='Share of recipients refused with 451, in [0, 1]. Default 0.')
+    parser.add_argument('--permfail-rate', type=float, default=0.0, help='Share of recipients refused with 550, in [0, 1]. Default 0.')
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help='Share of messages upon which the connection is dropped, in [0, 1]. Default 0.')
+    parser.add_argument('--store', type=Path, help='Directory to store messages received into, as .eml files with their envelope. Default: discard messages.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the random injection of faults, for reproducible runs.')
+    return parser.parse_args(args)
+
+def make_sink(args: argparse.Namespace) -> SMTPSink:
+    """Return a sink bound to the address given in the arguments, ready to serve."""
+    host, port = args.listen.rsplit(':', 1)
+    ssl_context = None
+    if args.tls_cert:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(args.tls_cert, args.tls_key)
+    extensions = [e.strip().upper() for e in args.extensions.split(',') if e.strip()]
+    settings = SinkSettings(extensions, args.latency, args.tempfail_rate, args.permfail_rate, args.disconnect_rate, args.auth, args.store)
+    return SMTPSink((host, int(port)), settings, ssl_context, args.seed)
+
+def main():
+    """Entry point function for command line execution."""
+    args = parse_args(get_cmdline_args())
+    try:
+        sink = make_sink(args)
+    except (OSError, ssl.SSLError) as err:
+        log.error("Unable to start SMTP sink on %s: %s", args.listen, err)
+        return 1
+    host, port = sink.server_address[:2]
+    log.warning("SMTP sink listening at %s:%s . Set TATTLER_SMTP_ADDRESS to it.", host, port)
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server_close()
+    log.info("Received: %s", sink.stats.as_dict())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
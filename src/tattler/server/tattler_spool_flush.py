@@ -0,0 +1,67 @@
+"""Deliver emails handed off to the spool directory (TATTLER_SMTP_SPOOL) over pooled SMTP connections"""
+
+import argparse
+import logging
+import sys
+import time
+from typing import List
+
+from tattler.server.tattler_utils import getenv
+from tattler.server.sendable import smtp_spool
+from tattler.server.sendable.vector_email import SMTPDelivery, get_smtp_retry_backoff
+
+
+logging.basicConfig(level=getenv('LOG_LEVEL', 'info').upper())
+log = logging.getLogger(__name__)
+
+default_poll_interval_s = 5
+default_retries = 10
+default_concurrency = 4
+# messages claimed for longer than this were abandoned by a crashed worker
+default_stale_after_s = 600
+
+
+def get_cmdline_args() -> List[str]:     # pragma: no cover
+    """Wrap sys.argv for mocking"""
+    return sys.argv[1:]
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='tattler_spool_flush', description='Deliver emails spooled by tattler_server with TATTLER_SMTP_SPOOL')
+    parser.add_argument('spool_dir', nargs='?', default=getenv('TATTLER_SMTP_SPOOL'), help='Spool directory. Defaults to TATTLER_SMTP_SPOOL.')
+    parser.add_argument('--once', action='store_true', help='Deliver the emails due, then exit, instead of polling for new ones.')
+    parser.add_argument('--interval', type=float, default=default_poll_interval_s, help=f'Seconds between polls of the spool. Default {default_poll_interval_s}.')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency, help=f'Emails to deliver in parallel, over as many pooled connections. Default {default_concurrency}.')
+    parser.add_argument('--retries', type=int, default=default_retries, help=f'Retries for recipients failing temporarily, with backoff from TATTLER_SMTP_RETRY_BACKOFF. Default {default_retries}.')
+    parsed = parser.parse_args(args)
+    if not parsed.spool_dir:
+        parser.error("No spool directory given, and TATTLER_SMTP_SPOOL is not set.")
+    return parsed
+
+def flush_spool(spool_dir: str, concurrency: int, retries: int, once: bool, interval: float) -> int:
+    """Deliver spooled emails, polling the spool until interrupted unless 'once'; return the number of emails processed."""
+    smtp = SMTPDelivery(pool_size=concurrency)
+    log.info("Delivering emails spooled in %s via SMTP %s ...", spool_dir, smtp.description)
+    processed = 0
+    while True:
+        smtp_spool.ensure_dirs(spool_dir)
+        smtp_spool.recover(spool_dir, default_stale_after_s)
+        count = smtp_spool.flush(spool_dir, smtp.deliver, retries, get_smtp_retry_backoff(), concurrency)
+        processed += count
+        if once:
+            return processed
+        if not count:
+            time.sleep(interval)
+
+def main():
+    """Entry point function for command line execution."""
+    args = parse_args(get_cmdline_args())
+    try:
+        processed = flush_spool(args.spool_dir, args.concurrency, args.retries, args.once, args.interval)
+    except KeyboardInterrupt:
+        return 0
+    log.info("Processed %d spooled emails.", processed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
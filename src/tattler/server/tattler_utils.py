@@ -3,10 +3,12 @@
 import base64
 import os
 import logging
+import time
 import uuid
 import binascii
+import threading
 from datetime import datetime
-from typing import Mapping, Any, Optional, Iterable, Union
+from typing import Mapping, Any, Optional, Iterable, Union, AbstractSet
 from pathlib import Path
 from importlib.resources import files
 
@@ -14,6 +16,7 @@ from tattler.server import pluginloader           # import in this exact way to
 
 from tattler.server.templatemgr import TemplateMgr
 from tattler.server import sendable
+from tattler.server import metrics
 from tattler.server.sendable.template_processor import TemplateProcessor
 from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor
 
@@ -34,6 +37,10 @@ native_plugins_path = [Path(__file__).parent / 'plugins']
 # trim long notification IDs at this number of characters
 max_notification_id_len = 12
 
+# map (template base, event, vector, template processor) to the signature of the templates and the variables they read
+_template_variables = {}
+_template_variables_lock = threading.Lock()
+
 logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
 log = logging.getLogger(__name__)
 
@@ -147,9 +154,66 @@ def core_template_variables(recipient: str, firstname: Optional[str], correlatio
         'event_name': event_name,
     }
 
-def plugin_template_variables(context: ContextType) -> ContextType:
-    """Solicit plugins to get variables to be fed into templates."""
-    return pluginloader.process_context(context)
+def plugin_template_variables(context: ContextType, used_variables: Optional[AbstractSet[str]]=None) -> ContextType:
+    """Solicit plugins to get variables to be fed into templates.
+
+    :param context:         Native context to pass to plugins.
+    :param used_variables:  Names of the variables the templates read, to skip plugins providing none of them; None to run all plugins.
+
+    :return:                Context to feed into templates."""
+    return pluginloader.process_context(context, used_variables)
+
+def _get_templates_signature(template_base: Path, event_name: str, vector: str) -> Iterable:
+    """Return the names and modification times of the files which the templates of an event for a vector may be read from.
+
+    :param template_base:   Path of the directory holding the templates of the scope.
+    :param event_name:      Name of the event to look up.
+    :param vector:          Name of the vector to look up.
+
+    :return:                Tuple of (pathname, mtime) pairs, which changes whenever any of those files does.
+    """
+    template_base = Path(template_base)
+    dirs = [template_base / event_name / vector]
+    for loc in [template_base, template_base.parent]:
+        dirs += [loc / '_base' / vector, loc / '_partials']
+    signature = []
+    for dirname in dirs:
+        for root, _, fnames in os.walk(dirname):
+            for fname in sorted(fnames):
+                pathname = os.path.join(root, fname)
+                try:
+                    signature.append((pathname, os.stat(pathname).st_mtime_ns))
+                except OSError:
+                    pass
+    return tuple(signature)
+
+def get_template_variables(template_base: Path, event_name: str, vector: str) -> Optional[AbstractSet[str]]:
+    """Return the names of the context variables which an event template reads for a vector.
+
+    Results are cached until any of the files of the template, its base template or partials changes.
+
+    :param template_base:   Path of the directory holding the templates of the scope.
+    :param event_name:      Name of the event to analyze.
+    :param vector:          Name of the vector to analyze the event template for.
+
+    :return:                Set of variable names, or None if they cannot be determined.
+    """
+    processor = get_template_processor()
+    key = (str(template_base), event_name, vector, processor)
+    signature = _get_templates_signature(template_base, event_name, vector)
+    with _template_variables_lock:
+        cached = _template_variables.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    try:
+        ntf = sendable.make_notification(vector, event_name, [], template_processor=processor, template_base=template_base)
+        variables = ntf.template_variables()
+    except Exception as err:
+        log.warning("Cannot determine variables used by template %s@%s (%s): %s. Assuming all are used.", event_name, vector, template_base, err)
+        return None
+    with _template_variables_lock:
+        _template_variables[key] = (signature, variables)
+    return variables
 
 def get_demo_template_path() -> Path:
     """Get the path where demo templates are stored"""
@@ -252,22 +316,26 @@ def send_notification_user_vectors(recipient_user, vectors, event_scope, event_n
         template_context = core_template_variables(recipient_user, user_contacts.get('first_name', None), correlationId, mode, vname, event_scope, event_name)
         if context:
             template_context.update(context)
-        template_context = plugin_template_variables(template_context)
+        template_context = plugin_template_variables(template_context, get_template_variables(tman.base_path, event_name, vname))
         errmsg = None
+        pending = []
         log.info("Sending %s:%s (evname:language) to #%s@%s => [%s], context=%s (cid=%s)", event_name, usrlang, recipient_user, vname, recipient, template_context, correlationId)
         blacklist = getenv('TATTLER_BLACKLIST_PATH')
+        t0 = time.perf_counter()
         try:
-            sendable.send_notification(vname, event_name, [recipient], template_base=tman.base_path, context=template_context, mode=mode, template_processor=get_template_processor(), blacklist=blacklist, language_code=usrlang)
+            ntf = sendable.send_notification(vname, event_name, [recipient], template_base=tman.base_path, context=template_context, mode=mode, template_processor=get_template_processor(), blacklist=blacklist, language_code=usrlang)
+            pending = list(ntf.pending_recipients())
         except Exception as err:
             errmsg = str(err)
             log.exception("Error sending %s for %s:%s@%s (evname:lang@scope) to %s. Skipping vector. (cid=%s)", vname, event_name, usrlang, event_scope, recipient, correlationId)
             log.debug("Context was (cid=%s): %s", correlationId, template_context)
+        metrics.observe('notification_seconds', time.perf_counter() - t0, vector=vname)
         retval.append({
             'id': f"{vname}:{uuid.uuid4()}",
             'vector': vname,
             'resultCode': 1 if errmsg else 0,
-            'result': 'error' if errmsg else 'success',
-            'detail': errmsg or 'OK'
+            'result': 'error' if errmsg else ('pending' if pending else 'success'),
+            'detail': errmsg or (f"Delivery deferred for {', '.join(pending)}" if pending else 'OK')
         })
     return retval
 
@@ -12,6 +12,10 @@ from tattler.server import pluginloader   # import in this exact way to ensure t
 
 from tattler.utils.serialization import decode_django_json
 from tattler.server.templatemgr import get_scopes
+from tattler.server import metrics
+from tattler.server.sendable import attachment_store
+from tattler.server.sendable.capture import MemoryCapture, get_capture
+from tattler.server.sendable.attachments import TOTAL_MAX_BYTES
 from tattler.server import tattler_utils
 from tattler.server.tattler_utils import getenv
 
@@ -23,8 +27,17 @@ default_master_mode = 'debug'
 
 MAX_REQUEST_BODY_BYTES = 12 * 1024 * 1024  # ~7 MB raw attachments + base64 overhead + slack
 
+attachment_req_re = re.compile(r'/attachments/(?P<digest>[0-9a-f]{64})')
 notification_req_re = re.compile(r'/notification/(?P<scope>[a-zA-Z0-9:._-]+)/((?P<event>[a-zA-Z0-9:._-]+)(?P<evprop>/vectors/)?)?')
 
+def get_attachment_max_bytes() -> int:
+    """Return the size of the largest file which clients may upload to the attachment store, in bytes."""
+    try:
+        return int(getenv('TATTLER_ATTACHMENT_STORE_MAX_FILE', TOTAL_MAX_BYTES))
+    except ValueError:
+        log.warning("Invalid value given for TATTLER_ATTACHMENT_STORE_MAX_FILE='%s'. Set to a number of bytes. Falling back to default %s", getenv('TATTLER_ATTACHMENT_STORE_MAX_FILE'), TOTAL_MAX_BYTES)
+        return TOTAL_MAX_BYTES
+
 class TattlerServer(http.server.BaseHTTPRequestHandler):
     def send(self, code, body):
         """Send response back to client, with given status code and payload."""
@@ -58,6 +71,15 @@ class TattlerServer(http.server.BaseHTTPRequestHandler):
     def do_GET(self) -> None:
         """Handler for GET requests"""
         log.info("%s", self.requestline)
+        if self.path == '/metrics/':
+            # serve operational metrics
+            return self.send(200, json.dumps(metrics.snapshot()))
+        if self.path == '/capture/':
+            # serve notifications captured in memory instead of delivered
+            capture = get_capture()
+            if not isinstance(capture, MemoryCapture):
+                return self.send_error(404, "Notifications are not captured in memory. Set TATTLER_CAPTURE=memory to do so.")
+            return self.send(200, json.dumps([msg.as_dict() for msg in capture.messages()]))
         if self.path == '/notification/':
             # serve list of scopes
             scopes = sorted(get_scopes(tattler_utils.get_template_mgr().base_path))
@@ -83,6 +105,56 @@ class TattlerServer(http.server.BaseHTTPRequestHandler):
         vectors = sorted(tman.available_vectors(event))
         return self.send(200, json.dumps(vectors))
 
+    def get_attachment_store(self):
+        """Return the attachment store and the digest addressed by the request, or None after replying with an error."""
+        reqparts = attachment_req_re.fullmatch(self.path)
+        if reqparts is None:
+            self.send_error(404, "Unknown path requested")
+            return None
+        store = attachment_store.get_store()
+        if store is None:
+            self.send_error(501, "Attachment store not enabled. Set TATTLER_ATTACHMENT_STORE to do so.")
+            return None
+        return store, reqparts.group('digest')
+
+    def do_HEAD(self):
+        """Handler for HEAD requests, telling whether an attachment is held in the store"""
+        log.info("%s", self.requestline)
+        found = self.get_attachment_store()
+        if found is None:
+            return
+        store, digest = found
+        if digest not in store:
+            return self.send_error(404, "Attachment not found")
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        """Handler for PUT requests, uploading an attachment to the store"""
+        log.info("%s", self.requestline)
+        found = self.get_attachment_store()
+        if found is None:
+            return
+        store, digest = found
+        try:
+            blen = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            blen = -1
+        if blen < 0:
+            return self.send_error(400, "Missing or invalid Content-Length")
+        # refuse before reading, to keep oversized uploads out of memory
+        max_bytes = get_attachment_max_bytes()
+        if blen > max_bytes:
+            return self.send_error(413, f"Attachment exceeds {max_bytes} bytes")
+        try:
+            created = store.put(digest, self.rfile.read(blen))
+        except ValueError as err:
+            return self.send_error(400, str(err))
+        self.send_response(201 if created else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
     def do_POST(self):
         """Handler for POST requests"""
         log.info("%s", self.requestline)
@@ -111,5 +111,5 @@ def get_scopes(base_path: Path) -> Iterable[str]:
     base_path = Path(base_path)
     if base_path.is_dir():
         all_dirnames = {p.name for p in base_path.iterdir() if p.is_dir()}
-        return sorted(set(all_dirnames) - {'_base'})
+        return sorted(set(all_dirnames) - {'_base', '_partials'})
     return set()
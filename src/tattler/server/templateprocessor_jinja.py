@@ -1,21 +1,169 @@
 """Template processor for Jinja format."""
 
+import hashlib
 import logging
 import os
+import threading
+import time
 from datetime import datetime, date, timedelta
-from typing import Optional, Mapping, Any
+from functools import lru_cache
+from typing import Optional, Mapping, Any, Iterable, AbstractSet, Tuple, List, Callable
 
-from jinja2 import Environment
+from jinja2 import meta, nodes
 from jinja2.environment import Template
-from jinja2.loaders import BaseLoader
+from jinja2.exceptions import TemplateNotFound
+from jinja2.loaders import BaseLoader, FileSystemLoader
+from jinja2.sandbox import SandboxedEnvironment
 
 import humanize
 
 from tattler.server.sendable import TemplateProcessor
+from tattler.server import metrics
 
 logging.basicConfig(level=os.getenv('LOG_LEVEL', 'info').upper())
 log = logging.getLogger(__name__)
 
+# abort expansion of a template after this many seconds
+_default_render_timeout_s = 10
+# abort expansion of a template whose output exceeds this many characters
+_default_render_max_size = 2 * 1024 * 1024
+# log a warning for templates whose expansion takes longer than this fraction of the timeout
+_slow_render_ratio = 0.5
+
+# deadline of the expansion in progress, per thread
+_render_budget = threading.local()
+
+# map partials search paths to the environment loading partials from them
+_environments = {}
+_environments_lock = threading.Lock()
+
+# map (partials search paths, content, base content) to the analysis of the template, and whether its partials are unchanged
+_analyses = {}
+_analyses_lock = threading.Lock()
+_analyses_max_entries = 1024
+
+
+def getenv(name, default=None):
+    """getenv wrapper for mocking in testing"""
+    return os.getenv(name, default)
+
+
+class TemplateLimitExceeded(ValueError):
+    """Raised when expanding a template exceeds its time or size budget."""
+
+
+def _check_render_deadline() -> None:
+    """Raise TemplateLimitExceeded if the expansion running in the current thread ran out of time."""
+    deadline = getattr(_render_budget, 'deadline', None)
+    if deadline is not None and time.monotonic() > deadline:
+        raise TemplateLimitExceeded(f"Expanding template '{_render_budget.template_name}' exceeded time budget of {_render_budget.timeout}s.")
+
+
+class BudgetedEnvironment(SandboxedEnvironment):
+    """Sandboxed Jinja environment which also checks the render deadline on every attribute access and call.
+
+    This catches runaway loops which produce little or no output, and would therefore
+    not be interrupted by the output-driven checks in :meth:`JinjaTemplateProcessor.expand`.
+    """
+
+    def getattr(self, obj, attribute):
+        _check_render_deadline()
+        return super().getattr(obj, attribute)
+
+    def getitem(self, obj, argument):
+        _check_render_deadline()
+        return super().getitem(obj, argument)
+
+    def call(__self, __context, __obj, *args, **kwargs):  # pylint: disable=no-self-argument
+        _check_render_deadline()
+        return super().call(__context, __obj, *args, **kwargs)
+
+
+def get_environment(partials_paths: Optional[Iterable[os.PathLike]]=None) -> BudgetedEnvironment:
+    """Return the process-wide sandboxed environment to compile templates with.
+
+    One environment is kept for each set of partials directories. Its loader resolves
+    ``{% include %}``, ``{% import %}`` and ``{% from %}`` against those directories, in order,
+    and the environment caches partials once compiled, recompiling them only if their file changes.
+
+    :param partials_paths:  Directories to look up partials from, in order of precedence; None or empty for no partials.
+
+    :return:                Environment to compile templates with.
+    """
+    key = tuple(str(p) for p in (partials_paths or []))
+    with _environments_lock:
+        if key not in _environments:
+            loader = FileSystemLoader(list(key)) if key else BaseLoader()
+            env = BudgetedEnvironment(loader=loader)
+            env.filters["humanize"] = humanize_jinja
+            _environments[key] = env
+            log.debug("Created template environment for partials in %s", key)
+        return _environments[key]
+
+
+@lru_cache(maxsize=1024)
+def compile_template(partials_paths: Tuple[str, ...], source: str) -> Template:
+    """Return a template compiled from source, caching it process-wide.
+
+    :param partials_paths:  Directories to look up partials from, see :func:`get_environment`.
+    :param source:          Source code of the template.
+
+    :return:                The compiled template.
+    """
+    return get_environment(partials_paths).from_string(source)
+
+
+@lru_cache(maxsize=4096)
+def analyze_template(source: str) -> Tuple[AbstractSet[str], Optional[AbstractSet[str]]]:
+    """Return the variables a template source reads, and the partials it references.
+
+    The analysis is cached by source, so every template is only parsed once per process.
+
+    :param source:  Source code of the template.
+
+    :return:        Pair (variables, partials) with the names of undeclared variables used in the template,
+                    and the names of partials it includes or imports -- or None in place of partials if the
+                    template references templates dynamically, i.e. by variable. The ``base_template``
+                    variable used by ``{% extends base_template %}`` is not counted as dynamic reference.
+    """
+    ast = get_environment().parse(source)
+    variables = frozenset(meta.find_undeclared_variables(ast))
+    partials = set()
+    for node in ast.find_all((nodes.Extends, nodes.FromImport, nodes.Import, nodes.Include)):
+        ref = node.template
+        if isinstance(ref, nodes.Const) and isinstance(ref.value, str):
+            partials.add(ref.value)
+        elif isinstance(ref, (nodes.Tuple, nodes.List)) and all(isinstance(x, nodes.Const) and isinstance(x.value, str) for x in ref.items):
+            partials |= {x.value for x in ref.items}
+        elif isinstance(node, nodes.Extends) and isinstance(ref, nodes.Name) and ref.name == 'base_template':
+            continue
+        else:
+            return variables, None
+    return variables, frozenset(partials)
+
+
+def _get_positive_setting(name: str, default: float, cast: type) -> float:
+    """Return a positive numeric setting from the environment, or default if unset or invalid."""
+    val = getenv(name)
+    if val is None:
+        return default
+    try:
+        val = cast(val)
+        if val <= 0:
+            raise ValueError
+    except ValueError:
+        log.warning("Invalid value given for %s='%s'. Set it to a positive number. Falling back to default %s", name, getenv(name), default)
+        return default
+    return val
+
+def get_render_timeout() -> float:
+    """Return the maximum number of seconds that expanding a template may take."""
+    return _get_positive_setting('TATTLER_TEMPLATE_RENDER_TIMEOUT', _default_render_timeout_s, float)
+
+def get_render_max_size() -> int:
+    """Return the maximum number of characters that expanding a template may produce."""
+    return _get_positive_setting('TATTLER_TEMPLATE_MAX_SIZE', _default_render_max_size, int)
+
 class JinjaTemplateProcessor(TemplateProcessor):
     """A template processor for the Jinja2 template language.
     
@@ -25,7 +173,14 @@ class JinjaTemplateProcessor(TemplateProcessor):
 
     See http://jinja.palletsprojects.com/ for details on the language.
 
-    This processor supports "base templates".
+    This processor supports "base templates", and partials: templates in the ``_partials``
+    directory of the scope (or of the template base) may be used via ``{% include %}``,
+    ``{% import %}`` and ``{% from ... import %}``, and are compiled once per process.
+
+    Templates are expanded in a sandbox, and expansion fails with :class:`TemplateLimitExceeded`
+    if it takes longer than ``TATTLER_TEMPLATE_RENDER_TIMEOUT`` seconds or produces more than
+    ``TATTLER_TEMPLATE_MAX_SIZE`` characters. The duration of every expansion is recorded
+    in :mod:`tattler.server.metrics` under ``template_render_seconds``.
     """
 
     def expand(self, context: Optional[Mapping[str, Any]]=None, **kwargs) -> str:
@@ -36,22 +191,117 @@ class JinjaTemplateProcessor(TemplateProcessor):
         :return: Expanded content for sending.
         :rtype: str
         :raises TypeError: if the template could not be expanded.
+        :raises TemplateLimitExceeded: if expansion exceeded its time or size budget.
         """
         context = context or {}
         base_content = kwargs.get('base_content', None) or self.base_content
+        template_name = self.kwargs.get('template_name', '<string>')
+        partials_key = tuple(str(p) for p in (self.kwargs.get('partials_paths', None) or []))
         full_context = {}
         if 'base_template' in context:
             log.warning("Omitting base template logic because 'base_template' var already provided in context.")
         elif base_content is not None:
-            full_context['base_template'] = Template(base_content)
+            full_context['base_template'] = compile_template(partials_key, base_content)
             log.debug("Base template = '%s'...", base_content[:100])
         full_context.update(context)
         full_context = {vname:convert_to_python(vname, vval) for vname, vval in full_context.items()}
-        log.debug("Expanding template with context keys = '%s'", sorted(context.keys()))
-        e = Environment(loader=BaseLoader())
-        e.filters["humanize"] = humanize_jinja
-        t = e.from_string(self.content)
-        return t.render(full_context)
+        log.debug("Expanding template '%s' with context keys = '%s'", template_name, sorted(context.keys()))
+        t = compile_template(partials_key, self.content)
+        timeout, max_size = get_render_timeout(), get_render_max_size()
+        t0 = time.monotonic()
+        _render_budget.deadline = t0 + timeout
+        _render_budget.timeout = timeout
+        _render_budget.template_name = template_name
+        try:
+            chunks = []
+            size = 0
+            for chunk in t.generate(full_context):
+                size += len(chunk)
+                if size > max_size:
+                    raise TemplateLimitExceeded(f"Expanding template '{template_name}' exceeded maximum size of {max_size} characters.")
+                _check_render_deadline()
+                chunks.append(chunk)
+        finally:
+            _render_budget.deadline = None
+            duration = time.monotonic() - t0
+            metrics.observe('template_render_seconds', duration, template=template_name)
+            if duration > timeout * _slow_render_ratio:
+                log.warning("Slow template: expanding '%s' took %.3fs (timeout is %ss).", template_name, duration, timeout)
+        return ''.join(chunks)
+
+    def _analyze(self) -> Tuple[Optional[AbstractSet[str]], Mapping[str, str]]:
+        """Return the variables read by the template, and the sources of the partials it uses, recursively.
+
+        The analysis is computed once per processor, and shared across processors of the same template
+        for as long as none of the partials it uses changes on disk.
+
+        :return:    Pair (variables, partials) with the set of variable names (or None if the template references
+                    partials dynamically), and a map of the names of partials found to their source.
+        """
+        analysis = getattr(self, '_analysis', None)
+        if analysis is not None:
+            return analysis
+        partials_key = tuple(str(p) for p in (self.kwargs.get('partials_paths', None) or []))
+        key = (partials_key, self.content, self.base_content)
+        with _analyses_lock:
+            cached = _analyses.get(key)
+        if cached is not None and all(uptodate() for uptodate in cached[1]):
+            self._analysis = cached[0]
+            return self._analysis
+        analysis, uptodates = self._do_analyze(partials_key)
+        if uptodates is not None:
+            with _analyses_lock:
+                if len(_analyses) >= _analyses_max_entries:
+                    _analyses.pop(next(iter(_analyses)))
+                _analyses[key] = (analysis, uptodates)
+        self._analysis = analysis
+        return analysis
+
+    def _do_analyze(self, partials_key: Tuple[str, ...]) -> Tuple[Tuple[Optional[AbstractSet[str]], Mapping[str, str]], Optional[List[Callable[[], bool]]]]:
+        """Analyze the template, reading the partials it uses.
+
+        :return:    Pair (analysis, uptodates) with the analysis as returned by :meth:`_analyze`, and the list of
+                    functions telling whether each partial read is unchanged -- or None if some partial was not
+                    found, and the analysis may therefore change without notice.
+        """
+        env = get_environment(partials_key)
+        variables = set()
+        pending = [self.content] + ([self.base_content] if self.base_content is not None else [])
+        partial_sources = {}
+        uptodates = []
+        while pending:
+            tvars, partials = analyze_template(pending.pop())
+            if partials is None:
+                return (None, partial_sources), uptodates
+            variables |= tvars
+            for pname in partials - partial_sources.keys():
+                try:
+                    partial_sources[pname], _, uptodate = env.loader.get_source(env, pname)
+                    pending.append(partial_sources[pname])
+                    if uptodates is not None:
+                        uptodates.append(uptodate or (lambda: True))
+                except TemplateNotFound:
+                    partial_sources[pname] = ''
+                    uptodates = None
+                    log.debug("Partial '%s' not found while analyzing '%s'. Ignoring.", pname, self.kwargs.get('template_name', '<string>'))
+        variables.discard('base_template')
+        return (frozenset(variables), partial_sources), uptodates
+
+    def variables(self) -> Optional[AbstractSet[str]]:
+        """Return the names of the context variables which the template may read during expansion.
+
+        This includes the variables read by the base template and by any partial used, recursively.
+
+        :return:    Set of variable names the template reads, or None if the template references partials dynamically.
+        """
+        return self._analyze()[0]
+
+    def fingerprint(self) -> str:
+        """Return a digest identifying the version of the template, its base template and the partials it uses."""
+        digest = hashlib.sha256(super().fingerprint().encode())
+        for pname, psource in sorted(self._analyze()[1].items()):
+            digest.update(f'\0{pname}\0{psource}'.encode('utf-8'))
+        return digest.hexdigest()
 
 def humanize_jinja(value, format=None):
     if format is not None:
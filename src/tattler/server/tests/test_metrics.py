@@ -0,0 +1,42 @@
+"""Tests for metrics registry"""
+
+import unittest
+
+from tattler.server import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_counters_accumulate_by_labels(self):
+        """Counters accumulate separately for each combination of labels"""
+        metrics.incr('hits')
+        metrics.incr('hits', 2)
+        metrics.incr('hits', vector='sms', scope='s')
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['hits'], 3)
+        self.assertEqual(counters['hits{scope=s,vector=sms}'], 1)
+
+    def test_gauges_keep_last_value(self):
+        """Gauges report the last value set"""
+        metrics.set_gauge('limit', 4)
+        metrics.set_gauge('limit', 2)
+        self.assertEqual(metrics.snapshot()['gauges'], {'limit': 2})
+
+    def test_timings_aggregate(self):
+        """Timings report count, total, average, max and last observation"""
+        for val in [1.0, 3.0, 2.0]:
+            metrics.observe('duration', val, template='x')
+        stats = metrics.snapshot()['timings']['duration{template=x}']
+        self.assertEqual(stats, {'count': 3, 'total': 6.0, 'avg': 2.0, 'max': 3.0, 'last': 2.0})
+
+    def test_reset(self):
+        """reset() discards all metrics"""
+        metrics.incr('hits')
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'gauges': {}, 'timings': {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -159,6 +159,22 @@ class PluginLoaderTest(unittest.TestCase):
                     m.process.assert_not_called()
             self.assertEqual(4, len(have_ctx))
 
+    def test_process_context_skips_plugins_providing_unused_variables(self):
+        """Context plugins declaring provided variables are skipped if templates use none of them"""
+        class BillingPlugin(pluginloader.ContextPlugin):
+            provided_variables = {'billing_history', 'billing_balance'}
+            def process(self, context):
+                return context | {'billing_history': [1, 2]}
+        class UndeclaredPlugin(pluginloader.ContextPlugin):
+            def process(self, context):
+                return context | {'other': 1}
+        plugs = {'context': {'BillingPlugin': BillingPlugin(), 'UndeclaredPlugin': UndeclaredPlugin()}}
+        with mock.patch('tattler.server.pluginloader.loaded_plugins', plugs):
+            self.assertEqual({'a': 1, 'other': 1}, pluginloader.process_context({'a': 1}, {'a', 'user_firstname'}))
+            self.assertEqual({'a': 1, 'other': 1, 'billing_history': [1, 2]}, pluginloader.process_context({'a': 1}, {'billing_history'}))
+            # unknown variables -> run all
+            self.assertEqual({'a': 1, 'other': 1, 'billing_history': [1, 2]}, pluginloader.process_context({'a': 1}))
+
     def test_process_context_tolerates_failing_plugins(self):
         """Context plugins that raise exception do not prevent subsequent plugins from running"""
         with mock.patch('tattler.server.pluginloader.loaded_plugins') as mplugs:
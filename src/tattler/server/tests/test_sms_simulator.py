@@ -0,0 +1,69 @@
+"""Test cases for tattler_sms_simulator"""
+
+import os
+import threading
+import unittest
+import urllib.error
+from unittest import mock
+
+from tattler.server import tattler_sms_simulator
+from tattler.server.sendable import sms_client
+from tattler.server.sendable.vector_sms import SMSSendable
+
+
+class SMSSimulatorTest(unittest.TestCase):
+    """Test cases for the simulated BulkSMS API"""
+    def start(self, *args):
+        srv = tattler_sms_simulator.make_simulator(tattler_sms_simulator.parse_args(['--listen', '127.0.0.1:0', '--seed', '1', *args]))
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        self.addCleanup(srv.server_close)
+        self.addCleanup(srv.shutdown)
+        url = f'http://127.0.0.1:{srv.server_address[1]}/v1'
+        client = sms_client.PooledBulkSMS(token_id='id', token_secret='secret', api_base=url)
+        self.addCleanup(client.pool.close)
+        return srv, url, client
+
+    def test_send_and_status(self):
+        """Messages submitted are reported delivered or failed after the delivery delay"""
+        srv, _, client = self.start('--failure-rate', '0.5', '--delivery-delay', '3600')
+        ids = client.send(['+4111', '+4122', '+4133', '+4144'], 'hello', sender='+4199')
+        self.assertEqual(4, len(set(ids)))
+        self.assertEqual({'ACCEPTED'}, {client.msg_delivery_status(i) for i in ids})
+        srv.settings.delivery_delay_s = 0
+        self.assertEqual({'DELIVERED', 'FAILED'}, {client.msg_delivery_status(i) for i in ids})
+        self.assertEqual(1, srv.stats.submissions)
+        self.assertEqual(4, srv.stats.messages)
+        self.assertEqual(1, srv.stats.connections)
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            client.msg_delivery_status('nonexistent')
+        self.assertEqual(404, err.exception.code)
+
+    def test_faults(self):
+        """Errors and rate limits are injected as configured"""
+        srv, _, client = self.start('--error-rate', '1')
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            client.send('+4111', 'hello')
+        self.assertEqual(503, err.exception.code)
+        srv.settings.error_rate = 0
+        srv.bucket = tattler_sms_simulator.TokenBucket(0.001, 1)
+        client.send('+4111', 'hello')
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            client.send('+4111', 'hello')
+        self.assertEqual(429, err.exception.code)
+        self.assertEqual((3, 1, 1), (srv.stats.requests, srv.stats.errors, srv.stats.rate_limited))
+
+    def test_sendable(self):
+        """SMSSendable delivers to the API at TATTLER_BULKSMS_URL"""
+        srv, url, _ = self.start()
+        env = {'TATTLER_BULKSMS_TOKEN': 'id:secret', 'TATTLER_BULKSMS_URL': url, 'TATTLER_SMS_REPORT_INTERVAL': '0'}
+        with mock.patch('tattler.server.sendable.vector_sms.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: env.get(k, os.getenv(k, v))
+            with mock.patch('tattler.server.sendable.vector_sms.vector_sendable.Sendable.content') as mcontent:
+                mcontent.return_value = 'Your code is 1234'
+                SMSSendable('event', ['+123456789', '+16548351']).send()
+        self.assertEqual(2, srv.stats.messages)
+        self.assertEqual({'Your code is 1234'}, {msg.body for msg in srv.messages.values()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Test cases for tattler_smtp_sink"""
+
+import os
+import shutil
+import smtplib
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server import tattler_smtp_sink
+from tattler.server.sendable.vector_email import EmailSendable
+
+tbase_path = Path(__file__).parent.parent / 'sendable' / 'tests' / 'fixtures' / 'templates_with_base'
+
+
+class SMTPSinkTest(unittest.TestCase):
+    """Test cases for the SMTP sink"""
+    def start(self, *args):
+        sink = tattler_smtp_sink.make_sink(tattler_smtp_sink.parse_args(['--listen', '127.0.0.1:0', '--seed', '1', *args]))
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+        self.addCleanup(sink.server_close)
+        self.addCleanup(sink.shutdown)
+        return sink
+
+    def connect(self, sink):
+        smtp = smtplib.SMTP('127.0.0.1', sink.server_address[1], timeout=5)
+        self.addCleanup(smtp.close)
+        return smtp
+
+    def test_store(self):
+        """Messages are counted, unstuffed, and stored with their envelope"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sink = self.start('--store', tmpdir)
+            smtp = self.connect(sink)
+            self.assertEqual({}, smtp.sendmail('from@test.com', ['to1@test.com', 'to2@test.com'], 'Subject: hi\r\n\r\n.dot\r\n'))
+            smtp.quit()
+            stored = list(Path(tmpdir).iterdir())
+            self.assertEqual(1, len(stored))
+            self.assertEqual(b'X-Sink-Mail-From: from@test.com\r\nX-Sink-Rcpt-To: to1@test.com\r\nX-Sink-Rcpt-To: to2@test.com\r\n'
+                             b'Subject: hi\r\n\r\n.dot\r\n', stored[0].read_bytes())
+        self.assertEqual((1, 1, 2), (sink.stats.connections, sink.stats.messages, sink.stats.recipients))
+        self.assertGreater(sink.stats.bytes_received, sink.stats.message_bytes)
+
+    def test_email_sendable(self):
+        """EmailSendable delivers to the sink, with BDAT when advertised"""
+        sink = self.start()
+        env = {'TATTLER_SMTP_ADDRESS': f'127.0.0.1:{sink.server_address[1]}'}
+        with mock.patch('tattler.server.sendable.vector_email.vector_sendable.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: env.get(k, os.getenv(k, v))
+            for extensions in ['CHUNKING,8BITMIME,SMTPUTF8', '']:
+                sink.settings.extensions = extensions.split(',') if extensions else []
+                EmailSendable('event1', ['foo@bar.com'], template_base=tbase_path).send()
+        self.assertEqual(2, sink.stats.messages)
+
+    def test_faults(self):
+        """Recipients are refused, and connections dropped, at the configured rates"""
+        sink = self.start('--permfail-rate', '1')
+        smtp = self.connect(sink)
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as err:
+            smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        self.assertEqual(550, err.exception.recipients['to@test.com'][0])
+        sink.settings.permfail_rate, sink.settings.tempfail_rate = 0, 1
+        with self.assertRaises(smtplib.SMTPRecipientsRefused) as err:
+            smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        self.assertEqual(451, err.exception.recipients['to@test.com'][0])
+        sink.settings.tempfail_rate, sink.settings.disconnect_rate = 0, 1
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        self.assertEqual((1, 1, 1, 0), (sink.stats.permfails, sink.stats.tempfails, sink.stats.disconnects, sink.stats.messages))
+
+    def test_auth(self):
+        """Sessions must authenticate with the configured credentials"""
+        sink = self.start('--auth', 'user:secret')
+        smtp = self.connect(sink)
+        with self.assertRaises(smtplib.SMTPSenderRefused):
+            smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        with self.assertRaises(smtplib.SMTPAuthenticationError):
+            smtp.login('user', 'wrong')
+        smtp.login('user', 'secret')
+        smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        smtp = self.connect(sink)
+        smtp.ehlo()
+        smtp.user, smtp.password = 'user', 'secret'
+        smtp.auth('LOGIN', smtp.auth_login, initial_response_ok=False)
+        smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        self.assertEqual(2, sink.stats.messages)
+
+    @unittest.skipUnless(shutil.which('openssl'), "openssl is required to generate a test certificate")
+    def test_starttls(self):
+        """Sessions upgrade to TLS with STARTTLS if a certificate is given"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cert, key = Path(tmpdir) / 'cert.pem', Path(tmpdir) / 'key.pem'
+            subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                            '-keyout', str(key), '-out', str(cert)], check=True, capture_output=True)
+            sink = self.start('--tls-cert', str(cert), '--tls-key', str(key))
+        smtp = self.connect(sink)
+        smtp.ehlo()
+        self.assertTrue(smtp.has_extn('starttls'))
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        smtp.starttls(context=context)
+        smtp.ehlo()
+        self.assertFalse(smtp.has_extn('starttls'))
+        smtp.sendmail('from@test.com', ['to@test.com'], 'Subject: hi\r\n\r\nhello\r\n')
+        smtp.quit()
+        self.assertEqual(1, sink.stats.messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+"""Test cases for tattler_spool_flush"""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tattler.server import tattler_spool_flush
+
+
+class SpoolFlushTest(unittest.TestCase):
+    """Test cases for the spool flush worker"""
+    def test_parse_args(self):
+        """The spool directory defaults to TATTLER_SMTP_SPOOL, and is required"""
+        args = tattler_spool_flush.parse_args(['/tmp/spool', '--once', '--concurrency', '2'])
+        self.assertEqual(('/tmp/spool', True, 2), (args.spool_dir, args.once, args.concurrency))
+        with mock.patch('tattler.server.tattler_spool_flush.getenv') as mgetenv:
+            mgetenv.return_value = None
+            with self.assertRaises(SystemExit):
+                with mock.patch('sys.stderr'):
+                    tattler_spool_flush.parse_args([])
+
+    def test_main_once(self):
+        """With --once, main delivers the spooled emails due and exits"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            spool = Path(tmpdir) / 'spool'
+            with mock.patch('tattler.server.tattler_spool_flush.get_cmdline_args') as margs:
+                margs.return_value = [str(spool), '--once']
+                with mock.patch('tattler.server.tattler_spool_flush.smtp_spool.flush') as mflush:
+                    mflush.return_value = 3
+                    self.assertEqual(0, tattler_spool_flush.main())
+            mflush.assert_called_once()
+            self.assertEqual(str(spool), mflush.call_args.args[0])
+            self.assertTrue((spool / 'new').is_dir())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import unittest
 import os
+import tempfile
 from unittest import mock
 from pathlib import Path
 try:
@@ -209,6 +210,19 @@ class TestTattlerUtils(unittest.TestCase):
                     self.assertEqual({1}, {x['resultCode'] for x in res}, msg=f"Expected all resultCode = 1, but got {[x['resultCode'] for x in res]}")
                     self.assertEqual({"connection reset"}, {x['detail'] for x in res}, msg=f"Expected error detail to contain '{errmsg}', but got {[x['detail'] for x in res]}")
 
+    def test_send_pending_reported(self):
+        """send_notification_user_vectors reports vectors whose delivery was deferred as pending, not as failed"""
+        with mock.patch('tattler.server.tattler_utils.getenv') as mgetenv:
+            mgetenv.side_effect = lambda x, y=None: { 'TATTLER_TEMPLATE_BASE': get_template_dir() }.get(x, os.getenv(x, y))
+            with mock.patch('tattler.server.tattler_utils.pluginloader.lookup_contacts') as maddrb:
+                maddrb.return_value = data_contacts['123']
+                with mock.patch('tattler.server.tattler_utils.sendable.send_notification') as msend:
+                    msend.return_value.pending_recipients.side_effect = lambda: [data_contacts['123'][msend.call_args.args[0]]]
+                    res = tattler_utils.send_notification_user_vectors('123', None, 'jinja', 'jinja_email_and_sms')
+                    self.assertEqual({'pending'}, {x['result'] for x in res})
+                    self.assertEqual({0}, {x['resultCode'] for x in res})
+                    self.assertEqual({"Delivery deferred for foo@bar.com", "Delivery deferred for 998877"}, {x['detail'] for x in res})
+
     def test_send_notification_user_vectors_does_not_deliver_to_blacklisted_addresses(self):
         with mock.patch('tattler.server.tattler_utils.pluginloader.lookup_contacts') as maddrb:
                 with mock.patch('tattler.server.tattler_utils.sendable.vector_email.EmailSendable.do_send') as msend:
@@ -347,6 +361,23 @@ class TestTattlerUtils(unittest.TestCase):
                         received_ctx = mproc.call_args[0][0]
                         self.assertEqual(ctx, {k:v for k, v in received_ctx.items() if k in ctx})
 
+    def test_template_variables_cached_until_template_changes(self):
+        """get_template_variables() analyzes templates once, and again only after any of their files changes"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        template_base = Path(tmpdir.name) / 'scope'
+        body = template_base / 'jinja_event' / 'sms' / 'body.txt'
+        body.parent.mkdir(parents=True)
+        body.write_text('Hi {{ foo }}')
+        with mock.patch('tattler.server.tattler_utils.sendable.make_notification', wraps=tattler_utils.sendable.make_notification) as mmake:
+            for _ in range(3):
+                self.assertEqual({'foo'}, tattler_utils.get_template_variables(template_base, 'jinja_event', 'sms'))
+            self.assertEqual(1, mmake.call_count)
+            body.write_text('Hi {{ bar }}')
+            os.utime(body, ns=(body.stat().st_atime_ns, body.stat().st_mtime_ns + 10**9))
+            self.assertEqual({'bar'}, tattler_utils.get_template_variables(template_base, 'jinja_event', 'sms'))
+            self.assertEqual(2, mmake.call_count)
+
     def test_name_phony(self):
         suff = '@d.org'
         for un in ('info', 'mail', 'noc', 'webmaster', 'root', 'hostmaster', 'sysadmin', 'postmaster', 'dns', 'ns', 'abuse', 'admin', 'hello', 'hi', 'it'):
@@ -1,8 +1,11 @@
 """Tests for tattler HTTP server"""
 
 import os
+import hashlib
+import http.client
 import logging
 import json
+import tempfile
 import unittest
 import unittest.mock
 from datetime import datetime, timedelta
@@ -16,6 +19,7 @@ from typing import Mapping, Optional
 
 from tattler.utils.serialization import serialize_json
 from tattler.server import tattlersrv_http
+from tattler.server import metrics
 
 data_contacts = {
     '123': {
@@ -37,6 +41,7 @@ class TattlerHttpServerTest(unittest.TestCase):
     def setUp(self):
         self.connstr = f'127.0.0.1:{self.port}'
         self.templatesdir = Path(__file__).parent / 'fixtures' / 'templates_dir'
+        self.capture_templatesdir = Path(__file__).parent / 'fixtures' / 'templates_dir_capture'
         self.base_env = {
                 'TATTLER_LISTEN_ADDRESS': self.connstr,
                 'TATTLER_TEMPLATE_BASE': self.templatesdir,
@@ -121,6 +126,15 @@ class TattlerHttpServerTest(unittest.TestCase):
                     res = json.loads(f.read().strip())
                     self.assertEqual(set(res), {'jinja', 'testcontext'})
 
+    def test_metrics(self):
+        metrics.incr('test_counter', label='x')
+        url = self.mkreq('/metrics/')
+        with urlopen(url) as f:
+            self.assertEqual(f.status, 200)
+            res = json.loads(f.read().strip())
+            self.assertEqual({'counters', 'gauges', 'timings'}, set(res))
+            self.assertEqual(1, res['counters']['test_counter{label=x}'])
+
     def test_list_events(self):
         url = self.mkreq('/notification/jinja/')
         with unittest.mock.patch('tattler.server.tattlersrv_http.getenv') as mgetenv:
@@ -261,9 +275,9 @@ class TattlerHttpServerTest(unittest.TestCase):
                             with urlopen(req) as f:
                                 self.assertEqual(f.status, 200)
                                 self.assertTrue(msend.mock_calls)
-                                call_vectors = {c.args[0] for c in msend.mock_calls}
+                                call_vectors = {c.args[0] for c in msend.call_args_list}
                                 self.assertEqual(call_vectors, envval)
-                                for mcall in msend.mock_calls:
+                                for mcall in msend.call_args_list:
                                     self.assertIn('mode', mcall.kwargs)
                                     self.assertEqual(mcall.kwargs['mode'], 'staging')
                                     # vector is not empty
@@ -283,7 +297,7 @@ class TattlerHttpServerTest(unittest.TestCase):
                         with urlopen(req) as f:
                             self.assertEqual(f.status, 200)
                             self.assertTrue(msend.mock_calls)
-                            for mcall in msend.mock_calls:
+                            for mcall in msend.call_args_list:
                                 vec_name = mcall.args[0]
                                 self.assertEqual(set(mcall.args[2]), {data_contacts['123'][vec_name]})
 
@@ -337,7 +351,7 @@ class TattlerHttpServerTest(unittest.TestCase):
                         mgetenv2.side_effect = mgetenv.side_effect
                         with urlopen(req):
                             msend.assert_called()
-                            for c in msend.mock_calls:
+                            for c in msend.call_args_list:
                                 if 'mode' in c.kwargs:
                                     self.assertEqual('debug', c.kwargs['mode'], msg=f"Tattler expected to limit mode=debug for TATTLER_MASTER_MODE, used {c.kwargs['mode']} instead.")
                                 else:
@@ -359,6 +373,95 @@ class TattlerHttpServerTest(unittest.TestCase):
                         self.assertIn('vector', res[0])
                         self.assertEqual(res[0]['vector'], 'email')
 
+    def test_capture(self):
+        """Notifications run the full pipeline and are served at /capture/ when captured in memory"""
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            urlopen(self.mkreq('/capture/'))
+        self.assertEqual(404, err.exception.code)
+        req = self.mkreq('/notification/capture/capture_email_and_sms/?user=123', method='POST')
+        with unittest.mock.patch('tattler.server.tattlersrv_http.tattler_utils.pluginloader.lookup_contacts') as mcontacts:
+            with unittest.mock.patch('tattler.server.tattlersrv_http.getenv') as mgetenv:
+                with unittest.mock.patch('tattler.server.tattler_utils.getenv') as mgetenv2:
+                    with unittest.mock.patch.dict(os.environ, {'TATTLER_CAPTURE': 'memory'}):
+                        with unittest.mock.patch('tattler.server.sendable.vector_email.smtplib.SMTP') as msmtp:
+                            mgetenv.side_effect = getenv_pseudo(self.base_env, {'TATTLER_TEMPLATE_BASE': self.capture_templatesdir})
+                            mgetenv2.side_effect = mgetenv.side_effect
+                            mcontacts.return_value = {'email': 'one@two.three', 'sms': '+41998877'}
+                            with urlopen(req) as f:
+                                res = json.loads(f.read())
+                            self.assertEqual({('email', 0), ('sms', 0)}, {(job['vector'], job['resultCode']) for job in res})
+                            msmtp.assert_not_called()
+                            with urlopen(self.mkreq('/capture/')) as f:
+                                captured = json.loads(f.read())
+        captured = {msg['vector']: msg for msg in captured[-2:]}
+        self.assertEqual(['+41998877'], captured['sms']['recipients'])
+        self.assertEqual('Hello!', captured['sms']['payload'])
+        self.assertEqual(['one@two.three'], captured['email']['recipients'])
+        self.assertIn('To: one@two.three', captured['email']['payload'])
+
+    def test_attachment_store(self):
+        """Attachments uploaded to /attachments/<sha256> are referenced by notifications"""
+        content = b'%PDF-1.4 terms and conditions'
+        digest = hashlib.sha256(content).hexdigest()
+        path = f'/attachments/{digest}'
+        with self.assertRaises(urllib.error.HTTPError) as err:
+            urlopen(self.mkreq(path, method='HEAD'))
+        self.assertEqual(501, err.exception.code)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with unittest.mock.patch.dict(os.environ, {'TATTLER_ATTACHMENT_STORE': tmpdir, 'TATTLER_CAPTURE': 'memory'}):
+                with self.assertRaises(urllib.error.HTTPError) as err:
+                    urlopen(self.mkreq(path, method='HEAD'))
+                self.assertEqual(404, err.exception.code)
+                with self.assertRaises(urllib.error.HTTPError) as err:
+                    urlopen(Request(f'http://{self.connstr}{path}', data=b'forged', method='PUT'))
+                self.assertEqual(400, err.exception.code)
+                statuses = []
+                for _ in range(2):
+                    with urlopen(Request(f'http://{self.connstr}{path}', data=content, method='PUT')) as resp:
+                        statuses.append(resp.status)
+                self.assertEqual([201, 200], statuses)
+                with urlopen(self.mkreq(path, method='HEAD')) as resp:
+                    self.assertEqual(200, resp.status)
+                body = json.dumps({'_attachments': {'terms.pdf': {'ref': digest}}}).encode()
+                req = self.mkreq('/notification/capture/capture_email_and_sms/?user=123&vector=email', data=body, method='POST')
+                with unittest.mock.patch('tattler.server.tattlersrv_http.tattler_utils.pluginloader.lookup_contacts') as mcontacts:
+                    with unittest.mock.patch('tattler.server.tattlersrv_http.getenv') as mgetenv:
+                        with unittest.mock.patch('tattler.server.tattler_utils.getenv') as mgetenv2:
+                            mgetenv.side_effect = getenv_pseudo(self.base_env, {'TATTLER_TEMPLATE_BASE': self.capture_templatesdir})
+                            mgetenv2.side_effect = mgetenv.side_effect
+                            mcontacts.return_value = {'email': 'one@two.three'}
+                            with urlopen(req) as f:
+                                res = json.loads(f.read())
+                            with urlopen(self.mkreq('/capture/')) as f:
+                                captured = json.loads(f.read())
+        self.assertEqual([('email', 0)], [(job['vector'], job['resultCode']) for job in res])
+        self.assertIn('filename="terms.pdf"', captured[-1]['payload'])
+
+    def put_attachment(self, path, body, length):
+        """PUT a body to the server with a given Content-Length header, and return the status of the response"""
+        conn = http.client.HTTPConnection(self.connstr)
+        try:
+            conn.putrequest('PUT', path)
+            if length is not None:
+                conn.putheader('Content-Length', length)
+            conn.endheaders(body)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_attachment_upload_limits(self):
+        """Uploads with a malformed Content-Length are refused with 400, and those above TATTLER_ATTACHMENT_STORE_MAX_FILE with 413"""
+        content = b'%PDF-1.4 terms and conditions'
+        path = f'/attachments/{hashlib.sha256(content).hexdigest()}'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with unittest.mock.patch.dict(os.environ, {'TATTLER_ATTACHMENT_STORE': tmpdir, 'TATTLER_ATTACHMENT_STORE_MAX_FILE': '10'}):
+                self.assertEqual(400, self.put_attachment(path, content, 'abc'))
+                self.assertEqual(400, self.put_attachment(path, content, '-1'))
+                self.assertEqual(400, self.put_attachment(path, None, None))
+                self.assertEqual(413, self.put_attachment(path, content, str(len(content))))
+                os.environ['TATTLER_ATTACHMENT_STORE_MAX_FILE'] = str(len(content))
+                self.assertEqual(201, self.put_attachment(path, content, str(len(content))))
+
     def test_send_vector_rejected_iff_inexistent(self):
         """Failure if requesting notification to a specific vector which is not supported by the event."""
         req = self.mkreq('/notification/jinja/jinja_humanize/?user=123&vector=email', method='POST')
@@ -28,6 +28,11 @@ class TemplateManagerTest(unittest.TestCase):
         self.assertNotIn('_base', have_scopes)
         self.assertEqual({'jinja', 'testcontext'}, set(have_scopes))
 
+    def test_available_scopes_omit_partials(self):
+        """get_scopes() does not list the _partials folder as a scope"""
+        have_scopes = get_scopes(Path(__file__).parent / 'fixtures' / 'templates_dir_partials')
+        self.assertEqual(['myscope'], have_scopes)
+
     def test_available_scopes_inexistent_dir(self):
         """get_scopes() for inexistent dir returns empty"""
         have_scopes = get_scopes(self.bad_templates_path)
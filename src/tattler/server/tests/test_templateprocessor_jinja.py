@@ -1,15 +1,22 @@
 import os
+import tempfile
 import unittest
+from unittest import mock
 from datetime import datetime, timedelta
 from pathlib import Path
 
-from tattler.server.sendable import EmailSendable
-from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor
+from jinja2.exceptions import SecurityError
+
+from tattler.server import metrics
+from tattler.server.sendable import EmailSendable, SMSSendable
+from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor, TemplateLimitExceeded, get_environment
 
 class JinjaTemplateProcessorTest(unittest.TestCase):
     def setUp(self) -> None:
         self.template_scopes_path = Path(__file__).parent / 'fixtures' / 'templates_dir'
         self.good_templates_path = self.template_scopes_path / 'jinja'
+        self.partials_scopes_path = Path(__file__).parent / 'fixtures' / 'templates_dir_partials'
+        self.partials_templates_path = self.partials_scopes_path / 'myscope'
 
     def test_expansion_with_base(self):
         # Plain
@@ -59,5 +66,113 @@ class JinjaTemplateProcessorTest(unittest.TestCase):
         self.assertIn('#12.3 billion', result)
         self.assertIn('2021', result)
 
+    def test_expansion_is_sandboxed(self):
+        """Templates cannot reach unsafe attributes of objects in their context"""
+        tpj = JinjaTemplateProcessor(content="{{ foo.__class__.__subclasses__() }}")
+        with self.assertRaises(SecurityError):
+            tpj.expand({'foo': 'bar'})
+
+    def test_expansion_exceeding_size_fails(self):
+        """Expansion fails if its output exceeds TATTLER_TEMPLATE_MAX_SIZE"""
+        tpj = JinjaTemplateProcessor(content="{% for i in range(100) %}0123456789{% endfor %}")
+        with mock.patch('tattler.server.templateprocessor_jinja.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_TEMPLATE_MAX_SIZE': '500'}.get(k, v)
+            with self.assertRaises(TemplateLimitExceeded) as cm:
+                tpj.expand({})
+            self.assertIn('500', str(cm.exception))
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_TEMPLATE_MAX_SIZE': '1000'}.get(k, v)
+            self.assertEqual(len(tpj.expand({})), 1000)
+
+    def test_expansion_exceeding_time_fails(self):
+        """Expansion fails if it takes longer than TATTLER_TEMPLATE_RENDER_TIMEOUT, even if it produces no output"""
+        tpj = JinjaTemplateProcessor(content="{% for i in range(100000) %}{% for j in items %}{% set x = j.real %}{% endfor %}{% endfor %}", template_name='scope/runaway/sms/body.txt')
+        with mock.patch('tattler.server.templateprocessor_jinja.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_TEMPLATE_RENDER_TIMEOUT': '0.2'}.get(k, v)
+            t0 = datetime.now()
+            with self.assertRaises(TemplateLimitExceeded) as cm:
+                tpj.expand({'items': list(range(1000))})
+            self.assertLess(datetime.now() - t0, timedelta(seconds=5))
+            self.assertIn('scope/runaway/sms/body.txt', str(cm.exception))
+
+    def test_invalid_limits_fall_back_to_default(self):
+        """Invalid settings for limits are ignored"""
+        tpj = JinjaTemplateProcessor(content="hello {{ name }}")
+        with mock.patch('tattler.server.templateprocessor_jinja.getenv') as mgetenv:
+            mgetenv.side_effect = lambda k, v=None: {'TATTLER_TEMPLATE_RENDER_TIMEOUT': '-1', 'TATTLER_TEMPLATE_MAX_SIZE': 'foo'}.get(k, v)
+            self.assertEqual(tpj.expand({'name': 'you'}), 'hello you')
+
+    def test_expansion_duration_recorded(self):
+        """The duration of every expansion is recorded by template name"""
+        metrics.reset()
+        es = EmailSendable('jinja_event', [], template_processor=JinjaTemplateProcessor, template_base=self.good_templates_path)
+        es._get_content_element('body.txt', {})
+        es._get_content_element('body.txt', {})
+        timings = metrics.snapshot()['timings']
+        self.assertEqual(timings['template_render_seconds{template=jinja/jinja_event/email/body.txt}']['count'], 2)
+
+    def test_partials_include_and_import(self):
+        """Templates can include and import partials from the scope's and the template base's _partials folders, scope first"""
+        ss = SMSSendable('event_with_partials', [], template_processor=JinjaTemplateProcessor, template_base=self.partials_templates_path)
+        content = ss.content({'user_firstname': 'Jim'})
+        self.assertIn('Hello Jim!', content)
+        self.assertIn('Footer of scope myscope', content)
+        self.assertNotIn('Shared footer', content)
+        self.assertIn('on behalf of the whole company', content)
+
+    def test_partials_compiled_once(self):
+        """Partials are compiled once and reused across expansions and sendables"""
+        partials_paths = [self.partials_templates_path / '_partials', self.partials_scopes_path / '_partials']
+        env = get_environment(partials_paths)
+        self.assertIs(env, get_environment([str(p) for p in partials_paths]))
+        for _ in range(3):
+            ss = SMSSendable('event_with_partials', [], template_processor=JinjaTemplateProcessor, template_base=self.partials_templates_path)
+            ss.content({'user_firstname': 'Jim'})
+        with mock.patch.object(env, '_parse', side_effect=AssertionError("partial recompiled")):
+            self.assertIsNotNone(env.get_template('footer.txt'))
+            self.assertIsNotNone(env.get_template('macros.txt'))
+
+    def test_missing_partial_fails(self):
+        """Including a partial that does not exist raises an error"""
+        tpj = JinjaTemplateProcessor(content="{% include 'nonexistent.txt' %}", partials_paths=[self.partials_templates_path / '_partials'])
+        with self.assertRaises(Exception):
+            tpj.expand({})
+
+    def test_variables_with_partials(self):
+        """variables() returns the variables read by the template and the partials it uses"""
+        ss = SMSSendable('event_with_partials', [], template_processor=JinjaTemplateProcessor, template_base=self.partials_templates_path)
+        self.assertEqual({'user_firstname'}, ss.template_variables())
+
+    def test_analysis_reads_partials_once(self):
+        """variables() and fingerprint() analyze the template once, and partials are re-read only after they change"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        partial = Path(tmpdir.name) / 'footer.txt'
+        partial.write_text('Bye {{ name }}')
+        env = get_environment([tmpdir.name])
+        content = "Hi {% include 'footer.txt' %}"
+        with mock.patch.object(env.loader, 'get_source', wraps=env.loader.get_source) as mget_source:
+            for _ in range(3):
+                tpj = JinjaTemplateProcessor(content=content, partials_paths=[tmpdir.name])
+                self.assertEqual({'name'}, tpj.variables())
+                fingerprint = tpj.fingerprint()
+            self.assertEqual(1, mget_source.call_count)
+            partial.write_text('Bye {{ surname }}')
+            os.utime(partial, (partial.stat().st_atime, partial.stat().st_mtime + 10))
+            tpj = JinjaTemplateProcessor(content=content, partials_paths=[tmpdir.name])
+            self.assertEqual({'surname'}, tpj.variables())
+            self.assertNotEqual(fingerprint, tpj.fingerprint())
+            self.assertEqual(2, mget_source.call_count)
+
+    def test_variables_with_base(self):
+        """variables() returns the variables read by the template and its base template, except base_template"""
+        tpj = JinjaTemplateProcessor(content="{% extends base_template %}{% block x %}{{ a }}{% for i in items %}{{ i }}{% endfor %}{% endblock %}",
+                                     base_content="{{ b.c }}{% block x %}{% endblock %}")
+        self.assertEqual({'a', 'b', 'items'}, tpj.variables())
+
+    def test_variables_unknown_with_dynamic_include(self):
+        """variables() returns None if the template includes partials by variable"""
+        tpj = JinjaTemplateProcessor(content="{% include partial_name %}{{ a }}")
+        self.assertIsNone(tpj.variables())
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,54 @@
+#! python
+
+"""Benchmark tattler's own notification pipeline, capturing notifications instead of delivering them.
+
+Sets TATTLER_CAPTURE=memory, then renders and builds the same email and SMS notifications many
+times from concurrent threads, so the throughput and latencies measured are those of tattler
+alone, regardless of relays and APIs.
+
+Usage: python benchmark_pipeline.py [notifications] [threads]
+"""
+
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tattler.server import sendable
+from tattler.server.sendable import capture
+
+template_base = Path(__file__).parent.parent / 'src' / 'tattler' / 'server' / 'sendable' / 'tests' / 'fixtures' / 'templates'
+
+
+def run(vector: str, recipient: str, notifications: int, threads: int) -> tuple:
+    """Send 'notifications' over a vector from 'threads' threads, and return (notifications per second, average latency, max latency)."""
+    def send_one(i):
+        t0 = time.perf_counter()
+        sendable.send_notification(vector, 'event_with_email_and_sms', [recipient], context={'one': str(i)}, template_base=template_base)
+        return time.perf_counter() - t0
+    send_one(0)
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as tpe:
+        latencies = list(tpe.map(send_one, range(notifications)))
+    return notifications / (time.monotonic() - t0), sum(latencies) / len(latencies), max(latencies)
+
+
+def main():
+    notifications = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    logging.getLogger('tattler').setLevel(logging.WARNING)
+    logging.getLogger('sendable').setLevel(logging.WARNING)
+    os.environ['TATTLER_CAPTURE'] = 'memory'
+    os.environ.setdefault('TATTLER_BULKSMS_TOKEN', 'benchmark:secret')
+    print(f"Capturing {notifications} notifications per vector from {threads} threads.")
+    print(f"{'vector':>8} {'notif/s':>10} {'avg ms':>8} {'max ms':>8}")
+    for vector, recipient in [('email', 'foo@bar.com'), ('sms', '+41791234567')]:
+        rate, avg, worst = run(vector, recipient, notifications, threads)
+        print(f"{vector:>8} {rate:10.1f} {avg * 1000:8.2f} {worst * 1000:8.2f}")
+    print(f"Captured {len(capture.get_capture())} notifications (latest kept).")
+
+
+if __name__ == '__main__':
+    main()
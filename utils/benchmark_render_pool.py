@@ -0,0 +1,59 @@
+#! python
+
+"""Benchmark template expansion throughput in-process vs. in a pool of worker processes.
+
+Expands a heavy HTML template -- a loop over a large table -- from many concurrent threads,
+first in-process, then with RenderPool using 1, 2, 4 ... processes up to the number of cores.
+
+Usage: python benchmark_render_pool.py [rows] [renders]
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tattler.server.sendable.render_pool import RenderPool
+from tattler.server.templateprocessor_jinja import JinjaTemplateProcessor
+
+template = """<html><body><h1>Report for {{ user_firstname }}</h1><table>
+{% for row in rows %}<tr>{% for cell in row %}<td style="padding: 4px">{{ cell | upper }}</td>{% endfor %}</tr>
+{% endfor %}</table></body></html>"""
+
+
+def run(pool, context, renders: int, threads: int) -> float:
+    """Expand the template 'renders' times from 'threads' threads, and return the renders per second."""
+    def render_one(_):
+        tpj = JinjaTemplateProcessor(template, template_name='benchmark/report/email/body.html')
+        if pool is None:
+            return tpj.expand(context)
+        return pool.expand(tpj, context)
+    # warm up caches and timing stats
+    render_one(0)
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as tpe:
+        for _ in tpe.map(render_one, range(renders)):
+            pass
+    return renders / (time.monotonic() - t0)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    renders = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    context = {'user_firstname': 'Jim', 'rows': [[f'cell {r}:{c}' for c in range(8)] for r in range(rows)]}
+    cores = os.cpu_count() or 1
+    print(f"Expanding {renders} times a template with {rows} rows, on {cores} cores.")
+    print(f"{'processes':>10} {'renders/s':>12}")
+    print(f"{'in-process':>10} {run(None, context, renders, cores):12.1f}")
+    nprocs = 1
+    while nprocs <= cores:
+        pool = RenderPool(nprocs, threshold_s=0.0)
+        try:
+            print(f"{nprocs:>10} {run(pool, context, renders, nprocs * 2):12.1f}")
+        finally:
+            pool.shutdown()
+        nprocs *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#! python
+
+"""Benchmark SMS delivery throughput against the local BulkSMS simulator.
+
+Starts tattler_sms_simulator in-process with the given API latency, then delivers the same
+SMS many times from concurrent threads through SMSSendable, first submitting each notification
+on its own, then micro-batched with TATTLER_SMS_BATCH_WINDOW.
+
+This measures applications delivering through the sendable API from several threads. tattlersrv_http
+serves one request at a time, so it never submits concurrently and batching does not apply to it.
+
+Usage: python benchmark_sms.py [messages] [threads] [latency_s]
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tattler.server import tattler_sms_simulator
+from tattler.server.sendable.vector_sms import SMSSendable
+
+template_base = Path(__file__).parent.parent / 'src' / 'tattler' / 'server' / 'sendable' / 'tests' / 'fixtures' / 'templates'
+
+
+def run(messages: int, threads: int, simulator: tattler_sms_simulator.SMSSimulator) -> tuple:
+    """Deliver 'messages' SMS from 'threads' threads, and return (messages per second, API calls made)."""
+    def send_one(i):
+        SMSSendable('event_with_email_and_sms', [f'+4179{i:07d}'], template_base=template_base).send(context={'one': '1'})
+    send_one(0)
+    submissions = simulator.stats.submissions
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as tpe:
+        for _ in tpe.map(send_one, range(messages)):
+            pass
+    return messages / (time.monotonic() - t0), simulator.stats.submissions - submissions
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    logging.getLogger('tattler').setLevel(logging.WARNING)
+    logging.getLogger('bulksms').setLevel(logging.WARNING)
+    args = tattler_sms_simulator.parse_args(['--listen', '127.0.0.1:0', '--latency', str(latency)])
+    simulator = tattler_sms_simulator.make_simulator(args)
+    threading.Thread(target=simulator.serve_forever, daemon=True).start()
+    os.environ['TATTLER_BULKSMS_URL'] = f'http://127.0.0.1:{simulator.server_address[1]}/v1'
+    os.environ['TATTLER_BULKSMS_TOKEN'] = 'benchmark:secret'
+    os.environ['TATTLER_SMS_REPORT_INTERVAL'] = '0'
+    print(f"Delivering {messages} SMS from {threads} threads to simulator at {os.environ['TATTLER_BULKSMS_URL']} with {latency}s latency.")
+    print(f"{'batch window':>12} {'messages/s':>12} {'API calls':>10}")
+    for window in ['0', '0.01', '0.05']:
+        os.environ['TATTLER_SMS_BATCH_WINDOW'] = window
+        rate, calls = run(messages, threads, simulator)
+        print(f"{window:>12} {rate:12.1f} {calls:10d}")
+    simulator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#! python
+
+"""Benchmark bytes on the wire and send time of emails by SMTP extensions supported by the relay.
+
+Starts tattler_smtp_sink in-process, advertising a given set of extensions, counting the bytes
+it receives and discarding messages, then delivers representative non-ASCII templates through
+EmailSendable: to a plain relay (base64/quoted-printable bodies), to a relay with 8BITMIME,
+and to a relay with 8BITMIME, SMTPUTF8 and CHUNKING (BDAT).
+
+Usage: python benchmark_smtp_encoding.py [messages]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from tattler.server import tattler_smtp_sink
+from tattler.server.sendable.vector_email import EmailSendable
+
+templates = {
+    'german': ('Ihre Bestellung bei Müller & Söhne',
+               '<p>Sehr geehrte Frau Müller,</p>\n<p>vielen Dank für Ihre Bestellung. Die Ware wird in Kürze versandt. Grüße aus München!</p>\n' * 30),
+    'japanese': ('ご注文ありがとうございます',
+                 '<p>山田様</p>\n<p>このたびはご注文いただき、誠にありがとうございます。商品は近日中に発送いたします。</p>\n' * 30),
+    'english': ('Your order',
+                '<p>Dear Ms Miller,</p>\n<p>thank you for your order. The goods will ship shortly. Greetings from London!</p>\n' * 30),
+}
+
+configurations = {
+    'plain': [],
+    '8bitmime': ['8BITMIME'],
+    '8bit+chunking': ['8BITMIME', 'SMTPUTF8', 'CHUNKING'],
+}
+
+
+def make_template_base(root: Path) -> Path:
+    """Write one email template per entry of 'templates' under root, and return root."""
+    for name, (subject, html) in templates.items():
+        path = root / name / 'email'
+        path.mkdir(parents=True)
+        (path / 'subject.txt').write_text(subject, encoding='utf-8')
+        (path / 'body.html').write_text(f'<html><body>{html}</body></html>', encoding='utf-8')
+        (path / 'body.txt').write_text(html.replace('<p>', '').replace('</p>', ''), encoding='utf-8')
+    return root
+
+
+def run(sink: tattler_smtp_sink.SMTPSink, template_base: Path, event: str, messages: int):
+    """Deliver 'messages' emails for 'event', and return (bytes per message, milliseconds per message)."""
+    sink.stats = tattler_smtp_sink.SinkStats()
+    t0 = time.monotonic()
+    for _ in range(messages):
+        EmailSendable(event, ['foo@bar.com'], template_base=template_base).send()
+    elapsed = time.monotonic() - t0
+    return sink.stats.bytes_received / messages, 1000 * elapsed / messages
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    logging.getLogger('tattler').setLevel(logging.WARNING)
+    sink = tattler_smtp_sink.SMTPSink(('127.0.0.1', 0))
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    os.environ['TATTLER_SMTP_ADDRESS'] = f'127.0.0.1:{sink.server_address[1]}'
+    print(f"Delivering {messages} emails per template and relay configuration to SMTP sink at {os.environ['TATTLER_SMTP_ADDRESS']}.")
+    print(f"{'template':>10} {'relay':>14} {'bytes/msg':>10} {'ms/msg':>8}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        template_base = make_template_base(Path(tmpdir))
+        for event in templates:
+            for config, extensions in configurations.items():
+                sink.settings.extensions = ['PIPELINING'] + extensions
+                size, ms = run(sink, template_base, event, messages)
+                print(f"{event:>10} {config:>14} {size:10.0f} {ms:8.2f}")
+    sink.shutdown()
+
+
+if __name__ == '__main__':
+    main()
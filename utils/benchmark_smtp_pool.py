@@ -0,0 +1,63 @@
+#! python
+
+"""Benchmark email delivery throughput with and without pooled SMTP connections.
+
+Starts tattler_smtp_sink in-process, accepting messages after the given latency and
+discarding them, then delivers the same message many times from concurrent threads
+through EmailSendable, first opening a connection per message, then with
+TATTLER_SMTP_POOL_SIZE set, then with the asynchronous engine (TATTLER_SMTP_ASYNC_CONCURRENCY).
+
+Usage: python benchmark_smtp_pool.py [messages] [threads] [latency_s]
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tattler.server import tattler_smtp_sink
+from tattler.server.sendable import smtp_async, smtp_pool
+from tattler.server.sendable.vector_email import EmailSendable
+
+template_base = Path(__file__).parent.parent / 'src' / 'tattler' / 'server' / 'sendable' / 'tests' / 'fixtures' / 'templates_with_base'
+
+
+def run(messages: int, threads: int) -> float:
+    """Deliver 'messages' emails from 'threads' threads, and return the messages per second."""
+    def send_one(_):
+        EmailSendable('event1', ['foo@bar.com'], template_base=template_base).send()
+    send_one(0)
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as tpe:
+        for _ in tpe.map(send_one, range(messages)):
+            pass
+    return messages / (time.monotonic() - t0)
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    logging.getLogger('tattler').setLevel(logging.WARNING)
+    sink = tattler_smtp_sink.SMTPSink(('127.0.0.1', 0), tattler_smtp_sink.SinkSettings(extensions=['PIPELINING'], latency_s=latency))
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    os.environ['TATTLER_SMTP_ADDRESS'] = f'127.0.0.1:{sink.server_address[1]}'
+    print(f"Delivering {messages} emails from {threads} threads to SMTP sink at {os.environ['TATTLER_SMTP_ADDRESS']} with {latency}s latency.")
+    print(f"{'pool size':>10} {'messages/s':>12}")
+    os.environ.pop('TATTLER_SMTP_POOL_SIZE', None)
+    print(f"{'none':>10} {run(messages, threads):12.1f}")
+    os.environ['TATTLER_SMTP_POOL_SIZE'] = str(threads)
+    print(f"{threads:>10} {run(messages, threads):12.1f}")
+    os.environ.pop('TATTLER_SMTP_POOL_SIZE')
+    os.environ['TATTLER_SMTP_ASYNC_CONCURRENCY'] = str(threads)
+    print(f"{'async ' + str(threads):>10} {run(messages, threads):12.1f}")
+    smtp_pool.close_all()
+    smtp_async.get_engine().close()
+    sink.shutdown()
+
+
+if __name__ == '__main__':
+    main()